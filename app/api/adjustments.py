@@ -12,6 +12,7 @@ from app import schemas, security
 from app.security import TokenData
 from app.services.adjustment_service import AdjustmentService
 from app.exceptions import ValidationError, NotFoundError, ErrorCodes
+from app import jobs
 import traceback
 import asyncio
 
@@ -109,15 +110,54 @@ async def export_adjustments_csv(auth: AuthDependency, company_id: int = Query(.
         raise HTTPException(500, f"Error exportando: {e}")
 
 
+ADJUSTMENTS_IMPORT_JOB = "adjustments.import_csv"
+
+
+def _run_adjustments_import(content: bytes, company_id: int, user_name: str) -> int:
+    """Parseo + validación (AdjustmentService) e importación. Síncrona (hilo o worker de trabajos)."""
+    # 1. Parsear CSV usando el servicio
+    rows, headers = AdjustmentService.parse_adjustment_csv(content)
+
+    # 2. Validar headers usando el servicio
+    AdjustmentService.validate_adjustment_csv_headers(headers)
+
+    # 3. Normalizar filas
+    normalized_rows = [
+        AdjustmentService.normalize_csv_row(row)
+        for row in rows
+    ]
+
+    if not normalized_rows:
+        raise ValidationError(
+            "Archivo vacío",
+            ErrorCodes.CSV_EMPTY_FILE
+        )
+
+    # 4. Ejecutar importación en el repositorio
+    return db.import_smart_adjustments_transaction(company_id, user_name, normalized_rows)
+
+
+@jobs.job_handler(ADJUSTMENTS_IMPORT_JOB)
+def _adjustments_import_job(ctx):
+    ctx.progress(5, "Leyendo archivo...", force=True)
+    with open(ctx.input_file, "rb") as f:
+        content = f.read()
+    ctx.progress(10, "Importando ajustes...", force=True)
+    count = _run_adjustments_import(content, ctx.company_id, ctx.user)
+    return {"created": count, "message": f"Se crearon {count} documentos de ajuste correctamente."}
+
+
 @router.post("/import/csv", status_code=201)
 async def import_adjustments_csv(
     auth: AuthDependency,
     company_id: int = Query(...),
-    file: UploadFile = File(...)
+    file: UploadFile = File(...),
+    async_mode: bool = Query(False)
 ):
     """
     Importa ajustes masivos desde CSV.
     Usa AdjustmentService para parsear y validar el CSV.
+    Con async_mode=true se encola como trabajo y se responde con su job_id.
     """
     if "adjustments.can_create" not in auth.permissions:
         raise HTTPException(403, "No autorizado")
@@ -126,31 +166,13 @@ async def import_adjustments_csv(
         # 1. Leer contenido del archivo
         content = await file.read()
 
-        # 2. Parsear CSV usando el servicio
-        rows, headers = AdjustmentService.parse_adjustment_csv(content)
-
-        # 3. Validar headers usando el servicio
-        AdjustmentService.validate_adjustment_csv_headers(headers)
-
-        # 4. Normalizar filas
-        normalized_rows = [
-            AdjustmentService.normalize_csv_row(row)
-            for row in rows
-        ]
-
-        if not normalized_rows:
-            raise ValidationError(
-                "Archivo vacío",
-                ErrorCodes.CSV_EMPTY_FILE
+        if async_mode:
+            return await jobs.submit_job_async(
+                company_id, ADJUSTMENTS_IMPORT_JOB, {}, auth.username, input_bytes=content
             )
 
-        # 5. Ejecutar importación en el repositorio
-        count = await asyncio.to_thread(
-            db.import_smart_adjustments_transaction,
-            company_id,
-            auth.username,
-            normalized_rows
-        )
+        # 2. Parsear, validar e importar fuera del event loop
+        count = await asyncio.to_thread(_run_adjustments_import, content, company_id, auth.username)
 
         return {"message": f"Se crearon {count} documentos de ajuste correctamente."}
 
@@ -72,10 +72,9 @@ async def create_user(user: schemas.UserCreate, auth: AuthDependency):
             warehouse_ids=user.warehouse_ids
         )
 
-        # Recargar usuario para devolverlo completo
-        user_raw = await asyncio.to_thread(db.get_users_for_admin)
-        new_user = next((u for u in user_raw if u['id'] == new_user_id), None)
-        return AdminService.build_user_response(dict(new_user))
+        # Recargar solo el usuario creado para devolverlo completo
+        new_user = await asyncio.to_thread(db.get_user_for_admin, new_user_id)
+        return AdminService.build_user_response(new_user)
 
     except ValidationError as ve:
         raise HTTPException(status_code=400, detail=ve.message)
@@ -110,9 +109,8 @@ async def update_user(user_id: int, user: schemas.UserUpdate, auth: AuthDependen
             warehouse_ids=user.warehouse_ids
         )
 
-        # Recargar usuario
-        user_raw = await asyncio.to_thread(db.get_users_for_admin)
-        updated_user = next((u for u in user_raw if u['id'] == user_id), None)
+        # Recargar solo el usuario editado
+        updated_user = await asyncio.to_thread(db.get_user_for_admin, user_id)
 
         if not updated_user:
             raise HTTPException(
@@ -120,7 +118,7 @@ async def update_user(user_id: int, user: schemas.UserUpdate, auth: AuthDependen
                 detail="Usuario no encontrado después de actualizar"
             )
 
-        return AdminService.build_user_response(dict(updated_user))
+        return AdminService.build_user_response(updated_user)
 
     except ValidationError as ve:
         raise HTTPException(status_code=400, detail=ve.message)
@@ -442,3 +440,26 @@ async def delete_company(company_id: int, auth: AuthDependency):
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error interno: {e}")
+
+
+# ==========================================
+# --- Caché de Datos de Referencia ---
+# ==========================================
+
+@router.get("/reference-cache", dependencies=[Depends(check_admin_permission)])
+async def get_reference_cache_stats():
+    """Aciertos/fallos/invalidaciones por tipo de dato de referencia (este proceso)."""
+    return db.reference_cache_stats()
+
+
+@router.delete("/reference-cache", dependencies=[Depends(check_admin_permission)])
+async def clear_reference_cache():
+    """Vacía la caché de referencia (este proceso y, vía NOTIFY, los demás workers)."""
+    db.invalidate_reference()
+    return {"message": "Caché de referencia vaciada."}
+
+
+@router.get("/password-pool", dependencies=[Depends(check_admin_permission)])
+async def get_password_pool_stats():
+    """Cola y tiempos del pool de hashing de contraseñas (este proceso)."""
+    return security.password_pool_stats()
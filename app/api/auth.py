@@ -13,6 +13,7 @@ from app.security import TokenData
 from app.schemas import TokenResponse, PasswordChangeRequest
 from app.services.auth_service import AuthService
 from app.exceptions import ValidationError, PermissionDeniedError
+import asyncio
 
 router = APIRouter()
 
@@ -27,8 +28,8 @@ async def login_for_access_token(
     Endpoint de login. Genera el token JWT e informa si se requiere cambio de contraseña.
     Usa AuthService para validación y generación de tokens.
     """
-    # 1. Validar credenciales (el repositorio verifica usuario/contraseña)
-    user_data, permissions_set = db.validate_user_and_get_permissions(
+    # 1. Validar credenciales (bcrypt en el pool de hashing, no en el event loop)
+    user_data, permissions_set = await security.authenticate_user(
         form_data.username, form_data.password
     )
 
@@ -49,7 +50,7 @@ async def login_for_access_token(
         )
 
     # 3. Obtener compañías del usuario
-    allowed_companies = db.get_user_companies(user_data['id'])
+    allowed_companies = await asyncio.to_thread(db.get_user_companies, user_data['id'])
     company_ids = [c['id'] for c in allowed_companies]
 
     # 4. Construir payload del token (usando el servicio)
@@ -98,7 +99,7 @@ async def change_password(
         raise HTTPException(status_code=400, detail=e.message)
 
     # 2. Validar la contraseña actual
-    user_data, _ = db.validate_user_and_get_permissions(
+    user_data, _ = await security.authenticate_user(
         current_user.username,
         payload.old_password
     )
@@ -115,9 +116,10 @@ async def change_password(
             detail="La nueva contraseña debe ser diferente a la actual."
         )
 
-    # 4. Cambiar la contraseña en BD
+    # 4. Cambiar la contraseña en BD (bcrypt en el pool de hashing)
+    new_hash = await security.hash_password_async(payload.new_password)
     try:
-        db.change_own_password(current_user.user_id, payload.new_password)
+        await asyncio.to_thread(db.set_own_password_hash, current_user.user_id, new_hash)
         return {"message": "Contraseña actualizada correctamente"}
     except Exception as e:
         raise HTTPException(
@@ -0,0 +1,85 @@
+# app/api/jobs.py
+"""
+Seguimiento de trabajos en segundo plano (ver app/jobs/runner.py).
+Los trabajos se crean desde los endpoints que aceptan async_mode=true
+(p.ej. /pickings/import/csv, /adjustments/import/csv, /reports/kardex-export/csv).
+"""
+
+from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi.responses import FileResponse
+from typing import List, Annotated
+from app import database as db
+from app import security
+from app.security import TokenData, verify_company_access
+import os
+import asyncio
+
+router = APIRouter()
+AuthDependency = Annotated[TokenData, Depends(security.get_current_user_data)]
+
+
+def _is_admin(auth: TokenData) -> bool:
+    return auth.role_name == "Administrador"
+
+
+async def _get_own_job(auth: TokenData, job_id: int, fetch=None):
+    """Trae el trabajo validando compañía y dueño (el Administrador ve todos)."""
+    job = await asyncio.to_thread(fetch or db.get_job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado.")
+    verify_company_access(auth, job['company_id'])
+    if job['created_by'] != auth.username and not _is_admin(auth):
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado.")
+    return job
+
+
+@router.get("/", response_model=List[dict])
+async def list_jobs(
+    auth: AuthDependency,
+    company_id: int = Query(...),
+    limit: int = Query(50, ge=1, le=200)
+):
+    """Trabajos recientes del usuario (todos los de la compañía para el Administrador)."""
+    verify_company_access(auth, company_id)
+    created_by = None if _is_admin(auth) else auth.username
+    jobs = await asyncio.to_thread(db.get_jobs, company_id, created_by, limit)
+    return [dict(j) for j in jobs]
+
+
+@router.get("/{job_id}", response_model=dict)
+async def get_job_status(auth: AuthDependency, job_id: int):
+    """Estado, avance y resultado de un trabajo (para polling)."""
+    job = await _get_own_job(auth, job_id)
+    data = dict(job)
+    if data['status'] == 'done' and data.pop('has_result_file'):
+        data['result_url'] = f"/jobs/{job_id}/result"
+    else:
+        data.pop('has_result_file', None)
+    return data
+
+
+@router.post("/{job_id}/cancel", response_model=dict)
+async def cancel_job(auth: AuthDependency, job_id: int):
+    """
+    Cancela un trabajo. En cola: se cancela de inmediato. En curso: se detiene
+    en su próximo reporte de avance (la transacción final de una importación,
+    una vez iniciada, no se interrumpe).
+    """
+    job = await _get_own_job(auth, job_id)
+    if job['status'] not in ('queued', 'running'):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"El trabajo ya está '{job['status']}'.")
+    new_status = await asyncio.to_thread(db.request_job_cancel, job_id, job['company_id'])
+    return {"job_id": job_id, "status": new_status, "cancel_requested": new_status == 'running'}
+
+
+@router.get("/{job_id}/result")
+async def download_job_result(auth: AuthDependency, job_id: int):
+    """Descarga el archivo generado por el trabajo (mientras no venza)."""
+    job = await _get_own_job(auth, job_id, fetch=db.get_job_result_file)
+    if job['status'] != 'done':
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"El trabajo está '{job['status']}'.")
+    if not job['result_file']:
+        raise HTTPException(status_code=404, detail="El trabajo no generó archivo.")
+    if not os.path.exists(job['result_file']):
+        raise HTTPException(status_code=status.HTTP_410_GONE, detail="El archivo de resultado venció o ya no está disponible.")
+    return FileResponse(job['result_file'], filename=job['result_filename'], media_type="text/csv")
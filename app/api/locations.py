@@ -1,25 +1,31 @@
 # app/api/locations.py
 from fastapi import APIRouter, Depends, HTTPException, status, Query, UploadFile, File
-from typing import List, Annotated, Optional, Dict
+from typing import List, Annotated, Optional, Dict, Union
 from pydantic import BaseModel
 from datetime import date
 from app import database as db
 from app import schemas, security
 from app.security import TokenData
 from app.services.location_service import LocationService
+from app.services.import_service import ImportService
 from app.exceptions import ValidationError, NotFoundError
 import traceback
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response
+import asyncio
 
 router = APIRouter()
 AuthDependency = Annotated[TokenData, Depends(security.get_current_user_data)]
 
-@router.get("/", response_model=List[schemas.LocationResponse])
+@router.get("/", response_model=Union[List[schemas.LocationResponse], schemas.Page[schemas.LocationResponse]])
 async def get_all_locations(
     auth: AuthDependency,
+    response: Response,
     company_id: int = Query(...),
     skip: int = 0,
     limit: int = 100,
+    cursor: Optional[str] = Query(None),  # Keyset: "" = primera página
+    with_total: bool = Query(False),
+    with_count: bool = Query(False),  # {items, total, next_cursor} en una sola consulta
     
     # --- ¡PARÁMETROS DE FILTRO Y ORDEN AÑADIDOS! ---
     sort_by: Optional[str] = Query(None),
@@ -43,6 +49,24 @@ async def get_all_locations(
         warehouse_status=warehouse_status
     )
 
+    if cursor is not None:
+        try:
+            page = await asyncio.to_thread(
+                db.get_locations_filtered_sorted, company_id, filters=clean_filters,
+                sort_by=sort_by, ascending=ascending, limit=limit, cursor=cursor,
+                with_total=with_total, with_count=with_count
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        response.headers.update(db.keyset_response_headers(page))
+        return page if with_count else page["items"]
+
+    if with_count:
+        return await asyncio.to_thread(
+            db.get_locations_filtered_sorted, company_id, filters=clean_filters,
+            sort_by=sort_by, ascending=ascending, limit=limit, offset=skip, with_count=True
+        )
+
     locations_raw = db.get_locations_filtered_sorted(
         company_id, 
         filters=clean_filters, 
@@ -240,57 +264,24 @@ async def import_locations_csv(
     LocationService.validate_csv_headers(headers)
 
     # 3. Cargar almacenes de BD para mapeos
-    warehouses_db = db.get_warehouses_simple(company_id)
+    warehouses_db = await asyncio.to_thread(db.get_warehouses_simple, company_id)
     warehouse_map = {wh['name'].upper(): wh['id'] for wh in warehouses_db}
     warehouse_code_map = {wh['id']: wh['code'] for wh in warehouses_db}
 
-    # 4. Procesar filas
-    created, updated = 0, 0
-    error_list = []
-
-    for i, row in enumerate(rows):
-        row_num = i + 2
-        name = row.get('name', '').strip()
-        type_str = row.get('type', '').strip()
-
-        if not name and not type_str:
-            continue  # Saltar filas vacías
+    # 4. Validar y normalizar TODAS las filas (se saltan las vacías)
+    prepared, error_list = ImportService.process_csv_rows(
+        rows, LocationService.process_csv_row, warehouse_map, warehouse_code_map,
+        row_label=lambda row: f"'{row.get('name', '').strip()}'",
+        skip_row=lambda row: not row.get('name', '').strip() and not row.get('type', '').strip()
+    )
 
+    # 5. Upsert por path en una sola transacción
+    created, updated = 0, 0
+    if not error_list:
         try:
-            # Usar LocationService para procesar y normalizar la fila
-            prepared = LocationService.process_csv_row(
-                row, row_num, warehouse_map, warehouse_code_map
-            )
-
-            # Upsert
-            existing_loc = db.get_location_by_path(company_id, prepared["path"])
-
-            if existing_loc:
-                db.update_location(
-                    existing_loc['id'],
-                    company_id,
-                    name=prepared["name"],
-                    path=prepared["path"],
-                    type=prepared["type"],
-                    category=prepared["category"],
-                    warehouse_id=prepared["warehouse_id"]
-                )
-                updated += 1
-            else:
-                db.create_location(
-                    company_id,
-                    name=prepared["name"],
-                    path=prepared["path"],
-                    type=prepared["type"],
-                    category=prepared["category"],
-                    warehouse_id=prepared["warehouse_id"]
-                )
-                created += 1
-
-        except ValidationError as ve:
-            error_list.append(ve.message)
+            created, updated = await asyncio.to_thread(db.upsert_locations_from_import, company_id, prepared)
         except Exception as e:
-            error_list.append(f"Fila {row_num} ('{name}'): {e}")
+            error_list.append(str(e))
 
     if error_list:
         raise ValidationError(
@@ -1,25 +1,31 @@
 # app/api/partners.py
 from fastapi import APIRouter, Depends, HTTPException, status, Query, UploadFile, File
-from typing import List, Annotated, Optional
+from typing import List, Annotated, Optional, Union
 from app import database as db
 from app import schemas, security
 from app.security import TokenData
 from app.services.partner_service import PartnerService
+from app.services.import_service import ImportService
 from app.exceptions import ValidationError, DuplicateError, NotFoundError
 import traceback
-from fastapi.responses import StreamingResponse
+import asyncio
+from fastapi.responses import StreamingResponse, Response
 
 router = APIRouter()
 AuthDependency = Annotated[TokenData, Depends(security.get_current_user_data)]
 
-@router.get("/", response_model=List[schemas.PartnerResponse])
+@router.get("/", response_model=Union[List[schemas.PartnerResponse], schemas.Page[schemas.PartnerResponse]])
 async def get_all_partners(
     auth: AuthDependency,
+    response: Response,
     company_id: int = Query(...),
     skip: int = 0,
     limit: int = 100,
     sort_by: Optional[str] = Query(None),
     ascending: bool = Query(True),
+    cursor: Optional[str] = Query(None),  # Keyset: "" = primera página
+    with_total: bool = Query(False),
+    with_count: bool = Query(False),  # {items, total, next_cursor} en una sola consulta
     name: Optional[str] = Query(None),
     ruc: Optional[str] = Query(None),
     social_reason: Optional[str] = Query(None),
@@ -39,6 +45,24 @@ async def get_all_partners(
         category_name=category_name
     )
 
+    if cursor is not None:
+        try:
+            page = await asyncio.to_thread(
+                db.get_partners_filtered_sorted, company_id, filters=clean_filters,
+                sort_by=sort_by, ascending=ascending, limit=limit, cursor=cursor,
+                with_total=with_total, with_count=with_count
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        response.headers.update(db.keyset_response_headers(page))
+        return page if with_count else page["items"]
+
+    if with_count:
+        return await asyncio.to_thread(
+            db.get_partners_filtered_sorted, company_id, filters=clean_filters,
+            sort_by=sort_by, ascending=ascending, limit=limit, offset=skip, with_count=True
+        )
+
     partners_raw = db.get_partners_filtered_sorted(
         company_id,
         filters=clean_filters,
@@ -237,43 +261,22 @@ async def import_partners_csv(
     PartnerService.validate_csv_headers(headers)
 
     # 3. Cargar categorías de BD y validar referencias
-    db_categories = db.get_partner_categories(company_id)
+    db_categories = await asyncio.to_thread(db.get_partner_categories, company_id)
     valid_category_names = {cat['name'] for cat in db_categories}
     PartnerService.validate_csv_categories(rows, valid_category_names)
 
     # 4. Crear mapeo de categorías
     cat_map = {cat['name']: cat['id'] for cat in db_categories}
 
-    # 5. Procesar filas
-    created, updated = 0, 0
-    error_list = []
+    # 5. Validar y normalizar TODAS las filas, luego una sola transacción
+    prepared, error_list = ImportService.process_csv_rows(rows, PartnerService.process_csv_row, cat_map)
 
-    for i, row in enumerate(rows):
-        row_num = i + 2
+    created, updated = 0, 0
+    if not error_list:
         try:
-            # Usar PartnerService para procesar y normalizar la fila
-            prepared = PartnerService.process_csv_row(row, row_num, cat_map)
-
-            result = db.upsert_partner_from_import(
-                company_id=company_id,
-                name=prepared["name"],
-                category_id=prepared["category_id"],
-                ruc=prepared["ruc"],
-                social_reason=prepared["social_reason"],
-                address=prepared["address"],
-                email=prepared["email"],
-                phone=prepared["phone"]
-            )
-
-            if result == "created":
-                created += 1
-            elif result == "updated":
-                updated += 1
-
-        except ValidationError as ve:
-            error_list.append(ve.message)
+            created, updated = await asyncio.to_thread(db.upsert_partners_from_import, company_id, prepared)
         except Exception as e:
-            error_list.append(f"Fila {row_num}: {e}")
+            error_list.append(str(e))
 
     if error_list:
         raise ValidationError(
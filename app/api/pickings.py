@@ -1,6 +1,6 @@
 # app/api/pickings.py
 from fastapi import APIRouter, Depends, HTTPException, status, Query, UploadFile, File
-from typing import List, Annotated, Optional, Dict
+from typing import List, Annotated, Optional, Dict, Union
 from pydantic import BaseModel
 from datetime import date, datetime
 from app import database as db
@@ -14,7 +14,10 @@ import asyncio
 from collections import defaultdict
 from app.security import TokenData, verify_company_access
 from app.services.picking_service import PickingService
+from app.services.report_service import ReportService
 from app.exceptions import ValidationError, BusinessRuleError, NotFoundError
+from app import jobs
+from app.streaming import CsvStreamingResponse
 
 # Matriz de Validación de Importación: { "Nombre Operación": (Categorías Origen, Categorías Destino) }
 IMPORT_LOGIC_RULES = {
@@ -133,10 +136,14 @@ def _build_picking_filters(type_code: str, filters_in: dict):
 
 # --- 1. Endpoints Fijos / Listas (Primero) ---
 
-@router.get("/", response_model=List[dict])
+@router.get("/", response_model=Union[List[dict], schemas.Page[dict]])
 async def get_all_pickings(
-    auth: AuthDependency, type_code: str, company_id: int = Query(...), skip: int = 0, limit: int = 25,
+    auth: AuthDependency, response: Response, type_code: str, company_id: int = Query(...), skip: int = 0, limit: int = 25,
     sort_by: Optional[str] = Query(None), ascending: bool = Query(False),
+    # Paginación por cursor (keyset): cursor="" pide la primera página
+    cursor: Optional[str] = Query(None), with_total: bool = Query(False),
+    # with_count=true: responde {items, total, next_cursor} (evita la llamada a /count)
+    with_count: bool = Query(False),
     # Filtros alineados con COLUMN_DEFINITIONS del frontend
     name: Optional[str] = Query(None), project_name: Optional[str] = Query(None), purchase_order: Optional[str] = Query(None),
     src_path_display: Optional[str] = Query(None), dest_path_display: Optional[str] = Query(None),
@@ -153,11 +160,29 @@ async def get_all_pickings(
     filters_dict = locals()
     clean_filters = _build_picking_filters(type_code, filters_dict)
     try:
+        if cursor is not None:
+            page = await asyncio.to_thread(
+                db.get_pickings_by_type, picking_type_code=type_code, company_id=company_id,
+                filters=clean_filters, sort_by=sort_by or 'id', ascending=ascending, limit=limit,
+                cursor=cursor, with_total=with_total, with_count=with_count
+            )
+            response.headers.update(db.keyset_response_headers(page))
+            return page if with_count else page["items"]
+
+        if with_count:
+            return await asyncio.to_thread(
+                db.get_pickings_by_type, picking_type_code=type_code, company_id=company_id,
+                filters=clean_filters, sort_by=sort_by or 'id', ascending=ascending, limit=limit, offset=skip,
+                with_count=True
+            )
+
         pickings_raw = db.get_pickings_by_type(
             picking_type_code=type_code, company_id=company_id, filters=clean_filters,
             sort_by=sort_by or 'id', ascending=ascending, limit=limit, offset=skip
         )
         return [dict(p) for p in pickings_raw]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error al obtener pickings: {e}")
@@ -283,21 +308,7 @@ async def export_pickings_csv(
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No autorizado")
 
     try:
-        # 1. Obtener los datos (PASANDO selected_ids)
-        # Nota: Tienes que asegurarte de que tu función db.get_data_for_export acepte este argumento también.
-        data_to_export = await asyncio.to_thread(
-            db.get_data_for_export, 
-            company_id, 
-            export_type, 
-            selected_ids # <--- 2. PASAMOS LA LISTA AL REPO
-        )
-        
-        if not data_to_export:
-            # Si se seleccionaron IDs pero no se encontraron (raro, tal vez borrados), devolvemos error
-            detail_msg = "No se encontraron registros para los IDs seleccionados." if selected_ids else "No hay datos para exportar con los filtros actuales."
-            raise HTTPException(status_code=404, detail=detail_msg)
-
-        # 2. Definir las cabeceras (la misma lógica que tenías en Flet)
+        # 1. Definir las cabeceras (la misma lógica que tenías en Flet)
         headers = []
         if export_type == 'headers':
             headers = [
@@ -324,84 +335,156 @@ async def export_pickings_csv(
                 'warehouse_observations',
                 'product_sku', 'product_name', 'quantity', 'price_unit', 'serial'
             ]
-        
-        # 3. Crear el CSV en memoria
-        output = io.StringIO(newline='')
-        writer = csv.DictWriter(output, fieldnames=headers, delimiter=';', extrasaction='ignore')
-        
-        writer.writeheader()
-        writer.writerows(data_to_export) # Escribir todas las filas
 
-        output.seek(0)
-        
-        # 4. Devolver el archivo
+        # 2. Cursor de servidor (PASANDO selected_ids): las filas se leen a medida que se envían
+        rows = db.get_data_for_export(company_id, export_type, selected_ids, stream=True)
+
+        # Si se seleccionaron IDs pero no se encontraron (raro, tal vez borrados), devolvemos error
+        detail_msg = "No se encontraron registros para los IDs seleccionados." if selected_ids else "No hay datos para exportar con los filtros actuales."
+
+        try:
+            # La primera lectura ejecuta la consulta (en un hilo) y detecta el caso vacío
+            chunks = await asyncio.to_thread(
+                ReportService.open_csv_stream, rows, headers, None, detail_msg
+            )
+        except NotFoundError as e:
+            raise HTTPException(status_code=404, detail=e.message)
+
+        # 3. Devolver el archivo por bloques (se cierra el cursor al terminar o si el cliente se desconecta)
         filename = f"operaciones_{export_type}.csv"
-        return StreamingResponse(
-            iter([output.getvalue()]),
-            media_type="text/csv",
-            headers={"Content-Disposition": f"attachment; filename={filename}"}
-        )
+        return CsvStreamingResponse(chunks, filename)
         
+    except HTTPException:
+        raise
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error al generar CSV: {e}")
 
+PICKINGS_IMPORT_JOB = "pickings.import_csv"
+
+
+def _read_pickings_csv(binary_file):
+    """
+    [STREAMING] Lee el CSV subido directamente (sin decodificar todo a un string).
+    Retorna (headers normalizados, filas normalizadas).
+    """
+    binary_file.seek(0)
+    file_io = io.TextIOWrapper(binary_file, encoding='utf-8-sig', newline='')
+    try:
+        sample = file_io.read(2048)
+
+        sniffer = csv.Sniffer()
+        try: dialect = sniffer.sniff(sample, delimiters=';,')
+        except csv.Error: dialect = csv.excel; dialect.delimiter = ';'
+
+        file_io.seek(0)
+        reader = csv.DictReader(file_io, dialect=dialect)
+
+        headers_csv = [h.lower().strip() for h in reader.fieldnames or []]
+        rows_to_process = [{k.lower().strip() if k else k : v.strip() if v else v for k, v in row_raw.items()} for row_raw in reader]
+    finally:
+        file_io.detach()  # No cerrar el archivo subido al soltar el wrapper
+
+    if not rows_to_process: raise ValueError("El archivo CSV está vacío.")
+    return headers_csv, rows_to_process
+
+
 @router.post("/import/csv", response_model=dict)
 async def import_pickings_csv(
     auth: AuthDependency,
     import_type: str = Query(..., enum=["headers", "full"]),
     company_id: int = Query(...),
-    file: UploadFile = File(...)
+    file: UploadFile = File(...),
+    async_mode: bool = Query(False)
 ):
+    """
+    Importa albaranes desde CSV. Con async_mode=true el archivo se encola como
+    trabajo en segundo plano y se responde con su job_id (ver /jobs/{id}).
+    """
     verify_company_access(auth, company_id)
     
     if "operations.can_import_export" not in auth.permissions:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No autorizado")
 
+    if async_mode:
+        content = await file.read()
+        return await jobs.submit_job_async(
+            company_id, PICKINGS_IMPORT_JOB, {'import_type': import_type}, auth.username, input_bytes=content
+        )
+
     print(f"\n--- Iniciando Importación (API) '{import_type}' con Lógica Blindada ---")
 
     try:
-        content = await file.read()
-        content_decoded = content.decode('utf-8-sig')
-        file_io = io.StringIO(content_decoded)
+        headers_csv, rows_to_process = await asyncio.to_thread(_read_pickings_csv, file.file)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error al leer el archivo: {e}")
 
-        sniffer = csv.Sniffer()
-        try: dialect = sniffer.sniff(content_decoded[:2048], delimiters=';,')
-        except csv.Error: dialect = csv.excel; dialect.delimiter = ';'
+    # Validación + ejecución fuera del event loop
+    return await asyncio.to_thread(
+        _execute_pickings_import, import_type, headers_csv, rows_to_process, company_id, auth.username
+    )
 
-        file_io.seek(0)
-        reader = csv.DictReader(file_io, dialect=dialect)
-        
-        headers_csv = [h.lower().strip() for h in reader.fieldnames or []]
-        rows_to_process = [{k.lower().strip() if k else k : v.strip() if v else v for k, v in row_raw.items()} for row_raw in reader]
 
-        if not rows_to_process: raise ValueError("El archivo CSV está vacío.")
+@jobs.job_handler(PICKINGS_IMPORT_JOB)
+def _pickings_import_job(ctx):
+    ctx.progress(5, "Leyendo archivo...", force=True)
+    with open(ctx.input_file, "rb") as f:
+        headers_csv, rows_to_process = _read_pickings_csv(f)
+    return _execute_pickings_import(
+        ctx.params['import_type'], headers_csv, rows_to_process, ctx.company_id, ctx.user,
+        progress=ctx.progress
+    )
 
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error al leer el archivo: {e}")
 
+def _execute_pickings_import(import_type, headers_csv, rows_to_process, company_id, responsible_user, progress=None):
+    """
+    Fase 1 (validación con mapas en memoria) + Fase 2 (pipeline masivo).
+    Síncrona: se llama en asyncio.to_thread desde el endpoint o desde un worker de trabajos.
+    progress(pct, mensaje, force=False): reporte de avance opcional (trabajos).
+    """
     all_errors = []
     validated_data = []
-    responsible_user = auth.username
 
     try:
-        # [NUEVO] Precarga de Categorías de Almacén
-        warehouse_cat_map = {}
-        try:
-            wh_rows = await asyncio.to_thread(
-                db.execute_query, 
-                "SELECT w.name, wc.name as cat_name FROM warehouses w JOIN warehouse_categories wc ON w.category_id = wc.id WHERE w.company_id = %s", 
-                (company_id,), 
-                fetchall=True
-            )
-            warehouse_cat_map = {row['name'].upper(): row['cat_name'] for row in wh_rows}
-        except Exception as e:
-            print(f"Warn: No se pudo cargar mapa de categorías: {e}")
+        # [BATCH] Resolver TODOS los nombres del archivo con pocas queries (fuera del event loop).
+        # La validación fila a fila de abajo solo consulta estos mapas en memoria.
+        loc_pairs, partner_names, proj_keys, skus, op_names = set(), set(), set(), set(), set()
+        for row in rows_to_process:
+            loc_pairs.add((row.get('almacen_origen'), row.get('ubicacion_origen')))
+            loc_pairs.add((row.get('almacen_destino'), row.get('ubicacion_destino')))
+            partner_names.update((row.get('ubicacion_origen'), row.get('ubicacion_destino')))
+            proj_keys.add((row.get('macro_project'), row.get('project_code')))
+            skus.add(row.get('product_sku'))
+            op_names.add(row.get('custom_operation_type'))
+
+        lookups = db.get_import_lookup_maps(company_id, loc_pairs, partner_names, proj_keys, skus, op_names)
+        if progress: progress(20, "Validando filas...")
+        warehouse_cat_map = lookups['warehouse_cats']
+        norm = db.normalize_import_key
+
+        def lookup_location(warehouse_name, location_name):
+            if not warehouse_name or not location_name: return None
+            return lookups['locations'].get((norm(warehouse_name), norm(location_name)))
+
+        def lookup_partner(name):
+            return lookups['partners'].get(norm(name)) if name else None
+
+        def lookup_product(sku):
+            return lookups['products'].get(norm(sku)) if sku else None
+
+        def lookup_op_type(name):
+            return lookups['op_types'].get(str(name).strip()) if name else None
+
+        def lookup_picking_type(type_code, warehouse_id=None):
+            for pt in lookups['picking_types']:
+                if pt['code'] == type_code and (not warehouse_id or pt['warehouse_id'] == warehouse_id):
+                    return pt['id']
+            return None
 
         # ============================================
         # --- BLOQUE COMÚN: VALIDACIÓN DE PROYECTO ---
         # ============================================
-        async def resolve_project_id(row_data):
+        def resolve_project_id(row_data):
             """Lógica encapsulada para buscar proyecto por Macro + Código."""
             macro_name = row_data.get('macro_project')
             proj_code = row_data.get('project_code')
@@ -413,10 +496,7 @@ async def import_pickings_csv(
 
             if macro_name and proj_code:
                 # Búsqueda EXACTA y SEGURA
-                p_id = await asyncio.to_thread(
-                    db.get_project_id_by_composite_key, 
-                    macro_name, proj_code, company_id
-                )
+                p_id = lookups['projects'].get((norm(macro_name), norm(proj_code)))
                 if p_id is None:
                     err = f"Proyecto no encontrado: Macro '{macro_name}' / Código '{proj_code}'."
             
@@ -437,7 +517,7 @@ async def import_pickings_csv(
                 validated_row_data = {'row_num': row_num, 'original_data': row}
                 
                 # --- 1. RESOLVER PROYECTO (PRELIMINAR) ---
-                pid, perr = await resolve_project_id(row)
+                pid, perr = resolve_project_id(row)
                 if perr: current_errors.append(perr)
                 validated_row_data['project_id'] = pid
                 # -----------------------------------------
@@ -457,7 +537,7 @@ async def import_pickings_csv(
                     if not all([op_type_name, ubicacion_origen_csv, ubicacion_destino_csv, date_str]):
                         current_errors.append("Faltan datos obligatorios.")
                     else:
-                        op_rule = db.get_operation_type_details_by_name(op_type_name)
+                        op_rule = lookup_op_type(op_type_name)
                         if not op_rule: current_errors.append(f"Tipo op '{op_type_name}' no encontrado.")
                         else:
                             validated_row_data['op_rule'] = op_rule
@@ -488,36 +568,36 @@ async def import_pickings_csv(
 
                             # Validar Origen/Destino
                             if expected_source_type == 'vendor':
-                                partner_info = db.get_partner_id_by_name(ubicacion_origen_csv, company_id)
+                                partner_info = lookup_partner(ubicacion_origen_csv)
                                 if not partner_info or partner_info['category_name'] != 'Proveedor Externo': current_errors.append(f"Proveedor Origen '{ubicacion_origen_csv}' inválido.")
                                 else: partner_id = partner_info['id']
                             elif expected_source_type == 'customer':
                                 # Origen es Cliente (ej: Consignación Recibida)
-                                partner_info = db.get_partner_id_by_name(ubicacion_origen_csv, company_id)
+                                partner_info = lookup_partner(ubicacion_origen_csv)
                                 if not partner_info or partner_info['category_name'] != 'Proveedor Cliente': current_errors.append(f"Cliente Origen '{ubicacion_origen_csv}' inválido.")
                                 else: partner_id = partner_info['id']
                             elif expected_source_type == 'internal':
                                 if not almacen_origen_csv: current_errors.append("Falta Almacén Origen.")
                                 else:
-                                    source_loc_details = db.get_location_details_by_names(company_id, almacen_origen_csv, ubicacion_origen_csv)
+                                    source_loc_details = lookup_location(almacen_origen_csv, ubicacion_origen_csv)
                                     if not source_loc_details: current_errors.append(f"Ubicación Origen '{almacen_origen_csv}/{ubicacion_origen_csv}' no encontrada.")
                                     else: src_loc_id = source_loc_details['id']; wh_id_for_pt = source_loc_details['warehouse_id']
 
                             if expected_dest_type == 'customer':
-                                partner_info = db.get_partner_id_by_name(ubicacion_destino_csv, company_id)
+                                partner_info = lookup_partner(ubicacion_destino_csv)
                                 if not partner_info or partner_info['category_name'] != 'Proveedor Cliente': current_errors.append(f"Cliente Destino '{ubicacion_destino_csv}' inválido.")
                                 else: partner_id = partner_info['id']
                             elif expected_dest_type == 'internal':
                                 if not almacen_destino_csv: current_errors.append("Falta Almacén Destino.")
                                 else:
-                                    dest_loc_details = db.get_location_details_by_names(company_id, almacen_destino_csv, ubicacion_destino_csv)
+                                    dest_loc_details = lookup_location(almacen_destino_csv, ubicacion_destino_csv)
                                     if not dest_loc_details: current_errors.append(f"Ubicación Destino '{almacen_destino_csv}/{ubicacion_destino_csv}' no encontrada.")
                                     else: 
                                         dest_loc_id = dest_loc_details['id']
                                         if wh_id_for_pt is None: wh_id_for_pt = dest_loc_details['warehouse_id']
 
                             if not current_errors:
-                                picking_type_id = db.find_picking_type_id(company_id, op_code, wh_id_for_pt)
+                                picking_type_id = lookup_picking_type(op_code, wh_id_for_pt)
                                 if not picking_type_id: current_errors.append(f"No se encontró tipo albarán compatible.")
                                 else: validated_row_data['picking_type_id'] = picking_type_id
                             
@@ -550,7 +630,7 @@ async def import_pickings_csv(
                 group_errors = []
 
                 # --- 1. RESOLVER PROYECTO (PRELIMINAR) ---
-                pid, perr = await resolve_project_id(first_line)
+                pid, perr = resolve_project_id(first_line)
                 if perr: group_errors.append(perr)
                 # -----------------------------------------
 
@@ -562,7 +642,7 @@ async def import_pickings_csv(
                     
                     if not all([op_type_name, ubicacion_origen_csv, ubicacion_destino_csv, date_str]): raise ValueError("Faltan datos cabecera.")
                     
-                    op_rule = db.get_operation_type_details_by_name(op_type_name)
+                    op_rule = lookup_op_type(op_type_name)
                     if not op_rule: raise ValueError(f"Tipo op '{op_type_name}' no encontrado.")
                     
                     op_code = op_rule['code']; expected_source_type = op_rule['source_location_category']; expected_dest_type = op_rule['destination_location_category']
@@ -591,7 +671,7 @@ async def import_pickings_csv(
                     # VALIDACIÓN DE EXISTENCIA - ORIGEN
                     if expected_source_type == 'vendor':
                         # Origen es Proveedor Externo (ej: Compra Nacional)
-                        partner_info = db.get_partner_id_by_name(ubicacion_origen_csv, company_id)
+                        partner_info = lookup_partner(ubicacion_origen_csv)
                         if not partner_info:
                             group_errors.append(f"Proveedor '{ubicacion_origen_csv}' no existe.")
                         elif partner_info.get('category_name') != 'Proveedor Externo':
@@ -603,7 +683,7 @@ async def import_pickings_csv(
 
                     elif expected_source_type == 'customer':
                         # Origen es Cliente (ej: Consignación Recibida - material del cliente entra a nuestro almacén)
-                        partner_info = db.get_partner_id_by_name(ubicacion_origen_csv, company_id)
+                        partner_info = lookup_partner(ubicacion_origen_csv)
                         if not partner_info:
                             group_errors.append(f"Cliente '{ubicacion_origen_csv}' no existe.")
                         elif partner_info.get('category_name') != 'Proveedor Cliente':
@@ -616,12 +696,12 @@ async def import_pickings_csv(
                     elif expected_source_type == 'internal':
                         if not almacen_origen_csv: group_errors.append("Falta Almacén Origen.")
                         else:
-                            sl = db.get_location_details_by_names(company_id, almacen_origen_csv, ubicacion_origen_csv)
+                            sl = lookup_location(almacen_origen_csv, ubicacion_origen_csv)
                             if not sl: group_errors.append(f"Origen '{almacen_origen_csv}/{ubicacion_origen_csv}' no existe.")
                             else: src_loc_id = sl['id']; wh_id_for_pt = sl['warehouse_id']
                     
                     if expected_dest_type == 'customer':
-                        partner_info = db.get_partner_id_by_name(ubicacion_destino_csv, company_id)
+                        partner_info = lookup_partner(ubicacion_destino_csv)
                         if not partner_info:
                             group_errors.append(f"Cliente '{ubicacion_destino_csv}' no existe.")
                         elif partner_info.get('category_name') != 'Proveedor Cliente':
@@ -634,14 +714,14 @@ async def import_pickings_csv(
                     elif expected_dest_type == 'internal':
                         if not almacen_destino_csv: group_errors.append("Falta Almacén Destino.")
                         else:
-                            dl = db.get_location_details_by_names(company_id, almacen_destino_csv, ubicacion_destino_csv)
+                            dl = lookup_location(almacen_destino_csv, ubicacion_destino_csv)
                             if not dl: group_errors.append(f"Destino '{almacen_destino_csv}/{ubicacion_destino_csv}' no existe.")
                             else: 
                                 dest_loc_id = dl['id']
                                 if wh_id_for_pt is None: wh_id_for_pt = dl['warehouse_id']
 
                     if not group_errors:
-                        picking_type_id = db.find_picking_type_id(company_id, op_code, wh_id_for_pt)
+                        picking_type_id = lookup_picking_type(op_code, wh_id_for_pt)
                         if not picking_type_id: group_errors.append(f"Tipo albarán no configurado.")
                         try: date_transfer_db = datetime.strptime(date_str, "%d/%m/%Y").strftime("%Y-%m-%d")
                         except ValueError: group_errors.append(f"Fecha inválida.")
@@ -656,7 +736,7 @@ async def import_pickings_csv(
                         sku = line_row.get('product_sku'); qty_str = line_row.get('quantity'); price_str = line_row.get('price_unit', '0'); serials_str = line_row.get('serial', '')
                         if not sku or not qty_str: raise ValueError(f"Línea {line_num}: Faltan SKU o Qty.")
                         
-                        product_details = db.get_product_details_by_sku(sku, company_id)
+                        product_details = lookup_product(sku)
                         if not product_details: raise ValueError(f"Línea {line_num}: SKU '{sku}' no encontrado.")
                         
                         try: qty = float(qty_str); price = float(price_str.replace(',', '.'))
@@ -676,60 +756,40 @@ async def import_pickings_csv(
         # --- FASE 2: EJECUCIÓN ---
         # ============================================
         
-        created_headers = 0; created_pickings = 0
-        
+        # [PIPELINE MASIVO] Todos los documentos se materializan en UNA transacción
+        # (COPY a staging + SQL set-based). Si algo falla, no se guarda nada.
         if import_type == 'headers':
-            for valid_row in validated_data:
-                try:
-                    new_name = db.get_next_picking_name(valid_row['picking_type_id'], company_id)
-                    new_picking_id = db.create_picking(
-                        new_name, valid_row['picking_type_id'], valid_row['src_loc_id'], valid_row['dest_loc_id'], 
-                        company_id, responsible_user, project_id=valid_row['project_id']
-                    )
-                    updates = {
-                        "partner_ref": valid_row.get('partner_ref'),
-                        "purchase_order": valid_row.get('purchase_order'),
-                        "date_transfer": valid_row.get('date_transfer_db'),
-                        "partner_id": valid_row.get('partner_id'),
-                        "location_src_id": valid_row['src_loc_id'],
-                        "location_dest_id": valid_row['dest_loc_id'],
-                        "custom_operation_type": valid_row['op_rule']['name'],
-                        "operations_instructions": valid_row.get('operations_instructions'),
-                        "warehouse_observations": valid_row.get('warehouse_observations')
-                    }
-                    db.update_picking_header(new_picking_id, updates)
-                    created_headers += 1
-                except Exception as e:
-                    all_errors.append(f"Error guardando fila {valid_row['row_num']}: {e}")
+            documents = [{
+                'doc_origen': valid_row['row_num'],
+                'header': {
+                    'picking_type_id': valid_row['picking_type_id'],
+                    'src_loc_id': valid_row['src_loc_id'],
+                    'dest_loc_id': valid_row['dest_loc_id'],
+                    'project_id': valid_row['project_id'],
+                    'partner_id': valid_row.get('partner_id'),
+                    'partner_ref': valid_row.get('partner_ref'),
+                    'purchase_order': valid_row.get('purchase_order'),
+                    'date_transfer_db': valid_row.get('date_transfer_db'),
+                    'op_type_name': valid_row['op_rule']['name'],
+                    'operations_instructions': valid_row.get('operations_instructions'),
+                    'warehouse_observations': valid_row.get('warehouse_observations'),
+                },
+                'lines': []
+            } for valid_row in validated_data]
+        else:
+            documents = validated_data
 
-        elif import_type == 'full':
-            # ═══════════════════════════════════════════════════════════════════════
-            # [TRANSACCIÓN ATÓMICA] Cada documento se procesa de forma atómica.
-            # Si falla la validación de reglas de negocio (ownership, etc.),
-            # NO se crea ningún registro huérfano en la BD.
-            # ═══════════════════════════════════════════════════════════════════════
-            for group_data in validated_data:
-                header = group_data['header']
-                lines = group_data['lines']
-                doc_origen = group_data['doc_origen']
-
-                # Usar función atómica que hace COMMIT solo si todo es exitoso
-                success, message, new_id = db.import_picking_atomic(
-                    header_data=header,
-                    lines_data=lines,
-                    company_id=company_id,
-                    responsible_user=responsible_user
-                )
-
-                if success:
-                    created_pickings += 1
-                else:
-                    all_errors.append(f"Doc '{doc_origen}': {message}")
+        if progress: progress(50, f"Guardando {len(documents)} documentos...", force=True)
+        created, exec_errors = db.import_pickings_bulk(documents, company_id, responsible_user)
+        for doc_ref, message in exec_errors:
+            if doc_ref is None: all_errors.append(message)
+            elif import_type == 'headers': all_errors.append(f"Error guardando fila {doc_ref}: {message}")
+            else: all_errors.append(f"Doc '{doc_ref}': {message}")
 
         if all_errors: raise HTTPException(status_code=500, detail="\n".join(all_errors[:10]))
-        return {"created": created_headers or created_pickings, "updated": 0, "errors": 0}
+        return {"created": len(created), "updated": 0, "errors": 0}
 
-    except HTTPException as he: raise he
+    except (HTTPException, jobs.JobCancelled): raise
     except ValueError as ve: raise HTTPException(status_code=400, detail=str(ve))
     except Exception as e: 
         traceback.print_exc()
@@ -1,17 +1,18 @@
 # app/api/products.py
 from fastapi import APIRouter, Depends, HTTPException, status, Query, UploadFile, File
-from typing import List, Annotated, Optional, Dict
+from typing import List, Annotated, Optional, Dict, Union
 from pydantic import BaseModel
 from datetime import date
 from app import database as db
 from app import schemas, security
 from app.security import TokenData
 from app.services.product_service import ProductService
+from app.services.import_service import ImportService
 from app.exceptions import ValidationError, WMSBaseException
 import traceback
 import io
 import csv
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response
 import asyncio
 
 router = APIRouter()
@@ -39,14 +40,18 @@ async def search_storable_products(
         # ... (manejo de error)
         raise HTTPException(status_code=500, detail="Error al buscar productos")
 
-@router.get("/", response_model=List[schemas.ProductResponse])
+@router.get("/", response_model=Union[List[schemas.ProductResponse], schemas.Page[schemas.ProductResponse]])
 async def get_all_products(
     auth: AuthDependency,
+    response: Response,
     company_id: int = Query(...),
     skip: int = 0,
     limit: int = 100,
     sort_by: Optional[str] = Query(None),
     ascending: bool = Query(True),
+    cursor: Optional[str] = Query(None),  # Keyset: "" = primera página
+    with_total: bool = Query(False),
+    with_count: bool = Query(False),  # {items, total, next_cursor} en una sola consulta
     name: Optional[str] = Query(None),
     sku: Optional[str] = Query(None),
     category_name: Optional[str] = Query(None),
@@ -64,6 +69,24 @@ async def get_all_products(
         uom_name=uom_name, tracking=tracking, ownership=ownership
     )
 
+    if cursor is not None:
+        try:
+            page = await asyncio.to_thread(
+                db.get_products_filtered_sorted, company_id, filters=clean_filters,
+                sort_by=sort_by, ascending=ascending, limit=limit, cursor=cursor,
+                with_total=with_total, with_count=with_count
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        response.headers.update(db.keyset_response_headers(page))
+        return page if with_count else page["items"]
+
+    if with_count:
+        return await asyncio.to_thread(
+            db.get_products_filtered_sorted, company_id, filters=clean_filters,
+            sort_by=sort_by, ascending=ascending, limit=limit, offset=skip, with_count=True
+        )
+
     products_raw = db.get_products_filtered_sorted(
         company_id,
         filters=clean_filters,
@@ -289,47 +312,27 @@ async def import_products_csv(
         ProductService.validate_csv_headers(headers)
 
         # 4. Cargar datos de referencia (Repository - SQL puro)
-        categories_map = {cat['name']: cat['id'] for cat in db.get_product_categories(company_id)}
-        uoms_map = {uom['name']: uom['id'] for uom in db.get_uoms(company_id)}
+        categories = await asyncio.to_thread(db.get_product_categories, company_id)
+        uoms = await asyncio.to_thread(db.get_uoms, company_id)
+        categories_map = {cat['name']: cat['id'] for cat in categories}
+        uoms_map = {uom['name']: uom['id'] for uom in uoms}
 
         # 5. Validar referencias (Service Layer)
         ProductService.validate_csv_references(rows, categories_map, uoms_map)
 
-        # 6. Procesar filas
-        created, updated = 0, 0
-        error_list = []
-
-        for i, row in enumerate(rows):
-            row_num = i + 2
-            sku = row.get('sku', '').strip()
+        # 6. Validar y normalizar TODAS las filas (Service Layer)
+        prepared, error_list = ImportService.process_csv_rows(
+            rows, ProductService.process_csv_row, categories_map, uoms_map,
+            row_label=lambda row: f"SKU: {row.get('sku', '').strip()}"
+        )
 
+        # 7. Insertar/Actualizar en una sola transacción (Repository - SQL puro)
+        created, updated = 0, 0
+        if not error_list:
             try:
-                # Validar y normalizar fila (Service Layer)
-                validated_data = ProductService.process_csv_row(
-                    row, row_num, categories_map, uoms_map
-                )
-
-                # Insertar/Actualizar (Repository - SQL puro)
-                result = db.upsert_product_from_import(
-                    company_id=company_id,
-                    sku=validated_data['sku'],
-                    name=validated_data['name'],
-                    category_id=validated_data['category_id'],
-                    uom_id=validated_data['uom_id'],
-                    tracking=validated_data['tracking'],
-                    ownership=validated_data['ownership'],
-                    price=validated_data['standard_price']
-                )
-
-                if result == "created":
-                    created += 1
-                elif result == "updated":
-                    updated += 1
-
-            except ValidationError as ve:
-                error_list.append(f"{ve.message}")
+                created, updated = await asyncio.to_thread(db.upsert_products_from_import, company_id, prepared)
             except Exception as e:
-                error_list.append(f"Fila {row_num} (SKU: {sku}): {e}")
+                error_list.append(str(e))
 
         if error_list:
             raise HTTPException(
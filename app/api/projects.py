@@ -7,7 +7,7 @@ from app.security import TokenData
 from app.services.project_service import ProjectService
 from app.exceptions import ValidationError, NotFoundError, BusinessRuleError, DuplicateError
 import traceback
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response
 
 router = APIRouter()
 AuthDependency = Annotated[TokenData, Depends(security.get_current_user_data)]
@@ -166,6 +166,7 @@ def delete_macro(item_id: int, auth: AuthDependency, company_id: int = Query(...
 @router.get("/", response_model=List[dict])
 def get_projects(
     auth: AuthDependency,
+    response: Response,
     company_id: int = Query(...),
     status: Optional[str] = None,
     search: Optional[str] = None,
@@ -184,30 +185,40 @@ def get_projects(
     limit: int = 100,
     skip: int = 0,
     sort_by: Optional[str] = None,
-    ascending: bool = True
+    ascending: bool = True,
+    cursor: Optional[str] = None,  # Keyset: "" = primera página
+    with_total: bool = False
 ):
     verify_access(auth, company_id)
-    return [dict(r) for r in db.get_projects(
-        company_id=company_id,
-        status=status,
-        search=search,
-        direction_id=direction_id,
-        management_id=management_id,
-
-        # Pasamos los filtros al repo
-        filter_code=f_code,
-        filter_macro=f_macro,
-        filter_dept=f_dept,
-        filter_prov=f_prov,
-        filter_dist=f_dist,
-        filter_direction=f_dir,
-        filter_management=f_mgmt,
-
-        limit=limit,
-        offset=skip,
-        sort_by=sort_by,
-        ascending=ascending
-    )]
+    try:
+        result = db.get_projects(
+            company_id=company_id,
+            status=status,
+            search=search,
+            direction_id=direction_id,
+            management_id=management_id,
+
+            # Pasamos los filtros al repo
+            filter_code=f_code,
+            filter_macro=f_macro,
+            filter_dept=f_dept,
+            filter_prov=f_prov,
+            filter_dist=f_dist,
+            filter_direction=f_dir,
+            filter_management=f_mgmt,
+
+            limit=limit,
+            offset=skip,
+            sort_by=sort_by,
+            ascending=ascending,
+            cursor=cursor,
+            with_total=with_total
+        )
+    except ValueError as e: raise HTTPException(400, detail=str(e))
+    if cursor is not None:
+        response.headers.update(db.keyset_response_headers(result))
+        return result["items"]
+    return [dict(r) for r in result]
 
 
 @router.get("/count", response_model=int)
@@ -1,6 +1,6 @@
 # app/api/reports.py
 from fastapi import APIRouter, Depends, HTTPException, status, Query
-from typing import List, Annotated, Optional, Dict
+from typing import List, Annotated, Optional, Dict, Union
 from app import database as db
 from app import schemas, security
 from app.security import TokenData
@@ -9,129 +9,208 @@ import traceback
 import csv
 import io
 import asyncio
-from fastapi.responses import StreamingResponse
+import os
+from fastapi.responses import StreamingResponse, Response, JSONResponse
 from decimal import Decimal, ROUND_HALF_UP, getcontext
 from app.database.repositories import operation_repo
 from app.services.report_service import ReportService
 from app.exceptions import NotFoundError, ValidationError
+from app import jobs
+from app.streaming import CsvStreamingResponse
 getcontext().prec = 28
 
 router = APIRouter()
 AuthDependency = Annotated[TokenData, Depends(security.get_current_user_data)]
 
+# Conexiones simultáneas máximas que puede usar UNA petición del dashboard
+DASHBOARD_MAX_CONCURRENCY = int(os.environ.get("DASHBOARD_MAX_CONCURRENCY", "3"))
+# Antigüedad máxima (segundos) del snapshot: pasada, la lectura encola un recálculo
+# (aging y atrasados dependen de la fecha aunque no haya operaciones)
+DASHBOARD_SNAPSHOT_MAX_AGE = int(os.environ.get("DASHBOARD_SNAPSHOT_MAX_AGE", "300"))
+_PENDING_WORK_ORDERS_QUERY = "SELECT COUNT(*) as c FROM work_orders WHERE phase != 'Liquidado' AND company_id=%s"
+
 @router.get("/dashboard-kpis", response_model=schemas.DashboardResponse)
 async def get_dashboard_kpis(
     auth: AuthDependency,
-    company_id: int = Query(...)
+    company_id: int = Query(...),
+    fresh: bool = Query(False, description="Ignora el snapshot y recalcula")
 ):
     """ 
-    [MODO SEGURO] Ejecución ESTRICTAMENTE SECUENCIAL.
-    Se eliminó asyncio.gather para evitar abrir múltiples conexiones SSL
-    simultáneas que saturan el Pooler de Supabase/Render.
+    [SNAPSHOT] Lee el dashboard precalculado de la compañía (O(1)).
+    Nunca recalcula dentro del request salvo con ?fresh=true: si el snapshot
+    está obsoleto se sirve igual y se encola su recálculo (app/jobs). Si la
+    compañía aún no tiene snapshot responde 503 con Retry-After mientras se
+    calcula el primero.
     """
     if "nav.dashboard.view" not in auth.permissions:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No autorizado")
     
     try:
-        # Ejecutamos UNA consulta a la vez (await explicito paso a paso)
-        
-        # 1. Conteos Básicos
-        kpis_counts = await asyncio.to_thread(db.get_dashboard_kpis, company_id)
-        
-        # 2. OTs Pendientes
-        ots_res = await asyncio.to_thread(db.execute_query, "SELECT COUNT(*) as c FROM work_orders WHERE phase != 'Liquidado' AND company_id=%s", (company_id,), fetchone=True)
-        ots_pendientes = ots_res['c'] if ots_res else 0
-
-        # 3. Valor Liquidado Global
-        total_liquidated = await asyncio.to_thread(db.get_total_liquidated_value_global, company_id)
-
-        # 4. Valor Inventario (Financiero)
-        inv_values = await asyncio.to_thread(db.get_inventory_value_kpis, company_id)
-
-        # 5. Distribución Propiedad
-        ownership_stats = await asyncio.to_thread(db.get_ownership_distribution, company_id)
-
-        # 6. Gráfico Rendimiento
-        throughput = await asyncio.to_thread(db.get_operations_throughput, company_id)
-
-        # 7. Aging
-        aging = await asyncio.to_thread(db.get_inventory_aging, company_id)
-
-        # 8. Flujo Materiales
-        flow_data = await asyncio.to_thread(db.get_material_flow_series, company_id, 30)
-
-        # 9. Top Proyectos
-        top_projects = await asyncio.to_thread(db.get_top_projects_statistics, company_id)
-
-        # 10. Geo Data
-        geo_data = await asyncio.to_thread(db.get_value_by_region, company_id)
-
-        # 11. Top Productos
-        top_products = await asyncio.to_thread(db.get_top_products_by_value, company_id)
-
-        # 12. Por Categoría
-        val_by_cat = await asyncio.to_thread(db.get_value_by_category, company_id)
-
-        # 13. Top Almacenes
-        top_wh = await asyncio.to_thread(db.get_warehouse_ranking_by_category, company_id, "ALMACEN PRINCIPAL", 5)
-
-        # 14. Top Contratistas
-        top_cont = await asyncio.to_thread(db.get_warehouse_ranking_by_category, company_id, "CONTRATISTA", 10)
-
-        # 15. Estadísticas ABC
-        abc_data = await asyncio.to_thread(db.get_abc_stats, company_id)
-
-        # 16. Tasa Devolución
-        ret_rate = await asyncio.to_thread(db.get_reverse_logistics_rate, company_id)
-
-        # --- Procesamiento Final ---
-        own_val = sum(x['value'] for x in ownership_stats if x['type'] == 'Propio')
-        cons_val = sum(x['value'] for x in ownership_stats if x['type'] == 'Consignado')
-
-        response = schemas.DashboardResponse(
-            # Financiero
-            total_inventory_value=inv_values['total'],
-            own_inventory_value=own_val,
-            consigned_inventory_value=cons_val,
-            total_liquidated_value=total_liquidated,
-            value_kpis=inv_values, 
-
-            # Operativo
-            pending_receptions=kpis_counts.get('IN', 0),
-            pending_transfers=kpis_counts.get('INT', 0),
-            pending_liquidations=ots_pendientes,
-
-            # [ELEGANTE] Atrasadas por categoría
-            in_late=kpis_counts.get('IN_late', 0),
-            int_late=kpis_counts.get('INT_late', 0),
-            out_late=kpis_counts.get('OUT_late', 0),
-
-            # Gráficos
-            throughput_chart=[{"day": day.strftime("%a"), "count": count} for day, count in throughput],
-            aging_chart=aging,
-            material_flow=flow_data,
-            
-            # Listas
-            top_projects=top_projects,
-            ownership_chart=ownership_stats,
-            top_products=top_products,
-            value_by_category=val_by_cat,
-            geo_heatmap=geo_data,
-            top_warehouses=top_wh,
-            top_contractors=top_cont,
-            abc_stats=abc_data,
-            return_rate=ret_rate
-        )
-        return response
+        snapshot = await asyncio.to_thread(db.get_dashboard_snapshot, company_id)
+
+        if fresh:
+            base_version = snapshot['version'] if snapshot else 0
+            response = await _compute_dashboard(company_id)
+            try:
+                await asyncio.to_thread(
+                    db.save_dashboard_snapshot, company_id, response.model_dump(mode="json"), base_version
+                )
+            except Exception as e:
+                print(f"[WARN] No se pudo guardar snapshot del dashboard: {e}")
+            return response
+
+        has_payload = snapshot is not None and snapshot['payload'] is not None
+        if (not has_payload or snapshot['snapshot_version'] != snapshot['version']
+                or snapshot['age_seconds'] >= DASHBOARD_SNAPSHOT_MAX_AGE):
+            await asyncio.to_thread(jobs.request_job, company_id, db.DASHBOARD_REFRESH_JOB)
+
+        if not has_payload:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="El dashboard se está calculando. Reintente en unos segundos.",
+                headers={"Retry-After": "5"}
+            )
+        return schemas.DashboardResponse(**snapshot['payload'])
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"ERROR DASHBOARD: {e}") 
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error de DB: {str(e)}")
 
-@router.get("/stock-summary", response_model=List[schemas.StockReportResponse])
+async def _compute_dashboard(company_id):
+    """ 
+    [FAN-OUT ACOTADO] Las 16 consultas se ejecutan en paralelo, pero con un tope
+    de concurrencia por petición (DASHBOARD_MAX_CONCURRENCY, por defecto 3).
+    Así la latencia se acerca a la de la consulta más lenta sin abrir
+    16 conexiones SSL simultáneas contra el Pooler de Supabase/Render.
+    Solo para ?fresh=true; el recálculo normal es _dashboard_refresh_job.
+    """
+    results = await db.async_core.gather_bounded(
+        asyncio.to_thread(db.get_dashboard_kpis, company_id),
+        db.async_core.execute_query(_PENDING_WORK_ORDERS_QUERY, (company_id,), fetchone=True),
+        asyncio.to_thread(db.get_total_liquidated_value_global, company_id),
+        asyncio.to_thread(db.get_inventory_value_kpis, company_id),
+        asyncio.to_thread(db.get_ownership_distribution, company_id),
+        asyncio.to_thread(db.get_operations_throughput, company_id),
+        asyncio.to_thread(db.get_inventory_aging, company_id),
+        asyncio.to_thread(db.get_material_flow_series, company_id, 30),
+        asyncio.to_thread(db.get_top_projects_statistics, company_id),
+        asyncio.to_thread(db.get_value_by_region, company_id),
+        asyncio.to_thread(db.get_top_products_by_value, company_id),
+        asyncio.to_thread(db.get_value_by_category, company_id),
+        asyncio.to_thread(db.get_warehouse_ranking_by_category, company_id, "ALMACEN PRINCIPAL", 5),
+        asyncio.to_thread(db.get_warehouse_ranking_by_category, company_id, "CONTRATISTA", 10),
+        asyncio.to_thread(db.get_abc_stats, company_id),
+        asyncio.to_thread(db.get_reverse_logistics_rate, company_id),
+        limit=DASHBOARD_MAX_CONCURRENCY
+    )
+    return _build_dashboard_response(*results)
+
+def _compute_dashboard_sync(company_id):
+    """Las mismas 16 consultas en secuencia, con una sola conexión a la vez (worker de trabajos)."""
+    return _build_dashboard_response(
+        db.get_dashboard_kpis(company_id),
+        db.execute_query(_PENDING_WORK_ORDERS_QUERY, (company_id,), fetchone=True),
+        db.get_total_liquidated_value_global(company_id),
+        db.get_inventory_value_kpis(company_id),
+        db.get_ownership_distribution(company_id),
+        db.get_operations_throughput(company_id),
+        db.get_inventory_aging(company_id),
+        db.get_material_flow_series(company_id, 30),
+        db.get_top_projects_statistics(company_id),
+        db.get_value_by_region(company_id),
+        db.get_top_products_by_value(company_id),
+        db.get_value_by_category(company_id),
+        db.get_warehouse_ranking_by_category(company_id, "ALMACEN PRINCIPAL", 5),
+        db.get_warehouse_ranking_by_category(company_id, "CONTRATISTA", 10),
+        db.get_abc_stats(company_id),
+        db.get_reverse_logistics_rate(company_id),
+    )
+
+def _build_dashboard_response(
+    kpis_counts,       # 1. Conteos Básicos
+    ots_res,           # 2. OTs Pendientes
+    total_liquidated,  # 3. Valor Liquidado Global
+    inv_values,        # 4. Valor Inventario (Financiero)
+    ownership_stats,   # 5. Distribución Propiedad
+    throughput,        # 6. Gráfico Rendimiento
+    aging,             # 7. Aging
+    flow_data,         # 8. Flujo Materiales
+    top_projects,      # 9. Top Proyectos
+    geo_data,          # 10. Geo Data
+    top_products,      # 11. Top Productos
+    val_by_cat,        # 12. Por Categoría
+    top_wh,            # 13. Top Almacenes
+    top_cont,          # 14. Top Contratistas
+    abc_data,          # 15. Estadísticas ABC
+    ret_rate,          # 16. Tasa Devolución
+):
+    ots_pendientes = ots_res['c'] if ots_res else 0
+
+    # --- Procesamiento Final ---
+    own_val = sum(x['value'] for x in ownership_stats if x['type'] == 'Propio')
+    cons_val = sum(x['value'] for x in ownership_stats if x['type'] == 'Consignado')
+
+    response = schemas.DashboardResponse(
+        # Financiero
+        total_inventory_value=inv_values['total'],
+        own_inventory_value=own_val,
+        consigned_inventory_value=cons_val,
+        total_liquidated_value=total_liquidated,
+        value_kpis=inv_values, 
+
+        # Operativo
+        pending_receptions=kpis_counts.get('IN', 0),
+        pending_transfers=kpis_counts.get('INT', 0),
+        pending_liquidations=ots_pendientes,
+
+        # [ELEGANTE] Atrasadas por categoría
+        in_late=kpis_counts.get('IN_late', 0),
+        int_late=kpis_counts.get('INT_late', 0),
+        out_late=kpis_counts.get('OUT_late', 0),
+
+        # Gráficos
+        throughput_chart=[{"day": day.strftime("%a"), "count": count} for day, count in throughput],
+        aging_chart=aging,
+        material_flow=flow_data,
+        
+        # Listas
+        top_projects=top_projects,
+        ownership_chart=ownership_stats,
+        top_products=top_products,
+        value_by_category=val_by_cat,
+        geo_heatmap=geo_data,
+        top_warehouses=top_wh,
+        top_contractors=top_cont,
+        abc_stats=abc_data,
+        return_rate=ret_rate
+    )
+    return response
+
+@jobs.job_handler(db.DASHBOARD_REFRESH_JOB)
+def _dashboard_refresh_job(ctx):
+    """
+    Recalcula el snapshot del dashboard fuera del request. Lo encolan las
+    operaciones que lo invalidan (mark_dashboard_snapshot_stale) y las lecturas
+    que lo encuentran viejo; si otro trabajo ya lo dejó al día no hace nada.
+    """
+    snapshot = db.get_dashboard_snapshot(ctx.company_id)
+    if (snapshot and snapshot['payload'] is not None
+            and snapshot['snapshot_version'] == snapshot['version']
+            and snapshot['age_seconds'] < DASHBOARD_SNAPSHOT_MAX_AGE):
+        return {"skipped": True}
+
+    base_version = snapshot['version'] if snapshot else 0
+    response = _compute_dashboard_sync(ctx.company_id)
+    db.save_dashboard_snapshot(ctx.company_id, response.model_dump(mode="json"), base_version)
+    return {"version": base_version}
+
+@router.get("/stock-summary", response_model=Union[List[schemas.StockReportResponse], schemas.Page[schemas.StockReportResponse]])
 async def get_stock_summary_report(
     auth: AuthDependency,
+    response: Response,
     company_id: int = Query(...),
     warehouse_id: Optional[int] = None,
     location_id: Optional[int] = None,
@@ -145,7 +224,10 @@ async def get_stock_summary_report(
     skip: int = 0,
     limit: int = 50,
     sort_by: str = 'sku',
-    ascending: bool = True
+    ascending: bool = True,
+    cursor: Optional[str] = None,  # Keyset: "" = primera página
+    with_total: bool = False,
+    with_count: bool = False  # {items, total, next_cursor} en una sola consulta
 ):
     if "reports.stock.view" not in auth.permissions:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No autorizado")
@@ -162,6 +244,22 @@ async def get_stock_summary_report(
     filters = {k: v for k, v in filters.items() if v is not None}
 
     try:
+        if cursor is not None:
+            page = await asyncio.to_thread(
+                db.get_stock_summary_filtered_sorted,
+                company_id=company_id, filters=filters, sort_by=sort_by, ascending=ascending,
+                limit=limit, cursor=cursor, with_total=with_total, with_count=with_count
+            )
+            response.headers.update(db.keyset_response_headers(page))
+            return page if with_count else page["items"]
+
+        if with_count:
+            return await asyncio.to_thread(
+                db.get_stock_summary_filtered_sorted,
+                company_id=company_id, filters=filters, sort_by=sort_by, ascending=ascending,
+                limit=limit, offset=skip, with_count=True
+            )
+
         stock_data = await asyncio.to_thread(
             db.get_stock_summary_filtered_sorted, 
             company_id=company_id, 
@@ -172,6 +270,8 @@ async def get_stock_summary_report(
             offset=skip
         )
         return [dict(row) for row in stock_data]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error al generar reporte de stock: {e}")
@@ -208,7 +308,7 @@ async def get_stock_summary_count(
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error al contar resumen: {e}")
 
-@router.get("/aging", response_model=List[schemas.AgingDetailResponse])
+@router.get("/aging", response_model=Union[List[schemas.AgingDetailResponse], schemas.Page[schemas.AgingDetailResponse]])
 async def get_aging_report(
     auth: AuthDependency,
     company_id: int = Query(...),
@@ -225,7 +325,8 @@ async def get_aging_report(
     skip: int = Query(0, ge=0),
     limit: int = Query(50, ge=1, le=500),
     sort_by: str = Query('aging_days'),
-    ascending: bool = Query(False)
+    ascending: bool = Query(False),
+    with_count: bool = Query(False)  # {items, total, next_cursor} en una sola consulta
 ):
     """
     [OPTIMIZADO] Obtiene el reporte detallado de antigüedad de inventario con paginación.
@@ -241,6 +342,12 @@ async def get_aging_report(
     filters = {k: v for k, v in filters.items() if v is not None and v != ""}
 
     try:
+        if with_count:
+            return await asyncio.to_thread(
+                db.get_inventory_aging_details, company_id, filters,
+                sort_by=sort_by, ascending=ascending, limit=limit, offset=skip, with_count=True
+            )
+
         aging_data = db.get_inventory_aging_details(
             company_id, filters,
             sort_by=sort_by, ascending=ascending,
@@ -431,8 +538,74 @@ async def get_kardex_detail(
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error al generar detalle kardex: {e}")
 
+@router.post("/stock-closing/run")
+async def run_stock_closing(
+    auth: AuthDependency,
+    company_id: int = Query(...),
+    up_to: Optional[date] = Query(None)
+):
+    """
+    Job de cierre mensual de stock: genera los snapshots de saldo de los
+    meses completos pendientes (hasta 'up_to' o el mes anterior).
+    Es idempotente: reanuda desde el último cierre vigente.
+    """
+    if "reports.kardex.view" not in auth.permissions:
+        raise HTTPException(status_code=403, detail="No autorizado")
+
+    try:
+        closed = await asyncio.to_thread(db.run_stock_closing, company_id, up_to)
+        return {"closed_periods": [d.isoformat() for d in closed]}
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Error al generar cierres de stock: {e}")
+
+@router.post("/reservations/reconcile")
+async def reconcile_stock_reservations(
+    auth: AuthDependency,
+    company_id: Optional[int] = Query(None),
+    fix: bool = Query(False)
+):
+    """
+    Compara el agregado stock_reservations con lo recalculado desde los
+    pickings en 'listo'. Con fix=true lo reconstruye (requiere admin).
+    """
+    if "reports.stock.view" not in auth.permissions:
+        raise HTTPException(status_code=403, detail="No autorizado")
+    if fix and "nav.admin.view" not in auth.permissions:
+        raise HTTPException(status_code=403, detail="No autorizado para corregir reservas")
+
+    try:
+        drift = await asyncio.to_thread(db.reconcile_stock_reservations, company_id, fix)
+        return {"drift_count": len(drift), "fixed": fix, "drift": drift}
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Error al conciliar reservas: {e}")
+
+@router.post("/stock-ledger/rebuild")
+async def rebuild_stock_ledger(
+    auth: AuthDependency,
+    company_id: int = Query(...)
+):
+    """
+    Reconstruye el libro mayor de stock de la compañía desde stock_moves
+    (reparación o tras restaurar datos). Invalida los cierres de stock.
+    """
+    if "nav.admin.view" not in auth.permissions:
+        raise HTTPException(status_code=403, detail="No autorizado")
+
+    try:
+        inserted = await asyncio.to_thread(db.rebuild_stock_ledger, company_id)
+        return {"message": "Libro mayor de stock reconstruido.", "rows": inserted}
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Error al reconstruir el libro mayor: {e}")
+
 # La función _process_kardex_export_data_sync ha sido movida a ReportService.process_kardex_export_data
 
+KARDEX_EXPORT_JOB = "reports.kardex_export"
+KARDEX_EXPORT_FILENAME = "kardex_detalle_completo.csv"
+
+
 @router.get("/kardex-export/csv", response_class=StreamingResponse)
 async def export_kardex_detail_csv(
     auth: AuthDependency,
@@ -441,19 +614,30 @@ async def export_kardex_detail_csv(
     company_id: int = Query(...),
     product_filter: Optional[str] = Query(None),
     warehouse_id: Optional[str] = Query(None),
-    date_from_display: str = Query(...)
+    date_from_display: str = Query(...),
+    async_mode: bool = Query(False)
 ):
     """
     Genera y transmite el reporte de Kardex detallado completo como CSV.
     Delega al ReportService para el procesamiento de datos.
+    Con async_mode=true se genera en segundo plano: responde un job_id y el
+    archivo se descarga luego desde /jobs/{id}/result.
     """
     if "reports.kardex.view" not in auth.permissions:
         raise HTTPException(status_code=403, detail="No autorizado")
 
+    if async_mode:
+        return JSONResponse(await jobs.submit_job_async(company_id, KARDEX_EXPORT_JOB, {
+            'date_from': date_from.strftime("%Y-%m-%d"),
+            'date_to': date_to.strftime("%Y-%m-%d"),
+            'warehouse_id': warehouse_id,
+            'product_filter': product_filter,
+            'date_from_display': date_from_display,
+        }, auth.username))
+
     try:
-        # 1. Procesar datos usando el servicio
-        processed_data = await asyncio.to_thread(
-            ReportService.process_kardex_export_data,
+        # 1. Motor de kardex en streaming (se ejecuta al consumir la respuesta)
+        kardex_rows = ReportService.iter_kardex_export_rows(
             company_id,
             date_from.strftime("%Y-%m-%d"),
             date_to.strftime("%Y-%m-%d"),
@@ -462,22 +646,56 @@ async def export_kardex_detail_csv(
             date_from_display
         )
 
-        # 2. Generar CSV usando el servicio
-        csv_content = ReportService.generate_kardex_csv_content(processed_data)
-
-        return StreamingResponse(
-            iter([csv_content]),
-            media_type="text/csv",
-            headers={"Content-Disposition": "attachment; filename=kardex_detalle_completo.csv"}
+        # 2. Transmitir el CSV por bloques
+        return await _stream_csv_response(
+            kardex_rows,
+            ReportService.get_kardex_csv_headers(),
+            KARDEX_EXPORT_FILENAME,
+            empty_message="No se encontraron movimientos para exportar"
         )
 
+    except HTTPException:
+        raise
     except NotFoundError as e:
         raise HTTPException(status_code=404, detail=e.message)
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error al generar exportación de kardex: {e}")
 
-@router.get("/stock-detail", response_model=List[schemas.StockDetailResponse])
+
+@jobs.job_handler(KARDEX_EXPORT_JOB)
+def _kardex_export_job(ctx):
+    """Mismo motor que el endpoint, escribiendo a un archivo de resultado con avance por filas."""
+    p = ctx.params
+    ctx.progress(5, "Calculando saldos iniciales...", force=True)
+    exported = 0
+
+    def counted(rows):
+        nonlocal exported
+        for row in rows:
+            exported += 1
+            if exported % 1000 == 0:
+                ctx.progress(50, f"{exported} filas exportadas...")
+            yield row
+
+    kardex_rows = ReportService.iter_kardex_export_rows(
+        ctx.company_id, p['date_from'], p['date_to'],
+        p.get('warehouse_id'), p.get('product_filter'), p['date_from_display']
+    )
+    try:
+        chunks = ReportService.open_csv_stream(
+            counted(kardex_rows), ReportService.get_kardex_csv_headers(),
+            empty_message="No se encontraron movimientos para exportar"
+        )
+        with open(ctx.result_path(KARDEX_EXPORT_FILENAME), "w", encoding="utf-8", newline="") as f:
+            for chunk in chunks:
+                f.write(chunk)
+    finally:
+        # Cancelado o con error a mitad: libera la conexión del cursor de servidor ya
+        kardex_rows.close()
+    return {"rows": exported}
+
+@router.get("/stock-detail", response_model=Union[List[schemas.StockDetailResponse], schemas.Page[schemas.StockDetailResponse]])
 async def get_stock_detail_report(
     auth: AuthDependency,
     company_id: int = Query(...),
@@ -496,7 +714,8 @@ async def get_stock_detail_report(
     skip: int = 0,
     limit: int = 50,
     sort_by: str = 'sku',
-    ascending: bool = True
+    ascending: bool = True,
+    with_count: bool = False  # {items, total, next_cursor} en una sola consulta
 ):
     """ 
     Obtiene el reporte de stock detallado PAGINADO.
@@ -525,8 +744,11 @@ async def get_stock_detail_report(
             sort_by=sort_by,
             ascending=ascending,
             limit=limit,
-            offset=skip
+            offset=skip,
+            with_count=with_count
         )
+        if with_count:
+            return stock_data
         return [dict(row) for row in stock_data]
 
     except Exception as e:
@@ -571,6 +793,25 @@ async def get_stock_detail_count(
 
 # --- ENDPOINTS FALTANTES PARA EXPORTAR CSV ---
 
+async def _stream_csv_response(rows, fieldnames: List[str], filename: str,
+                               header_labels: Optional[List[str]] = None,
+                               empty_message: str = "No hay datos para exportar") -> StreamingResponse:
+    """
+    Helper de exportación en streaming (CSV por bloques).
+    La primera fila se lee en un hilo antes de responder: si no hay datos
+    devolvemos 404; si los hay, el resto se transmite mientras se lee el cursor.
+    CsvStreamingResponse cierra el generador (conexión + cursor de servidor)
+    al terminar, aunque el cliente se desconecte a mitad de la descarga.
+    """
+    try:
+        chunks = await asyncio.to_thread(
+            ReportService.open_csv_stream, rows, fieldnames, header_labels, empty_message
+        )
+    except NotFoundError as e:
+        raise HTTPException(status_code=404, detail=e.message)
+
+    return CsvStreamingResponse(chunks, filename)
+
 def _generate_csv_response(data: List[dict], headers_map: dict, filename: str) -> StreamingResponse:
     """Helper genérico para crear un CSV usando ReportService."""
     try:
@@ -656,11 +897,10 @@ async def export_stock_detail_csv(
     filters = {k: v for k, v in filters.items() if v is not None and v != ""}
     
     try:
-        # 1. Obtener datos
-        stock_data_raw = db.get_stock_on_hand_filtered_sorted(
-            company_id=company_id, filters=filters
+        # 1. Cursor de servidor (las filas se leen a medida que se envían)
+        stock_rows = db.get_stock_on_hand_filtered_sorted(
+            company_id=company_id, filters=filters, stream=True
         )
-        stock_data = [dict(row) for row in stock_data_raw]
 
         # 2. Construir Headers Dinámicos
         # Definimos las columnas fijas
@@ -689,8 +929,13 @@ async def export_stock_detail_csv(
             'notes': "Observaciones"
         })
         
-        return _generate_csv_response(stock_data, headers_map, "stock_detalle.csv")
+        return await _stream_csv_response(
+            stock_rows, list(headers_map.keys()), "stock_detalle.csv",
+            header_labels=list(headers_map.values())
+        )
 
+    except HTTPException:
+        raise
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error al exportar detalle: {e}")
@@ -741,7 +986,7 @@ async def get_warehouses_kpi(
         # Obtener rol si no está en token
         role_name = auth.role_name
         if not hasattr(auth, 'role_name') or not role_name:
-             user_data = await asyncio.to_thread(db.execute_query, 
+             user_data = await db.async_core.execute_query(
                 "SELECT r.name FROM users u JOIN roles r ON u.role_id = r.id WHERE u.id=%s", 
                 (user_id,), fetchone=True)
              role_name = user_data['name'] if user_data else 'Usuario'
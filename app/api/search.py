@@ -0,0 +1,65 @@
+# app/api/search.py
+from fastapi import APIRouter, Depends, HTTPException, status, Query
+from typing import List, Annotated, Optional
+from app import database as db
+from app import schemas, security
+from app.security import TokenData, verify_company_access
+import traceback
+import asyncio
+
+router = APIRouter()
+AuthDependency = Annotated[TokenData, Depends(security.get_current_user_data)]
+
+# Permiso requerido para ver cada tipo de resultado (None = cualquier usuario de la compañía)
+ENTITY_PERMISSIONS = {
+    'picking': "operations.can_view",
+    'product': "products.can_crud",
+    'partner': "partners.can_crud",
+    'project': None,
+}
+
+
+@router.get("/", response_model=List[schemas.SearchResult])
+async def global_search(
+    auth: AuthDependency,
+    company_id: int = Query(...),
+    q: str = Query(..., min_length=2),
+    types: Optional[str] = Query(None),  # "picking,product" (vacío = todos los permitidos)
+    limit_per_type: int = Query(10, ge=1, le=50)
+):
+    """
+    Búsqueda global rankeada sobre pickings, productos, partners y proyectos.
+    Solo devuelve los tipos que el usuario puede ver.
+    """
+    verify_company_access(auth, company_id)
+
+    requested = [t.strip() for t in types.split(",") if t.strip()] if types else list(ENTITY_PERMISSIONS)
+    allowed = [
+        t for t in requested
+        if t in ENTITY_PERMISSIONS and (ENTITY_PERMISSIONS[t] is None or ENTITY_PERMISSIONS[t] in auth.permissions)
+    ]
+    if not allowed:
+        return []
+
+    try:
+        rows = await asyncio.to_thread(db.search_global, company_id, q, allowed, limit_per_type)
+        return [dict(r) for r in rows]
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Error en la búsqueda: {e}")
+
+
+@router.post("/reindex")
+async def reindex_search(auth: AuthDependency, company_id: Optional[int] = Query(None)):
+    """Reconstruye el índice de búsqueda (carga inicial o tras restaurar datos)."""
+    if "nav.admin.view" not in auth.permissions:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No autorizado")
+    if company_id is not None:
+        verify_company_access(auth, company_id)
+
+    try:
+        counts = await asyncio.to_thread(db.rebuild_search_documents, company_id)
+        return {"message": "Índice de búsqueda reconstruido.", "indexed": counts}
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Error al reconstruir el índice: {e}")
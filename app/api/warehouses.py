@@ -1,12 +1,13 @@
 # app/api/warehouses.py
 from fastapi import APIRouter, Depends, HTTPException, status, Query, UploadFile, File
-from typing import List, Annotated, Optional, Dict
+from typing import List, Annotated, Optional, Dict, Union
 from pydantic import BaseModel
 from datetime import date
 from app import database as db
 from app import schemas, security
 from app.security import TokenData
 from app.services.warehouse_service import WarehouseService
+from app.services.import_service import ImportService
 from app.exceptions import ValidationError, NotFoundError, DuplicateError
 import traceback
 from fastapi.responses import StreamingResponse
@@ -15,7 +16,7 @@ import asyncio
 router = APIRouter()
 AuthDependency = Annotated[TokenData, Depends(security.get_current_user_data)]
 
-@router.get("/", response_model=List[schemas.WarehouseResponse])
+@router.get("/", response_model=Union[List[schemas.WarehouseResponse], schemas.Page[schemas.WarehouseResponse]])
 async def get_all_warehouses(
     auth: AuthDependency,
     company_id: int = Query(...),
@@ -25,6 +26,7 @@ async def get_all_warehouses(
     # Estos deben coincidir con las claves de self.active_filters en Flet
     sort_by: Optional[str] = Query(None),
     ascending: bool = Query(True),
+    with_count: bool = Query(False),  # {items, total, next_cursor} en una sola consulta
     name: Optional[str] = Query(None),
     code: Optional[str] = Query(None),
     status: Optional[str] = Query(None),
@@ -46,6 +48,12 @@ async def get_all_warehouses(
         address=address
     )
 
+    if with_count:
+        return await asyncio.to_thread(
+            db.get_warehouses_filtered_sorted, company_id, filters=clean_filters,
+            sort_by=sort_by, ascending=ascending, limit=limit, offset=skip, with_count=True
+        )
+
     warehouses_raw = db.get_warehouses_filtered_sorted(
         company_id, 
         filters=clean_filters, 
@@ -283,45 +291,22 @@ async def import_warehouses_csv(
     WarehouseService.validate_csv_headers(headers)
 
     # 3. Cargar categorías de BD y validar referencias
-    db_categories = db.get_warehouse_categories(company_id)
+    db_categories = await asyncio.to_thread(db.get_warehouse_categories, company_id)
     valid_category_names = {cat['name'] for cat in db_categories}
     WarehouseService.validate_csv_categories(rows, valid_category_names)
 
     # 4. Crear mapeo de categorías
     cat_map = {cat['name']: cat['id'] for cat in db_categories}
 
-    # 5. Procesar filas
-    created, updated = 0, 0
-    error_list = []
+    # 5. Validar y normalizar TODAS las filas, luego una sola transacción
+    prepared, error_list = ImportService.process_csv_rows(rows, WarehouseService.process_csv_row, cat_map)
 
-    for i, row in enumerate(rows):
-        row_num = i + 2
+    created, updated = 0, 0
+    if not error_list:
         try:
-            # Usar WarehouseService para procesar y normalizar la fila
-            prepared = WarehouseService.process_csv_row(row, row_num, cat_map)
-
-            result = db.upsert_warehouse_from_import(
-                company_id=company_id,
-                code=prepared["code"],
-                name=prepared["name"],
-                status=prepared["status"],
-                social_reason=prepared["social_reason"],
-                ruc=prepared["ruc"],
-                email=prepared["email"],
-                phone=prepared["phone"],
-                address=prepared["address"],
-                category_id=prepared["category_id"]
-            )
-
-            if result == "created":
-                created += 1
-            elif result == "updated":
-                updated += 1
-
-        except ValidationError as ve:
-            error_list.append(ve.message)
+            created, updated = await asyncio.to_thread(db.upsert_warehouses_from_import, company_id, prepared)
         except Exception as e:
-            error_list.append(f"Fila {row_num}: {e}")
+            error_list.append(str(e))
 
     if error_list:
         raise ValidationError(
@@ -5,10 +5,11 @@ from app import database as db
 from app import schemas, security
 from app.security import TokenData, verify_company_access
 from app.services.work_order_service import WorkOrderService
+from app.services.import_service import ImportService
 from app.exceptions import ValidationError, BusinessRuleError, NotFoundError
 import traceback
 import asyncio
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response
 
 router = APIRouter()
 AuthDependency = Annotated[TokenData, Depends(security.get_current_user_data)]
@@ -41,10 +42,13 @@ async def get_all_work_orders(
     auth: AuthDependency,
     company_id: int, 
     request: Request, # <-- ¡CAMBIO! Aceptamos el Request
+    response: Response,
     skip: int = 0,
     limit: int = 50,
     sort_by: str = 'id',
-    ascending: bool = False
+    ascending: bool = False,
+    cursor: Optional[str] = Query(None),  # Keyset: "" = primera página
+    with_total: bool = Query(False)
 ):
     verify_company_access(auth, company_id) # <--- BLINDAJE DE SEGURIDAD
     """ 
@@ -57,6 +61,14 @@ async def get_all_work_orders(
     try:
         # ¡CAMBIO! Parseamos los filtros desde la URL
         filters = _parse_filters_from_request(request)
+
+        if cursor is not None:
+            page = await asyncio.to_thread(
+                db.get_work_orders_filtered_sorted, company_id=company_id, filters=filters,
+                sort_by=sort_by, ascending=ascending, limit=limit, cursor=cursor, with_total=with_total
+            )
+            response.headers.update(db.keyset_response_headers(page))
+            return page["items"]
         
         wo_raw = db.get_work_orders_filtered_sorted(
             company_id=company_id, 
@@ -67,6 +79,8 @@ async def get_all_work_orders(
             offset=skip
         )
         return [dict(wo) for wo in wo_raw]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error al obtener OTs: {e}")
@@ -205,6 +219,73 @@ async def save_liquidation_progress(
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error interno: {e}")
 
+# Tope por request: más OTs se envían en varios lotes
+MAX_LIQUIDATION_BATCH = 1000
+
+@router.post("/liquidate-batch", response_model=schemas.WorkOrderBatchLiquidationResponse)
+async def liquidate_work_orders_batch(
+    data: schemas.WorkOrderBatchLiquidationRequest,
+    auth: AuthDependency,
+    company_id: int = Query(...)
+):
+    """
+    Liquida muchas OTs en una sola llamada (cierre de día).
+    Cada OT se valida y confirma por separado: el resultado es por OT y un
+    error en una no impide liquidar las demás.
+    """
+    verify_company_access(auth, company_id)
+
+    if "liquidaciones.can_liquidate" not in auth.permissions:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No autorizado")
+
+    if len(data.items) > MAX_LIQUIDATION_BATCH:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Máximo {MAX_LIQUIDATION_BATCH} OTs por lote."
+        )
+
+    try:
+        results = [None] * len(data.items)
+        batch_items, batch_positions = [], []
+
+        for pos, item in enumerate(data.items):
+            consumptions = [l.dict() for l in item.consumo_data.lines_data]
+            retiros = [l.dict() for l in item.retiro_data.lines_data] if item.retiro_data else []
+            try:
+                WorkOrderService.validate_liquidation_has_lines(consumptions, retiros)
+            except ValidationError as ve:
+                results[pos] = {"wo_id": item.wo_id, "success": False, "message": ve.message}
+                continue
+
+            batch_positions.append(pos)
+            batch_items.append({
+                "wo_id": item.wo_id,
+                "consumptions": consumptions,
+                "retiros": retiros,
+                "service_act_number": item.consumo_data.service_act_number,
+                "date_attended_db": item.consumo_data.date_attended_db,
+                "location_src_id": item.consumo_data.location_src_id,
+            })
+
+        if batch_items:
+            batch_results = await asyncio.to_thread(
+                db.process_liquidation_batch, batch_items, company_id, auth.username
+            )
+            for pos, res in zip(batch_positions, batch_results):
+                results[pos] = res
+
+        success_count = sum(1 for r in results if r['success'])
+        return {
+            "total": len(results),
+            "success_count": success_count,
+            "failed_count": len(results) - success_count,
+            "results": results
+        }
+
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Error interno: {e}")
+
 @router.post("/{wo_id}/liquidate", status_code=status.HTTP_200_OK)
 async def liquidate_work_order(
     wo_id: int,
@@ -315,28 +396,21 @@ async def import_work_orders_csv(
         # Validar headers usando el servicio
         WorkOrderService.validate_csv_headers(headers)
 
-        created_count, updated_count, error_list = 0, 0, []
-
-        for i, row in enumerate(rows):
-            row_num = i + 2
+        # Validar y normalizar TODAS las filas con el servicio
+        prepared, error_list = ImportService.process_csv_rows(
+            rows, WorkOrderService.process_csv_row,
+            row_label=lambda row: f"OT: {row.get('ot_number', 'N/A')}"
+        )
 
+        # Una sola transacción para todo el archivo
+        created_count, updated_count = 0, 0
+        if not error_list:
             try:
-                # Usar el servicio para procesar la fila
-                processed = WorkOrderService.process_csv_row(row, row_num)
-
-                # Llamada al repositorio
-                result = db.upsert_work_order_from_import(company_id, processed)
-
-                if result == "created":
-                    created_count += 1
-                elif result == "updated":
-                    updated_count += 1
-
-            except ValidationError as ve:
-                error_list.append(ve.message)
+                created_count, updated_count = await asyncio.to_thread(
+                    db.upsert_work_orders_from_import, company_id, prepared
+                )
             except Exception as e:
-                ot = row.get('ot_number', 'N/A')
-                error_list.append(f"Fila {row_num} (OT: {ot}): {str(e)}")
+                error_list.append(str(e))
 
         if error_list:
             detail_msg = "Errores en la importación:\n- " + "\n- ".join(error_list[:10])
@@ -6,9 +6,24 @@ from .core import (
     execute_commit_query,
     db_pool,
     get_db_connection,
-    return_db_connection
+    return_db_connection,
+    stream_query
 )
 
+# 1a. Paginación por cursor (keyset) para los listados
+from .pagination import keyset_response_headers, estimate_count
+
+# 1a. Caché de datos de referencia + invalidación entre workers (LISTEN/NOTIFY)
+from .ref_cache import reference_cache_stats, invalidate_reference
+from .invalidation import (
+    start_invalidation_listener, stop_invalidation_listener,
+    publish_invalidation, register_invalidation_handler
+)
+
+# 1b. Capa asíncrona (pool asyncio + execute_query/execute_commit_query awaitables)
+from . import async_core
+from .async_core import init_async_pool, close_async_pool
+
 # 2. Importar Schema (para inicialización)
 from .schema import create_schema, create_initial_data
 
@@ -22,6 +37,8 @@ from .repositories.operation_repo import *
 from .repositories.work_order_repo import *
 from .repositories.report_repo import *
 from .repositories.project_repo import *
+from .repositories.search_repo import *
+from .repositories.job_repo import *
 from .repositories.operation_repo import *
 from .repositories.employee_repo import (
     create_employee,
@@ -0,0 +1,325 @@
+"""
+Pool asíncrono de conexiones y capa de consultas awaitable.
+
+Convive con app.database.core (pool síncrono ThreadedConnectionPool):
+- Los endpoints async pueden hacer `await async_core.execute_query(...)` sin
+  ocupar un hilo del threadpool de asyncio.to_thread.
+- Usa el modo asíncrono nativo de psycopg2 (async_=1) integrado con el event
+  loop mediante add_reader/add_writer, por lo que no requiere dependencias nuevas.
+
+Limitaciones del modo asíncrono de psycopg2:
+- Las conexiones son AUTOCOMMIT: cada sentencia es su propia transacción.
+  Las transacciones de varias sentencias siguen usando get_db_connection().
+- No soporta cursores con nombre (server-side) ni COPY.
+"""
+
+import asyncio
+import os
+import time
+import traceback
+from collections import deque
+from contextlib import asynccontextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+from dotenv import load_dotenv
+
+# --- CONFIGURACIÓN DEL POOL ASÍNCRONO GLOBAL ---
+async_pool = None
+
+
+class PoolTimeoutError(Exception):
+    """No se obtuvo una conexión dentro del tiempo de espera configurado."""
+    pass
+
+
+class PoolOverloadedError(Exception):
+    """La cola de espera del pool superó el máximo permitido (backpressure)."""
+    pass
+
+
+async def _wait(conn):
+    """
+    Espera a que la conexión asíncrona termine la operación en curso
+    (conexión o consulta), cediendo el control al event loop.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+
+        fd = conn.fileno()
+        fut = loop.create_future()
+
+        def _ready():
+            if not fut.done():
+                fut.set_result(None)
+
+        if state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(fd, _ready)
+            try:
+                await fut
+            finally:
+                loop.remove_reader(fd)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            loop.add_writer(fd, _ready)
+            try:
+                await fut
+            finally:
+                loop.remove_writer(fd)
+        else:
+            raise psycopg2.OperationalError(f"Estado de poll() inesperado: {state}")
+
+
+class AsyncConnectionPool:
+    """
+    Pool de conexiones asíncronas con:
+    - Límite de conexiones abiertas (maxconn) y mínimo precalentado (minconn).
+    - Timeout de adquisición (acquire_timeout).
+    - Máximo de peticiones en espera (max_waiters) -> PoolOverloadedError.
+    - Health check al entregar conexiones ociosas (SELECT 1 si superan health_check_interval).
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=10, acquire_timeout=10.0,
+                 max_waiters=50, health_check_interval=30.0, **connect_kwargs):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.acquire_timeout = acquire_timeout
+        self.max_waiters = max_waiters
+        self.health_check_interval = health_check_interval
+        self.connect_kwargs = connect_kwargs
+
+        self._idle = deque()  # (conn, last_used_ts)
+        self._slots = asyncio.Semaphore(maxconn)
+        self._waiters = 0
+        self._in_use = 0
+        self._closed = False
+
+    async def _connect(self):
+        conn = psycopg2.connect(self.dsn, async_=1, **self.connect_kwargs)
+        try:
+            await _wait(conn)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    async def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if (time.monotonic() - last_used) < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+                await _wait(conn)
+            return True
+        except Exception:
+            return False
+
+    async def open(self):
+        """Precalienta minconn conexiones (Fail Fast si la BD no responde)."""
+        for _ in range(self.minconn):
+            conn = await self._connect()
+            self._idle.append((conn, time.monotonic()))
+
+    async def acquire(self, timeout=None):
+        if self._closed:
+            raise PoolTimeoutError("El pool asíncrono está cerrado.")
+
+        if self._slots.locked() and self._waiters >= self.max_waiters:
+            raise PoolOverloadedError(
+                f"Pool saturado: {self._waiters} peticiones en espera (máx {self.max_waiters})."
+            )
+
+        timeout = self.acquire_timeout if timeout is None else timeout
+        self._waiters += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeoutError(
+                f"No se obtuvo conexión en {timeout}s ({self._in_use}/{self.maxconn} en uso)."
+            )
+        finally:
+            self._waiters -= 1
+
+        try:
+            conn = None
+            while self._idle:
+                candidate, last_used = self._idle.popleft()
+                if await self._is_healthy(candidate, last_used):
+                    conn = candidate
+                    break
+                print(" -> [ASYNC POOL] Descartando conexión inactiva/rota.")
+                self._discard(candidate)
+            if conn is None:
+                conn = await self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+        self._in_use += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            if not conn.closed:
+                conn.close()
+        except Exception:
+            pass
+
+    def release(self, conn, discard=False):
+        self._in_use -= 1
+        try:
+            # Una conexión con una consulta a medio ejecutar (p.ej. tarea cancelada)
+            # no puede reutilizarse: se cancela en servidor y se descarta.
+            if not conn.closed and conn.isexecuting():
+                try: conn.cancel()
+                except Exception: pass
+                discard = True
+
+            if discard or self._closed or conn.closed:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    @asynccontextmanager
+    async def connection(self, timeout=None):
+        conn = await self.acquire(timeout)
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.release(conn, discard=broken)
+
+    def stats(self):
+        return {
+            "max": self.maxconn,
+            "in_use": self._in_use,
+            "idle": len(self._idle),
+            "waiting": self._waiters,
+        }
+
+    async def close(self):
+        self._closed = True
+        while self._idle:
+            conn, _ = self._idle.popleft()
+            self._discard(conn)
+
+
+async def init_async_pool():
+    """
+    Inicializa el pool asíncrono global.
+    Configurable por entorno: DB_ASYNC_POOL_MIN, DB_ASYNC_POOL_MAX,
+    DB_ASYNC_ACQUIRE_TIMEOUT, DB_ASYNC_MAX_WAITERS.
+    """
+    global async_pool
+    if async_pool:
+        return async_pool
+
+    load_dotenv()
+    database_url = os.environ.get("DATABASE_URL")
+    if database_url is None:
+        raise ValueError("No se pudo conectar: DATABASE_URL no está configurada.")
+
+    connect_kwargs = {}
+    # Misma regla que el pool síncrono: SSL obligatorio fuera de localhost
+    if "localhost" not in database_url and "127.0.0.1" not in database_url:
+        connect_kwargs["sslmode"] = "require"
+
+    pool = AsyncConnectionPool(
+        database_url,
+        minconn=int(os.environ.get("DB_ASYNC_POOL_MIN", "1")),
+        maxconn=int(os.environ.get("DB_ASYNC_POOL_MAX", "10")),
+        acquire_timeout=float(os.environ.get("DB_ASYNC_ACQUIRE_TIMEOUT", "10")),
+        max_waiters=int(os.environ.get("DB_ASYNC_MAX_WAITERS", "50")),
+        **connect_kwargs
+    )
+    try:
+        await pool.open()
+    except psycopg2.OperationalError as e:
+        print(f"!!! ERROR CRÍTICO AL CREAR EL POOL ASÍNCRONO !!!\n{e}")
+        traceback.print_exc()
+        await pool.close()
+        raise
+
+    async_pool = pool
+    print(f" -> Pool de BD asíncrono creado (max {pool.maxconn}).")
+    return async_pool
+
+
+async def close_async_pool():
+    global async_pool
+    if async_pool:
+        await async_pool.close()
+        async_pool = None
+
+
+async def execute_query(query, params=(), fetchone=False, fetchall=False):
+    """
+    Versión awaitable de core.execute_query (LECTURA).
+    Misma firma y mismo formato de filas (DictRow).
+    """
+    pool = async_pool or await init_async_pool()
+
+    try:
+        async with pool.connection() as conn:
+            cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            try:
+                cursor.execute(query, params)
+                await _wait(conn)
+                if fetchone: return cursor.fetchone()
+                if fetchall: return cursor.fetchall()
+            finally:
+                cursor.close()
+    except Exception as e:
+        print(f"Error lectura SQL (async): {e}")
+        raise e
+
+
+async def execute_commit_query(query, params=(), fetchone=False):
+    """
+    Versión awaitable de core.execute_commit_query (ESCRITURA).
+    La conexión es autocommit: la sentencia queda confirmada al terminar
+    (o revertida por Postgres si falla).
+    """
+    pool = async_pool or await init_async_pool()
+
+    try:
+        async with pool.connection() as conn:
+            cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            try:
+                cursor.execute(query, params)
+                await _wait(conn)
+                if fetchone: return cursor.fetchone()
+                return True
+            finally:
+                cursor.close()
+    except Exception as e:
+        print(f"Error escritura SQL (async): {e}")
+        traceback.print_exc()
+        raise e
+
+
+async def gather_bounded(*aws, limit=3):
+    """
+    asyncio.gather con tope de concurrencia.
+    Cada awaitable (p.ej. asyncio.to_thread(db.func, ...)) solo arranca cuando
+    obtiene un turno, así una sola petición nunca ocupa más de `limit`
+    conexiones del pool a la vez. Devuelve los resultados en el mismo orden.
+    """
+    slots = asyncio.Semaphore(max(1, limit))
+
+    async def _run(aw):
+        async with slots:
+            return await aw
+
+    return await asyncio.gather(*(_run(aw) for aw in aws))
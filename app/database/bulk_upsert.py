@@ -0,0 +1,80 @@
+"""
+UPSERT masivo para las importaciones CSV de datos maestros (productos, socios,
+almacenes, ubicaciones, OTs).
+
+En vez de una conexión + un commit por fila, el repositorio abre UNA transacción
+y llama a bulk_upsert(cursor, ...), que envía las filas en lotes de
+INSERT ... VALUES ... ON CONFLICT ... DO UPDATE con execute_values. Cada fila
+devuelta trae (xmax = 0) para distinguir creadas de actualizadas.
+
+Uso desde un repositorio:
+    created, updated, returned = bulk_upsert(
+        cursor, "products",
+        columns=("company_id", "sku", "name"),
+        rows=[(company_id, "SKU-1", "Tornillo"), ...],
+        conflict_columns=("company_id", "sku"),
+        returning=("id", "sku"),
+    )
+
+- Filas repetidas para la misma clave de conflicto se colapsan (gana la última,
+  igual que aplicar las filas una a una): Postgres no permite que un mismo
+  INSERT ... ON CONFLICT DO UPDATE toque dos veces la misma fila.
+- update_where agrega "DO UPDATE ... WHERE <condición>": las filas en conflicto
+  que no la cumplen no se modifican ni se devuelven (el llamador las detecta
+  pidiendo la clave en returning).
+- No hace commit: el llamador decide (todo o nada).
+"""
+
+import psycopg2.extras
+
+BULK_UPSERT_PAGE_SIZE = 1000
+
+
+def dedupe_by_key(columns, rows, conflict_columns):
+    """Colapsa filas con la misma clave de conflicto (gana la última, conserva el orden de aparición)."""
+    key_idx = [columns.index(c) for c in conflict_columns]
+    unique = {}
+    for row in rows:
+        unique[tuple(row[i] for i in key_idx)] = tuple(row)
+    return list(unique.values())
+
+
+def bulk_upsert(cursor, table, columns, rows, conflict_columns, update_columns=None,
+                returning=(), update_where=None, page_size=BULK_UPSERT_PAGE_SIZE):
+    """
+    Inserta o actualiza `rows` (tuplas en el orden de `columns`) en `table`.
+
+    Args:
+        update_columns: columnas a sobrescribir en conflicto (por defecto todas
+                        las que no son clave).
+        returning: columnas extra a devolver por cada fila afectada.
+    Returns:
+        (created, updated, returned) donde returned es la lista de filas
+        (inserted, *returning) afectadas.
+    """
+    columns = tuple(columns)
+    rows = dedupe_by_key(columns, rows, conflict_columns)
+    if not rows:
+        return 0, 0, []
+
+    if update_columns is None:
+        update_columns = [c for c in columns if c not in conflict_columns]
+
+    if update_columns:
+        action = "DO UPDATE SET " + ", ".join(f"{c} = EXCLUDED.{c}" for c in update_columns)
+        if update_where:
+            action += f" WHERE {update_where}"
+    else:
+        action = "DO NOTHING"
+
+    returning_sql = "".join(f", {c}" for c in returning)
+    query = f"""
+        INSERT INTO {table} ({", ".join(columns)}) VALUES %s
+        ON CONFLICT ({", ".join(conflict_columns)}) {action}
+        RETURNING (xmax = 0) AS inserted{returning_sql}
+    """
+    returned = psycopg2.extras.execute_values(cursor, query, rows, page_size=page_size, fetch=True)
+
+    created = sum(1 for r in returned if r[0])
+    return created, len(returned) - created, returned
+
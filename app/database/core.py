@@ -2,13 +2,20 @@ import psycopg2
 import psycopg2.pool
 import psycopg2.extras
 import os
+import time
 import traceback
+import uuid
 from dotenv import load_dotenv
 
 # --- CONFIGURACIÓN DEL POOL GLOBAL ---
 db_pool = None
 DATABASE_URL = None
 
+# Límites de las lecturas en streaming (stream_query)
+STREAM_STATEMENT_TIMEOUT_MS = int(os.environ.get("STREAM_STATEMENT_TIMEOUT_MS", "120000"))
+STREAM_IDLE_TIMEOUT_MS = int(os.environ.get("STREAM_IDLE_TIMEOUT_MS", "60000"))
+STREAM_MAX_SECONDS = int(os.environ.get("STREAM_MAX_SECONDS", "900"))
+
 def init_db_pool():
     """
     Inicializa el pool de conexiones.
@@ -56,6 +63,22 @@ def init_db_pool():
         traceback.print_exc()
         raise
 
+def open_dedicated_connection():
+    """
+    Abre una conexión PROPIA (fuera del pool) para procesos de larga vida como
+    LISTEN. Usa LISTEN_DATABASE_URL si está definida (p.ej. conexión directa
+    cuando DATABASE_URL apunta a un pooler en modo transacción), si no DATABASE_URL.
+    """
+    load_dotenv()
+    dsn = os.environ.get("LISTEN_DATABASE_URL") or DATABASE_URL or os.environ.get("DATABASE_URL")
+    if dsn is None:
+        raise ValueError("No se pudo conectar: DATABASE_URL no está configurada.")
+
+    conn_args = {"dsn": dsn}
+    if "localhost" not in dsn and "127.0.0.1" not in dsn:
+        conn_args["sslmode"] = "require"
+    return psycopg2.connect(**conn_args)
+
 def get_db_connection():
     """Helper para obtener una conexión raw del pool (para transacciones manuales)"""
     global db_pool
@@ -126,4 +149,50 @@ def execute_commit_query(query, params=(), fetchone=False):
         if conn: conn.rollback() 
         raise e 
     finally:
-        if conn: db_pool.putconn(conn)
\ No newline at end of file
+        if conn: db_pool.putconn(conn)
+
+def stream_query(query, params=(), chunk_size=2000):
+    """
+    [STREAMING] Generador de filas (LECTURA) con cursor de servidor (named cursor).
+    Postgres entrega el resultado en bloques de `chunk_size` filas, así la memoria
+    del proceso queda plana aunque el reporte tenga cientos de miles de filas.
+    La conexión se devuelve al pool al agotar o cerrar el generador (quien lo
+    consume debe cerrarlo: ver app/streaming.py).
+
+    Límites para que una exportación no retenga la conexión indefinidamente:
+    - statement_timeout: cada FETCH (STREAM_STATEMENT_TIMEOUT_MS).
+    - idle_in_transaction_session_timeout: espera entre FETCH si el cliente
+      deja de leer (STREAM_IDLE_TIMEOUT_MS); el servidor corta la sesión.
+    - STREAM_MAX_SECONDS: duración total del recorrido.
+    """
+    global db_pool
+    if not db_pool: init_db_pool()
+
+    conn = db_pool.getconn()
+    deadline = time.monotonic() + STREAM_MAX_SECONDS
+    try:
+        with conn.cursor() as cursor:
+            # SET LOCAL: solo esta transacción; el rollback final restaura la conexión
+            cursor.execute("SET LOCAL statement_timeout = %s", (STREAM_STATEMENT_TIMEOUT_MS,))
+            cursor.execute("SET LOCAL idle_in_transaction_session_timeout = %s", (STREAM_IDLE_TIMEOUT_MS,))
+        with conn.cursor(name=f"stream_{uuid.uuid4().hex}",
+                         cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.itersize = chunk_size
+            cursor.execute(query, params)
+            for i, row in enumerate(cursor, 1):
+                if i % chunk_size == 0 and time.monotonic() > deadline:
+                    raise TimeoutError(f"La exportación superó {STREAM_MAX_SECONDS}s y fue cancelada.")
+                yield row
+        conn.rollback()  # Cierra la transacción implícita de solo lectura
+    except Exception as e:
+        print(f"Error lectura SQL (stream): {e}")
+        raise e
+    finally:
+        # Si el consumidor abandonó el generador o el servidor cortó la sesión
+        # (timeout), la conexión se descarta en lugar de volver rota al pool.
+        try:
+            if not conn.closed:
+                conn.rollback()
+        except Exception:
+            conn.close()
+        db_pool.putconn(conn)
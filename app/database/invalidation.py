@@ -0,0 +1,191 @@
+"""
+Bus de invalidación de cachés entre workers con LISTEN/NOTIFY de Postgres.
+
+Cada worker (gunicorn/uvicorn) tiene sus propias cachés en memoria (ref_cache,
+permisos...). Cuando un worker escribe, invalida su caché local y publica un
+evento (namespaces, company_id, id) en el canal CHANNEL; los demás workers lo
+reciben en un hilo de fondo y descartan las entradas correspondientes.
+
+- Sin servicio extra: NOTIFY viaja por la misma BD.
+- Ráfagas (p.ej. una importación que invalida cientos de veces) se agrupan en
+  una ventana de COALESCE_WINDOW segundos y se aplican una sola vez.
+- Si la conexión del listener cae, se reconecta con backoff y, como pudieron
+  perderse eventos, vacía todas las cachés registradas al volver.
+- Los eventos del propio proceso se ignoran (ya invalidó localmente).
+
+Otras cachés se enganchan con register_invalidation_handler(handler), donde
+handler(namespace, company_id) recibe namespace=None para "invalidar todo".
+"""
+
+import json
+import os
+import select
+import threading
+import time
+import uuid
+
+import psycopg2.extensions
+
+from .core import execute_commit_query, open_dedicated_connection
+from . import ref_cache
+
+CHANNEL = "wms_cache_invalidation"
+COALESCE_WINDOW = 0.05
+KEEPALIVE_SECONDS = 30
+RECONNECT_MAX_DELAY = 30
+
+_TOKEN = uuid.uuid4().hex[:8]
+_handlers = []
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def _origin():
+    # Con gunicorn --preload el módulo se importa antes del fork: el pid distingue workers
+    return f"{os.getpid()}-{_TOKEN}"
+
+
+def register_invalidation_handler(handler):
+    """Registra handler(namespace, company_id) para los eventos de otros workers."""
+    if handler not in _handlers:
+        _handlers.append(handler)
+
+
+def publish_invalidation(namespaces=None, company_id=None, entity_id=None):
+    """
+    Publica un evento de invalidación. namespaces=None significa "todo".
+    Un fallo al publicar no rompe la escritura (queda el TTL de las cachés).
+    """
+    payload = json.dumps({
+        "o": _origin(),
+        "n": sorted(namespaces) if namespaces else None,
+        "c": company_id,
+        "i": entity_id,
+    }, default=str)
+    try:
+        execute_commit_query("SELECT pg_notify(%s, %s)", (CHANNEL, payload))
+    except Exception as e:
+        print(f"[INVALIDATION] No se pudo publicar {payload}: {e}")
+
+
+def _dispatch(events):
+    """Aplica un lote de eventos ya agrupado: {(namespace|None, company_id|None)}."""
+    if (None, None) in events:
+        events = {(None, None)}
+    for namespace, company_id in events:
+        for handler in list(_handlers):
+            try:
+                handler(namespace, company_id)
+            except Exception as e:
+                print(f"[INVALIDATION] Handler {getattr(handler, '__name__', handler)} falló: {e}")
+
+
+def _parse(notify, events):
+    try:
+        payload = json.loads(notify.payload)
+    except (ValueError, TypeError):
+        events.add((None, None))  # Mensaje ilegible: lo seguro es vaciar todo
+        return
+    if payload.get("o") == _origin():
+        return
+    company_id = payload.get("c")
+    for namespace in (payload.get("n") or [None]):
+        events.add((namespace, company_id))
+
+
+class _InvalidationListener(threading.Thread):
+    """Hilo de fondo con su propia conexión (autocommit) escuchando CHANNEL."""
+
+    def __init__(self):
+        super().__init__(name="cache-invalidation-listener", daemon=True)
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        delay = 1
+        connected_before = False
+        while not self._stop_event.is_set():
+            conn = None
+            try:
+                conn = open_dedicated_connection()
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CHANNEL};")
+                print(f"[INVALIDATION] Escuchando '{CHANNEL}' (worker {_origin()}).")
+
+                if connected_before:
+                    # Estuvimos desconectados: pudimos perder eventos
+                    _dispatch({(None, None)})
+                connected_before = True
+                delay = 1
+                self._listen(conn)
+            except Exception as e:
+                if self._stop_event.is_set():
+                    break
+                print(f"[INVALIDATION] Conexión del listener perdida: {e}. Reintentando en {delay}s...")
+                self._stop_event.wait(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            finally:
+                if conn:
+                    try: conn.close()
+                    except Exception: pass
+
+    def _listen(self, conn):
+        last_activity = time.monotonic()
+        while not self._stop_event.is_set():
+            readable, _, _ = select.select([conn], [], [], 1.0)
+            if not readable:
+                if time.monotonic() - last_activity > KEEPALIVE_SECONDS:
+                    # Detecta conexiones muertas (select no se entera de un corte silencioso)
+                    with conn.cursor() as cursor:
+                        cursor.execute("SELECT 1")
+                    last_activity = time.monotonic()
+                continue
+
+            events = set()
+            conn.poll()
+            while conn.notifies:
+                _parse(conn.notifies.pop(0), events)
+
+            # Agrupa la ráfaga: sigue leyendo mientras lleguen eventos dentro de la ventana
+            deadline = time.monotonic() + COALESCE_WINDOW
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([conn], [], [], remaining)[0]:
+                    break
+                conn.poll()
+                while conn.notifies:
+                    _parse(conn.notifies.pop(0), events)
+
+            last_activity = time.monotonic()
+            if events:
+                _dispatch(events)
+
+
+def start_invalidation_listener():
+    """Arranca el listener de este worker (idempotente)."""
+    global _listener
+    with _listener_lock:
+        if _listener and _listener.is_alive():
+            return
+        _listener = _InvalidationListener()
+        _listener.start()
+
+
+def stop_invalidation_listener():
+    global _listener
+    with _listener_lock:
+        if _listener:
+            _listener.stop()
+            _listener.join(timeout=5)
+            _listener = None
+
+
+def _evict_reference_cache(namespace, company_id):
+    namespaces = (namespace,) if namespace else ()
+    ref_cache.invalidate_reference(*namespaces, company_id=company_id, broadcast=False)
+
+
+register_invalidation_handler(_evict_reference_cache)
@@ -0,0 +1,208 @@
+"""
+Paginación por cursor (keyset) para los listados *_filtered_sorted.
+
+Con LIMIT/OFFSET la página N obliga a Postgres a recorrer y descartar todas las
+filas anteriores. Con keyset la página siguiente se pide "después de la última
+fila vista" (columna de orden + id como desempate), así que la página 500 cuesta
+lo mismo que la primera si existe un índice sobre el orden.
+
+Uso desde un repositorio:
+    1. Agregar keyset_columns(sort_expr, id_expr) al SELECT de la consulta base
+       (sin ORDER BY ni LIMIT).
+    2. Devolver fetch_keyset_page(base_query, params, ...).
+
+El cursor es opaco para el cliente (base64 de JSON) y va ligado al orden con el
+que se generó: reutilizarlo con otro sort_by/ascending es un ValueError.
+
+Página + total en una sola consulta (with_count): la página lleva una columna
+COUNT(*) OVER() que Postgres calcula sobre el conjunto filtrado antes del LIMIT,
+así la grilla no necesita una segunda llamada a /count con los mismos joins.
+"""
+
+import base64
+import json
+import threading
+import time
+
+from .core import execute_query
+
+KEYSET_SORT_COLUMN = "_keyset_sort"
+KEYSET_ID_COLUMN = "_keyset_id"
+TOTAL_COUNT_COLUMN = "_total_count"
+
+# Columna extra para el SELECT de la página (offset): total del conjunto filtrado
+TOTAL_COUNT_SELECT = f", COUNT(*) OVER() AS {TOTAL_COUNT_COLUMN}"
+
+# Caché de conteos estimados: {(query, params): (timestamp, total)}
+COUNT_ESTIMATE_TTL = 60
+_COUNT_ESTIMATE_MAX_ENTRIES = 256
+_count_estimates = {}
+_count_estimates_lock = threading.Lock()
+
+
+def encode_cursor(sort_by, ascending, sort_value, row_id):
+    """Genera el cursor opaco a partir de la última fila de la página."""
+    payload = {"s": sort_by, "a": bool(ascending), "v": sort_value, "i": row_id}
+    raw = json.dumps(payload, default=str, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, sort_by, ascending):
+    """
+    Devuelve (sort_value, row_id) o None si el cursor está vacío (primera página).
+    Lanza ValueError si el cursor está corrupto o no corresponde al orden pedido.
+    """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        sort_value, row_id = payload["v"], payload["i"]
+    except Exception:
+        raise ValueError("Cursor de paginación inválido.")
+
+    if payload.get("s") != sort_by or payload.get("a") != bool(ascending):
+        raise ValueError("El cursor de paginación no corresponde al orden solicitado.")
+    return sort_value, row_id
+
+
+def keyset_columns(sort_expr, id_expr):
+    """Columnas extra que la consulta base debe seleccionar para paginar por cursor."""
+    return f", {sort_expr} AS {KEYSET_SORT_COLUMN}, {id_expr} AS {KEYSET_ID_COLUMN}"
+
+
+def _keyset_condition(after, ascending, same_column):
+    """WHERE para "filas posteriores a `after`" respetando ORDER BY ... NULLS LAST."""
+    if after is None:
+        return "", []
+
+    sort_value, row_id = after
+    op = ">" if ascending else "<"
+
+    if same_column:
+        return f"WHERE {KEYSET_ID_COLUMN} {op} %s", [row_id]
+    if sort_value is None:
+        # Ya estamos en el bloque de NULLs (siempre al final): solo avanza el id
+        return f"WHERE {KEYSET_SORT_COLUMN} IS NULL AND {KEYSET_ID_COLUMN} {op} %s", [row_id]
+    return (
+        f"WHERE (({KEYSET_SORT_COLUMN}, {KEYSET_ID_COLUMN}) {op} (%s, %s) OR {KEYSET_SORT_COLUMN} IS NULL)",
+        [sort_value, row_id]
+    )
+
+
+def fetch_keyset_page(base_query, params, sort_by, ascending, limit, cursor,
+                      same_column=False, with_total=False, with_count=False):
+    """
+    Ejecuta una página keyset sobre base_query (que ya incluye keyset_columns).
+
+    Retorna {"items": [dict], "next_cursor": str|None, "total_estimate": int|None}.
+    - same_column=True cuando el orden es por el propio id (condición más simple).
+    - with_total=True agrega un conteo aproximado (estimación del planner, cacheada).
+    - with_count=True agrega "total" exacto calculado en la misma consulta.
+    """
+    after = decode_cursor(cursor, sort_by, ascending)
+    where_sql, where_params = _keyset_condition(after, ascending, same_column)
+    direction = "ASC" if ascending else "DESC"
+    order_sql = (
+        f"{KEYSET_ID_COLUMN} {direction}" if same_column
+        else f"{KEYSET_SORT_COLUMN} {direction} NULLS LAST, {KEYSET_ID_COLUMN} {direction}"
+    )
+
+    # La subconsulta es simple (sin agregados ni LIMIT), Postgres la aplana y
+    # la condición/orden llegan a los índices de las tablas base.
+    # Con with_count la ventana se calcula ANTES de la condición keyset (sobre todo
+    # el conjunto filtrado); eso impide aplanar, pero evita la segunda consulta.
+    source = (
+        f"SELECT *, COUNT(*) OVER() AS {TOTAL_COUNT_COLUMN} FROM ({base_query}) counted_q"
+        if with_count else base_query
+    )
+    page_query = f"""
+        SELECT * FROM (
+            {source}
+        ) keyset_q
+        {where_sql}
+        ORDER BY {order_sql}
+        LIMIT %s
+    """
+    rows = execute_query(page_query, tuple(params) + tuple(where_params) + (limit + 1,), fetchall=True) or []
+
+    items = [dict(r) for r in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit and items:
+        last = items[-1]
+        next_cursor = encode_cursor(sort_by, ascending, last[KEYSET_SORT_COLUMN], last[KEYSET_ID_COLUMN])
+    total = _pop_total(items)
+    for item in items:
+        item.pop(KEYSET_SORT_COLUMN, None)
+        item.pop(KEYSET_ID_COLUMN, None)
+
+    page = {
+        "items": items,
+        "next_cursor": next_cursor,
+        "total_estimate": estimate_count(base_query, params) if with_total else None
+    }
+    if with_count:
+        if total is None and after is not None:
+            # Página vacía al final del recorrido: la ventana no trajo filas
+            res = execute_query(f"SELECT COUNT(*) AS total FROM ({base_query}) count_q", tuple(params), fetchone=True)
+            total = res['total'] if res else 0
+        page["total"] = total or 0
+    return page
+
+
+def _pop_total(items):
+    """Quita la columna de conteo de las filas y devuelve su valor (None si no hay filas)."""
+    total = items[0].get(TOTAL_COUNT_COLUMN) if items else None
+    for item in items:
+        item.pop(TOTAL_COUNT_COLUMN, None)
+    return total
+
+
+def fetch_counted_page(query, params, offset=None, count_fallback=None):
+    """
+    Ejecuta una página LIMIT/OFFSET cuyo SELECT incluye TOTAL_COUNT_SELECT.
+
+    Retorna {"items": [dict], "total": int, "next_cursor": None} (misma forma que
+    el modo keyset). count_fallback es una función que cuenta por separado; solo
+    se usa si la página viene vacía con offset > 0 (la ventana no trajo filas).
+    """
+    rows = execute_query(query, tuple(params), fetchall=True) or []
+    items = [dict(r) for r in rows]
+    total = _pop_total(items)
+    if total is None:
+        total = count_fallback() if (offset and count_fallback) else 0
+    return {"items": items, "total": total, "next_cursor": None}
+
+
+def estimate_count(query, params=()):
+    """
+    Conteo aproximado de filas de `query` usando la estimación del planner
+    (EXPLAIN, sin ejecutar la consulta). Se cachea COUNT_ESTIMATE_TTL segundos.
+    """
+    key = (query, tuple(params))
+    now = time.monotonic()
+    with _count_estimates_lock:
+        cached = _count_estimates.get(key)
+        if cached and now - cached[0] < COUNT_ESTIMATE_TTL:
+            return cached[1]
+
+    row = execute_query(f"EXPLAIN (FORMAT JSON) {query}", tuple(params), fetchone=True)
+    plan = row[0] if row else None
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    total = int(plan[0]["Plan"]["Plan Rows"]) if plan else 0
+
+    with _count_estimates_lock:
+        if len(_count_estimates) >= _COUNT_ESTIMATE_MAX_ENTRIES:
+            _count_estimates.clear()
+        _count_estimates[key] = (now, total)
+    return total
+
+
+def keyset_response_headers(page):
+    """Cabeceras HTTP con el cursor siguiente y el total (exacto o estimado, si se pidió)."""
+    headers = {"X-Next-Cursor": page["next_cursor"] or ""}
+    total = page.get("total", page.get("total_estimate"))
+    if total is not None:
+        headers["X-Total-Count"] = str(total)
+    return headers
@@ -0,0 +1,208 @@
+"""
+Constructor declarativo de consultas para los listados *_filtered_sorted / *_count.
+
+Cada repositorio describe su listado una sola vez (ListQuery): tabla base,
+joins disponibles, filtros por key del frontend y columnas de orden. A partir de
+esa especificación se generan la consulta de página y la de conteo con los mismos
+filtros, en lugar de mantener dos bucles de filtros que se desincronizan.
+
+Poda de joins: solo se agregan los joins cuyos alias aparecen en las expresiones
+realmente usadas (SELECT en la página; filtros activos en el conteo). Un conteo
+que solo filtra por p.state no une empleados, proyectos ni almacenes. Por eso los
+joins podables deben ser muchos-a-uno (LEFT JOIN por clave primaria) o el conteo
+debe usar COUNT(DISTINCT ...).
+
+Filtros de texto sobre columnas sin índice (o de tablas unidas) pueden declarar
+search=(entidad, expr_id): el ILIKE se antepone con un pre-filtro contra
+search_documents (índice trigram, ver search_repo) y la condición original se
+mantiene para conservar el resultado exacto.
+"""
+
+import re
+from datetime import datetime
+
+# Por debajo de 3 caracteres el índice trigram no filtra: se usa el ILIKE directo
+SEARCH_MIN_LENGTH = 3
+
+
+class Filter:
+    """
+    Filtro de un campo del listado. Usar los constructores de abajo
+    (ilike, eq, date_eq, ...) en lugar de instanciarlo directamente.
+    """
+
+    def __init__(self, op, expr, null_value=None, null_sql=None, choices=None, search=None):
+        self.op = op
+        self.expr = expr
+        self.null_value = null_value
+        self.null_sql = null_sql
+        self.choices = choices or {}
+        self.search = search
+
+    def expressions(self):
+        exprs = list(self.expr) if isinstance(self.expr, (tuple, list)) else [self.expr]
+        if self.null_sql:
+            exprs.append(self.null_sql)
+        exprs.extend(self.choices.values())
+        return [e for e in exprs if e]
+
+    def to_sql(self, value):
+        """Devuelve (sql, params) o None si el valor no aplica (p.ej. fecha inválida)."""
+        if self.null_value is not None and value == self.null_value:
+            return self.null_sql, []
+
+        if self.op == 'ilike':
+            return self._with_search(f"{self.expr} ILIKE %s", [f"%{value}%"], value)
+        if self.op == 'ilike_any':
+            parts = " OR ".join(f"{e} ILIKE %s" for e in self.expr)
+            return self._with_search(f"({parts})", [f"%{value}%"] * len(self.expr), value)
+        if self.op == 'eq':
+            return f"{self.expr} = %s", [value]
+        if self.op == 'choice':
+            sql = self.choices.get(value)
+            return (sql, []) if sql else None
+        if self.op in ('date_eq', 'date_gte', 'date_lte'):
+            try:
+                db_date = datetime.strptime(value, "%d/%m/%Y").strftime("%Y-%m-%d")
+            except (ValueError, TypeError):
+                return None
+            operator = {'date_eq': '=', 'date_gte': '>=', 'date_lte': '<='}[self.op]
+            return f"{self.expr} {operator} %s", [db_date]
+        raise ValueError(f"Operador de filtro desconocido: {self.op}")
+
+    def _with_search(self, sql, params, value):
+        """Antepone el pre-filtro indexado de search_documents (si el filtro lo declara)."""
+        if not self.search or len(str(value)) < SEARCH_MIN_LENGTH:
+            return sql, params
+        entity_type, id_expr = self.search
+        prefilter = (
+            f"{id_expr} IN (SELECT sd.entity_id FROM search_documents sd "
+            f"WHERE sd.entity_type = '{entity_type}' AND sd.search_text ILIKE %s)"
+        )
+        return f"({prefilter} AND {sql})", [f"%{value}%"] + params
+
+
+def ilike(expr, null_value=None, null_sql=None, search=None):
+    """Contiene (ILIKE %valor%). search=(entidad, expr_id) usa el índice de búsqueda."""
+    return Filter('ilike', expr, null_value, null_sql, search=search)
+
+def ilike_any(*exprs, search=None):
+    """Contiene en cualquiera de las expresiones (OR)."""
+    return Filter('ilike_any', tuple(exprs), search=search)
+
+def eq(expr, null_value=None, null_sql=None):
+    """Igualdad exacta (dropdowns, estados)."""
+    return Filter('eq', expr, null_value, null_sql)
+
+def date_eq(expr):
+    """Fecha exacta; el valor llega como DD/MM/YYYY (se ignora si no parsea)."""
+    return Filter('date_eq', expr)
+
+def date_gte(expr):
+    return Filter('date_gte', expr)
+
+def date_lte(expr):
+    return Filter('date_lte', expr)
+
+def choice(choices):
+    """Valor -> condición SQL fija (sin parámetros). Valores no listados se ignoran."""
+    return Filter('choice', None, choices=choices)
+
+
+class ListQuery:
+    """
+    Especificación de un listado.
+
+    - select: lista de columnas del SELECT de la página.
+    - from_: tabla base con alias (p.ej. "pickings p").
+    - where: condición base con sus %s (compañía, tipo...); sus params van primero.
+    - joins: {alias: (sql_del_join, (alias_requeridos, ...))} en orden de aplicación.
+    - filters: {key_del_frontend: Filter}.
+    - sorts: {key_del_frontend: expresión SQL}; default_sort es la key por defecto.
+    - count_expr: expresión del conteo (COUNT(DISTINCT ...) si hay joins uno-a-muchos).
+    """
+
+    def __init__(self, select, from_, where, joins=None, filters=None, sorts=None,
+                 default_sort='id', count_expr="COUNT(*)"):
+        self.select = select
+        self.from_ = from_
+        self.where = where
+        self.joins = joins or {}
+        self.filters = filters or {}
+        self.sorts = sorts or {}
+        self.default_sort = default_sort
+        self.count_expr = count_expr
+        self._alias_re = {
+            alias: re.compile(rf"\b{re.escape(alias)}\.") for alias in self.joins
+        }
+
+    # --- Helpers internos ---
+
+    def _aliases_in(self, *sql_parts):
+        text = " ".join(p for p in sql_parts if p)
+        return {alias for alias, rx in self._alias_re.items() if rx.search(text)}
+
+    def _join_sql(self, aliases):
+        """Joins necesarios (incluye dependencias) en el orden declarado."""
+        needed = set()
+        pending = list(aliases)
+        while pending:
+            alias = pending.pop()
+            if alias in needed:
+                continue
+            needed.add(alias)
+            pending.extend(self.joins[alias][1])
+        return "\n".join(sql for alias, (sql, _) in self.joins.items() if alias in needed)
+
+    def build_where(self, filters):
+        """Devuelve (clauses, params, expresiones_usadas) para los filtros activos."""
+        clauses, params, used = [], [], []
+        for key, value in (filters or {}).items():
+            spec = self.filters.get(key)
+            if spec is None or value is None or value == "":
+                continue
+            built = spec.to_sql(value)
+            if not built:
+                continue
+            sql, sql_params = built
+            clauses.append(sql)
+            params.extend(sql_params)
+            used.append(sql)
+        return clauses, params, used
+
+    def sort_expr(self, sort_by):
+        return self.sorts.get(sort_by) or self.sorts[self.default_sort]
+
+    # --- Consultas ---
+
+    def select_query(self, filters, base_params=(), extra_select="", sort_by=None):
+        """SELECT de la página sin ORDER BY/LIMIT (base para offset o keyset)."""
+        clauses, params, used = self.build_where(filters)
+        sort_sql = self.sort_expr(sort_by) if sort_by is not None else ""
+        joins = self._join_sql(self._aliases_in(self.select, self.where, extra_select, sort_sql, *used))
+        where_sql = " AND ".join([self.where] + clauses)
+        query = f"SELECT {self.select} {extra_select}\nFROM {self.from_}\n{joins}\nWHERE {where_sql}"
+        return query, list(base_params) + params
+
+    def page_query(self, filters, base_params=(), sort_by=None, ascending=True, limit=None, offset=None,
+                   extra_select=""):
+        """
+        SELECT + ORDER BY + LIMIT/OFFSET (paginación clásica).
+        extra_select=pagination.TOTAL_COUNT_SELECT trae el total en la misma consulta.
+        """
+        sort_by = sort_by if sort_by in self.sorts else self.default_sort
+        query, params = self.select_query(filters, base_params, extra_select=extra_select, sort_by=sort_by)
+        direction = "ASC" if ascending else "DESC"
+        query += f"\nORDER BY {self.sort_expr(sort_by)} {direction}"
+        if limit is not None and offset is not None:
+            query += " LIMIT %s OFFSET %s"
+            params.extend([limit, offset])
+        return query, params
+
+    def count_query(self, filters, base_params=()):
+        """Conteo con los mismos filtros, uniendo solo lo que los filtros necesitan."""
+        clauses, params, used = self.build_where(filters)
+        joins = self._join_sql(self._aliases_in(self.where, self.count_expr, *used))
+        where_sql = " AND ".join([self.where] + clauses)
+        query = f"SELECT {self.count_expr} AS total_count\nFROM {self.from_}\n{joins}\nWHERE {where_sql}"
+        return query, list(base_params) + params
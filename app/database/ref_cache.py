@@ -0,0 +1,111 @@
+"""
+Caché en memoria (por proceso) de datos de referencia: categorías, UdM, tipos de
+operación/picking, almacenes y ubicaciones para dropdowns y validaciones.
+
+Uso desde un repositorio:
+    @reference_data('uoms')
+    def get_uoms(company_id): ...
+
+    # En cada escritura que cambia esos datos:
+    invalidate_reference('uoms', company_id=company_id)
+
+- Las entradas expiran a los REF_CACHE_TTL segundos.
+- Tamaño acotado (LRU) a REF_CACHE_MAX_ENTRIES.
+- company_scoped=True (por defecto): el primer argumento (o company_id=) es la
+  compañía y la invalidación puede limitarse a ella. Si no, se invalida todo el
+  namespace.
+- invalidate_reference también avisa a los otros workers por LISTEN/NOTIFY
+  (invalidation.py); el TTL queda como respaldo si el aviso se pierde.
+"""
+
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+REF_CACHE_TTL = 300
+REF_CACHE_MAX_ENTRIES = 2048
+
+# (namespace, scope, args, kwargs) -> (expira_en, valor)
+_entries = OrderedDict()
+_lock = threading.Lock()
+_stats = {}        # namespace -> {"hits", "misses", "invalidations"}
+_generations = {}  # namespace -> int (evita guardar un valor leído antes de invalidar)
+
+
+def _stat(namespace):
+    return _stats.setdefault(namespace, {"hits": 0, "misses": 0, "invalidations": 0})
+
+
+def _copy(value):
+    # Los listados/conjuntos se comparten entre requests: se entrega uno nuevo
+    if isinstance(value, list):
+        return list(value)
+    if isinstance(value, set):
+        return set(value)
+    return value
+
+
+def reference_data(namespace, ttl=REF_CACHE_TTL, company_scoped=True):
+    """Decorador de lecturas de referencia (ver docstring del módulo)."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            scope = kwargs.get('company_id', args[0] if args else None) if company_scoped else None
+            key = (namespace, scope, args, tuple(sorted(kwargs.items())))
+            now = time.monotonic()
+            with _lock:
+                cached = _entries.get(key)
+                if cached and cached[0] > now:
+                    _entries.move_to_end(key)
+                    _stat(namespace)["hits"] += 1
+                    return _copy(cached[1])
+                _stat(namespace)["misses"] += 1
+                generation = _generations.get(namespace, 0)
+
+            value = fn(*args, **kwargs)
+
+            with _lock:
+                if _generations.get(namespace, 0) == generation:
+                    _entries[key] = (now + ttl, value)
+                    _entries.move_to_end(key)
+                    while len(_entries) > REF_CACHE_MAX_ENTRIES:
+                        _entries.popitem(last=False)
+            return _copy(value)
+
+        wrapper.uncached = fn
+        return wrapper
+    return decorator
+
+
+def invalidate_reference(*namespaces, company_id=None, entity_id=None, broadcast=True):
+    """
+    Descarta entradas de los namespaces dados (todos si no se pasa ninguno).
+    Con company_id solo las de esa compañía (en namespaces por compañía).
+    broadcast=True publica el evento para los demás workers (ver invalidation.py);
+    el listener lo llama con broadcast=False.
+    """
+    _evict(namespaces, company_id)
+    if broadcast:
+        # Import lazy: invalidation importa este módulo para registrar su handler
+        from .invalidation import publish_invalidation
+        publish_invalidation(namespaces or None, company_id, entity_id)
+
+
+def _evict(namespaces, company_id):
+    with _lock:
+        targets = set(namespaces) if namespaces else {key[0] for key in _entries}
+        for ns in targets:
+            _generations[ns] = _generations.get(ns, 0) + 1
+            _stat(ns)["invalidations"] += 1
+        for key in [k for k in _entries if k[0] in targets and (company_id is None or k[1] in (None, company_id))]:
+            del _entries[key]
+
+
+def reference_cache_stats():
+    """Contadores por namespace (hits, misses, invalidations, entries)."""
+    with _lock:
+        stats = {ns: dict(values, entries=0) for ns, values in _stats.items()}
+        for key in _entries:
+            stats.setdefault(key[0], {"hits": 0, "misses": 0, "invalidations": 0, "entries": 0})["entries"] += 1
+        return stats
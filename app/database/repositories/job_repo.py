@@ -0,0 +1,194 @@
+#app/database/repositories/job_repo.py
+"""
+Cola de trabajos en segundo plano sobre la tabla background_jobs.
+El ciclo de vida y los workers están en app/jobs/runner.py; aquí solo SQL.
+
+Estados: queued -> running -> done | failed | cancelled
+"""
+import json
+from ..core import get_db_connection, return_db_connection, execute_query, execute_commit_query
+
+# created_by de los trabajos internos (recálculos), que no encola un usuario
+SYSTEM_JOB_USER = "sistema"
+
+# Columnas que se devuelven al cliente al consultar un trabajo
+_JOB_PUBLIC_COLUMNS = """
+    id, company_id, kind, status, progress, progress_message, cancel_requested,
+    result, error, result_filename, (result_file IS NOT NULL) AS has_result_file,
+    created_by, created_at, started_at, finished_at, expires_at
+"""
+
+
+def create_job(company_id, kind, params, created_by, input_file=None):
+    """Encola un trabajo. Retorna su id."""
+    return execute_commit_query("""
+        INSERT INTO background_jobs (company_id, kind, params, created_by, input_file)
+        VALUES (%s, %s, %s, %s, %s)
+        RETURNING id
+    """, (company_id, kind, json.dumps(params or {}, default=str), created_by, input_file), fetchone=True)[0]
+
+
+def enqueue_job_once(company_id, kind, created_by, params=None, cursor=None):
+    """
+    Encola un trabajo sin archivo de entrada salvo que ya haya uno del mismo
+    tipo en cola para la compañía (p.ej. recálculos: basta con uno pendiente).
+    Con `cursor` se encola dentro de la transacción del llamador y solo existe
+    si esta confirma. Retorna el id creado o None si ya había uno en cola.
+    """
+    query = """
+        INSERT INTO background_jobs (company_id, kind, params, created_by)
+        SELECT %s, %s, %s, %s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM background_jobs
+            WHERE company_id = %s AND kind = %s AND status = 'queued'
+        )
+        RETURNING id
+    """
+    params = (company_id, kind, json.dumps(params or {}, default=str), created_by, company_id, kind)
+    if cursor is not None:
+        cursor.execute(query, params)
+        row = cursor.fetchone()
+    else:
+        row = execute_commit_query(query, params, fetchone=True)
+    return row[0] if row else None
+
+
+def claim_next_job(worker_name, kinds):
+    """
+    Toma el trabajo pendiente más antiguo (de los tipos que este worker sabe
+    ejecutar) y lo marca 'running'. SKIP LOCKED: varios workers/procesos
+    pueden pedir trabajo a la vez sin bloquearse ni tomar el mismo.
+    """
+    return execute_commit_query("""
+        UPDATE background_jobs SET
+            status = 'running', worker = %s,
+            started_at = NOW(), heartbeat_at = NOW(), progress = 0
+        WHERE id = (
+            SELECT id FROM background_jobs
+            WHERE status = 'queued' AND kind = ANY(%s)
+            ORDER BY created_at, id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, company_id, kind, params, created_by, input_file
+    """, (worker_name, list(kinds)), fetchone=True)
+
+
+def update_job_progress(job_id, progress, message=None):
+    """Actualiza el avance (y el heartbeat). Retorna True si se pidió cancelar."""
+    row = execute_commit_query("""
+        UPDATE background_jobs SET progress = %s, progress_message = COALESCE(%s, progress_message), heartbeat_at = NOW()
+        WHERE id = %s
+        RETURNING cancel_requested
+    """, (progress, message, job_id), fetchone=True)
+    return bool(row and row[0])
+
+
+def touch_jobs_heartbeat(job_ids):
+    """Heartbeat de los trabajos en curso de este proceso (aunque no reporten avance)."""
+    if not job_ids: return
+    execute_commit_query(
+        "UPDATE background_jobs SET heartbeat_at = NOW() WHERE id = ANY(%s) AND status = 'running'",
+        (list(job_ids),)
+    )
+
+
+def finish_job(job_id, status, result=None, error=None, result_file=None, result_filename=None, ttl_hours=24):
+    """Cierra un trabajo (done / failed / cancelled) y fija su vencimiento."""
+    execute_commit_query("""
+        UPDATE background_jobs SET
+            status = %s, result = %s, error = %s,
+            result_file = %s, result_filename = %s,
+            progress = CASE WHEN %s = 'done' THEN 100 ELSE progress END,
+            finished_at = NOW(), heartbeat_at = NOW(),
+            expires_at = NOW() + make_interval(hours => %s)
+        WHERE id = %s
+    """, (
+        status, json.dumps(result, default=str) if result is not None else None, error,
+        result_file, result_filename, status, ttl_hours, job_id
+    ))
+
+
+def request_job_cancel(job_id, company_id):
+    """
+    Cancela un trabajo: si aún está en cola se cancela de inmediato; si está
+    corriendo se marca cancel_requested y el handler se detiene en su próximo
+    reporte de avance. Retorna el estado resultante o None si no existe.
+    """
+    row = execute_commit_query("""
+        UPDATE background_jobs SET
+            cancel_requested = (status = 'running'),
+            status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END,
+            finished_at = CASE WHEN status = 'queued' THEN NOW() ELSE finished_at END,
+            expires_at = CASE WHEN status = 'queued' THEN NOW() + INTERVAL '1 hour' ELSE expires_at END
+        WHERE id = %s AND company_id = %s
+        RETURNING status
+    """, (job_id, company_id), fetchone=True)
+    return row[0] if row else None
+
+
+def get_job(job_id):
+    return execute_query(
+        f"SELECT {_JOB_PUBLIC_COLUMNS} FROM background_jobs WHERE id = %s",
+        (job_id,), fetchone=True
+    )
+
+
+def get_job_result_file(job_id):
+    return execute_query(
+        "SELECT id, company_id, created_by, status, result_file, result_filename FROM background_jobs WHERE id = %s",
+        (job_id,), fetchone=True
+    )
+
+
+def get_jobs(company_id, created_by=None, limit=50):
+    """Trabajos recientes de la compañía (de un usuario si se indica)."""
+    user_clause = "AND created_by = %s" if created_by else ""
+    params = [company_id] + ([created_by] if created_by else []) + [limit]
+    return execute_query(f"""
+        SELECT {_JOB_PUBLIC_COLUMNS} FROM background_jobs
+        WHERE company_id = %s {user_clause}
+        ORDER BY id DESC
+        LIMIT %s
+    """, tuple(params), fetchall=True)
+
+
+def fail_stale_jobs(stale_seconds):
+    """
+    Trabajos 'running' sin heartbeat (el proceso que los tenía murió).
+    Se marcan fallidos, no se reencolan: una importación a medias no es
+    idempotente. Retorna sus archivos de entrada para borrarlos.
+    """
+    return _execute_returning_all("""
+        UPDATE background_jobs SET
+            status = 'failed', error = 'El worker que ejecutaba el trabajo se detuvo. Vuelva a enviarlo.',
+            finished_at = NOW(), expires_at = NOW() + INTERVAL '24 hours'
+        WHERE status = 'running' AND heartbeat_at < NOW() - make_interval(secs => %s)
+        RETURNING id, input_file
+    """, (stale_seconds,))
+
+
+def purge_expired_jobs():
+    """Borra los trabajos vencidos. Retorna sus archivos para eliminarlos del disco."""
+    return _execute_returning_all("""
+        DELETE FROM background_jobs
+        WHERE expires_at IS NOT NULL AND expires_at < NOW()
+        RETURNING id, input_file, result_file
+    """)
+
+
+def _execute_returning_all(query, params=()):
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+        conn.commit()
+        return rows
+    except Exception as e:
+        if conn: conn.rollback()
+        print(f"[DB-ERROR] Cola de trabajos: {e}")
+        raise e
+    finally:
+        if conn: return_db_connection(conn)
@@ -4,13 +4,20 @@ import psycopg2
 import psycopg2.extras
 import psycopg2.pool
 import traceback
-import functools
 from datetime import datetime, date, timedelta
 import re
 from collections import defaultdict
 import json
-from ..core import get_db_connection, return_db_connection, execute_query, execute_commit_query
+import io
+import csv
+from ..core import get_db_connection, return_db_connection, execute_query, execute_commit_query, stream_query
+from ..pagination import fetch_keyset_page, fetch_counted_page, keyset_columns, TOTAL_COUNT_SELECT
+from .. import query_builder as qb
+from ..query_builder import ListQuery
+from ..ref_cache import reference_data
+from ..sequences import next_document_names, picking_name_prefix, REMISSION_PREFIX
 from . import project_repo
+from . import report_repo
 
 # Nota: PickingService se importa de forma lazy dentro de las funciones
 # para evitar dependencias circulares con app.services
@@ -190,6 +197,8 @@ def update_picking_header(pid: int, updates: dict):
                 moves_params.append(pid)
                 cursor.execute(query_moves, tuple(moves_params))
                 print(f"[DB] Cascada ejecutada para Picking {pid} (Moves actualizados)")
+                if current_state == 'listo':
+                    refresh_picking_reservations(cursor, pid)
 
             conn.commit()
 
@@ -200,6 +209,212 @@ def update_picking_header(pid: int, updates: dict):
     finally:
         if conn: return_db_connection(conn)
 
+# =============================================================================
+# RESERVAS DE STOCK (Agregado mantenido en stock_reservations)
+# =============================================================================
+# stock_reservations guarda, por (producto, ubicación, lote, proyecto), lo que
+# los pickings en 'listo' tienen comprometido:
+#   - reserved_qty / incoming_qty: salidas/entradas por serie (sml.qty_done si hay
+#     series, si no product_uom_qty). Es lo que muestran los reportes de stock.
+#   - demand_out_qty / demand_in_qty: demanda del movimiento (product_uom_qty),
+#     cargada en la fila sin lote. Es lo que usan los chequeos de disponibilidad.
+# stock_reservation_pickings guarda el aporte exacto de cada picking, para que
+# liberar reste lo mismo que se sumó aunque las líneas se hayan editado.
+
+_RESERVATION_CONTRIB_SQL = """
+    WITH mv AS (
+        SELECT p.id as picking_id, p.company_id, sm.id as move_id, sm.product_id,
+               sm.location_src_id, sm.location_dest_id, sm.project_id, sm.product_uom_qty
+        FROM stock_moves sm
+        JOIN pickings p ON sm.picking_id = p.id
+        WHERE sm.state != 'cancelled' AND {where}
+    ),
+    lines AS (
+        SELECT mv.*, sml.lot_id,
+               CASE WHEN sml.id IS NOT NULL THEN sml.qty_done ELSE mv.product_uom_qty END as line_qty
+        FROM mv
+        LEFT JOIN stock_move_lines sml ON sml.move_id = mv.move_id
+    )
+    SELECT picking_id, company_id, product_id, location_id, lot_id, project_id,
+           SUM(reserved_qty) as reserved_qty, SUM(incoming_qty) as incoming_qty,
+           SUM(demand_out_qty) as demand_out_qty, SUM(demand_in_qty) as demand_in_qty
+    FROM (
+        SELECT picking_id, company_id, product_id, location_src_id as location_id, lot_id, project_id,
+               line_qty as reserved_qty, 0 as incoming_qty, 0 as demand_out_qty, 0 as demand_in_qty
+        FROM lines
+        UNION ALL
+        SELECT picking_id, company_id, product_id, location_dest_id, lot_id, project_id, 0, line_qty, 0, 0
+        FROM lines
+        UNION ALL
+        SELECT picking_id, company_id, product_id, location_src_id, NULL::integer, project_id, 0, 0, product_uom_qty, 0
+        FROM mv
+        UNION ALL
+        SELECT picking_id, company_id, product_id, location_dest_id, NULL::integer, project_id, 0, 0, 0, product_uom_qty
+        FROM mv
+    ) contrib
+    WHERE location_id IS NOT NULL
+    GROUP BY picking_id, company_id, product_id, location_id, lot_id, project_id
+"""
+
+_RESERVATION_COLUMNS = "reserved_qty, incoming_qty, demand_out_qty, demand_in_qty"
+
+_RESERVATION_KEY_MATCH = """
+    r.product_id = c.product_id AND r.location_id = c.location_id
+    AND COALESCE(r.lot_id, -1) = COALESCE(c.lot_id, -1)
+    AND COALESCE(r.project_id, -1) = COALESCE(c.project_id, -1)
+"""
+
+def reserve_picking_stock(cursor, picking_id):
+    """
+    Suma el aporte del picking al agregado de reservas (al pasar a 'listo').
+    Se ejecuta dentro de la transacción del llamador.
+    """
+    cursor.execute(f"""
+        INSERT INTO stock_reservation_pickings
+            (picking_id, company_id, product_id, location_id, lot_id, project_id, {_RESERVATION_COLUMNS})
+        {_RESERVATION_CONTRIB_SQL.format(where="p.id = %s")}
+    """, (picking_id,))
+
+    # Orden estable de claves -> orden estable de bloqueos entre transacciones concurrentes
+    cursor.execute(f"""
+        INSERT INTO stock_reservations
+            (company_id, product_id, location_id, lot_id, project_id, {_RESERVATION_COLUMNS})
+        SELECT company_id, product_id, location_id, lot_id, project_id, {_RESERVATION_COLUMNS}
+        FROM stock_reservation_pickings
+        WHERE picking_id = %s
+        ORDER BY product_id, location_id, lot_id, project_id
+        ON CONFLICT (product_id, location_id, COALESCE(lot_id, -1), COALESCE(project_id, -1))
+        DO UPDATE SET
+            reserved_qty = stock_reservations.reserved_qty + EXCLUDED.reserved_qty,
+            incoming_qty = stock_reservations.incoming_qty + EXCLUDED.incoming_qty,
+            demand_out_qty = stock_reservations.demand_out_qty + EXCLUDED.demand_out_qty,
+            demand_in_qty = stock_reservations.demand_in_qty + EXCLUDED.demand_in_qty
+    """, (picking_id,))
+
+def release_picking_stock(cursor, picking_id):
+    """
+    Resta del agregado exactamente lo que el picking aportó al reservar
+    (al volver a borrador, cancelar o validar). Sin aporte previo no hace nada.
+    """
+    cursor.execute(f"""
+        UPDATE stock_reservations r SET
+            reserved_qty = r.reserved_qty - c.reserved_qty,
+            incoming_qty = r.incoming_qty - c.incoming_qty,
+            demand_out_qty = r.demand_out_qty - c.demand_out_qty,
+            demand_in_qty = r.demand_in_qty - c.demand_in_qty
+        FROM (
+            SELECT * FROM stock_reservation_pickings
+            WHERE picking_id = %s
+            ORDER BY product_id, location_id, lot_id, project_id
+        ) c
+        WHERE {_RESERVATION_KEY_MATCH}
+    """, (picking_id,))
+    if cursor.rowcount == 0:
+        return
+
+    # Limpiar claves que quedaron en cero (margen para el redondeo de REAL)
+    cursor.execute(f"""
+        DELETE FROM stock_reservations r
+        USING stock_reservation_pickings c
+        WHERE c.picking_id = %s AND {_RESERVATION_KEY_MATCH}
+          AND ABS(r.reserved_qty) < 0.000001 AND ABS(r.incoming_qty) < 0.000001
+          AND ABS(r.demand_out_qty) < 0.000001 AND ABS(r.demand_in_qty) < 0.000001
+    """, (picking_id,))
+    cursor.execute("DELETE FROM stock_reservation_pickings WHERE picking_id = %s", (picking_id,))
+
+def refresh_picking_reservations(cursor, picking_id):
+    """
+    Recalcula el aporte de un picking 'listo' tras editar sus líneas/series.
+    No hace nada si el picking no está en 'listo'.
+    """
+    cursor.execute("SELECT state FROM pickings WHERE id = %s", (picking_id,))
+    row = cursor.fetchone()
+    if row and row[0] == 'listo':
+        release_picking_stock(cursor, picking_id)
+        reserve_picking_stock(cursor, picking_id)
+
+def reconcile_stock_reservations(company_id=None, fix=False):
+    """
+    Compara stock_reservations con lo que resulta de recalcular desde los
+    movimientos de los pickings en 'listo'. Devuelve las claves con diferencia.
+    Con fix=True reconstruye ambas tablas (para la compañía o para todas).
+    """
+    company_clause = " AND p.company_id = %s" if company_id else ""
+    company_params = (company_id,) if company_id else ()
+    agg_company_clause = "WHERE company_id = %s" if company_id else ""
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            if fix:
+                # Bloquea reservas/liberaciones concurrentes mientras se reconstruye
+                cursor.execute("LOCK TABLE stock_reservation_pickings, stock_reservations IN SHARE ROW EXCLUSIVE MODE")
+
+            expected_sql = _RESERVATION_CONTRIB_SQL.format(where="p.state = 'listo'" + company_clause)
+            cursor.execute(f"""
+                WITH expected AS (
+                    SELECT product_id, location_id, lot_id, project_id,
+                           SUM(reserved_qty) as reserved_qty, SUM(incoming_qty) as incoming_qty,
+                           SUM(demand_out_qty) as demand_out_qty, SUM(demand_in_qty) as demand_in_qty
+                    FROM ({expected_sql}) e
+                    GROUP BY product_id, location_id, lot_id, project_id
+                ),
+                actual AS (
+                    SELECT product_id, location_id, lot_id, project_id, {_RESERVATION_COLUMNS}
+                    FROM stock_reservations {agg_company_clause}
+                )
+                SELECT
+                    COALESCE(e.product_id, a.product_id) as product_id,
+                    COALESCE(e.location_id, a.location_id) as location_id,
+                    COALESCE(e.lot_id, a.lot_id) as lot_id,
+                    COALESCE(e.project_id, a.project_id) as project_id,
+                    COALESCE(e.reserved_qty, 0) as expected_reserved, COALESCE(a.reserved_qty, 0) as actual_reserved,
+                    COALESCE(e.incoming_qty, 0) as expected_incoming, COALESCE(a.incoming_qty, 0) as actual_incoming,
+                    COALESCE(e.demand_out_qty, 0) as expected_demand_out, COALESCE(a.demand_out_qty, 0) as actual_demand_out,
+                    COALESCE(e.demand_in_qty, 0) as expected_demand_in, COALESCE(a.demand_in_qty, 0) as actual_demand_in
+                FROM expected e
+                FULL OUTER JOIN actual a
+                  ON e.product_id = a.product_id AND e.location_id = a.location_id
+                 AND COALESCE(e.lot_id, -1) = COALESCE(a.lot_id, -1)
+                 AND COALESCE(e.project_id, -1) = COALESCE(a.project_id, -1)
+                WHERE ABS(COALESCE(e.reserved_qty, 0) - COALESCE(a.reserved_qty, 0)) > 0.000001
+                   OR ABS(COALESCE(e.incoming_qty, 0) - COALESCE(a.incoming_qty, 0)) > 0.000001
+                   OR ABS(COALESCE(e.demand_out_qty, 0) - COALESCE(a.demand_out_qty, 0)) > 0.000001
+                   OR ABS(COALESCE(e.demand_in_qty, 0) - COALESCE(a.demand_in_qty, 0)) > 0.000001
+                ORDER BY 1, 2
+            """, company_params + company_params)
+            drift = [dict(r) for r in cursor.fetchall()]
+
+            if fix:
+                cursor.execute(f"DELETE FROM stock_reservation_pickings {agg_company_clause}", company_params)
+                cursor.execute(f"DELETE FROM stock_reservations {agg_company_clause}", company_params)
+                cursor.execute(f"""
+                    INSERT INTO stock_reservation_pickings
+                        (picking_id, company_id, product_id, location_id, lot_id, project_id, {_RESERVATION_COLUMNS})
+                    {expected_sql}
+                """, company_params)
+                cursor.execute(f"""
+                    INSERT INTO stock_reservations
+                        (company_id, product_id, location_id, lot_id, project_id, {_RESERVATION_COLUMNS})
+                    SELECT company_id, product_id, location_id, lot_id, project_id,
+                           SUM(reserved_qty), SUM(incoming_qty), SUM(demand_out_qty), SUM(demand_in_qty)
+                    FROM stock_reservation_pickings
+                    {agg_company_clause}
+                    GROUP BY company_id, product_id, location_id, lot_id, project_id
+                """, company_params)
+
+        conn.commit()
+        print(f"[RESERVAS] Conciliación (compañía={company_id or 'todas'}): {len(drift)} claves con diferencia{' (corregidas)' if fix else ''}.")
+        return drift
+
+    except Exception as e:
+        if conn: conn.rollback()
+        print(f"[RESERVAS] Error en conciliación: {e}")
+        raise e
+    finally:
+        if conn: return_db_connection(conn)
+
 def cancel_picking(picking_id):
     """
     [BLINDADO] Cancela un picking asegurando que nadie lo esté validando en ese instante.
@@ -209,7 +424,7 @@ def cancel_picking(picking_id):
         conn = get_db_connection()
         with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
             # 1. BLOQUEO ATÓMICO
-            cursor.execute("SELECT id, state FROM pickings WHERE id = %s FOR UPDATE", (picking_id,))
+            cursor.execute("SELECT id, state, company_id FROM pickings WHERE id = %s FOR UPDATE", (picking_id,))
             picking = cursor.fetchone()
             
             if not picking: return False, "El albarán no existe."
@@ -226,6 +441,8 @@ def cancel_picking(picking_id):
             cursor.execute("UPDATE pickings SET state = 'cancelled' WHERE id = %s", (picking_id,))
             # Cancelar también los movimientos hijos para liberar reservas si las hubiera
             cursor.execute("UPDATE stock_moves SET state = 'cancelled' WHERE picking_id = %s", (picking_id,))
+            release_picking_stock(cursor, picking_id)
+            report_repo.mark_dashboard_snapshot_stale(cursor, picking['company_id'])
             
         conn.commit()
         return True, "Albarán cancelado correctamente."
@@ -294,7 +511,7 @@ def mark_picking_as_ready(picking_id):
                     p.id, p.state, p.partner_id, p.scheduled_date, p.purchase_order,
                     p.date_transfer, p.custom_operation_type, p.adjustment_reason,
                     p.project_id, p.location_src_id, p.location_dest_id, p.employee_id,
-                    pt.code as type_code
+                    p.company_id, pt.code as type_code
                 FROM pickings p
                 JOIN picking_types pt ON p.picking_type_id = pt.id
                 WHERE p.id = %s FOR UPDATE
@@ -358,6 +575,12 @@ def mark_picking_as_ready(picking_id):
 
             # 8. ACTUALIZACIÓN DE ESTADO
             cursor.execute("UPDATE pickings SET state = 'listo' WHERE id = %s", (picking_id,))
+
+            # 9. REGISTRAR RESERVA EN EL AGREGADO
+            reserve_picking_stock(cursor, picking_id)
+
+            # 10. [SNAPSHOT] Cambian los pendientes/atrasados del dashboard
+            report_repo.mark_dashboard_snapshot_stale(cursor, p['company_id'])
             
         conn.commit()
         return True
@@ -382,7 +605,7 @@ def return_picking_to_draft(picking_id):
         with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
             
             # 1. BLOQUEO ATÓMICO
-            cursor.execute("SELECT id, state FROM pickings WHERE id = %s FOR UPDATE", (picking_id,))
+            cursor.execute("SELECT id, state, company_id FROM pickings WHERE id = %s FOR UPDATE", (picking_id,))
             row = cursor.fetchone()
             
             if not row: return False, "No encontrado."
@@ -400,6 +623,8 @@ def return_picking_to_draft(picking_id):
             
             # Luego liberamos las reservas en los movimientos
             cursor.execute("UPDATE stock_moves SET state = 'draft' WHERE picking_id = %s", (picking_id,))
+            release_picking_stock(cursor, picking_id)
+            report_repo.mark_dashboard_snapshot_stale(cursor, row['company_id'])
             
             conn.commit()
             return True, "Regresado a borrador exitosamente."
@@ -460,75 +685,42 @@ def bulk_picking_action(ids: list, action: str):
 
 def get_next_picking_name(picking_type_id, company_id):
     """
-    [BLINDADO CON ADVISORY LOCK] 
-    Genera secuencia única por empresa de forma segura.
-    Usa un bloqueo ligero a nivel de aplicación DB para evitar colisiones.
+    Siguiente nombre C{empresa}/{tipo}/NNNNN de la secuencia de la compañía
+    (document_sequences: un UPDATE ... RETURNING, sin locks ni búsquedas).
     """
-    # 1. Obtener código
     pt = execute_query("SELECT code FROM picking_types WHERE id = %s", (picking_type_id,), fetchone=True)
-    pt_code = pt['code']
-    prefix = f"C{company_id}/{pt_code}/"
+    if not pt:
+        raise ValueError("Tipo de operación no válido.")
+    return next_document_names(company_id, picking_name_prefix(company_id, pt['code']))[0]
 
-    conn = None
-    try:
-        conn = get_db_connection()
-        with conn.cursor() as cursor:
-            # 2. ADVISORY LOCK (Basado en un hash del prefijo para no bloquear todo el sistema)
-            # Esto pone en "fila india" solo a quienes intentan generar un código con este prefijo.
-            lock_id = abs(hash(prefix)) % 2147483647 # Postgres integer limit
-            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (lock_id,))
-            
-            # 3. Ahora que tenemos el turno exclusivo, buscamos el último
-            cursor.execute(
-                "SELECT name FROM pickings WHERE name LIKE %s AND company_id = %s ORDER BY id DESC LIMIT 1",
-                (f"{prefix}%", company_id)
-            )
-            last_res = cursor.fetchone()
-            
-            current_sequence = 0
-            if last_res:
-                try: current_sequence = int(last_res[0].split('/')[-1])
-                except: pass
+def get_next_remission_number(company_id):
+    """Secuencia para Guías de Remisión (GR-NNNNN) de la compañía."""
+    return next_document_names(company_id, REMISSION_PREFIX, column='remission_number')[0]
 
-            new_name = f"{prefix}{str(current_sequence + 1).zfill(5)}"
-            
-            # El lock se libera automáticamente al terminar la transacción (commit/rollback)
-            # o al devolver la conexión si usamos advisory_xact_lock
-            return new_name
-    finally:
-        if conn: return_db_connection(conn)
+# --- MOVIMIENTOS DE STOCK (Moves) ---
 
-def get_next_remission_number(company_id):
+def _execute_move_edit(query, params):
     """
-    [BLINDADO CON ADVISORY LOCK] Secuencia para Guías de Remisión.
+    Ejecuta una escritura sobre una línea (la consulta debe devolver picking_id)
+    y recalcula las reservas de su picking en la misma transacción, igual que
+    delete_stock_move. Si el picking está en 'listo' su aporte queda al día.
     """
     conn = None
     try:
         conn = get_db_connection()
-        with conn.cursor() as cursor:
-            # Lock específico para guías de esta empresa
-            lock_key = f"GR-{company_id}"
-            lock_id = abs(hash(lock_key)) % 2147483647
-            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (lock_id,))
-
-            cursor.execute(
-                "SELECT remission_number FROM pickings WHERE remission_number IS NOT NULL AND company_id = %s ORDER BY remission_number DESC LIMIT 1",
-                (company_id,)
-            )
-            res = cursor.fetchone()
-            
-            last = 0
-            if res:
-                # Asumiendo formato GR-00001. Si cambia, ajustar parseo.
-                try: last = int(res[0].replace("GR-", ""))
-                except: pass
-                
-            return f"GR-{str(last + 1).zfill(5)}"
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.execute(query, params)
+            row = cursor.fetchone()
+            if row:
+                refresh_picking_reservations(cursor, row['picking_id'])
+        conn.commit()
+        return row
+    except Exception as e:
+        if conn: conn.rollback()
+        raise e
     finally:
         if conn: return_db_connection(conn)
 
-# --- MOVIMIENTOS DE STOCK (Moves) ---
-
 def add_stock_move_to_picking(picking_id, product_id, qty, loc_src_id, loc_dest_id, company_id, price_unit=0, partner_id=None, project_id=None):
     """
     Añade una línea. Soporta project_id.
@@ -580,7 +772,8 @@ def add_stock_move_to_picking(picking_id, product_id, qty, loc_src_id, loc_dest_
         RETURNING *
     )
     SELECT sm.id, pr.name, pr.sku, sm.product_uom_qty, sm.quantity_done, pr.tracking, pr.id as product_id, u.name as uom_name, sm.price_unit,
-           sm.project_id, pr.ownership -- Agregamos ownership al retorno por si acaso
+           sm.project_id, pr.ownership, -- Agregamos ownership al retorno por si acaso
+           sm.picking_id
     FROM new_move sm
     JOIN products pr ON (sm.product_id = pr.id AND pr.company_id = %(cid)s)
     LEFT JOIN uom u ON pr.uom_id = u.id;
@@ -592,7 +785,7 @@ def add_stock_move_to_picking(picking_id, product_id, qty, loc_src_id, loc_dest_
         "price": price_unit, "part": partner_id, "proj": project_id
     }
     
-    new_move = execute_commit_query(query, params, fetchone=True)
+    new_move = _execute_move_edit(query, params)
     if new_move: return new_move
     raise Exception("Error creando move.")
 
@@ -601,17 +794,48 @@ def update_move_quantity_done(move_id, quantity_done, company_id):
     WITH updated_move AS (
         UPDATE stock_moves SET product_uom_qty = %(qty)s, quantity_done = %(qty)s WHERE id = %(mid)s RETURNING *
     )
-    SELECT sm.id, pr.name, pr.sku, sm.product_uom_qty, sm.quantity_done, pr.tracking, pr.id as product_id, u.name as uom_name, sm.price_unit
+    SELECT sm.id, pr.name, pr.sku, sm.product_uom_qty, sm.quantity_done, pr.tracking, pr.id as product_id, u.name as uom_name, sm.price_unit,
+           sm.picking_id
     FROM updated_move sm JOIN products pr ON (sm.product_id = pr.id AND pr.company_id = %(cid)s) LEFT JOIN uom u ON pr.uom_id = u.id;
     """
-    return execute_commit_query(query, {"qty": quantity_done, "mid": move_id, "cid": company_id}, fetchone=True)
+    return _execute_move_edit(query, {"qty": quantity_done, "mid": move_id, "cid": company_id})
 
 def update_move_price(move_id, new_price):
     """ Actualiza solo el precio unitario de una línea existente. """
-    # Usamos execute_commit_query para asegurar que se guarde
-    query = "UPDATE stock_moves SET price_unit = %s WHERE id = %s RETURNING id"
-    res = execute_commit_query(query, (new_price, move_id), fetchone=True)
-    return True if res else False
+    # [LEDGER] Si la línea ya está validada, el libro mayor se corrige en la misma sentencia
+    # y, como cambia el valor del stock, se invalidan los cierres desde la fecha del movimiento.
+    query = """
+        WITH updated_move AS (
+            UPDATE stock_moves SET price_unit = %s WHERE id = %s
+            RETURNING id, picking_id, price_unit, quantity_done, location_src_id, location_dest_id
+        ), ledger AS (
+            UPDATE stock_ledger sl SET
+                price_unit = um.price_unit,
+                value_in = CASE WHEN um.location_dest_id = sl.location_id THEN um.quantity_done * um.price_unit ELSE 0 END,
+                value_out = CASE WHEN um.location_src_id = sl.location_id THEN um.quantity_done * um.price_unit ELSE 0 END
+            FROM updated_move um
+            WHERE sl.move_id = um.id
+        )
+        SELECT um.id, p.company_id, p.state, p.date_done::date AS done_date
+        FROM updated_move um
+        LEFT JOIN pickings p ON p.id = um.picking_id
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.execute(query, (new_price, move_id))
+            res = cursor.fetchone()
+            if res and res['state'] == 'done' and res['done_date']:
+                report_repo.invalidate_stock_closings(cursor, res['company_id'], res['done_date'])
+                report_repo.mark_dashboard_snapshot_stale(cursor, res['company_id'])
+        conn.commit()
+        return True if res else False
+    except Exception as e:
+        if conn: conn.rollback()
+        raise e
+    finally:
+        if conn: return_db_connection(conn)
 
 
 def update_move_location(move_id: int, loc_src_id: int = None, loc_dest_id: int = None):
@@ -629,8 +853,8 @@ def update_move_location(move_id: int, loc_src_id: int = None, loc_dest_id: int
     if not updates:
         return False
     params.append(move_id)
-    query = f"UPDATE stock_moves SET {', '.join(updates)} WHERE id = %s RETURNING id"
-    res = execute_commit_query(query, tuple(params), fetchone=True)
+    query = f"UPDATE stock_moves SET {', '.join(updates)} WHERE id = %s RETURNING id, picking_id"
+    res = _execute_move_edit(query, tuple(params))
     return res is not None
 
 
@@ -640,7 +864,10 @@ def delete_stock_move(move_id):
         conn = get_db_connection()
         with conn.cursor() as cursor:
             cursor.execute("DELETE FROM stock_move_lines WHERE move_id = %s", (move_id,))
-            cursor.execute("DELETE FROM stock_moves WHERE id = %s", (move_id,))
+            cursor.execute("DELETE FROM stock_moves WHERE id = %s RETURNING picking_id", (move_id,))
+            deleted = cursor.fetchone()
+            if deleted:
+                refresh_picking_reservations(cursor, deleted[0])
         conn.commit()
         return True
     except Exception as e:
@@ -654,8 +881,9 @@ def save_move_lines_for_move(move_id, tracking_data: dict):
     try:
         conn = get_db_connection()
         with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-            cursor.execute("SELECT product_id FROM stock_moves WHERE id = %s", (move_id,))
-            product_id = cursor.fetchone()['product_id']
+            cursor.execute("SELECT product_id, picking_id FROM stock_moves WHERE id = %s", (move_id,))
+            move = cursor.fetchone()
+            product_id = move['product_id']
             
             cursor.execute("DELETE FROM stock_move_lines WHERE move_id = %s", (move_id,))
             count = 0
@@ -664,6 +892,7 @@ def save_move_lines_for_move(move_id, tracking_data: dict):
                 lot_id = create_lot(cursor, product_id, name)
                 cursor.execute("INSERT INTO stock_move_lines (move_id, lot_id, qty_done) VALUES (%s, %s, %s)", (move_id, lot_id, qty))
                 count += 1
+            refresh_picking_reservations(cursor, move['picking_id'])
         conn.commit()
         return True, f"{count} series guardadas."
     except Exception as e:
@@ -749,199 +978,301 @@ def _aggregate_import_lines(lines_data: list) -> list:
 
     return result
 
-def import_picking_atomic(header_data: dict, lines_data: list, company_id: int, responsible_user: str):
+def normalize_import_key(value):
+    """Clave normalizada para búsquedas insensibles a mayúsculas/espacios (equivale a TRIM + ILIKE)."""
+    return str(value).strip().lower() if value else ''
+
+
+def get_import_lookup_maps(company_id, location_pairs=(), partner_names=(), project_keys=(), skus=(), op_type_names=()):
     """
-    [TRANSACCIÓN ATÓMICA] Importa un picking completo (cabecera + líneas) de forma segura.
+    [BATCH] Resuelve TODOS los nombres de un CSV de importación con una query por entidad
+    (en lugar de 4-5 queries por fila). Una sola conexión para todo.
 
-    Si CUALQUIER validación o inserción falla, se hace ROLLBACK total.
-    Nada queda guardado en la BD hasta que TODO sea exitoso.
+    Devuelve un dict de mapas con claves normalizadas (normalize_import_key):
+        locations:      {(almacen, ubicacion): {'id', 'warehouse_id'}}
+        partners:       {nombre: {'id', 'category_name'}}
+        projects:       {(macro, codigo): project_id}
+        products:       {sku: {'id', 'name', 'tracking', 'ownership'}}
+        op_types:       {nombre (TRIM): fila operation_types}
+        picking_types:  [filas (id, code, warehouse_id) ordenadas por id]
+        warehouse_cats: {NOMBRE ALMACÉN: categoría}
+    """
+    loc_keys = sorted({(normalize_import_key(w), normalize_import_key(l)) for w, l in location_pairs if w and l})
+    partner_keys = sorted({normalize_import_key(n) for n in partner_names if n})
+    proj_keys = sorted({(normalize_import_key(m), normalize_import_key(c)) for m, c in project_keys if m and c})
+    sku_keys = sorted({normalize_import_key(s) for s in skus if s})
+    op_keys = sorted({str(n).strip() for n in op_type_names if n})
+
+    maps = {
+        'locations': {}, 'partners': {}, 'projects': {}, 'products': {},
+        'op_types': {}, 'picking_types': [], 'warehouse_cats': {}
+    }
 
-    [AGREGACIÓN AUTOMÁTICA] Si el CSV contiene múltiples filas para el mismo
-    producto, se consolidan en una sola línea con cantidad sumada y series unificadas.
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            if loc_keys:
+                cursor.execute("""
+                    SELECT DISTINCT ON (k.wh, k.loc) k.wh, k.loc, l.id, l.warehouse_id
+                    FROM unnest(%s::text[], %s::text[]) AS k(wh, loc)
+                    JOIN warehouses w ON LOWER(TRIM(w.name)) = k.wh
+                    JOIN locations l ON l.warehouse_id = w.id AND LOWER(TRIM(l.name)) = k.loc
+                    WHERE l.company_id = %s AND l.type = 'internal'
+                    ORDER BY k.wh, k.loc, l.id
+                """, ([k[0] for k in loc_keys], [k[1] for k in loc_keys], company_id))
+                maps['locations'] = {(r['wh'], r['loc']): {'id': r['id'], 'warehouse_id': r['warehouse_id']} for r in cursor.fetchall()}
+
+            if partner_keys:
+                cursor.execute("""
+                    SELECT DISTINCT ON (k.nm) k.nm, p.id, pc.name AS category_name
+                    FROM unnest(%s::text[]) AS k(nm)
+                    JOIN partners p ON LOWER(TRIM(p.name)) = k.nm AND p.company_id = %s
+                    LEFT JOIN partner_categories pc ON p.category_id = pc.id
+                    ORDER BY k.nm, p.id
+                """, (partner_keys, company_id))
+                maps['partners'] = {r['nm']: {'id': r['id'], 'category_name': r['category_name']} for r in cursor.fetchall()}
+
+            if proj_keys:
+                cursor.execute("""
+                    SELECT DISTINCT ON (k.macro, k.code) k.macro, k.code, p.id
+                    FROM unnest(%s::text[], %s::text[]) AS k(macro, code)
+                    JOIN macro_projects mp ON LOWER(TRIM(mp.name)) = k.macro
+                    JOIN projects p ON p.macro_project_id = mp.id AND LOWER(TRIM(p.code)) = k.code
+                    WHERE p.company_id = %s AND p.status = 'active'
+                    ORDER BY k.macro, k.code, p.id
+                """, ([k[0] for k in proj_keys], [k[1] for k in proj_keys], company_id))
+                maps['projects'] = {(r['macro'], r['code']): r['id'] for r in cursor.fetchall()}
+
+            if sku_keys:
+                cursor.execute("""
+                    SELECT DISTINCT ON (k.sku) k.sku, p.id, p.name, p.tracking, p.ownership
+                    FROM unnest(%s::text[]) AS k(sku)
+                    JOIN products p ON LOWER(TRIM(p.sku)) = k.sku AND p.company_id = %s
+                    ORDER BY k.sku, p.id
+                """, (sku_keys, company_id))
+                maps['products'] = {r['sku']: dict(r) for r in cursor.fetchall()}
 
-    Args:
-        header_data: dict con keys:
-            - picking_type_id, src_loc_id, dest_loc_id, op_type_name,
-            - partner_id, date_transfer_db, partner_ref, purchase_order, project_id
-        lines_data: list de dicts con keys:
-            - product_id, final_qty, final_price, serials (list)
-        company_id: ID de la empresa
-        responsible_user: Usuario que importa
+            if op_keys:
+                cursor.execute("SELECT * FROM operation_types WHERE TRIM(name) = ANY(%s)", (op_keys,))
+                maps['op_types'] = {r['name'].strip(): r for r in cursor.fetchall()}
+
+            cursor.execute("SELECT id, code, warehouse_id FROM picking_types WHERE company_id = %s ORDER BY id", (company_id,))
+            maps['picking_types'] = [dict(r) for r in cursor.fetchall()]
+
+            cursor.execute("""
+                SELECT w.name, wc.name AS cat_name FROM warehouses w
+                JOIN warehouse_categories wc ON w.category_id = wc.id
+                WHERE w.company_id = %s
+            """, (company_id,))
+            maps['warehouse_cats'] = {r['name'].upper(): r['cat_name'] for r in cursor.fetchall()}
 
+        return maps
+    finally:
+        if conn: return_db_connection(conn)
+
+
+def _reserve_picking_names(cursor, company_id, pt_code, count):
+    """
+    Reserva 'count' nombres consecutivos C{company}/{code}/NNNNN en un solo bloque
+    de la secuencia, dentro de la transacción del llamador (un rollback los devuelve).
+    """
+    return next_document_names(company_id, picking_name_prefix(company_id, pt_code), count, cursor=cursor)
+
+
+def _ownership_violation_message(op_type_name, product_name):
+    if op_type_name == "Compra Nacional":
+        return f"No puedes comprar '{product_name}' porque es material Consignado."
+    elif op_type_name == "Consignación Recibida":
+        return f"'{product_name}' es material Propio, no puedes recibirlo como Consignación."
+    elif op_type_name == "Devolución a Proveedor":
+        return f"No puedes devolver '{product_name}' a proveedor porque es Consignado."
+    elif op_type_name == "Devolución a Cliente":
+        return f"No puedes devolver '{product_name}' a cliente porque es Propio."
+    return f"Producto '{product_name}' no compatible con operación '{op_type_name}'."
+
+
+def import_pickings_bulk(documents: list, company_id: int, responsible_user: str):
+    """
+    [PIPELINE MASIVO] Importa N pickings (cabecera + líneas + series) en UNA transacción.
+
+    1. Valida reglas de ownership de todos los documentos con una sola query.
+    2. Reserva los nombres por tipo de albarán e inserta las cabeceras en bloque.
+    3. Carga líneas y series con COPY a tablas temporales (staging).
+    4. Materializa stock_moves, stock_lots y stock_move_lines con SQL set-based.
+
+    Args:
+        documents: lista de dicts {'doc_origen', 'header', 'lines'} con el mismo formato
+                   que import_picking_atomic (lines puede estar vacío: solo cabecera).
     Returns:
-        (success: bool, message: str, picking_id: int or None)
+        (created: list[{'doc_origen', 'id', 'name'}], errors: list[(doc_origen, mensaje)]).
+        Si hay errores NO se guarda nada.
     """
-    conn = None
-    new_picking_id = None
+    if not documents: return [], []
+
+    for doc in documents:
+        doc['lines'] = _aggregate_import_lines(doc.get('lines') or [])
 
+    conn = None
     try:
         conn = get_db_connection()
         with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
 
-            # ═══════════════════════════════════════════════════════════════════
-            # FASE 0: AGREGACIÓN DE LÍNEAS DUPLICADAS
-            # ═══════════════════════════════════════════════════════════════════
-            # Consolida filas con el mismo product_id: suma cantidades, une series
-            lines_data = _aggregate_import_lines(lines_data)
-
-            # ═══════════════════════════════════════════════════════════════════
-            # FASE 1: VALIDACIÓN PREVIA DE TODAS LAS LÍNEAS (Antes de crear nada)
-            # ═══════════════════════════════════════════════════════════════════
-            op_type_name = header_data.get('op_type_name')
-            required_ownership = OWNERSHIP_RULES.get(op_type_name)
-
-            if required_ownership:
-                # [OPTIMIZADO] Una sola consulta para todos los productos (evita N+1)
-                product_ids = [line['product_id'] for line in lines_data]
+            # --- 1. VALIDACIÓN DE OWNERSHIP (una sola query para todos los documentos) ---
+            all_product_ids = list({l['product_id'] for d in documents for l in d['lines']})
+            products_map = {}
+            if all_product_ids:
                 cursor.execute(
                     "SELECT id, name, ownership FROM products WHERE id = ANY(%s) AND company_id = %s",
-                    (product_ids, company_id)
+                    (all_product_ids, company_id)
                 )
                 products_map = {row['id']: row for row in cursor.fetchall()}
 
-                # Validar cada línea contra el mapa precargado
-                for i, line in enumerate(lines_data):
-                    product_id = line['product_id']
-                    prod = products_map.get(product_id)
+            errors = []
+            for doc in documents:
+                op_type_name = doc['header'].get('op_type_name')
+                required_ownership = OWNERSHIP_RULES.get(op_type_name)
+                if not required_ownership: continue
+                for i, line in enumerate(doc['lines']):
+                    prod = products_map.get(line['product_id'])
                     if not prod:
-                        raise ValueError(f"Línea {i+1}: Producto ID {product_id} no encontrado.")
-
-                    actual_ownership = prod['ownership'] or 'owned'
-                    if actual_ownership != required_ownership:
-                        if op_type_name == "Compra Nacional":
-                            msg = f"No puedes comprar '{prod['name']}' porque es material Consignado."
-                        elif op_type_name == "Consignación Recibida":
-                            msg = f"'{prod['name']}' es material Propio, no puedes recibirlo como Consignación."
-                        elif op_type_name == "Devolución a Proveedor":
-                            msg = f"No puedes devolver '{prod['name']}' a proveedor porque es Consignado."
-                        elif op_type_name == "Devolución a Cliente":
-                            msg = f"No puedes devolver '{prod['name']}' a cliente porque es Propio."
-                        else:
-                            msg = f"Producto '{prod['name']}' no compatible con operación '{op_type_name}'."
-                        raise ValueError(f"Regla de Negocio: {msg}")
-
-            # ═══════════════════════════════════════════════════════════════════
-            # FASE 2: CREAR CABECERA (Picking)
-            # ═══════════════════════════════════════════════════════════════════
-
-            # Obtener código del tipo de picking (usa la misma lógica que get_next_picking_name)
-            cursor.execute(
-                "SELECT code FROM picking_types WHERE id = %s",
-                (header_data['picking_type_id'],)
-            )
-            pt_row = cursor.fetchone()
-            if not pt_row:
-                raise ValueError("Tipo de albarán no encontrado.")
-
-            pt_code = pt_row['code']
-            prefix = f"C{company_id}/{pt_code}/"
-
-            # Buscar último picking con este prefijo (misma lógica que get_next_picking_name)
-            cursor.execute(
-                "SELECT name FROM pickings WHERE name LIKE %s AND company_id = %s ORDER BY id DESC LIMIT 1",
-                (f"{prefix}%", company_id)
-            )
-            last_res = cursor.fetchone()
-
-            current_sequence = 0
-            if last_res:
-                try:
-                    current_sequence = int(last_res['name'].split('/')[-1])
-                except:
-                    pass
-
-            new_name = f"{prefix}{str(current_sequence + 1).zfill(5)}"
-
-            # Insertar picking
-            cursor.execute("""
+                        errors.append((doc['doc_origen'], f"Línea {i+1}: Producto ID {line['product_id']} no encontrado."))
+                        break
+                    if (prod['ownership'] or 'owned') != required_ownership:
+                        errors.append((doc['doc_origen'], f"Regla de Negocio: {_ownership_violation_message(op_type_name, prod['name'])}"))
+                        break
+            if errors:
+                conn.rollback()
+                return [], errors
+
+            # --- 2. CABECERAS: nombres por bloque + INSERT masivo ---
+            type_ids = list({d['header']['picking_type_id'] for d in documents})
+            cursor.execute("SELECT id, code FROM picking_types WHERE id = ANY(%s)", (type_ids,))
+            type_code_map = {r['id']: r['code'] for r in cursor.fetchall()}
+
+            docs_by_code = defaultdict(list)
+            for doc in documents:
+                pt_code = type_code_map.get(doc['header']['picking_type_id'])
+                if not pt_code:
+                    conn.rollback()
+                    return [], [(doc['doc_origen'], "Tipo de albarán no encontrado.")]
+                docs_by_code[pt_code].append(doc)
+
+            for pt_code in sorted(docs_by_code):
+                docs = docs_by_code[pt_code]
+                for doc, name in zip(docs, _reserve_picking_names(cursor, company_id, pt_code, len(docs))):
+                    doc['name'] = name
+
+            now = datetime.now()
+            header_rows = [(
+                company_id, d['name'], d['header']['picking_type_id'],
+                d['header'].get('src_loc_id'), d['header'].get('dest_loc_id'),
+                now, responsible_user, d['header'].get('project_id'),
+                d['header'].get('partner_id'), d['header'].get('partner_ref'),
+                d['header'].get('purchase_order'), d['header'].get('date_transfer_db'),
+                d['header'].get('op_type_name'),
+                d['header'].get('operations_instructions'), d['header'].get('warehouse_observations')
+            ) for d in documents]
+            inserted = psycopg2.extras.execute_values(cursor, """
                 INSERT INTO pickings (
                     company_id, name, picking_type_id,
                     location_src_id, location_dest_id,
                     scheduled_date, state, responsible_user, project_id,
                     partner_id, partner_ref, purchase_order, date_transfer, custom_operation_type,
                     operations_instructions, warehouse_observations
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, 'draft', %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING id
-            """, (
-                company_id, new_name, header_data['picking_type_id'],
-                header_data.get('src_loc_id'), header_data.get('dest_loc_id'),
-                datetime.now(), responsible_user, header_data.get('project_id'),
-                header_data.get('partner_id'), header_data.get('partner_ref'),
-                header_data.get('purchase_order'), header_data.get('date_transfer_db'),
-                header_data.get('op_type_name'),
-                header_data.get('operations_instructions'), header_data.get('warehouse_observations')
-            ))
-
-            new_picking_id = cursor.fetchone()[0]
-
-            # ═══════════════════════════════════════════════════════════════════
-            # FASE 3: CREAR LÍNEAS (Stock Moves)
-            # ═══════════════════════════════════════════════════════════════════
-            for line in lines_data:
+                ) VALUES %s
+                RETURNING id, name
+            """, header_rows,
+                template="(%s, %s, %s, %s, %s, %s, 'draft', %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                page_size=1000, fetch=True)
+            picking_id_by_name = {r['name']: r['id'] for r in inserted}
+
+            # --- 3. STAGING (COPY) de líneas y series ---
+            lines_buf, serials_buf = io.StringIO(), io.StringIO()
+            lines_writer, serials_writer = csv.writer(lines_buf), csv.writer(serials_buf)
+            for d in documents:
+                h = d['header']
+                pick_id = picking_id_by_name[d['name']]
+                for line in d['lines']:
+                    lines_writer.writerow([
+                        pick_id, line['product_id'], line['final_qty'], line.get('final_price', 0),
+                        h.get('src_loc_id'), h.get('dest_loc_id'), h.get('partner_id'), h.get('project_id')
+                    ])
+                    for serial_name in line.get('serials', []) or []:
+                        if serial_name:
+                            serials_writer.writerow([pick_id, line['product_id'], serial_name.strip().upper()])
+
+            if lines_buf.tell():
+                cursor.execute("""
+                    CREATE TEMP TABLE _import_stage_lines (
+                        picking_id INTEGER, product_id INTEGER, qty DOUBLE PRECISION, price DOUBLE PRECISION,
+                        location_src_id INTEGER, location_dest_id INTEGER, partner_id INTEGER, project_id INTEGER
+                    ) ON COMMIT DROP
+                """)
+                cursor.execute("CREATE TEMP TABLE _import_stage_serials (picking_id INTEGER, product_id INTEGER, serial TEXT) ON COMMIT DROP")
+
+                lines_buf.seek(0)
+                cursor.copy_expert("COPY _import_stage_lines FROM STDIN WITH (FORMAT csv)", lines_buf)
+                serials_buf.seek(0)
+                cursor.copy_expert("COPY _import_stage_serials FROM STDIN WITH (FORMAT csv)", serials_buf)
+
+                # --- 4. MATERIALIZACIÓN SET-BASED ---
                 cursor.execute("""
                     INSERT INTO stock_moves (
                         picking_id, product_id, product_uom_qty, quantity_done,
                         location_src_id, location_dest_id, price_unit, partner_id, project_id
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    RETURNING id
-                """, (
-                    new_picking_id, line['product_id'], line['final_qty'], line['final_qty'],
-                    header_data.get('src_loc_id'), header_data.get('dest_loc_id'),
-                    line.get('final_price', 0), header_data.get('partner_id'),
-                    header_data.get('project_id')
-                ))
-
-                move_id = cursor.fetchone()[0]
-
-                # Insertar series si las hay
-                serials = line.get('serials', [])
-                if serials:
-                    for serial_name in serials:
-                        if not serial_name:
-                            continue
-                        # Crear o encontrar lote
-                        cursor.execute(
-                            "SELECT id FROM stock_lots WHERE product_id = %s AND name = %s",
-                            (line['product_id'], serial_name.strip().upper())
-                        )
-                        lot_row = cursor.fetchone()
-                        if lot_row:
-                            lot_id = lot_row['id']
-                        else:
-                            cursor.execute(
-                                "INSERT INTO stock_lots (product_id, name) VALUES (%s, %s) RETURNING id",
-                                (line['product_id'], serial_name.strip().upper())
-                            )
-                            lot_id = cursor.fetchone()[0]
+                    )
+                    SELECT picking_id, product_id, qty, qty, location_src_id, location_dest_id, price, partner_id, project_id
+                    FROM _import_stage_lines
+                """)
+                cursor.execute("""
+                    INSERT INTO stock_lots (product_id, name)
+                    SELECT DISTINCT product_id, serial FROM _import_stage_serials
+                    ON CONFLICT (product_id, name) DO NOTHING
+                """)
+                cursor.execute("""
+                    INSERT INTO stock_move_lines (move_id, lot_id, qty_done)
+                    SELECT sm.id, sl.id, 1
+                    FROM _import_stage_serials ss
+                    JOIN stock_moves sm ON sm.picking_id = ss.picking_id AND sm.product_id = ss.product_id
+                    JOIN stock_lots sl ON sl.product_id = ss.product_id AND sl.name = ss.serial
+                """)
 
-                        cursor.execute(
-                            "INSERT INTO stock_move_lines (move_id, lot_id, qty_done) VALUES (%s, %s, %s)",
-                            (move_id, lot_id, 1)
-                        )
+            report_repo.mark_dashboard_snapshot_stale(cursor, company_id)
 
-            # ═══════════════════════════════════════════════════════════════════
-            # FASE 4: COMMIT - Todo exitoso
-            # ═══════════════════════════════════════════════════════════════════
             conn.commit()
-            return True, f"Picking {new_name} creado exitosamente.", new_picking_id
+            print(f"[IMPORT-BULK] {len(documents)} pickings creados en una transacción.")
+            return [{'doc_origen': d['doc_origen'], 'id': picking_id_by_name[d['name']], 'name': d['name']} for d in documents], []
 
     except ValueError as ve:
-        # Error de validación de negocio
-        if conn:
-            conn.rollback()
-        return False, str(ve), None
-
+        if conn: conn.rollback()
+        return [], [(None, str(ve))]
     except Exception as e:
-        # Error inesperado
-        if conn:
-            conn.rollback()
+        if conn: conn.rollback()
         traceback.print_exc()
-        return False, f"Error interno: {str(e)}", None
-
+        return [], [(None, f"Error interno: {str(e)}")]
     finally:
-        if conn:
-            return_db_connection(conn)
+        if conn: return_db_connection(conn)
+
+
+def import_picking_atomic(header_data: dict, lines_data: list, company_id: int, responsible_user: str):
+    """
+    [TRANSACCIÓN ATÓMICA] Importa un picking completo (cabecera + líneas) de forma segura.
+
+    Si CUALQUIER validación o inserción falla, se hace ROLLBACK total.
+    [AGREGACIÓN AUTOMÁTICA] Las filas del mismo producto se consolidan.
+    Delegado en import_pickings_bulk (mismo pipeline COPY + SQL set-based).
+
+    Returns:
+        (success: bool, message: str, picking_id: int or None)
+    """
+    created, errors = import_pickings_bulk(
+        [{'doc_origen': None, 'header': header_data, 'lines': lines_data}],
+        company_id, responsible_user
+    )
+    if errors:
+        return False, errors[0][1], None
+    return True, f"Picking {created[0]['name']} creado exitosamente.", created[0]['id']
 
 
 # --- LOTES Y SERIES ---
@@ -952,26 +1283,36 @@ def get_lot_by_name(cursor, product_id, lot_name):
     cursor.execute("SELECT id FROM stock_lots WHERE product_id = %s AND name = %s", (product_id, lot_name))
     return cursor.fetchone()
 
+def _clean_lot_name(lot_name):
+    """
+    Limpieza y validación estricta del nombre de lote/serie (sin tocar la BD).
+    [CORREGIDO] Agregado .strip() para eliminar \r y \n invisibles.
+    """
+    if not lot_name:
+        return lot_name
+
+    # 1. LIMPIEZA AGRESIVA
+    # .strip() elimina \r, \n, \t del inicio y final. 
+    # .replace(" ", "") elimina espacios intermedios.
+    lot_name = str(lot_name).strip().replace(" ", "").upper()
+    
+    # 2. VALIDACIÓN DE LONGITUD
+    if len(lot_name) > 30:
+        raise ValueError(f"La serie '{lot_name[:15]}...' es demasiado larga (Máximo 30 caracteres).")
+        
+    # 3. VALIDACIÓN DE CARACTERES (Whitelist)
+    if not re.match(r'^[A-Z0-9\-_/\.]+$', lot_name):
+        # Usamos repr() para que el error muestre los caracteres invisibles si quedan (ej: 'Serie\r')
+        raise ValueError(f"La serie {repr(lot_name)} contiene caracteres inválidos. Solo se permiten letras, números y guiones.")
+
+    return lot_name
+
 def create_lot(cursor, product_id, lot_name):
     """
     Crea un lote/serie asegurando limpieza y validación estricta.
-    [CORREGIDO] Agregado .strip() para eliminar \r y \n invisibles.
     """
     try:
-        if lot_name:
-            # 1. LIMPIEZA AGRESIVA
-            # .strip() elimina \r, \n, \t del inicio y final. 
-            # .replace(" ", "") elimina espacios intermedios.
-            lot_name = str(lot_name).strip().replace(" ", "").upper()
-            
-            # 2. VALIDACIÓN DE LONGITUD
-            if len(lot_name) > 30:
-                raise ValueError(f"La serie '{lot_name[:15]}...' es demasiado larga (Máximo 30 caracteres).")
-                
-            # 3. VALIDACIÓN DE CARACTERES (Whitelist)
-            if not re.match(r'^[A-Z0-9\-_/\.]+$', lot_name):
-                # Usamos repr() para que el error muestre los caracteres invisibles si quedan (ej: 'Serie\r')
-                raise ValueError(f"La serie {repr(lot_name)} contiene caracteres inválidos. Solo se permiten letras, números y guiones.")
+        lot_name = _clean_lot_name(lot_name)
 
         cursor.execute("INSERT INTO stock_lots (name, product_id) VALUES (%s, %s) ON CONFLICT (product_id, name) DO NOTHING RETURNING id", (lot_name, product_id))
         new_id = cursor.fetchone()
@@ -982,6 +1323,29 @@ def create_lot(cursor, product_id, lot_name):
     except Exception as e:
         raise e
 
+def _bulk_get_or_create_lots(cursor, product_lot_pairs):
+    """
+    [BATCH] Versión masiva de create_lot: 2 queries para N series.
+    Recibe pares (product_id, nombre) YA LIMPIOS (_clean_lot_name) y
+    devuelve {(product_id, nombre): lot_id}.
+    """
+    pairs = sorted(set(product_lot_pairs))
+    if not pairs: return {}
+
+    pids = [p for p, _ in pairs]
+    names = [n for _, n in pairs]
+    cursor.execute("""
+        INSERT INTO stock_lots (name, product_id)
+        SELECT k.nm, k.pid FROM unnest(%s::int[], %s::text[]) AS k(pid, nm)
+        ON CONFLICT (product_id, name) DO NOTHING
+    """, (pids, names))
+    cursor.execute("""
+        SELECT sl.id, sl.product_id, sl.name
+        FROM stock_lots sl
+        JOIN unnest(%s::int[], %s::text[]) AS k(pid, nm) ON sl.product_id = k.pid AND sl.name = k.nm
+    """, (pids, names))
+    return {(r[1], r[2]): r[0] for r in cursor.fetchall()}
+
 def get_available_serials_at_location(product_id, location_id, project_id=None):
     """
     Obtiene series disponibles, filtrando por PROYECTO si se especifica.
@@ -1034,6 +1398,7 @@ def get_serials_for_picking(picking_id):
 
 # --- HELPERS DE CONFIGURACIÓN Y TIPOS ---
 
+@reference_data('picking_types')
 def get_picking_types(company_id):
     query = "SELECT MIN(id) as id, MIN(name) as name, code FROM picking_types WHERE company_id = %s GROUP BY code ORDER BY code"
     return execute_query(query, (company_id,), fetchall=True)
@@ -1047,53 +1412,122 @@ def find_picking_type_id(company_id, type_code, warehouse_id=None):
     result = execute_query(query + " LIMIT 1", tuple(params), fetchone=True)
     return result['id'] if result else None
 
+# Tipos de operación: globales (sin company_id) y de solo lectura en la app
+@reference_data('operation_types', company_scoped=False)
 def get_operation_types_by_code(code): return execute_query("SELECT id, name FROM operation_types WHERE code = %s ORDER BY name", (code,), fetchall=True)
 def get_operation_type_details(name): return execute_query("SELECT * FROM operation_types WHERE name = %s", (name,), fetchone=True)
-@functools.lru_cache
+@reference_data('operation_types', company_scoped=False)
 def get_operation_type_details_by_name(name): return execute_query("SELECT * FROM operation_types WHERE TRIM(name) = TRIM(%s)", (name,), fetchone=True)
 
 
 # --- LÓGICA CORE: VALIDACIÓN Y STOCK UPDATE (CON PROYECTOS) ---
 
+class InsufficientStockError(ValueError):
+    """
+    Uno o más deltas dejarían un quant por debajo de cero.
+    'rows' contiene las filas ofensoras: product_id, location_id, lot_id,
+    project_id, delta, quant_id (None si no existe) y quantity (stock actual).
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        first = rows[0]
+        ref = f"ID Quant: {first['quant_id']}" if first['quant_id'] else f"Prod {first['product_id']} Loc {first['location_id']}"
+        msg = f"Stock insuficiente ({ref}). Se intentó restar {abs(first['delta'])}, había {first['quantity']}."
+        if len(rows) > 1:
+            msg += f" (+{len(rows) - 1} registros más)"
+        super().__init__(msg)
+
+_QUANT_DELTA_TEMPLATE = "(%s::int, %s::int, %s::int, %s::int, %s::float8)"
+
+def apply_stock_quant_deltas(cursor, deltas):
+    """
+    [BULK] Aplica deltas de stock en 2 sentencias, sin importar cuántas filas.
+    deltas: iterable de (product_id, location_id, lot_id, project_id, delta).
+
+    1. Bloquea (FOR UPDATE) los quants existentes y detecta en servidor los que
+       quedarían < 0 -> InsufficientStockError con las filas ofensoras.
+    2. En una sola sentencia: borra los que quedan en ~0, actualiza el resto e
+       inserta los nuevos (ON CONFLICT sobre idx_stock_quants_unique).
+
+    Los deltas repetidos para la misma clave se suman antes de enviarlos.
+    Devuelve {'deleted': n, 'updated': n, 'inserted': n}.
+    """
+    net = defaultdict(float)
+    for product_id, location_id, lot_id, project_id, delta in deltas:
+        if location_id is None: raise ValueError("Location ID null")
+        net[(product_id, location_id, lot_id or None, project_id or None)] += delta
+
+    # Orden estable de claves -> orden estable de bloqueos entre transacciones concurrentes
+    rows = [
+        key + (delta,)
+        for key, delta in sorted(net.items(), key=lambda kv: tuple(-1 if v is None else v for v in kv[0]))
+        if abs(delta) > 1e-9
+    ]
+    if not rows:
+        return {'deleted': 0, 'updated': 0, 'inserted': 0}
+
+    # 1. Bloqueo + validación "nunca bajo cero"
+    offending = psycopg2.extras.execute_values(cursor, """
+        SELECT d.product_id, d.location_id, d.lot_id, d.project_id, d.delta,
+               q.id AS quant_id, COALESCE(q.quantity, 0) AS quantity
+        FROM (VALUES %s) AS d(product_id, location_id, lot_id, project_id, delta)
+        LEFT JOIN LATERAL (
+            SELECT sq.id, sq.quantity FROM stock_quants sq
+            WHERE sq.product_id = d.product_id AND sq.location_id = d.location_id
+              AND COALESCE(sq.lot_id, -1) = COALESCE(d.lot_id, -1)
+              AND COALESCE(sq.project_id, -1) = COALESCE(d.project_id, -1)
+            FOR UPDATE
+        ) q ON TRUE
+        WHERE COALESCE(q.quantity, 0) + d.delta < -0.001
+    """, rows, template=_QUANT_DELTA_TEMPLATE, page_size=len(rows), fetch=True)
+
+    if offending:
+        cols = ('product_id', 'location_id', 'lot_id', 'project_id', 'delta', 'quant_id', 'quantity')
+        raise InsufficientStockError([dict(zip(cols, r)) for r in offending])
+
+    # 2. Borrado de filas en cero + actualización + inserción (filas disjuntas)
+    result = psycopg2.extras.execute_values(cursor, """
+        WITH d(product_id, location_id, lot_id, project_id, delta) AS (VALUES %s),
+        cur AS (
+            SELECT d.*, sq.id AS quant_id, COALESCE(sq.quantity, 0) + d.delta AS new_qty
+            FROM d
+            LEFT JOIN stock_quants sq
+              ON sq.product_id = d.product_id AND sq.location_id = d.location_id
+             AND COALESCE(sq.lot_id, -1) = COALESCE(d.lot_id, -1)
+             AND COALESCE(sq.project_id, -1) = COALESCE(d.project_id, -1)
+        ),
+        del AS (
+            DELETE FROM stock_quants sq USING cur
+            WHERE sq.id = cur.quant_id AND cur.new_qty <= 0.001
+            RETURNING sq.id
+        ),
+        upd AS (
+            UPDATE stock_quants sq SET quantity = cur.new_qty
+            FROM cur
+            WHERE sq.id = cur.quant_id AND cur.new_qty > 0.001
+            RETURNING sq.id
+        ),
+        ins AS (
+            INSERT INTO stock_quants (product_id, location_id, lot_id, project_id, quantity)
+            SELECT product_id, location_id, lot_id, project_id, new_qty
+            FROM cur WHERE quant_id IS NULL AND new_qty > 0.001
+            ON CONFLICT (product_id, location_id, COALESCE(lot_id, -1), COALESCE(project_id, -1))
+            DO UPDATE SET quantity = stock_quants.quantity + EXCLUDED.quantity
+            RETURNING id
+        )
+        SELECT (SELECT COUNT(*) FROM del), (SELECT COUNT(*) FROM upd), (SELECT COUNT(*) FROM ins)
+    """, rows, template=_QUANT_DELTA_TEMPLATE, page_size=len(rows), fetch=True)
+
+    deleted, updated, inserted = result[0]
+    return {'deleted': deleted, 'updated': updated, 'inserted': inserted}
+
 def update_stock_quant(cursor, product_id, location_id, quantity_change, lot_id=None, project_id=None):
     """
-    Actualiza el stock físico.
+    Actualiza el stock físico de un único quant.
     [MODIFICADO V2] Soporta 'project_id'. Si project_id es None, usa stock general (NULL).
+    [BULK] Delegado en apply_stock_quant_deltas; para varios quants, llamar a esa función directamente.
     """
-    op_type = "SUMANDO" if quantity_change > 0 else "RESTANDO"
-    print(f"    [+] update_stock_quant: {op_type} {abs(quantity_change)} uds. Prod {product_id} Loc {location_id} Proj {project_id}")
-
-    if location_id is None: raise ValueError("Location ID null")
-    
-    # Manejo de NULLs para la consulta SQL
-    lot_sql = "lot_id = %s" if lot_id else "lot_id IS NULL"
-    proj_sql = "project_id = %s" if project_id else "project_id IS NULL"
-    
-    params = [product_id, location_id]
-    if lot_id: params.append(lot_id)
-    if project_id: params.append(project_id)
-    
-    cursor.execute(f"SELECT id, quantity FROM stock_quants WHERE product_id = %s AND location_id = %s AND {lot_sql} AND {proj_sql}", tuple(params))
-    quant = cursor.fetchone()
-    
-    if quant:
-        new_qty = quant['quantity'] + quantity_change
-        if new_qty < -0.001 and quantity_change < 0: 
-            raise ValueError(f"Stock insuficiente (ID Quant: {quant['id']}). Se intentó restar {abs(quantity_change)}, había {quant['quantity']}.")
-        
-        if new_qty > 0.001:
-            cursor.execute("UPDATE stock_quants SET quantity = %s WHERE id = %s", (new_qty, quant['id']))
-        else:
-            cursor.execute("DELETE FROM stock_quants WHERE id = %s", (quant['id'],))
-    elif quantity_change > 0.001:
-        # Crear nuevo registro de stock (con el project_id correspondiente)
-        cursor.execute(
-            "INSERT INTO stock_quants (product_id, location_id, lot_id, project_id, quantity) VALUES (%s, %s, %s, %s, %s)", 
-            (product_id, location_id, lot_id, project_id, quantity_change)
-        )
-    elif quantity_change < -0.001:
-        # Intentando restar de algo que no existe
-        pass # El validador previo debería haber atrapado esto
+    apply_stock_quant_deltas(cursor, [(product_id, location_id, lot_id, project_id, quantity_change)])
 
 def _check_stock_with_cursor(cursor, picking_id, picking_type_code):
     """
@@ -1129,19 +1563,18 @@ def _check_stock_with_cursor(cursor, picking_id, picking_type_code):
     """, (product_ids, location_ids))
     physical_map = {(row['product_id'], row['location_id']): float(row['qty']) for row in cursor.fetchall()}
 
-    # 3. [BATCH] Obtener reservas globales de TODOS en UNA query
+    # 3. [BATCH] Reservas globales desde el agregado (descontando el aporte del propio picking)
     cursor.execute("""
-        SELECT sm.product_id, sm.location_src_id, COALESCE(SUM(sm.product_uom_qty), 0) as qty
-        FROM stock_moves sm
-        JOIN pickings p ON sm.picking_id = p.id
-        WHERE sm.product_id = ANY(%s)
-          AND sm.location_src_id = ANY(%s)
-          AND p.state = 'listo'
-          AND p.id != %s
-          AND sm.state != 'cancelled'
-        GROUP BY sm.product_id, sm.location_src_id
-    """, (product_ids, location_ids, picking_id))
-    reserved_map = {(row['product_id'], row['location_src_id']): float(row['qty']) for row in cursor.fetchall()}
+        SELECT r.product_id, r.location_id,
+               SUM(r.demand_out_qty) - COALESCE((
+                   SELECT SUM(c.demand_out_qty) FROM stock_reservation_pickings c
+                   WHERE c.picking_id = %s AND c.product_id = r.product_id AND c.location_id = r.location_id
+               ), 0) as qty
+        FROM stock_reservations r
+        WHERE r.product_id = ANY(%s) AND r.location_id = ANY(%s)
+        GROUP BY r.product_id, r.location_id
+    """, (picking_id, product_ids, location_ids))
+    reserved_map = {(row['product_id'], row['location_id']): float(row['qty']) for row in cursor.fetchall()}
 
     # 4. Validar cada demanda usando los mapas precargados
     errors = []
@@ -1167,6 +1600,19 @@ def _check_stock_with_cursor(cursor, picking_id, picking_type_code):
     if errors: return False, "Stock insuficiente:\n" + "\n".join(errors)
     return True, "Ok"
 
+def _compute_weighted_cost(current_qty, current_price, incoming_qty, incoming_price):
+    """Costo Promedio Ponderado (función pura, compartida por la validación masiva)."""
+    # Protegernos contra stocks negativos teóricos al valorar
+    current_qty = max(0.0, current_qty) 
+
+    # Calcular Nuevo Precio Promedio
+    new_total_qty = current_qty + incoming_qty
+    
+    # Calcular valor total actual + valor de lo que entra
+    total_value = (current_qty * current_price) + (incoming_qty * incoming_price)
+    
+    return total_value / new_total_qty if new_total_qty > 0 else incoming_price
+
 def _update_product_weighted_cost(cursor, product_id, incoming_qty, incoming_price):
     """
     [BLINDADO FINANCIERO] Recalcula el Precio Estándar (Costo Promedio).
@@ -1188,16 +1634,7 @@ def _update_product_weighted_cost(cursor, product_id, incoming_qty, incoming_pri
     res_qty = cursor.fetchone()
     current_qty = res_qty['total'] if res_qty and res_qty['total'] else 0.0
     
-    # Protegernos contra stocks negativos teóricos al valorar
-    current_qty = max(0.0, current_qty) 
-
-    # 3. Calcular Nuevo Precio Promedio
-    new_total_qty = current_qty + incoming_qty
-    
-    # Calcular valor total actual + valor de lo que entra
-    total_value = (current_qty * current_price) + (incoming_qty * incoming_price)
-    
-    new_avg_price = total_value / new_total_qty if new_total_qty > 0 else incoming_price
+    new_avg_price = _compute_weighted_cost(current_qty, current_price, incoming_qty, incoming_price)
 
     # 4. Actualizar Maestro de Productos
     # Usamos redondeo a 4 decimales para evitar micro-cambios irrelevantes
@@ -1205,7 +1642,8 @@ def _update_product_weighted_cost(cursor, product_id, incoming_qty, incoming_pri
         cursor.execute("UPDATE products SET standard_price = %s WHERE id = %s", (new_avg_price, product_id))
         print(f"[WAC-SAFE] Prod {product_id}: {current_price:.2f} -> {new_avg_price:.2f} (Base: {current_qty} uds, Entran: {incoming_qty} @ {incoming_price})")
 
-def _process_picking_validation_with_cursor(cursor, picking_id, moves_with_tracking, validation_fields=None):
+def _process_picking_validation_with_cursor(cursor, picking_id, moves_with_tracking, validation_fields=None,
+                                            update_project_phase=True, mark_dashboard=True):
     """
     [BLINDADO v2 - PREVENCIÓN DOBLE CLIC]
     Valida y ejecuta el movimiento de stock.
@@ -1214,6 +1652,11 @@ def _process_picking_validation_with_cursor(cursor, picking_id, moves_with_track
     [NUEVO] validation_fields: dict opcional con campos que se actualizan ANTES de
             cambiar el estado a 'done'. Permite que el Almacén escriba partner_ref
             y warehouse_observations sin necesitar permiso 'can_edit'.
+    update_project_phase: False si el llamador recalcula la fase de la obra una
+            sola vez al final (p.ej. liquidación de OT con consumo + retiro).
+    mark_dashboard: False si el llamador valida varios pickings en la misma
+            transacción e invalida el snapshot una sola vez justo antes del commit
+            (tomar su fila al principio invertiría el orden de bloqueo con los quants).
     """
     # 1. BLOQUEO ATÓMICO (Critical Section)
     # Al usar FOR UPDATE, si llega un segundo clic, se quedará esperando aquí
@@ -1277,35 +1720,144 @@ def _process_picking_validation_with_cursor(cursor, picking_id, moves_with_track
     ok, msg = _check_stock_with_cursor(cursor, picking_id, p_code)
     if not ok: return False, msg
 
+    # =====================================================================
+    # 5. [SET-BASED] PRECARGA: destinos, quants, series y costos en pocas queries
+    #    (antes: varias queries por movimiento y por serie, con el picking bloqueado)
+    # =====================================================================
+    def _route(m):
+        src, dest = m['location_src_id'], m['location_dest_id']
+        if p_code == 'IN': src = v_loc
+        elif p_code == 'OUT': dest = c_loc
+        return src, dest
+
+    def _tracking_data(m):
+        return moves_with_tracking.get(str(m['id'])) or moves_with_tracking.get(m['id']) or {}
+
+    move_ids = [m['id'] for m in moves]
+    product_ids = list({m['product_id'] for m in moves})
+    location_ids, dest_ids, serial_keys = set(), set(), set()
+    for m in moves:
+        src, dest = _route(m)
+        location_ids.update(l for l in (src, dest) if l is not None)
+        if dest is not None: dest_ids.add(dest)
+        if m['tracking'] != 'none':
+            for lname in _tracking_data(m):
+                raw = lname.strip().upper()
+                # Nombre tal cual se consulta y tal cual se guarda (create_lot quita espacios)
+                serial_keys.add((m['product_id'], raw))
+                serial_keys.add((m['product_id'], raw.replace(" ", "")))
+
+    # 5.1 Categoría del almacén destino (regla ALMACEN PRINCIPAL)
+    dest_cat_map = {}
+    if dest_ids:
+        cursor.execute("""
+            SELECT l.id, wc.name FROM locations l 
+            JOIN warehouses w ON l.warehouse_id = w.id 
+            JOIN warehouse_categories wc ON w.category_id = wc.id 
+            WHERE l.id = ANY(%s)
+        """, (list(dest_ids),))
+        dest_cat_map = {r['id']: r['name'] for r in cursor.fetchall()}
+
+    # 5.2 Quants involucrados, bloqueados: (product_id, location_id, lot_name, project_id) -> [quant_id, qty]
+    # ORDER BY id: orden fijo de bloqueo entre validaciones concurrentes (como los productos en 5.3)
+    quants = {}
+    if product_ids and location_ids:
+        cursor.execute("""
+            SELECT id, product_id, location_id, project_id, quantity
+            FROM stock_quants
+            WHERE lot_id IS NULL AND product_id = ANY(%s) AND location_id = ANY(%s)
+            ORDER BY id
+            FOR UPDATE
+        """, (product_ids, list(location_ids)))
+        for r in cursor.fetchall():
+            quants[(r['product_id'], r['location_id'], None, r['project_id'])] = [r['id'], r['quantity']]
+
+    serial_rows = defaultdict(list)  # (product_id, lot_name) -> quants de esa serie
+    if serial_keys:
+        s_pids = [k[0] for k in serial_keys]
+        s_names = [k[1] for k in serial_keys]
+        cursor.execute("""
+            SELECT sq.id, sq.product_id, sq.location_id, sq.project_id, sq.quantity,
+                   sl.name AS lot_name, l.type AS loc_type, w.name AS wh_name
+            FROM stock_lots sl
+            JOIN unnest(%s::int[], %s::text[]) AS k(pid, nm) ON sl.product_id = k.pid AND sl.name = k.nm
+            JOIN stock_quants sq ON sq.lot_id = sl.id
+            JOIN locations l ON sq.location_id = l.id
+            LEFT JOIN warehouses w ON l.warehouse_id = w.id
+            ORDER BY sq.id
+            FOR UPDATE OF sq
+        """, (s_pids, s_names))
+        for r in cursor.fetchall():
+            serial_rows[(r['product_id'], r['lot_name'])].append(r)
+            quants[(r['product_id'], r['location_id'], r['lot_name'], r['project_id'])] = [r['id'], r['quantity']]
+    original_by_key = {key: q[1] for key, q in quants.items()}
+
+    # 5.3 Costo promedio: bloqueo de productos (orden fijo) + stock global actual
+    price_map, stock_total_map = {}, {}
+    wac_pids = sorted({
+        m['product_id'] for m in moves
+        if p_code == 'IN' and m['ownership'] == 'owned' and m['quantity_done'] > 0 and m['price_unit'] > 0
+    })
+    if wac_pids:
+        cursor.execute("SELECT id, standard_price FROM products WHERE id = ANY(%s) ORDER BY id FOR UPDATE", (wac_pids,))
+        price_map = {r['id']: r['standard_price'] for r in cursor.fetchall()}
+        cursor.execute("SELECT product_id, SUM(quantity) AS total FROM stock_quants WHERE product_id = ANY(%s) GROUP BY product_id", (wac_pids,))
+        stock_total_map = {r['product_id']: (r['total'] or 0.0) for r in cursor.fetchall()}
+
+    # =====================================================================
+    # 6. CÁLCULO EN MEMORIA (mismo orden y mismos mensajes que la versión fila a fila)
+    # =====================================================================
+    product_qty_delta = defaultdict(float)
+    price_updates = {}
+    pending_lines = []  # (move_id, product_id, lot_name, qty)
+
+    def _apply_quant_delta(product_id, location_id, quantity_change, lot_name=None, proj_id=None):
+        """Equivalente en memoria de update_stock_quant."""
+        if location_id is None: raise ValueError("Location ID null")
+        key = (product_id, location_id, lot_name, proj_id or None)
+        quant = quants.get(key)
+        if quant:
+            new_qty = quant[1] + quantity_change
+            if new_qty < -0.001 and quantity_change < 0:
+                raise ValueError(f"Stock insuficiente (ID Quant: {quant[0]}). Se intentó restar {abs(quantity_change)}, había {quant[1]}.")
+            if new_qty > 0.001:
+                quant[1] = new_qty
+            else:
+                del quants[key]
+            product_qty_delta[product_id] += quantity_change
+        elif quantity_change > 0.001:
+            quants[key] = [None, quantity_change]
+            product_qty_delta[product_id] += quantity_change
+        # Restar de algo que no existe: el validador previo debería haberlo atrapado
+
     processed_serials_in_transaction = set()
     
     for m in moves:
-        # ... (INICIO DE LÓGICA DE VALORACIÓN - IGUAL QUE ANTES) ...
+        # --- VALORACIÓN (Costo Promedio Ponderado) ---
         if p_code == 'IN' and m['ownership'] == 'owned':
             qty_in = m['quantity_done']
             cost_in = m['price_unit']
             if qty_in > 0 and cost_in > 0:
-                _update_product_weighted_cost(cursor, m['product_id'], qty_in, cost_in)
-        # ---------------------------------------------------
-
-        src, dest = m['location_src_id'], m['location_dest_id']
-        if p_code == 'IN': src = v_loc
-        elif p_code == 'OUT': dest = c_loc
-        
+                pid = m['product_id']
+                current_price = price_map.get(pid, 0.0)
+                current_qty = stock_total_map.get(pid, 0.0) + product_qty_delta[pid]
+                new_avg_price = _compute_weighted_cost(current_qty, current_price, qty_in, cost_in)
+                if abs(new_avg_price - current_price) > 0.0001:
+                    price_map[pid] = new_avg_price
+                    price_updates[pid] = new_avg_price
+                    print(f"[WAC-SAFE] Prod {pid}: {current_price:.2f} -> {new_avg_price:.2f} (Base: {current_qty} uds, Entran: {qty_in} @ {cost_in})")
+
+        src, dest = _route(m)
         qty_total = m['quantity_done']
         m_proj = m['project_id']
 
-        # --- LIMPIEZA DE LÍNEAS ANTERIORES (Evita duplicados Draft → Done) ---
-        # [FIX] Eliminar stock_move_lines existentes del borrador antes de recrearlas
-        cursor.execute("DELETE FROM stock_move_lines WHERE move_id = %s", (m['id'],))
-
         # --- VALIDACIÓN DE LOTE/SERIE ---
-        lot_ids_to_process = []
+        lots_to_process = []  # (lot_name limpio o None, qty)
 
         if m['tracking'] == 'none':
-            lot_ids_to_process.append((None, qty_total))
+            lots_to_process.append((None, qty_total))
         else:
-            t_data = moves_with_tracking.get(str(m['id'])) or moves_with_tracking.get(m['id']) or {}
+            t_data = _tracking_data(m)
             
             total_tracking_qty = sum(t_data.values())
             if abs(qty_total - total_tracking_qty) > 0.001:
@@ -1321,80 +1873,107 @@ def _process_picking_validation_with_cursor(cursor, picking_id, moves_with_track
                 if m['tracking'] == 'serial' and lqty > 1:
                     return False, f"Error: La serie '{lname}' tiene cantidad {lqty}. Debe ser 1."
 
+                rows = serial_rows.get((m['product_id'], lname), [])
+
                 # REGLA DE LA VIRGINIDAD (Solo Entradas - IN)
                 if p_code == 'IN' and m['tracking'] == 'serial':
-                    cursor.execute("""
-                        SELECT w.name FROM stock_quants sq
-                        JOIN stock_lots sl ON sq.lot_id = sl.id
-                        JOIN locations l ON sq.location_id = l.id
-                        JOIN warehouses w ON l.warehouse_id = w.id
-                        WHERE sl.name = %s AND sl.product_id = %s AND sq.quantity > 0 AND l.type = 'internal'
-                        LIMIT 1
-                    """, (lname, m['product_id']))
-                    existing = cursor.fetchone()
+                    existing = next((r for r in rows if r['quantity'] > 0 and r['loc_type'] == 'internal' and r['wh_name'] is not None), None)
                     if existing:
-                        return False, f"La serie '{lname}' YA EXISTE en '{existing['name']}'."
+                        return False, f"La serie '{lname}' YA EXISTE en '{existing['wh_name']}'."
 
                 # [REGLA CRÍTICA] VALIDACIÓN DE EXISTENCIA EN ORIGEN (Solo Salidas/Internas)
                 if p_code in ('OUT', 'INT'):
-                    cursor.execute("""
-                        SELECT 1 FROM stock_quants sq
-                        JOIN stock_lots sl ON sq.lot_id = sl.id
-                        WHERE sl.name = %s AND sl.product_id = %s AND sq.location_id = %s AND sq.quantity > 0
-                        LIMIT 1
-                    """, (lname, m['product_id'], src))
-                    if not cursor.fetchone():
+                    if not any(r['location_id'] == src and r['quantity'] > 0 for r in rows):
                         return False, f"La serie '{lname}' NO existe en la ubicación de origen."
 
-                lot_id = create_lot(cursor, m['product_id'], lname)
-                lot_ids_to_process.append((lot_id, lqty))
-                cursor.execute("INSERT INTO stock_move_lines (move_id, lot_id, qty_done) VALUES (%s, %s, %s)", (m['id'], lot_id, lqty))
+                clean_name = _clean_lot_name(lname)
+                lots_to_process.append((clean_name, lqty))
+                pending_lines.append((m['id'], m['product_id'], clean_name, lqty))
 
         # --- LÓGICA DE STOCK Y PROYECTOS ---
-        cursor.execute("""
-            SELECT wc.name FROM locations l 
-            JOIN warehouses w ON l.warehouse_id = w.id 
-            JOIN warehouse_categories wc ON w.category_id = wc.id 
-            WHERE l.id = %s
-        """, (dest,))
-        dest_cat_row = cursor.fetchone()
-        is_dest_main = (dest_cat_row and dest_cat_row['name'] == 'ALMACEN PRINCIPAL')
+        is_dest_main = (dest_cat_map.get(dest) == 'ALMACEN PRINCIPAL')
         dest_proj_id = None if is_dest_main else m_proj
 
-        for lot_id, qty in lot_ids_to_process:
+        for lot_name, qty in lots_to_process:
             if p_code == 'IN' or (p_code == 'ADJ' and qty > 0):
-                update_stock_quant(cursor, m['product_id'], dest, qty, lot_id, dest_proj_id)
-                if p_code == 'ADJ': update_stock_quant(cursor, m['product_id'], src, -qty, lot_id, m_proj)
+                _apply_quant_delta(m['product_id'], dest, qty, lot_name, dest_proj_id)
+                if p_code == 'ADJ': _apply_quant_delta(m['product_id'], src, -qty, lot_name, m_proj)
             else:
                 qty_to_deduct = qty
                 # A) DESCONTAR DEL ORIGEN (Proyecto específico primero)
                 if m_proj is not None:
-                    cursor.execute("SELECT quantity FROM stock_quants WHERE product_id=%s AND location_id=%s AND project_id=%s " + ("AND lot_id=%s" if lot_id else "AND lot_id IS NULL"), 
-                                   (m['product_id'], src, m_proj) + ((lot_id,) if lot_id else ()))
-                    res = cursor.fetchone()
-                    available_proj = res['quantity'] if res else 0.0
+                    proj_quant = quants.get((m['product_id'], src, lot_name, m_proj))
+                    available_proj = proj_quant[1] if proj_quant else 0.0
                     deduct_from_proj = min(qty_to_deduct, available_proj)
                     
                     if deduct_from_proj > 0:
-                        update_stock_quant(cursor, m['product_id'], src, -deduct_from_proj, lot_id, m_proj)
+                        _apply_quant_delta(m['product_id'], src, -deduct_from_proj, lot_name, m_proj)
                         qty_to_deduct -= deduct_from_proj
                 
                 # B) Si falta, descontar del Stock GENERAL
                 if qty_to_deduct > 0:
-                    update_stock_quant(cursor, m['product_id'], src, -qty_to_deduct, lot_id, None) 
+                    _apply_quant_delta(m['product_id'], src, -qty_to_deduct, lot_name, None) 
 
                 # C) SUMAR AL DESTINO
                 if p_code != 'ADJ': 
-                    update_stock_quant(cursor, m['product_id'], dest, qty, lot_id, dest_proj_id)
+                    _apply_quant_delta(m['product_id'], dest, qty, lot_name, dest_proj_id)
                 else:
                     # Ajuste negativo
-                    update_stock_quant(cursor, m['product_id'], dest, qty, lot_id, m_proj)
+                    _apply_quant_delta(m['product_id'], dest, qty, lot_name, m_proj)
+
+    # =====================================================================
+    # 7. ESCRITURA MASIVA (todo dentro de la misma transacción)
+    # =====================================================================
+    # 7.1 Lotes/series y líneas de movimiento
+    # [FIX] Eliminar stock_move_lines existentes del borrador antes de recrearlas
+    if move_ids:
+        cursor.execute("DELETE FROM stock_move_lines WHERE move_id = ANY(%s)", (move_ids,))
+    lot_id_map = _bulk_get_or_create_lots(cursor, [(pid, name) for _, pid, name, _ in pending_lines])
+    if pending_lines:
+        psycopg2.extras.execute_values(
+            cursor,
+            "INSERT INTO stock_move_lines (move_id, lot_id, qty_done) VALUES %s",
+            [(mid, lot_id_map[(pid, name)], qty) for mid, pid, name, qty in pending_lines]
+        )
+
+    # 7.2 Quants: delta neto por clave, aplicado en bloque (valida "nunca bajo cero" en servidor)
+    quant_deltas = []
+    for key in set(original_by_key) | set(quants):
+        final_qty = quants[key][1] if key in quants else 0.0
+        delta = final_qty - original_by_key.get(key, 0.0)
+        if abs(delta) > 1e-9:
+            pid, loc, lot_name, proj = key
+            quant_deltas.append((pid, loc, lot_id_map[(pid, lot_name)] if lot_name else None, proj, delta))
+    apply_stock_quant_deltas(cursor, quant_deltas)
+
+    # 7.3 Costos promedio recalculados
+    if price_updates:
+        psycopg2.extras.execute_values(
+            cursor,
+            "UPDATE products p SET standard_price = v.price FROM (VALUES %s) AS v(id, price) WHERE p.id = v.id",
+            list(price_updates.items())
+        )
 
     cursor.execute("UPDATE stock_moves SET state = 'done' WHERE picking_id = %s", (picking_id,))
     cursor.execute("UPDATE pickings SET state = 'done', date_done = NOW() WHERE id = %s", (picking_id,))
+
+    # [LEDGER] Una fila por (movimiento, ubicación) para los reportes de kardex/flujo/cobertura
+    report_repo.record_stock_ledger(cursor, picking_id)
+
+    # [RESERVAS] Lo reservado pasa a ser stock físico: se libera del agregado
+    release_picking_stock(cursor, picking_id)
     
-    if project_id:
-        project_repo.check_and_update_project_phase(project_id)
+    # [FASE] Dentro de la misma transacción: ve el stock recién movido
+    if project_id and update_project_phase:
+        project_repo.check_and_update_project_phase_with_cursor(cursor, project_id)
+
+    # [SNAPSHOT] Invalida el dashboard y encola su recálculo (se confirma con esta transacción).
+    # Se hace al final para mantener el bloqueo de la fila del snapshot lo menos posible.
+    if mark_dashboard:
+        report_repo.mark_dashboard_snapshot_stale(cursor, picking['company_id'])
+
+    # [CIERRES] No se invalidan aquí: date_done es NOW() y solo se cierran meses completos.
+    # Las rutas que modifican movimientos ya validados (p.ej. update_move_price) sí lo hacen.
 
     return True, "Validado correctamente."
 
@@ -1423,193 +2002,14 @@ def process_picking_validation(picking_id, moves_with_tracking, validation_field
         if conn: return_db_connection(conn)
 
 # --- OTROS HELPERS (Listados) ---
-def get_pickings_count(picking_type_code, company_id, filters={}):
-    """
-    Cuenta pickings aplicando los mismos filtros que get_pickings_by_type.
-    """
-    query_params = [picking_type_code, company_id]
-    where_clauses = []
-
-    # --- Lógica de Filtros (misma que get_pickings_by_type) ---
-    for key, value in filters.items():
-        if value:
-            if key in ["date_transfer_from", "date_transfer_to"]:
-                try:
-                    db_date = datetime.strptime(value, "%d/%m/%Y").strftime("%Y-%m-%d")
-                    operator = ">=" if key == "date_transfer_from" else "<="
-                    where_clauses.append(f"p.date_transfer {operator} %s")
-                    query_params.append(db_date)
-                except ValueError: pass
-            elif key == 'date':
-                try:
-                    db_date = datetime.strptime(value, "%d/%m/%Y").strftime("%Y-%m-%d")
-                    where_clauses.append("DATE(p.scheduled_date) = %s")
-                    query_params.append(db_date)
-                except ValueError: pass
-            elif key == 'transfer_date':
-                try:
-                    db_date = datetime.strptime(value, "%d/%m/%Y").strftime("%Y-%m-%d")
-                    where_clauses.append("DATE(p.date_transfer) = %s")
-                    query_params.append(db_date)
-                except ValueError: pass
-            elif key == 'state':
-                where_clauses.append("p.state = %s"); query_params.append(value)
-            elif key == 'employee_name':
-                where_clauses.append("(emp.first_name ILIKE %s OR emp.last_name ILIKE %s)")
-                query_params.extend([f"%{value}%", f"%{value}%"])
-            elif key == 'project_name':
-                where_clauses.append("(proj.code ILIKE %s OR mp.name ILIKE %s)")
-                query_params.extend([f"%{value}%", f"%{value}%"])
-            elif key == 'name':
-                where_clauses.append("p.name ILIKE %s"); query_params.append(f"%{value}%")
-            elif key == 'custom_operation_type':
-                where_clauses.append("p.custom_operation_type = %s"); query_params.append(value)
-            elif key == 'partner_ref':
-                where_clauses.append("p.partner_ref ILIKE %s"); query_params.append(f"%{value}%")
-            elif key == 'purchase_order':
-                where_clauses.append("p.purchase_order ILIKE %s"); query_params.append(f"%{value}%")
-            elif key == 'responsible_user':
-                where_clauses.append("p.responsible_user ILIKE %s"); query_params.append(f"%{value}%")
-            elif key == 'src_path_display':
-                where_clauses.append("CASE WHEN pt.code = 'IN' THEN partner.name ELSE l_src.path END ILIKE %s")
-                query_params.append(f"%{value}%")
-            elif key == 'dest_path_display':
-                where_clauses.append("CASE WHEN pt.code = 'OUT' THEN partner.name ELSE l_dest.path END ILIKE %s")
-                query_params.append(f"%{value}%")
-            elif key == 'warehouse_src_name':
-                where_clauses.append("w_src.name ILIKE %s"); query_params.append(f"%{value}%")
-            elif key == 'warehouse_dest_name':
-                where_clauses.append("w_dest.name ILIKE %s"); query_params.append(f"%{value}%")
-
-    where_string = " AND " + " AND ".join(where_clauses) if where_clauses else ""
-
-    query = f"""
-    SELECT COUNT(p.id) as total_count
-    FROM pickings p
-    JOIN picking_types pt ON p.picking_type_id = pt.id
-    LEFT JOIN locations l_src ON p.location_src_id = l_src.id
-    LEFT JOIN locations l_dest ON p.location_dest_id = l_dest.id
-    LEFT JOIN partners partner ON p.partner_id = partner.id
-    LEFT JOIN warehouses w_src ON l_src.warehouse_id = w_src.id
-    LEFT JOIN warehouses w_dest ON l_dest.warehouse_id = w_dest.id
-    LEFT JOIN employees emp ON p.employee_id = emp.id
-    LEFT JOIN projects proj ON p.project_id = proj.id
-    LEFT JOIN macro_projects mp ON proj.macro_project_id = mp.id
-    WHERE pt.code = %s AND p.company_id = %s AND pt.code != 'ADJ'
-    {where_string}
-    """
-    result = execute_query(query, tuple(query_params), fetchone=True)
-    return result['total_count'] if result else 0
-
-def get_pickings_by_type(picking_type_code, company_id, filters={}, sort_by='id', ascending=False, limit=None, offset=None):
-    """
-    Obtiene la lista de operaciones.
-    [CORREGIDO] 'project_name' ahora devuelve "PEP (Macro)" en lugar del nombre simple.
-    """
-    sort_map = {
-        'name': "p.name", 'purchase_order': "p.purchase_order", 
-        'project_name': "proj.code", # Ordenar por código PEP es más útil ahora
-        'src_path_display': "src_path_display", 'dest_path_display': "dest_path_display",
-        'warehouse_src_name': "w_src.name", 'warehouse_dest_name': "w_dest.name",
-        'date': "p.scheduled_date", 'transfer_date': "p.date_transfer",
-        'state': "p.state", 'id': "p.id", 'custom_operation_type': 'p.custom_operation_type',
-        'partner_ref': 'p.partner_ref', 'responsible_user': 'p.responsible_user',
-        'employee_name': "emp.last_name"
-    }
-    order_by_column = sort_map.get(sort_by, "p.id")
-    direction = "ASC" if ascending else "DESC"
-
-    query_params = [picking_type_code, company_id]
-    where_clauses = []
-
-    # --- Lógica de Filtros (keys alineadas con COLUMN_DEFINITIONS del frontend) ---
-    for key, value in filters.items():
-         if value:
-            # 1. Filtros de Fecha (rango desde/hasta)
-            if key in ["date_transfer_from", "date_transfer_to"]:
-                try:
-                    db_date = datetime.strptime(value, "%d/%m/%Y").strftime("%Y-%m-%d")
-                    operator = ">=" if key == "date_transfer_from" else "<="
-                    where_clauses.append(f"p.date_transfer {operator} %s")
-                    query_params.append(db_date)
-                except ValueError: pass
-
-            # 1b. Filtro de Fecha Registro (columna 'date' del frontend)
-            elif key == 'date':
-                try:
-                    db_date = datetime.strptime(value, "%d/%m/%Y").strftime("%Y-%m-%d")
-                    where_clauses.append("DATE(p.scheduled_date) = %s")
-                    query_params.append(db_date)
-                except ValueError: pass
-
-            # 1c. Filtro de Fecha Traslado (columna 'transfer_date' del frontend)
-            elif key == 'transfer_date':
-                try:
-                    db_date = datetime.strptime(value, "%d/%m/%Y").strftime("%Y-%m-%d")
-                    where_clauses.append("DATE(p.date_transfer) = %s")
-                    query_params.append(db_date)
-                except ValueError: pass
-
-            # 2. Filtro de Estado (exacto, no ILIKE)
-            elif key == 'state':
-                where_clauses.append("p.state = %s")
-                query_params.append(value)
-
-            # 3. Filtro de Técnico (busca en nombre y apellido)
-            elif key == 'employee_name':
-                where_clauses.append("(emp.first_name ILIKE %s OR emp.last_name ILIKE %s)")
-                query_params.extend([f"%{value}%", f"%{value}%"])
-
-            # 4. Filtro de Proyecto (Código PEP o Nombre Macro)
-            elif key == 'project_name':
-                where_clauses.append("(proj.code ILIKE %s OR mp.name ILIKE %s)")
-                query_params.extend([f"%{value}%", f"%{value}%"])
-
-            # 5. Filtro de Referencia (nombre del picking)
-            elif key == 'name':
-                where_clauses.append("p.name ILIKE %s")
-                query_params.append(f"%{value}%")
-
-            # 6. Filtro de Tipo de Movimiento (exacto para dropdown)
-            elif key == 'custom_operation_type':
-                where_clauses.append("p.custom_operation_type = %s")
-                query_params.append(value)
-
-            # 7. Filtro de Guía de Remisión
-            elif key == 'partner_ref':
-                where_clauses.append("p.partner_ref ILIKE %s")
-                query_params.append(f"%{value}%")
-
-            # 8. Filtro de Orden de Compra
-            elif key == 'purchase_order':
-                where_clauses.append("p.purchase_order ILIKE %s")
-                query_params.append(f"%{value}%")
-
-            # 9. Filtro de Responsable
-            elif key == 'responsible_user':
-                where_clauses.append("p.responsible_user ILIKE %s")
-                query_params.append(f"%{value}%")
-
-            # 10. Filtros de Ubicación (usan CASE por lógica de IN/OUT)
-            elif key == 'src_path_display':
-                where_clauses.append("CASE WHEN pt.code = 'IN' THEN partner.name ELSE l_src.path END ILIKE %s")
-                query_params.append(f"%{value}%")
-            elif key == 'dest_path_display':
-                where_clauses.append("CASE WHEN pt.code = 'OUT' THEN partner.name ELSE l_dest.path END ILIKE %s")
-                query_params.append(f"%{value}%")
-
-            # 11. Filtros de Almacén
-            elif key == 'warehouse_src_name':
-                where_clauses.append("w_src.name ILIKE %s")
-                query_params.append(f"%{value}%")
-            elif key == 'warehouse_dest_name':
-                where_clauses.append("w_dest.name ILIKE %s")
-                query_params.append(f"%{value}%")
-
-    where_string = " AND " + " AND ".join(where_clauses) if where_clauses else ""
-
-    query = f"""
-    SELECT
+# Documento de búsqueda del picking (search_repo): incluye el texto de las columnas
+# de abajo, así los filtros sin índice propio se pre-filtran por search_documents.
+_PICKING_SEARCH = ('picking', 'p.id')
+
+# Listado de operaciones (IN/OUT/INT): una sola especificación para página y conteo.
+# Keys alineadas con COLUMN_DEFINITIONS del frontend.
+_PICKINGS_LIST = ListQuery(
+    select="""
         p.id, p.name, p.state, p.purchase_order, p.partner_ref, p.custom_operation_type, p.responsible_user,
         TO_CHAR(p.scheduled_date, 'DD/MM/YYYY') as date,
         TO_CHAR(p.date_transfer, 'DD/MM/YYYY') as transfer_date,
@@ -1630,30 +2030,104 @@ def get_pickings_by_type(picking_type_code, company_id, filters={}, sort_by='id'
             WHEN proj.id IS NOT NULL THEN CONCAT(proj.code, ' (', mp.name, ')') 
             ELSE NULL 
         END as project_name
+    """,
+    from_="pickings p",
+    where="pt.code = %s AND p.company_id = %s AND pt.code != 'ADJ'",
+    joins={
+        'pt': ("JOIN picking_types pt ON p.picking_type_id = pt.id", ()),
+        'l_src': ("LEFT JOIN locations l_src ON p.location_src_id = l_src.id", ()),
+        'l_dest': ("LEFT JOIN locations l_dest ON p.location_dest_id = l_dest.id", ()),
+        'partner': ("LEFT JOIN partners partner ON p.partner_id = partner.id", ()),
+        'w_src': ("LEFT JOIN warehouses w_src ON l_src.warehouse_id = w_src.id", ('l_src',)),
+        'w_dest': ("LEFT JOIN warehouses w_dest ON l_dest.warehouse_id = w_dest.id", ('l_dest',)),
+        'emp': ("LEFT JOIN employees emp ON p.employee_id = emp.id", ()),
+        # Joins de Proyecto
+        'proj': ("LEFT JOIN projects proj ON p.project_id = proj.id", ()),
+        'mp': ("LEFT JOIN macro_projects mp ON proj.macro_project_id = mp.id", ('proj',)),
+    },
+    filters={
+        # Fechas (DD/MM/YYYY): rango de traslado, día de registro y día de traslado
+        'date_transfer_from': qb.date_gte("p.date_transfer"),
+        'date_transfer_to': qb.date_lte("p.date_transfer"),
+        'date': qb.date_eq("DATE(p.scheduled_date)"),
+        'transfer_date': qb.date_eq("DATE(p.date_transfer)"),
+        # Exactos (dropdowns)
+        'state': qb.eq("p.state"),
+        'custom_operation_type': qb.eq("p.custom_operation_type"),
+        # Técnico (nombre o apellido) y Proyecto (Código PEP o Nombre Macro)
+        # [SEARCH] Texto sin índice propio: pre-filtro por search_documents
+        'employee_name': qb.ilike_any("emp.first_name", "emp.last_name", search=_PICKING_SEARCH),
+        'project_name': qb.ilike_any("proj.code", "mp.name", search=_PICKING_SEARCH),
+        'name': qb.ilike("p.name"),
+        'partner_ref': qb.ilike("p.partner_ref", search=_PICKING_SEARCH),
+        'purchase_order': qb.ilike("p.purchase_order", search=_PICKING_SEARCH),
+        'responsible_user': qb.ilike("p.responsible_user", search=_PICKING_SEARCH),
+        # Ubicaciones (usan CASE por lógica de IN/OUT)
+        'src_path_display': qb.ilike("CASE WHEN pt.code = 'IN' THEN partner.name ELSE l_src.path END", search=_PICKING_SEARCH),
+        'dest_path_display': qb.ilike("CASE WHEN pt.code = 'OUT' THEN partner.name ELSE l_dest.path END", search=_PICKING_SEARCH),
+        'warehouse_src_name': qb.ilike("w_src.name", search=_PICKING_SEARCH),
+        'warehouse_dest_name': qb.ilike("w_dest.name", search=_PICKING_SEARCH),
+    },
+    sorts={
+        'name': "p.name", 'purchase_order': "p.purchase_order",
+        'project_name': "proj.code", # Ordenar por código PEP es más útil ahora
+        'src_path_display': "CASE WHEN pt.code = 'IN' THEN partner.name ELSE l_src.path END",
+        'dest_path_display': "CASE WHEN pt.code = 'OUT' THEN partner.name ELSE l_dest.path END",
+        'warehouse_src_name': "w_src.name", 'warehouse_dest_name': "w_dest.name",
+        'date': "p.scheduled_date", 'transfer_date': "p.date_transfer",
+        'state': "p.state", 'id': "p.id", 'custom_operation_type': 'p.custom_operation_type',
+        'partner_ref': 'p.partner_ref', 'responsible_user': 'p.responsible_user',
+        'employee_name': "emp.last_name"
+    },
+    default_sort='id'
+)
 
-    FROM pickings p
-    JOIN picking_types pt ON p.picking_type_id = pt.id
-    LEFT JOIN locations l_src ON p.location_src_id = l_src.id
-    LEFT JOIN locations l_dest ON p.location_dest_id = l_dest.id
-    LEFT JOIN partners partner ON p.partner_id = partner.id
-    LEFT JOIN warehouses w_src ON l_src.warehouse_id = w_src.id
-    LEFT JOIN warehouses w_dest ON l_dest.warehouse_id = w_dest.id
-    LEFT JOIN employees emp ON p.employee_id = emp.id
-    
-    -- Joins de Proyecto
-    LEFT JOIN projects proj ON p.project_id = proj.id
-    LEFT JOIN macro_projects mp ON proj.macro_project_id = mp.id
-    
-    WHERE pt.code = %s AND p.company_id = %s AND pt.code != 'ADJ'
-    {where_string}
-    ORDER BY {order_by_column} {direction}
+def get_pickings_count(picking_type_code, company_id, filters={}):
+    """
+    Cuenta pickings aplicando los mismos filtros que get_pickings_by_type.
+    Solo une las tablas que los filtros activos necesitan.
+    """
+    query, params = _PICKINGS_LIST.count_query(filters, (picking_type_code, company_id))
+    result = execute_query(query, tuple(params), fetchone=True)
+    return result['total_count'] if result else 0
+
+def get_pickings_by_type(picking_type_code, company_id, filters={}, sort_by='id', ascending=False, limit=None, offset=None,
+                         cursor=None, with_total=False, with_count=False):
     """
+    Obtiene la lista de operaciones.
+    [CORREGIDO] 'project_name' ahora devuelve "PEP (Macro)" en lugar del nombre simple.
+    [KEYSET] Con cursor ("" = primera página) pagina por cursor y devuelve
+    {items, next_cursor, total_estimate} en lugar de la lista (ver pagination.py).
+    [CONTEO] Con with_count devuelve {items, total, next_cursor}: página y total
+    en una sola consulta (reemplaza la llamada aparte a get_pickings_count).
+    """
+    base_params = (picking_type_code, company_id)
+
+    if cursor is not None:
+        sort_key = sort_by if sort_by in _PICKINGS_LIST.sorts else 'id'
+        sort_expr = _PICKINGS_LIST.sort_expr(sort_key)
+        query, params = _PICKINGS_LIST.select_query(
+            filters, base_params, extra_select=keyset_columns(sort_expr, "p.id")
+        )
+        return fetch_keyset_page(
+            query, params, sort_key, ascending, limit or 25, cursor,
+            same_column=(sort_expr == "p.id"), with_total=with_total, with_count=with_count
+        )
 
+    query, params = _PICKINGS_LIST.page_query(
+        filters, base_params, sort_by, ascending,
+        extra_select=TOTAL_COUNT_SELECT if with_count else ""
+    )
     if limit is not None:
         query += " LIMIT %s OFFSET %s"
-        query_params.extend([limit, offset])
+        params.extend([limit, offset])
 
-    return execute_query(query, tuple(query_params), fetchall=True)
+    if with_count:
+        return fetch_counted_page(
+            query, params, offset,
+            count_fallback=lambda: get_pickings_count(picking_type_code, company_id, filters)
+        )
+    return execute_query(query, tuple(params), fetchall=True)
 
 def get_or_create_by_name(cursor, table, name):
     if not name: return None
@@ -1702,26 +2176,18 @@ def get_reserved_stock(product_id, location_id):
     # Nota: El stock reservado también debería considerar el proyecto, 
     # pero por ahora sumamos todo lo reservado en esa ubicación física.
     query = """
-        SELECT SUM(sm.product_uom_qty) as reserved_qty
-        FROM stock_moves sm
-        JOIN pickings p ON sm.picking_id = p.id
-        WHERE sm.product_id = %s
-          AND sm.location_src_id = %s
-          AND p.state = 'listo'
-          AND sm.state != 'cancelled'
+        SELECT SUM(demand_out_qty) as reserved_qty
+        FROM stock_reservations
+        WHERE product_id = %s AND location_id = %s
     """
     result = execute_query(query, (product_id, location_id), fetchone=True)
     return result['reserved_qty'] if result and result['reserved_qty'] else 0.0
 
 def get_incoming_stock(product_id, location_id):
     query = """
-        SELECT SUM(sm.product_uom_qty) as incoming_qty
-        FROM stock_moves sm
-        JOIN pickings p ON sm.picking_id = p.id
-        WHERE sm.product_id = %s
-          AND sm.location_dest_id = %s
-          AND p.state = 'listo'
-          AND sm.state != 'cancelled'
+        SELECT SUM(demand_in_qty) as incoming_qty
+        FROM stock_reservations
+        WHERE product_id = %s AND location_id = %s
     """
     result = execute_query(query, (product_id, location_id), fetchone=True)
     return result['incoming_qty'] if result and result['incoming_qty'] else 0.0
@@ -1755,13 +2221,9 @@ def get_real_available_stock(product_id, location_id, project_id=None):
     # 2. Reservado Total (Global)
     # Sumamos todas las reservas activas en esa ubicación, sin importar quién las pidió.
     res_res = execute_query("""
-        SELECT COALESCE(SUM(sm.product_uom_qty), 0) as reserved
-        FROM stock_moves sm
-        JOIN pickings p ON sm.picking_id = p.id
-        WHERE sm.product_id = %s 
-          AND sm.location_src_id = %s
-          AND p.state = 'listo'
-          AND sm.state != 'cancelled'
+        SELECT COALESCE(SUM(demand_out_qty), 0) as reserved
+        FROM stock_reservations
+        WHERE product_id = %s AND location_id = %s
     """, (product_id, location_id), fetchone=True)
     reserved = float(res_res['reserved'])
 
@@ -1802,13 +2264,10 @@ def get_product_stock_all_locations(product_id: int, warehouse_id: int = None):
             GROUP BY sq.location_id
         ),
         reserved_stock AS (
-            SELECT sm.location_src_id as location_id, COALESCE(SUM(sm.product_uom_qty), 0) as reserved
-            FROM stock_moves sm
-            JOIN pickings p ON sm.picking_id = p.id
-            WHERE sm.product_id = %s
-              AND p.state = 'listo'
-              AND sm.state != 'cancelled'
-            GROUP BY sm.location_src_id
+            SELECT location_id, COALESCE(SUM(demand_out_qty), 0) as reserved
+            FROM stock_reservations
+            WHERE product_id = %s
+            GROUP BY location_id
         )
         SELECT
             l.id as location_id,
@@ -1937,24 +2396,8 @@ def create_draft_adjustment(company_id, user_name):
             # Capturamos el ID del almacén para guardarlo
             wh_id = pt['warehouse_id'] 
             
-            # --- GENERACIÓN DE NOMBRE C{id} ---
-            prefix = f"C{company_id}/ADJ/"
-            
-            cursor.execute("SELECT name FROM pickings WHERE name LIKE %s AND company_id = %s ORDER BY id DESC LIMIT 1", (f"{prefix}%", company_id))
-            last_res = cursor.fetchone()
-            
-            current_seq = 0
-            if last_res:
-                try: current_seq = int(last_res['name'].split('/')[-1])
-                except: pass
-            
-            while True:
-                current_seq += 1
-                new_name = f"{prefix}{str(current_seq).zfill(5)}"
-                cursor.execute("SELECT 1 FROM pickings WHERE name = %s", (new_name,))
-                if not cursor.fetchone():
-                    break
-            # -----------------------------------
+            # --- GENERACIÓN DE NOMBRE C{id} (secuencia de la compañía) ---
+            new_name = next_document_names(company_id, picking_name_prefix(company_id, 'ADJ'), cursor=cursor)[0]
             
             s_date = datetime.now()
             
@@ -2034,35 +2477,11 @@ def save_adjustment_draft(picking_id, header_data, lines_data):
     finally:
         if conn: return_db_connection(conn)
 
-def get_adjustments_count(company_id, filters={}):
-    base_query = """
-    SELECT COUNT(p.id) as total_count FROM pickings p JOIN picking_types pt ON p.picking_type_id = pt.id
-    WHERE p.company_id = %s AND pt.code = 'ADJ'
-    """
-    params = [company_id]
-    # (Agregar lógica de filtros WHERE si necesario, igual que en get_pickings_count)
-    res = execute_query(base_query, tuple(params), fetchone=True)
-    return res['total_count'] if res else 0
+# Listado de Ajustes de Inventario (página y conteo desde la misma especificación)
+_ADJ_DEST_PATH_SORT = "CASE WHEN l_src.category = 'AJUSTE' THEN COALESCE(l_dest.path, w_dest.name) ELSE COALESCE(l_src.path, w_src.name) END"
 
-def get_adjustments_filtered_sorted(company_id, filters={}, sort_by='id', ascending=False, limit=None, offset=None):
-    """
-    Listado de Ajustes de Inventario con nombres legibles de ubicaciones.
-    [MEJORA] Lógica inteligente para 'dest_path' (Ubicación Afectada).
-    """
-    sort_map = {
-        'id': "p.id", 'name': "p.name", 'state': "p.state",
-        'date': "p.scheduled_date", 
-        'src_path': "COALESCE(l_src.path, w_src.name)", 
-        # Mapeamos 'dest_path' a la lógica inteligente para que el ordenamiento funcione
-        'dest_path': "CASE WHEN l_src.category = 'AJUSTE' THEN COALESCE(l_dest.path, w_dest.name) ELSE COALESCE(l_src.path, w_src.name) END", 
-        'responsible_user': "p.responsible_user",
-        'adjustment_reason': "p.adjustment_reason"
-    }
-    order_by_column = sort_map.get(sort_by, "p.id")
-    direction = "ASC" if ascending else "DESC"
-    
-    query = """
-        SELECT 
+_ADJUSTMENTS_LIST = ListQuery(
+    select="""
             p.id, p.company_id, p.name, p.state, 
             TO_CHAR(p.scheduled_date, 'YYYY-MM-DD') as date,
             p.responsible_user, p.adjustment_reason, p.notes, p.loss_confirmation,
@@ -2082,49 +2501,49 @@ def get_adjustments_filtered_sorted(company_id, filters={}, sort_by='id', ascend
 
             -- (Opcional) Mantenemos src_path original por si se necesita
             COALESCE(l_src.path, w_src.name) as src_path
+    """,
+    from_="pickings p",
+    where="p.company_id = %s AND pt.code = 'ADJ'",
+    joins={
+        'pt': ("JOIN picking_types pt ON p.picking_type_id = pt.id", ()),
+        'l_src': ("LEFT JOIN locations l_src ON p.location_src_id = l_src.id", ()),
+        'l_dest': ("LEFT JOIN locations l_dest ON p.location_dest_id = l_dest.id", ()),
+        'w_src': ("LEFT JOIN warehouses w_src ON l_src.warehouse_id = w_src.id", ('l_src',)),
+        'w_dest': ("LEFT JOIN warehouses w_dest ON l_dest.warehouse_id = w_dest.id", ('l_dest',)),
+    },
+    filters={
+        'state': qb.eq("p.state"),
+        'name': qb.ilike("p.name"),
+        'responsible_user': qb.ilike("p.responsible_user"),
+        'adjustment_reason': qb.ilike("p.adjustment_reason"),
+        'src_path': qb.ilike("COALESCE(l_src.path, w_src.name)"),
+        # Filtro para la nueva columna inteligente
+        'dest_path': qb.ilike(_ADJ_DEST_PATH_SORT),
+    },
+    sorts={
+        'id': "p.id", 'name': "p.name", 'state': "p.state",
+        'date': "p.scheduled_date", 
+        'src_path': "COALESCE(l_src.path, w_src.name)", 
+        # Mapeamos 'dest_path' a la lógica inteligente para que el ordenamiento funcione
+        'dest_path': _ADJ_DEST_PATH_SORT, 
+        'responsible_user': "p.responsible_user",
+        'adjustment_reason': "p.adjustment_reason"
+    },
+    default_sort='id'
+)
 
-        FROM pickings p 
-        JOIN picking_types pt ON p.picking_type_id = pt.id
-        LEFT JOIN locations l_src ON p.location_src_id = l_src.id
-        LEFT JOIN locations l_dest ON p.location_dest_id = l_dest.id
-        LEFT JOIN warehouses w_src ON l_src.warehouse_id = w_src.id
-        LEFT JOIN warehouses w_dest ON l_dest.warehouse_id = w_dest.id
-        
-        WHERE p.company_id = %s AND pt.code = 'ADJ'
+def get_adjustments_count(company_id, filters={}):
+    """Cuenta ajustes con los mismos filtros que get_adjustments_filtered_sorted."""
+    query, params = _ADJUSTMENTS_LIST.count_query(filters, (company_id,))
+    res = execute_query(query, tuple(params), fetchone=True)
+    return res['total_count'] if res else 0
+
+def get_adjustments_filtered_sorted(company_id, filters={}, sort_by='id', ascending=False, limit=None, offset=None):
     """
-    params = [company_id]
-    where_clauses = []
-    
-    for key, value in filters.items():
-        if not value: continue
-        
-        if key == 'state':
-            where_clauses.append("p.state = %s"); params.append(value)
-        elif key == 'name':
-            where_clauses.append("p.name ILIKE %s"); params.append(f"%{value}%")
-        elif key == 'responsible_user':
-            where_clauses.append("p.responsible_user ILIKE %s"); params.append(f"%{value}%")
-        elif key == 'adjustment_reason':
-            where_clauses.append("p.adjustment_reason ILIKE %s"); params.append(f"%{value}%")
-        # Filtro para la nueva columna inteligente
-        elif key == 'dest_path':
-             where_clauses.append("""
-                (CASE 
-                    WHEN l_src.category = 'AJUSTE' THEN COALESCE(l_dest.path, w_dest.name)
-                    ELSE COALESCE(l_src.path, w_src.name)
-                END) ILIKE %s
-             """)
-             params.append(f"%{value}%")
-    
-    if where_clauses:
-        query += " AND " + " AND ".join(where_clauses)
-    
-    query += f" ORDER BY {order_by_column} {direction}"
-    
-    if limit is not None and offset is not None:
-        query += " LIMIT %s OFFSET %s"
-        params.extend([limit, offset])
-        
+    Listado de Ajustes de Inventario con nombres legibles de ubicaciones.
+    [MEJORA] Lógica inteligente para 'dest_path' (Ubicación Afectada).
+    """
+    query, params = _ADJUSTMENTS_LIST.page_query(filters, (company_id,), sort_by, ascending, limit, offset)
     return execute_query(query, tuple(params), fetchall=True)
 
 # --- UI DETAILS ---
@@ -2295,29 +2714,8 @@ def create_full_picking_transaction(data: dict):
         wh_id = pt['warehouse_id'] 
         # ---------------------------------------
 
-        # --- GENERACIÓN DE NOMBRE (LÓGICA C{id}) ---
-        pt_code = pt['code'] # El código ya viene en la consulta de picking_types
-        
-        # Prefijo: C{company_id}/{TIPO}/
-        prefix = f"C{data['company_id']}/{pt_code}/"
-        
-        # Buscar último
-        cursor.execute("SELECT name FROM pickings WHERE name LIKE %s AND company_id = %s ORDER BY id DESC LIMIT 1", (f"{prefix}%", data['company_id']))
-        last_res = cursor.fetchone()
-        
-        current_seq = 0
-        if last_res:
-            try: current_seq = int(last_res['name'].split('/')[-1])
-            except: pass
-
-        # Bucle de Seguridad
-        while True:
-            current_seq += 1
-            new_name = f"{prefix}{str(current_seq).zfill(5)}"
-            cursor.execute("SELECT 1 FROM pickings WHERE name = %s", (new_name,))
-            if not cursor.fetchone():
-                break
-        # -----------------------------------
+        # --- GENERACIÓN DE NOMBRE C{id}/{TIPO}/NNNNN (secuencia de la compañía) ---
+        new_name = next_document_names(data['company_id'], picking_name_prefix(data['company_id'], pt['code']), cursor=cursor)[0]
 
         # 3. Ubicaciones (Respetando NULLs de la UI)
         final_src = data.get('location_src_id')
@@ -2504,9 +2902,16 @@ def get_adjustments_for_export(company_id):
 
 def import_smart_adjustments_transaction(company_id, user_name, rows):
     """
-    [LÓGICA INTELIGENTE v6 - SECUENCIA MATEMÁTICA] 
-    Calcula el máximo ID existente una sola vez y proyecta los nuevos IDs en memoria.
-    Esto evita huecos (1, 3, 5) causados por falsos positivos en consultas DB repetitivas.
+    [LÓGICA INTELIGENTE v8 - PIPELINE MASIVO]
+    Importa ajustes (uno por 'referencia') en una transacción con un número fijo
+    de queries, sin importar la cantidad de filas (conteos físicos de 50k líneas):
+
+    1. Valida las filas y resuelve SKUs y ubicaciones con dos queries = ANY(%s).
+    2. Reserva los nombres ADJ en un solo bloque de document_sequences.
+    3. Crea todas las series/lotes en bloque (_bulk_get_or_create_lots).
+    4. Inserta cabeceras, movimientos y líneas con execute_values.
+
+    Los errores conservan la fila del CSV y el SKU; si hay alguno no se guarda nada.
     """
     conn = None
     try:
@@ -2526,90 +2931,66 @@ def import_smart_adjustments_transaction(company_id, user_name, rows):
         if not loc_virtual: raise ValueError("No existe ubicación virtual 'AJUSTE'.")
         virtual_id = loc_virtual['id']
 
-        # Obtener prefijo del almacén
-        cursor.execute("SELECT wt.code FROM warehouses wt WHERE id = %s", (pt['warehouse_id'],))
-        wh_code = cursor.fetchone()['code']
-        prefix = f"C{company_id}/ADJ/"
+        prefix = picking_name_prefix(company_id, 'ADJ')
 
         # 2. Agrupar filas
-        from collections import defaultdict
         grouped_rows = defaultdict(list)
+        skus, loc_keys = set(), set()
         
         for i, row in enumerate(rows):
             ref = row.get('referencia') or f"IMP-{datetime.now().strftime('%Y%m%d-%H%M')}"
             grouped_rows[ref].append({'data': row, 'line': i + 2})
+            if row.get('sku'): skus.add(row['sku'])
+            if row.get('ubicacion'): loc_keys.add(row['ubicacion'])
 
-        # --- CÁLCULO DE SECUENCIA MAESTRA ---
-        cursor.execute(
-            "SELECT name FROM pickings WHERE name LIKE %s AND company_id = %s", 
-            (f"{prefix}%", company_id)
-        )
-        existing_names = cursor.fetchall()
-        
-        max_sequence = 0
-        for row in existing_names:
-            try:
-                name_str = row[0]
-                num_part = int(name_str.split('/')[-1])
-                if num_part > max_sequence:
-                    max_sequence = num_part
-            except (ValueError, IndexError):
-                continue
-        
-        current_sequence_counter = max_sequence
-        print(f"[IMPORT] Secuencia inicial detectada para Cia {company_id}: {current_sequence_counter}")
-        # ------------------------------------
+        if not grouped_rows:
+            return 0
+
+        # 3. Resolver SKUs y ubicaciones (una query cada uno)
+        products_map = {}
+        if skus:
+            cursor.execute("""
+                SELECT id, sku, standard_price, tracking FROM products
+                WHERE company_id = %s AND sku = ANY(%s)
+                ORDER BY id
+            """, (company_id, list(skus)))
+            for r in cursor.fetchall():
+                products_map.setdefault(r['sku'], r)
+
+        loc_by_path, loc_by_name = {}, {}
+        if loc_keys:
+            cursor.execute("""
+                SELECT id, path, name FROM locations
+                WHERE company_id = %s AND type = 'internal'
+                  AND (path = ANY(%s) OR name = ANY(%s))
+                ORDER BY id
+            """, (company_id, list(loc_keys), list(loc_keys)))
+            for r in cursor.fetchall():
+                if r['path']: loc_by_path.setdefault(r['path'], r['id'])
+                if r['name']: loc_by_name.setdefault(r['name'], r['id'])
+
+        def _resolve_location(loc_path):
+            # La ruta completa tiene prioridad sobre el nombre corto
+            return loc_by_path.get(loc_path) or loc_by_name.get(loc_path)
+
+        # 4. Validar y armar documentos en memoria (en el orden del archivo)
+        documents = []
+        lot_pairs = set()
 
-        total_created = 0
-        
-        # 3. Procesar Grupos
         for ref, lines in grouped_rows.items():
             first_row = lines[0]['data']
             reason = first_row.get('razon')
             if not reason or not reason.strip():
                 raise ValueError(f"Fila {lines[0]['line']}: La 'razon' es OBLIGATORIA.")
-            
-            notes = first_row.get('notas', '')
 
-            # --- [FIX] DETECTAR UBICACIÓN FÍSICA PARA LA CABECERA ---
-            # Leemos la ubicación de la primera línea para asignarla al documento general
+            # --- [FIX] UBICACIÓN FÍSICA PARA LA CABECERA (la de la primera línea) ---
             first_loc_path = first_row.get('ubicacion')
-            header_dest_id = virtual_id # Por defecto (si falla)
-
-            if first_loc_path:
-                cursor.execute(
-                    "SELECT id FROM locations WHERE (path = %s OR name = %s) AND company_id = %s AND type='internal'", 
-                    (first_loc_path, first_loc_path, company_id)
-                )
-                res_loc = cursor.fetchone()
-                if res_loc:
-                    header_dest_id = res_loc['id']
-
-            # --- ASIGNACIÓN DE NOMBRE ---
-            current_sequence_counter += 1
-            new_name = f"{prefix}{str(current_sequence_counter).zfill(5)}"
+            header_dest_id = (_resolve_location(first_loc_path) if first_loc_path else None) or virtual_id
 
-            # Crear Cabecera
-            # [CORREGIDO] Usamos header_dest_id en location_dest_id
-            cursor.execute("""
-                INSERT INTO pickings (
-                    company_id, name, picking_type_id, warehouse_id,
-                    state, responsible_user, 
-                    adjustment_reason, notes, custom_operation_type,
-                    location_src_id, location_dest_id, scheduled_date
-                ) VALUES (%s, %s, %s, %s, 'draft', %s, %s, %s, 'Ajuste de Inventario', %s, %s, NOW())
-                RETURNING id
-            """, (
-                company_id, new_name, pt['id'], wh_id, 
-                user_name, reason, notes, 
-                virtual_id, header_dest_id # <--- AQUI ESTABA EL ERROR (antes era virtual_id)
-            ))
-
-            picking_id = cursor.fetchone()[0]
-            
-            # Procesar Líneas
+            doc_moves = []
             for line_info in lines:
                 row = line_info['data']
+                line_no = line_info['line']
                 sku = row.get('sku')
                 qty_str = row.get('cantidad')
                 loc_path = row.get('ubicacion')
@@ -2617,21 +2998,20 @@ def import_smart_adjustments_transaction(company_id, user_name, rows):
                 serials_str = row.get('series') or row.get('serie') or row.get('serial') or row.get('lote') or ''
 
                 if not sku or not qty_str or not loc_path:
-                    raise ValueError(f"Fila {line_info['line']}: Faltan datos (SKU, Cantidad, Ubicación).")
+                    raise ValueError(f"Fila {line_no}: Faltan datos (SKU, Cantidad, Ubicación).")
 
-                # Buscar Producto
-                cursor.execute("SELECT id, standard_price, tracking FROM products WHERE sku = %s AND company_id = %s", (sku, company_id))
-                prod = cursor.fetchone()
-                if not prod: raise ValueError(f"Fila {line_info['line']}: SKU '{sku}' no existe.")
-                
-                # Buscar Ubicación Real
-                cursor.execute("SELECT id FROM locations WHERE (path = %s OR name = %s) AND company_id = %s AND type='internal'", (loc_path, loc_path, company_id))
-                loc_real = cursor.fetchone()
-                if not loc_real: raise ValueError(f"Fila {line_info['line']}: Ubicación '{loc_path}' no encontrada o no es interna.")
-                
-                real_id = loc_real['id']
-                qty = float(qty_str)
-                cost = float(cost_str) if cost_str and float(cost_str) > 0 else (prod['standard_price'] or 0)
+                prod = products_map.get(sku)
+                if not prod: raise ValueError(f"Fila {line_no}: SKU '{sku}' no existe.")
+
+                real_id = _resolve_location(loc_path)
+                if not real_id: raise ValueError(f"Fila {line_no}: Ubicación '{loc_path}' no encontrada o no es interna.")
+
+                try:
+                    qty = float(qty_str)
+                    cost_val = float(cost_str) if cost_str else 0
+                except (TypeError, ValueError):
+                    raise ValueError(f"Fila {line_no}: SKU '{sku}' tiene cantidad o costo no numérico.")
+                cost = cost_val if cost_val > 0 else (prod['standard_price'] or 0)
 
                 if qty >= 0:
                     src, dest = virtual_id, real_id
@@ -2640,44 +3020,96 @@ def import_smart_adjustments_transaction(company_id, user_name, rows):
                     src, dest = real_id, virtual_id
                     final_qty = abs(qty)
 
-                cursor.execute("""
-                    INSERT INTO stock_moves (
-                        picking_id, product_id, product_uom_qty, quantity_done, 
-                        location_src_id, location_dest_id, price_unit, cost_at_adjustment, state
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'draft')
-                    RETURNING id
-                """, (picking_id, prod['id'], final_qty, final_qty, src, dest, cost, cost))
-                
-                move_id = cursor.fetchone()[0]
-
-                # Carga de Series
+                # Carga de Series: se validan aquí, se crean todas juntas después
+                move_lots = []  # [(nombre_limpio, qty_done)]
                 tracking_type = prod['tracking']
-                if tracking_type != 'none' and serials_str:
-                    raw_vals = [s.strip() for s in re.split(r'[;,\n]', serials_str) if s.strip()]
-                    if not raw_vals: continue
+                raw_vals = [s.strip() for s in re.split(r'[;,\n]', serials_str) if s.strip()] if tracking_type != 'none' and serials_str else []
+                if raw_vals:
+                    try:
+                        clean_vals = [_clean_lot_name(v) for v in raw_vals]
+                    except ValueError as ve:
+                        raise ValueError(f"Fila {line_no}: SKU '{sku}': {ve}")
 
                     if tracking_type == 'serial':
-                        if len(raw_vals) != int(final_qty):
-                            raise ValueError(f"Fila {line_info['line']}: SKU '{sku}' requiere {int(final_qty)} series, se indicaron {len(raw_vals)}.")
-                        for sn in raw_vals:
-                            lot_id = create_lot(cursor, prod['id'], sn)
-                            cursor.execute("INSERT INTO stock_move_lines (move_id, lot_id, qty_done) VALUES (%s, %s, 1)", (move_id, lot_id))
-                            
+                        if len(clean_vals) != int(final_qty):
+                            raise ValueError(f"Fila {line_no}: SKU '{sku}' requiere {int(final_qty)} series, se indicaron {len(clean_vals)}.")
+                        move_lots = [(sn, 1) for sn in clean_vals]
                     elif tracking_type == 'lot':
-                        if len(raw_vals) == 1:
-                            lot_id = create_lot(cursor, prod['id'], raw_vals[0])
-                            cursor.execute("INSERT INTO stock_move_lines (move_id, lot_id, qty_done) VALUES (%s, %s, %s)", (move_id, lot_id, final_qty))
+                        if len(clean_vals) == 1:
+                            move_lots = [(clean_vals[0], final_qty)]
                         else:
-                            if len(raw_vals) != int(final_qty):
-                                 print(f"[WARN] Lotes múltiples para '{sku}'. Se asignará 1 unidad a cada lote listado.")
-                            for sn in raw_vals:
-                                lot_id = create_lot(cursor, prod['id'], sn)
-                                cursor.execute("INSERT INTO stock_move_lines (move_id, lot_id, qty_done) VALUES (%s, %s, 1)", (move_id, lot_id))
+                            if len(clean_vals) != int(final_qty):
+                                print(f"[WARN] Lotes múltiples para '{sku}'. Se asignará 1 unidad a cada lote listado.")
+                            move_lots = [(sn, 1) for sn in clean_vals]
+
+                    lot_pairs.update((prod['id'], sn) for sn, _ in move_lots)
+
+                doc_moves.append({
+                    'product_id': prod['id'], 'qty': final_qty,
+                    'src': src, 'dest': dest, 'cost': cost, 'lots': move_lots
+                })
+
+            documents.append({
+                'reason': reason, 'notes': first_row.get('notas', ''),
+                'dest_id': header_dest_id, 'moves': doc_moves
+            })
+
+        # 5. Nombres ADJ en un solo bloque (uno por documento)
+        for doc, name in zip(documents, next_document_names(company_id, prefix, len(documents), cursor=cursor)):
+            doc['name'] = name
+
+        # 6. Cabeceras
+        inserted = psycopg2.extras.execute_values(cursor, """
+            INSERT INTO pickings (
+                company_id, name, picking_type_id, warehouse_id,
+                state, responsible_user,
+                adjustment_reason, notes, custom_operation_type,
+                location_src_id, location_dest_id, scheduled_date
+            ) VALUES %s
+            RETURNING id
+        """, [(
+            company_id, d['name'], pt['id'], wh_id, user_name,
+            d['reason'], d['notes'], virtual_id, d['dest_id']
+        ) for d in documents],
+            template="(%s, %s, %s, %s, 'draft', %s, %s, %s, 'Ajuste de Inventario', %s, %s, NOW())",
+            page_size=len(documents), fetch=True)
+
+        # 7. Movimientos (RETURNING respeta el orden de VALUES)
+        all_moves, move_rows = [], []
+        for doc, picking_row in zip(documents, inserted):
+            for m in doc['moves']:
+                all_moves.append(m)
+                move_rows.append((picking_row[0], m['product_id'], m['qty'], m['qty'], m['src'], m['dest'], m['cost'], m['cost']))
+
+        if move_rows:
+            move_ids = psycopg2.extras.execute_values(cursor, """
+                INSERT INTO stock_moves (
+                    picking_id, product_id, product_uom_qty, quantity_done,
+                    location_src_id, location_dest_id, price_unit, cost_at_adjustment, state
+                ) VALUES %s
+                RETURNING id
+            """, move_rows, template="(%s, %s, %s, %s, %s, %s, %s, %s, 'draft')",
+                page_size=len(move_rows), fetch=True)
+
+            # 8. Series/lotes en bloque + líneas de movimiento
+            lot_id_map = _bulk_get_or_create_lots(cursor, lot_pairs)
+            line_rows = [
+                (move_row[0], lot_id_map[(m['product_id'], sn)], qty_done)
+                for m, move_row in zip(all_moves, move_ids)
+                for sn, qty_done in m['lots']
+            ]
+            if line_rows:
+                psycopg2.extras.execute_values(
+                    cursor,
+                    "INSERT INTO stock_move_lines (move_id, lot_id, qty_done) VALUES %s",
+                    line_rows, page_size=1000
+                )
 
-            total_created += 1
+        report_repo.mark_dashboard_snapshot_stale(cursor, company_id)
 
         conn.commit()
-        return total_created
+        print(f"[IMPORT-ADJ] {len(documents)} ajustes / {len(move_rows)} líneas importadas.")
+        return len(documents)
 
     except Exception as e:
         if conn: conn.rollback()
@@ -2687,9 +3119,10 @@ def import_smart_adjustments_transaction(company_id, user_name, rows):
         if conn: return_db_connection(conn)
 
 # --- EXPORTACIÓN CSV (Agregado a operation_repo.py) ---
-def get_data_for_export(company_id, export_type, selected_ids=None):
+def get_data_for_export(company_id, export_type, selected_ids=None, stream=False):
     """
     Obtiene los datos para el CSV.
+    [STREAMING] Con stream=True devuelve un generador (cursor de servidor) en lugar de una lista.
     [MEJORA v4] 1 Fila por Serie: Productos con series generan múltiples filas.
     [MEJORA v3] Agregado Técnico (Empleado), Instrucciones y Observaciones.
     [MEJORA v2] Lógica Inteligente para Nombres de Proveedores/Clientes.
@@ -2805,6 +3238,8 @@ def get_data_for_export(company_id, export_type, selected_ids=None):
               {filter_clause}
             ORDER BY p.id DESC
         """
+        if stream:
+            return stream_query(query, tuple(params))
         return execute_query(query, tuple(params), fetchall=True)
 
     elif export_type == 'full':
@@ -2913,9 +3348,11 @@ def get_data_for_export(company_id, export_type, selected_ids=None):
         """
         # Para UNION necesitamos company_id dos veces
         union_params = list(params) + list(params)
+        if stream:
+            return stream_query(query, tuple(union_params))
         return execute_query(query, tuple(union_params), fetchall=True)
 
-    return []
+    return iter(()) if stream else []
 
 def get_project_id_by_composite_key(macro_name, project_code, company_id):
     """
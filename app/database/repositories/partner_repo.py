@@ -6,9 +6,15 @@ from ..core import (
     execute_query, 
     execute_commit_query
 )
+from ..pagination import fetch_keyset_page, fetch_counted_page, keyset_columns, TOTAL_COUNT_SELECT
+from .. import query_builder as qb
+from ..query_builder import ListQuery
+from ..ref_cache import reference_data, invalidate_reference
+from ..bulk_upsert import bulk_upsert
 
 # --- CATEGORÍAS DE PARTNER ---
 
+@reference_data('partner_categories')
 def get_partner_categories(company_id: int):
     """Obtiene categorías de partner FILTRADAS POR COMPAÑÍA."""
     return execute_query(
@@ -25,6 +31,7 @@ def create_partner_category(name: str, company_id: int):
             (name, company_id),
             fetchone=True
         )
+        invalidate_reference('partner_categories', company_id=company_id)
         return new_item
     except Exception as e:
         if "partner_categories_company_id_name_key" in str(e):
@@ -41,6 +48,8 @@ def update_partner_category(category_id: int, name: str, company_id: int):
         )
         if not updated_item:
             raise ValueError("Categoría no encontrada o no pertenece a esta compañía.")
+        # El nombre de categoría también va en get_partners
+        invalidate_reference('partner_categories', 'partners', company_id=company_id, entity_id=category_id)
         return updated_item
     except Exception as e:
         if "partner_categories_company_id_name_key" in str(e):
@@ -54,6 +63,7 @@ def delete_partner_category(category_id: int, company_id: int):
             "DELETE FROM partner_categories WHERE id = %s AND company_id = %s",
             (category_id, company_id)
         )
+        invalidate_reference('partner_categories', company_id=company_id, entity_id=category_id)
         return True, "Categoría eliminada."
     except Exception as e:
         if "foreign key constraint" in str(e):
@@ -69,6 +79,7 @@ def get_partner_category_id_by_name(name):
 
 # --- PARTNERS (SOCIOS/CLIENTES/PROVEEDORES) ---
 
+@reference_data('partners')
 def get_partners(company_id, category_name=None):
     """Obtiene todos los partners de una compañía."""
     query = """
@@ -148,6 +159,7 @@ def create_partner(name, category_id, company_id, social_reason, ruc, email, pho
     params = (name, category_id, company_id, social_reason, ruc, email, phone, address)
 
     result = execute_commit_query(query, params, fetchone=True)
+    invalidate_reference('partners', company_id=company_id)
     if result:
         return result[0]
     else:
@@ -171,6 +183,7 @@ def update_partner(partner_id, name, category_id, social_reason, ruc, email, pho
     """
     params = (name, category_id, social_reason, ruc, email, phone, address, partner_id)
     execute_commit_query(query, params)
+    invalidate_reference('partners', entity_id=partner_id)
 
 def delete_partner(partner_id):
     """
@@ -195,6 +208,7 @@ def delete_partner(partner_id):
             cursor.execute("DELETE FROM partners WHERE id = %s", (partner_id,))
             
             conn.commit()
+            invalidate_reference('partners', entity_id=partner_id)
             return True, "Proveedor/Cliente eliminado correctamente."
 
     except Exception as e:
@@ -206,107 +220,103 @@ def delete_partner(partner_id):
     finally:
         if conn: return_db_connection(conn) # <-- USAR HELPER
 
-def upsert_partner_from_import(company_id, name, category_id, ruc, social_reason, address, email, phone):
-    """
-    Inserta o actualiza un partner desde la importación.
-    SQL PURO - Los datos deben venir pre-normalizados desde el Service Layer.
-    """
-    query = """
-        INSERT INTO partners (company_id, name, category_id, ruc, social_reason, address, email, phone)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (company_id, name) DO UPDATE SET
-            category_id = EXCLUDED.category_id,
-            ruc = EXCLUDED.ruc,
-            social_reason = EXCLUDED.social_reason,
-            address = EXCLUDED.address,
-            email = EXCLUDED.email,
-            phone = EXCLUDED.phone
-        RETURNING (xmax = 0) AS inserted;
-    """
-    params = (company_id, name, category_id, ruc, social_reason, address, email, phone)
-
-    result = execute_commit_query(query, params, fetchone=True)
-    if result:
-        was_inserted = result[0]
-        return "created" if was_inserted else "updated"
-    return "error"
+_PARTNER_IMPORT_COLUMNS = ("company_id", "name", "category_id", "ruc", "social_reason", "address", "email", "phone")
 
-def get_partners_filtered_sorted(company_id, filters={}, sort_by='name', ascending=True, limit=None, offset=None):
-    """ Obtiene proveedores/clientes filtrados, ordenados y paginados. """
-    base_query = """
-    SELECT p.id, p.company_id, p.name, p.social_reason, p.ruc, p.email, p.phone, p.address,
-           pc.name as category_name, p.category_id
-    FROM partners p
-    LEFT JOIN partner_categories pc ON p.category_id = pc.id
-    WHERE p.company_id = %s
+def upsert_partners_from_import(company_id, rows):
     """
-    params = [company_id]
-    where_clauses = []
-
-    column_map = {
-        'name': "p.name", 'ruc': "p.ruc", 'social_reason': "p.social_reason",
-        'address': "p.address", 'category_name': "pc.name"
-    }
-
-    for key, value in filters.items():
-        if not value: continue
-        sql_column = column_map.get(key)
-        if not sql_column: continue
+    [BATCH] Inserta o actualiza partners en UNA transacción (bulk_upsert por lotes).
+    SQL PURO - rows vienen normalizadas por PartnerService.process_csv_row.
+    Retorna (created, updated).
+    """
+    values = [(
+        company_id, r['name'], r['category_id'], r['ruc'], r['social_reason'],
+        r['address'], r['email'], r['phone']
+    ) for r in rows]
 
-        if value == "_NO_CATEGORY_":
-            where_clauses.append("p.category_id IS NULL")
-        elif key in ['name', 'ruc', 'social_reason', 'address']:
-            where_clauses.append(f"{sql_column} ILIKE %s")
-            params.append(f"%{value}%")
-        else: # Para el dropdown de categoría
-            where_clauses.append(f"{sql_column} = %s")
-            params.append(value)
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            created, updated, _ = bulk_upsert(
+                cursor, "partners", _PARTNER_IMPORT_COLUMNS, values,
+                conflict_columns=("company_id", "name")
+            )
+        conn.commit()
+        invalidate_reference('partners', company_id=company_id)
+        print(f"[IMPORT-PARTNERS] {created} creados, {updated} actualizados.")
+        return created, updated
 
-    if where_clauses:
-        base_query += " AND " + " AND ".join(where_clauses)
+    except Exception as e:
+        if conn: conn.rollback()
+        print(f"Error en importación masiva de partners: {e}")
+        raise e
+    finally:
+        if conn: return_db_connection(conn)
 
-    sort_column_map = {
+def upsert_partner_from_import(company_id, name, category_id, ruc, social_reason, address, email, phone):
+    """
+    Inserta o actualiza un partner desde la importación.
+    SQL PURO - Los datos deben venir pre-normalizados desde el Service Layer.
+    """
+    created, _ = upsert_partners_from_import(company_id, [{
+        'name': name, 'category_id': category_id, 'ruc': ruc, 'social_reason': social_reason,
+        'address': address, 'email': email, 'phone': phone
+    }])
+    return "created" if created else "updated"
+
+# Listado de proveedores/clientes (página y conteo desde la misma especificación)
+_PARTNERS_LIST = ListQuery(
+    select="""
+        p.id, p.company_id, p.name, p.social_reason, p.ruc, p.email, p.phone, p.address,
+        pc.name as category_name, p.category_id
+    """,
+    from_="partners p",
+    where="p.company_id = %s",
+    joins={
+        'pc': ("LEFT JOIN partner_categories pc ON p.category_id = pc.id", ()),
+    },
+    filters={
+        'name': qb.ilike("p.name"), 'ruc': qb.ilike("p.ruc"),
+        'social_reason': qb.ilike("p.social_reason"), 'address': qb.ilike("p.address"),
+        # Dropdown de categoría ('_NO_CATEGORY_' = sin categoría)
+        'category_name': qb.eq("pc.name", null_value="_NO_CATEGORY_", null_sql="p.category_id IS NULL"),
+    },
+    sorts={
         'id': "p.id", 'name': "p.name", 'category_name': "pc.name", 'ruc': "p.ruc",
         'social_reason': "p.social_reason", 'address': "p.address"
-    }
-    order_by_col = sort_column_map.get(sort_by, "p.id")
-    direction = "ASC" if ascending else "DESC"
-    base_query += f" ORDER BY {order_by_col} {direction}"
+    },
+    default_sort='id'
+)
+
+def get_partners_filtered_sorted(company_id, filters={}, sort_by='name', ascending=True, limit=None, offset=None,
+                                 cursor=None, with_total=False, with_count=False):
+    """
+    Obtiene proveedores/clientes filtrados, ordenados y paginados.
+    [KEYSET] Con cursor ("" = primera página) devuelve {items, next_cursor, total_estimate}.
+    [CONTEO] Con with_count devuelve {items, total, next_cursor} en una sola consulta.
+    """
+    if cursor is not None:
+        sort_key = sort_by if sort_by in _PARTNERS_LIST.sorts else 'id'
+        sort_expr = _PARTNERS_LIST.sort_expr(sort_key)
+        query, params = _PARTNERS_LIST.select_query(
+            filters, (company_id,), extra_select=keyset_columns(sort_expr, "p.id")
+        )
+        return fetch_keyset_page(
+            query, params, sort_key, ascending, limit or 100, cursor,
+            same_column=(sort_expr == "p.id"), with_total=with_total, with_count=with_count
+        )
 
-    if limit is not None and offset is not None:
-        base_query += " LIMIT %s OFFSET %s"
-        params.extend([limit, offset])
+    if with_count:
+        query, params = _PARTNERS_LIST.page_query(
+            filters, (company_id,), sort_by, ascending, limit, offset, extra_select=TOTAL_COUNT_SELECT
+        )
+        return fetch_counted_page(query, params, offset, count_fallback=lambda: get_partners_count(company_id, filters))
 
-    return execute_query(base_query, tuple(params), fetchall=True)
+    query, params = _PARTNERS_LIST.page_query(filters, (company_id,), sort_by, ascending, limit, offset)
+    return execute_query(query, tuple(params), fetchall=True)
 
 def get_partners_count(company_id, filters={}):
     """ Cuenta el total de proveedores/clientes que coinciden con los filtros. """
-    base_query = """
-    SELECT COUNT(p.id) as total_count
-    FROM partners p
-    LEFT JOIN partner_categories pc ON p.category_id = pc.id
-    WHERE p.company_id = %s
-    """
-    params = [company_id]
-    where_clauses = []
-    
-    column_map = {
-        'name': "p.name", 'ruc': "p.ruc", 'social_reason': "p.social_reason",
-        'address': "p.address", 'category_name': "pc.name"
-    }
-    for key, value in filters.items():
-        if not value: continue
-        sql_column = column_map.get(key)
-        if not sql_column: continue
-        
-        if value == "_NO_CATEGORY_": where_clauses.append("p.category_id IS NULL")
-        elif key in ['name', 'ruc', 'social_reason', 'address']:
-            where_clauses.append(f"{sql_column} LIKE %s"); params.append(f"%{value}%")
-        else:
-            where_clauses.append(f"{sql_column} = %s"); params.append(value)
-
-    if where_clauses:
-        base_query += " AND " + " AND ".join(where_clauses)
-
-    result = execute_query(base_query, tuple(params), fetchone=True)
+    query, params = _PARTNERS_LIST.count_query(filters, (company_id,))
+    result = execute_query(query, tuple(params), fetchone=True)
     return result['total_count'] if result else 0
\ No newline at end of file
@@ -3,6 +3,12 @@
 import traceback
 import psycopg2.extras
 from ..core import get_db_connection, return_db_connection, execute_query, execute_commit_query
+from ..pagination import fetch_keyset_page, fetch_counted_page, keyset_columns, TOTAL_COUNT_SELECT
+from .. import query_builder as qb
+from ..query_builder import ListQuery
+from ..ref_cache import reference_data, invalidate_reference
+from ..bulk_upsert import bulk_upsert
+from . import report_repo
 
 # --- PRODUCTOS ---
 
@@ -160,145 +166,113 @@ def delete_product(product_id):
         if conn:
             return_db_connection(conn)
 
-def get_products_filtered_sorted(company_id, filters={}, sort_by='name', ascending=True, limit=None, offset=None):
-    """ 
-    Obtiene productos filtrados, ordenados y paginados.
-    [CORREGIDO] Asegura que se seleccionen todos los campos requeridos por el schema ProductResponse.
-    """
-    
-    # --- ¡INICIO DE LA CORRECCIÓN! ---
-    # Aseguramos que 'p.type' y 'p.company_id' estén en el SELECT
-    base_query = """
-    SELECT 
+# Listado de productos (página y conteo desde la misma especificación)
+_PRODUCTS_LIST = ListQuery(
+    # [CORREGIDO] 'p.type' y 'p.company_id' son requeridos por el schema ProductResponse
+    select="""
         p.id, p.company_id, p.name, p.sku, 
         p.category_id, pc.name as category_name, 
         p.uom_id, u.name as uom_name,
         p.tracking, p.ownership, p.standard_price, 
-        p.type  -- Este campo era requerido por el schema
-    FROM products p
-    LEFT JOIN product_categories pc ON p.category_id = pc.id
-    LEFT JOIN uom u ON p.uom_id = u.id
-    WHERE p.company_id = %s
-    """
-    # --- FIN DE LA CORRECCIÓN ---
-    
-    params = [company_id]
-    where_clauses = []
-
-    # (El resto de tu lógica de filtros es correcta)
-    column_map = {
-        'name': "p.name", 'sku': "p.sku", 'category_name': "pc.name",
-        'uom_name': "u.name", 'tracking': "p.tracking", 'ownership': "p.ownership"
-    }
-
-    for key, value in filters.items():
-        if not value: continue
-        sql_column = column_map.get(key)
-        if not sql_column: continue
-
-        if key in ['name', 'sku']:
-            where_clauses.append(f"{sql_column} ILIKE %s") 
-            params.append(f"%{value}%")
-        else: 
-            where_clauses.append(f"{sql_column} = %s")
-            params.append(value)
-
-    if where_clauses:
-        base_query += " AND " + " AND ".join(where_clauses)
-
-    sort_column_map = {
+        p.type
+    """,
+    from_="products p",
+    where="p.company_id = %s",
+    joins={
+        'pc': ("LEFT JOIN product_categories pc ON p.category_id = pc.id", ()),
+        'u': ("LEFT JOIN uom u ON p.uom_id = u.id", ()),
+    },
+    filters={
+        'name': qb.ilike("p.name"), 'sku': qb.ilike("p.sku"),
+        'category_name': qb.eq("pc.name"), 'uom_name': qb.eq("u.name"),
+        'tracking': qb.eq("p.tracking"), 'ownership': qb.eq("p.ownership"),
+    },
+    sorts={
         'id': "p.id", 'name': "p.name", 'sku': "p.sku", 'category_name': "pc.name",
         'uom_name': "u.name", 'tracking': "p.tracking", 'ownership': "p.ownership",
         'standard_price': "p.standard_price"
-    }
-    order_by_col = sort_column_map.get(sort_by, "p.id")
-    direction = "ASC" if ascending else "DESC"
-    base_query += f" ORDER BY {order_by_col} {direction}"
+    },
+    default_sort='id'
+)
+
+def get_products_filtered_sorted(company_id, filters={}, sort_by='name', ascending=True, limit=None, offset=None,
+                                 cursor=None, with_total=False, with_count=False):
+    """ 
+    Obtiene productos filtrados, ordenados y paginados.
+    [KEYSET] Con cursor ("" = primera página) devuelve {items, next_cursor, total_estimate}.
+    [CONTEO] Con with_count devuelve {items, total, next_cursor} en una sola consulta.
+    """
+    if cursor is not None:
+        sort_key = sort_by if sort_by in _PRODUCTS_LIST.sorts else 'id'
+        sort_expr = _PRODUCTS_LIST.sort_expr(sort_key)
+        query, params = _PRODUCTS_LIST.select_query(
+            filters, (company_id,), extra_select=keyset_columns(sort_expr, "p.id")
+        )
+        return fetch_keyset_page(
+            query, params, sort_key, ascending, limit or 100, cursor,
+            same_column=(sort_expr == "p.id"), with_total=with_total, with_count=with_count
+        )
 
-    if limit is not None and offset is not None:
-        base_query += " LIMIT %s OFFSET %s"
-        params.extend([limit, offset])
+    if with_count:
+        query, params = _PRODUCTS_LIST.page_query(
+            filters, (company_id,), sort_by, ascending, limit, offset, extra_select=TOTAL_COUNT_SELECT
+        )
+        return fetch_counted_page(query, params, offset, count_fallback=lambda: get_products_count(company_id, filters))
 
-    return execute_query(base_query, tuple(params), fetchall=True)
+    query, params = _PRODUCTS_LIST.page_query(filters, (company_id,), sort_by, ascending, limit, offset)
+    return execute_query(query, tuple(params), fetchall=True)
 
 def get_products_count(company_id, filters={}):
     """ Cuenta el total de productos que coinciden con los filtros. """
-    base_query = """
-    SELECT COUNT(p.id) as total_count
-    FROM products p
-    LEFT JOIN product_categories pc ON p.category_id = pc.id
-    LEFT JOIN uom u ON p.uom_id = u.id
-    WHERE p.company_id =  %s
-    """
-    params = [company_id]
-    where_clauses = []
-
-    column_map = {
-        'name': "p.name", 'sku': "p.sku", 'category_name': "pc.name",
-        'uom_name': "u.name", 'tracking': "p.tracking", 'ownership': "p.ownership"
-    }
-    
-    for key, value in filters.items():
-        if not value: continue
-        sql_column = column_map.get(key)
-        if not sql_column: continue
-
-        if key in ['name', 'sku']:
-            where_clauses.append(f"{sql_column} LIKE  %s")
-            params.append(f"%{value}%")
-        else:
-            where_clauses.append(f"{sql_column} =  %s")
-            params.append(value)
-
-    if where_clauses:
-        base_query += " AND " + " AND ".join(where_clauses)
-
-    result = execute_query(base_query, tuple(params), fetchone=True)
+    query, params = _PRODUCTS_LIST.count_query(filters, (company_id,))
+    result = execute_query(query, tuple(params), fetchone=True)
     return result['total_count'] if result else 0
 
-def upsert_product_from_import(company_id, sku, name, category_id, uom_id, tracking, ownership, price):
+_PRODUCT_IMPORT_COLUMNS = ("company_id", "sku", "name", "category_id", "uom_id", "tracking", "ownership", "standard_price")
+
+def upsert_products_from_import(company_id, rows):
     """
-    Inserta o actualiza un producto (UPSERT).
-    NOTA: Los datos deben venir ya normalizados desde el Service Layer.
+    [BATCH] Inserta o actualiza productos en UNA transacción (bulk_upsert por lotes).
+    rows: dicts ya normalizados por ProductService.process_csv_row
+          (sku, name, category_id, uom_id, tracking, ownership, standard_price).
+    Retorna (created, updated).
     """
-    conn = None
-
-    query = """
-        INSERT INTO products (
-            company_id, sku, name, category_id, uom_id, tracking, ownership, standard_price
-        )
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (company_id, sku)
-        DO UPDATE SET
-            name = EXCLUDED.name,
-            category_id = EXCLUDED.category_id,
-            uom_id = EXCLUDED.uom_id,
-            tracking = EXCLUDED.tracking,
-            ownership = EXCLUDED.ownership,
-            standard_price = EXCLUDED.standard_price
-        RETURNING (xmax = 0) AS inserted
-    """
-    params = (company_id, sku, name, category_id, uom_id, tracking, ownership, price)
+    values = [(
+        company_id, r['sku'], r['name'], r['category_id'], r['uom_id'],
+        r['tracking'], r['ownership'], r['standard_price']
+    ) for r in rows]
 
+    conn = None
     try:
         conn = get_db_connection()
         with conn.cursor() as cursor:
-            cursor.execute(query, params)
-            result = cursor.fetchone()
-            was_inserted = result[0] if result else False
-
-            conn.commit()
-            return "created" if was_inserted else "updated"
+            created, updated, _ = bulk_upsert(
+                cursor, "products", _PRODUCT_IMPORT_COLUMNS, values,
+                conflict_columns=("company_id", "sku")
+            )
+            # Cambian costos -> valor de inventario del dashboard
+            report_repo.mark_dashboard_snapshot_stale(cursor, company_id)
+        conn.commit()
+        print(f"[IMPORT-PRODUCTS] {created} creados, {updated} actualizados.")
+        return created, updated
 
     except Exception as e:
-        if conn:
-            conn.rollback()
-        print(f"Error procesando fila para SKU {sku}: {e}")
+        if conn: conn.rollback()
+        print(f"Error en importación masiva de productos: {e}")
         raise e
-
     finally:
-        if conn:
-            return_db_connection(conn)
+        if conn: return_db_connection(conn)
+
+def upsert_product_from_import(company_id, sku, name, category_id, uom_id, tracking, ownership, price):
+    """
+    Inserta o actualiza un producto (UPSERT).
+    NOTA: Los datos deben venir ya normalizados desde el Service Layer.
+    """
+    created, _ = upsert_products_from_import(company_id, [{
+        'sku': sku, 'name': name, 'category_id': category_id, 'uom_id': uom_id,
+        'tracking': tracking, 'ownership': ownership, 'standard_price': price
+    }])
+    return "created" if created else "updated"
 
 def search_storable_products_by_term(company_id: int, search_term: str):
     """
@@ -364,6 +338,7 @@ def find_products_by_skus(company_id: int, skus: list):
 
 # --- UNIDADES DE MEDIDA (UOM) - REFACTORIZADO PARA MULTI-COMPAÑÍA ---
 
+@reference_data('uoms')
 def get_uoms(company_id: int):
     """
     [CORREGIDO] Obtiene UdM FILTRADAS por compañía.
@@ -383,6 +358,7 @@ def create_uom(name: str, company_id: int):
     
     try:
         result = execute_commit_query(query, params, fetchone=True)
+        invalidate_reference('uoms', company_id=company_id)
         if result:
             return result[0]
         else:
@@ -403,6 +379,7 @@ def update_uom(uom_id: int, name: str, company_id: int):
     
     try:
         execute_commit_query(query, params)
+        invalidate_reference('uoms', company_id=company_id, entity_id=uom_id)
     except Exception as e: 
         if "unique constraint" in str(e): 
             raise ValueError(f"La unidad '{name}' ya existe.")
@@ -418,6 +395,7 @@ def delete_uom(uom_id: int, company_id: int):
     
     try:
         execute_commit_query(query, params)
+        invalidate_reference('uoms', company_id=company_id, entity_id=uom_id)
         return True, "Unidad de medida eliminada."
     except Exception as e:
         if "violates foreign key constraint" in str(e):
@@ -439,6 +417,7 @@ def get_uom_id_by_name(name, company_id):
 
 # --- CATEGORÍAS (Ya estaban bien, solo las incluimos para completar) ---
 
+@reference_data('product_categories')
 def get_product_categories(company_id: int):
     return execute_query(
         "SELECT id, name FROM product_categories WHERE company_id = %s ORDER BY name", 
@@ -447,10 +426,12 @@ def get_product_categories(company_id: int):
 
 def create_product_category(name: str, company_id: int):
     try:
-        return execute_commit_query(
+        created = execute_commit_query(
             "INSERT INTO product_categories (name, company_id) VALUES (%s, %s) RETURNING id, name",
             (name, company_id), fetchone=True
         )
+        invalidate_reference('product_categories', company_id=company_id)
+        return created
     except Exception as e:
         if "unique constraint" in str(e):
             raise ValueError(f"La categoría '{name}' ya existe.")
@@ -463,6 +444,7 @@ def update_product_category(category_id: int, name: str, company_id: int):
             (name, category_id, company_id), fetchone=True
         )
         if not updated: raise ValueError("No encontrada o sin permisos.")
+        invalidate_reference('product_categories', company_id=company_id, entity_id=category_id)
         return updated
     except Exception as e:
         if "unique constraint" in str(e):
@@ -475,6 +457,7 @@ def delete_product_category(category_id: int, company_id: int):
             "DELETE FROM product_categories WHERE id = %s AND company_id = %s",
             (category_id, company_id)
         )
+        invalidate_reference('product_categories', company_id=company_id, entity_id=category_id)
         return True, "Categoría eliminada."
     except Exception as e:
         if "foreign key constraint" in str(e):
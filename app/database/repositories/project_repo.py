@@ -1,6 +1,7 @@
 #app/database/repositories/project_repo.py
 import psycopg2
 from ..core import execute_query, execute_commit_query, get_db_connection, return_db_connection
+from ..pagination import fetch_keyset_page, keyset_columns
 
 # --- 1. DIRECCIONES (Nivel 1) ---
 
@@ -146,11 +147,30 @@ def get_projects(company_id: int, status: str = None, search: str = None,
                  filter_management: str = None,
                  
                  limit: int = 100, offset: int = 0,
-                 sort_by: str = None, ascending: bool = True):
+                 sort_by: str = None, ascending: bool = True,
+                 cursor: str = None, with_total: bool = False):
     """
     Lista Obras con KPIs y Nombre Compuesto (PEP + Macro).
+    [KEYSET] Con cursor ("" = primera página) devuelve {items, next_cursor, total_estimate}.
     """
-    query = """
+    # --- ORDENAMIENTO ---
+    sort_map = {
+        'id': 'p.id', 'code': 'p.code', 'name': 'p.name', 'phase': 'p.phase',
+        'start_date': 'p.start_date', 'department': 'p.department', 'budget': 'p.budget',
+        'macro_name': 'mp.name', 'management_name': 'm.name', 'direction_name': 'd.name',
+        'stock_value': 'stock_value', 'liquidated_value': 'liquidated_value'
+    }
+    order_col = sort_map.get(sort_by, 'p.name')
+    direction = "ASC" if ascending else "DESC"
+
+    keyset_sort_map = {
+        'stock_value': 'COALESCE(ps.stock_value, 0)',
+        'liquidated_value': 'COALESCE(pc.liquidated_value, 0)'
+    }
+    keyset_sort = keyset_sort_map.get(sort_by, order_col)
+    keyset_select = keyset_columns(keyset_sort, "p.id") if cursor is not None else ""
+
+    query = f"""
         WITH ProjectStock AS (
             SELECT 
                 sq.project_id, 
@@ -183,6 +203,7 @@ def get_projects(company_id: int, status: str = None, search: str = None,
 
             -- [NUEVO] Columna compuesta para Dropdowns: "PEP (Macro)"
             CONCAT(p.code, ' (', mp.name, ')') as full_name_display
+            {keyset_select}
 
         FROM projects p
         LEFT JOIN macro_projects mp ON p.macro_project_id = mp.id
@@ -211,15 +232,11 @@ def get_projects(company_id: int, status: str = None, search: str = None,
     if filter_direction: query += " AND d.name ILIKE %s"; params.append(f"%{filter_direction}%")
     if filter_management: query += " AND m.name ILIKE %s"; params.append(f"%{filter_management}%")
 
-    # --- ORDENAMIENTO ---
-    sort_map = {
-        'id': 'p.id', 'code': 'p.code', 'name': 'p.name', 'phase': 'p.phase',
-        'start_date': 'p.start_date', 'department': 'p.department', 'budget': 'p.budget',
-        'macro_name': 'mp.name', 'management_name': 'm.name', 'direction_name': 'd.name',
-        'stock_value': 'stock_value', 'liquidated_value': 'liquidated_value'
-    }
-    order_col = sort_map.get(sort_by, 'p.name')
-    direction = "ASC" if ascending else "DESC"
+    if cursor is not None:
+        return fetch_keyset_page(
+            query, params, sort_by or 'name', ascending, limit, cursor,
+            same_column=(keyset_sort == "p.id"), with_total=with_total
+        )
     
     query += f" ORDER BY {order_col} {direction}, p.id ASC LIMIT %s OFFSET %s"
     params.extend([limit, offset])
@@ -370,66 +387,87 @@ def delete_project(project_id: int):
 
 # --- MÁQUINA DE ESTADOS (Lógica de Negocio Automática) ---
 
-def check_and_update_project_phase(project_id: int):
-    """
-    [AUTOMATIZACIÓN - CORREGIDA] Revisa el stock y actualiza la fase de la obra.
-    Se debe llamar después de cualquier movimiento de stock (IN/OUT) relacionado a un proyecto.
-    """
-    if not project_id: return
-
-    # 1. Obtener estado actual
-    proj = execute_query("SELECT phase, status FROM projects WHERE id = %s", (project_id,), fetchone=True)
-    if not proj or proj['status'] != 'active': return
-    
-    current_phase = proj['phase']
-    
-    # 2. Calcular Stock Total en Custodia (SOLO INTERNO)
-    # [CORRECCIÓN CRÍTICA] Agregamos el JOIN con locations y el filtro internal.
-    # Si no hacemos esto, el stock entregado al cliente cuenta como 'En Custodia'
-    # y la obra nunca pasaría a 'Por Facturar'.
-    stock_res = execute_query("""
-        SELECT SUM(sq.quantity) as total 
-        FROM stock_quants sq
-        JOIN locations l ON sq.location_id = l.id
-        WHERE sq.project_id = %s AND l.type = 'internal'
-    """, (project_id,), fetchone=True)
-    
-    total_stock = stock_res['total'] if stock_res and stock_res['total'] else 0
-    
-    new_phase = current_phase
-
-    # 3. REGLAS DE TRANSICIÓN
-    
+def _next_project_phase(current_phase, total_stock, has_consumption):
+    """Reglas de transición de fase (función pura)."""
     # Regla A: De 'Sin Iniciar' a 'En Instalación' (Si recibe material en custodia)
     if current_phase == 'Sin Iniciar' and total_stock > 0:
-        new_phase = 'En Instalación'
+        return 'En Instalación'
         
     # Regla B: De 'Liquidado' a 'En Devolución' (Si le sobró material y volvió a custodia)
-    elif current_phase == 'Liquidado' and total_stock > 0:
-        new_phase = 'En Devolución'
+    if current_phase == 'Liquidado' and total_stock > 0:
+        return 'En Devolución'
         
     # Regla C: De 'Liquidado' a 'Por Facturar' (Si quedó limpio en 0)
-    elif current_phase == 'Liquidado' and total_stock <= 0.001:
-        new_phase = 'Por Facturar'
+    if current_phase == 'Liquidado' and total_stock <= 0.001:
+        return 'Por Facturar'
 
     # Regla D: De 'En Devolución' a 'Por Facturar' (Cuando termina de devolver todo)
-    elif current_phase == 'En Devolución' and total_stock <= 0.001:
-        new_phase = 'Por Facturar'
+    if current_phase == 'En Devolución' and total_stock <= 0.001:
+        return 'Por Facturar'
         
     # Regla E: De 'En Instalación' a 'Por Facturar' (Caso raro: liquidó todo de golpe sin pasar por 'Liquidado')
-    elif current_phase == 'En Instalación' and total_stock <= 0.001:
-        # Verificamos si hubo consumo para no regresarlo a 'Sin Iniciar' por error
-        has_consumption = execute_query(
-            "SELECT 1 FROM stock_moves WHERE project_id=%s AND state='done' LIMIT 1", 
-            (project_id,), fetchone=True
-        )
-        if has_consumption:
-            new_phase = 'Por Facturar'
+    # Exige consumo previo para no regresarlo a 'Sin Iniciar' por error
+    if current_phase == 'En Instalación' and total_stock <= 0.001 and has_consumption:
+        return 'Por Facturar'
+
+    return current_phase
+
+def check_and_update_project_phase_with_cursor(cursor, project_id: int):
+    """
+    Igual que check_and_update_project_phase pero dentro de la transacción del
+    llamador: ve el stock que esa misma transacción acaba de mover y el cambio
+    de fase se confirma (o se revierte) junto con ella. 2 queries.
+    """
+    if not project_id: return
+
+    # Estado + stock en custodia (SOLO INTERNO) + consumo previo en una query.
+    # [CORRECCIÓN CRÍTICA] El stock entregado al cliente no cuenta como 'En Custodia',
+    # si no la obra nunca pasaría a 'Por Facturar'.
+    cursor.execute("""
+        SELECT pr.phase, pr.status,
+               COALESCE((
+                   SELECT SUM(sq.quantity)
+                   FROM stock_quants sq
+                   JOIN locations l ON sq.location_id = l.id
+                   WHERE sq.project_id = pr.id AND l.type = 'internal'
+               ), 0) AS total_stock,
+               EXISTS (SELECT 1 FROM stock_moves sm WHERE sm.project_id = pr.id AND sm.state = 'done') AS has_consumption
+        FROM projects pr
+        WHERE pr.id = %s
+    """, (project_id,))
+    proj = cursor.fetchone()
+    if not proj or proj[1] != 'active': return
+
+    current_phase, total_stock = proj[0], proj[2]
+    new_phase = _next_project_phase(current_phase, total_stock, proj[3])
 
-    # 4. Aplicar cambio si hubo transición
     if new_phase != current_phase:
         print(f"[AUTO-PHASE] Obra {project_id}: {current_phase} -> {new_phase} (Stock Interno: {total_stock})")
-        execute_commit_query("UPDATE projects SET phase = %s WHERE id = %s", (new_phase, project_id))
+        # Solo si nadie la cambió entretanto
+        cursor.execute(
+            "UPDATE projects SET phase = %s WHERE id = %s AND phase = %s",
+            (new_phase, project_id, current_phase)
+        )
+
+def check_and_update_project_phase(project_id: int):
+    """
+    [AUTOMATIZACIÓN - CORREGIDA] Revisa el stock y actualiza la fase de la obra.
+    Se debe llamar después de cualquier movimiento de stock (IN/OUT) relacionado a un proyecto.
+    Dentro de una transacción abierta usar check_and_update_project_phase_with_cursor.
+    """
+    if not project_id: return
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            check_and_update_project_phase_with_cursor(cursor, project_id)
+        conn.commit()
+    except Exception as e:
+        if conn: conn.rollback()
+        raise e
+    finally:
+        if conn: return_db_connection(conn)
 
 # --- IMPORTACIÓN MASIVA ---
 
@@ -2,7 +2,249 @@
 
 from datetime import datetime, date, timedelta
 from collections import defaultdict
-from ..core import get_db_connection, return_db_connection, execute_query
+import json
+from ..core import get_db_connection, return_db_connection, execute_query, execute_commit_query, stream_query
+from ..pagination import fetch_keyset_page, fetch_counted_page, keyset_columns, TOTAL_COUNT_SELECT
+from . import security_repo, job_repo
+
+# --- DASHBOARD SNAPSHOT (Lectura O(1)) ---
+# El snapshot solo se recalcula fuera del request: las operaciones que lo afectan
+# incrementan 'version' y encolan un trabajo DASHBOARD_REFRESH_JOB (app/jobs) en su
+# misma transacción; la lectura sirve siempre el último snapshot guardado.
+
+DASHBOARD_REFRESH_JOB = "reports.dashboard_refresh"
+
+def get_dashboard_snapshot(company_id):
+    """
+    Devuelve el snapshot del dashboard de la compañía (o None).
+    Incluye 'version' (contador de invalidaciones), 'snapshot_version'
+    (versión con la que se calculó) y 'age_seconds'.
+    """
+    query = """
+        SELECT payload, version, snapshot_version,
+               EXTRACT(EPOCH FROM (NOW() - computed_at)) AS age_seconds
+        FROM dashboard_snapshots
+        WHERE company_id = %s
+    """
+    row = execute_query(query, (company_id,), fetchone=True)
+    return dict(row) if row else None
+
+def save_dashboard_snapshot(company_id, payload, based_on_version):
+    """
+    Guarda el dashboard calculado a partir de 'based_on_version'.
+    Si mientras se calculaba se invalidó otra vez, version > snapshot_version
+    y el trabajo encolado por esa invalidación lo vuelve a calcular.
+    """
+    query = """
+        INSERT INTO dashboard_snapshots (company_id, payload, computed_at, version, snapshot_version)
+        VALUES (%s, %s, NOW(), %s, %s)
+        ON CONFLICT (company_id) DO UPDATE SET
+            payload = EXCLUDED.payload,
+            computed_at = NOW(),
+            snapshot_version = EXCLUDED.snapshot_version
+        WHERE dashboard_snapshots.snapshot_version <= EXCLUDED.snapshot_version
+    """
+    execute_commit_query(query, (company_id, json.dumps(payload), based_on_version, based_on_version))
+
+def request_dashboard_refresh(company_id, cursor=None):
+    """Encola el recálculo del snapshot (uno pendiente por compañía como máximo)."""
+    return job_repo.enqueue_job_once(company_id, DASHBOARD_REFRESH_JOB, job_repo.SYSTEM_JOB_USER, cursor=cursor)
+
+def mark_dashboard_snapshot_stale(cursor, company_id):
+    """
+    Invalida el snapshot y encola su recálculo dentro de la transacción del
+    llamador (ambos se confirman junto con la operación). Si la compañía aún
+    no tiene snapshot no hay nada que recalcular.
+    """
+    cursor.execute(
+        "UPDATE dashboard_snapshots SET version = version + 1 WHERE company_id = %s RETURNING company_id",
+        (company_id,)
+    )
+    if cursor.fetchone():
+        request_dashboard_refresh(company_id, cursor=cursor)
+
+# --- CIERRES MENSUALES DE STOCK (Saldos iniciales del Kardex) ---
+
+def _month_end(day):
+    """Último día del mes de 'day'."""
+    next_month = (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+    return next_month - timedelta(days=1)
+
+def invalidate_stock_closings(cursor, company_id, move_date):
+    """
+    Borra los cierres con period_end >= move_date (y sus snapshots, en cascada)
+    dentro de la transacción del llamador. Se usa al modificar un movimiento
+    ya validado con fecha dentro de un periodo ya cerrado (p.ej. su precio).
+    """
+    cursor.execute(
+        "DELETE FROM stock_closing_periods WHERE company_id = %s AND period_end >= %s",
+        (company_id, move_date)
+    )
+
+def _close_stock_period(cursor, company_id, prev_end, period_end):
+    """
+    Genera el snapshot de cierre de 'period_end' de forma incremental:
+    snapshot del cierre anterior + movimientos internos del mes.
+    Devuelve False si otro proceso ya cerró ese periodo.
+    """
+    cursor.execute("""
+        INSERT INTO stock_closing_periods (company_id, period_end)
+        VALUES (%s, %s)
+        ON CONFLICT (company_id, period_end) DO NOTHING
+        RETURNING period_end
+    """, (company_id, period_end))
+    if not cursor.fetchone():
+        return False
+
+    prev_clause = ""
+    params = [company_id, period_end]
+    if prev_end:
+        prev_clause = """
+            SELECT warehouse_id, product_id, quantity, value
+            FROM stock_closing_snapshots
+            WHERE company_id = %s AND period_end = %s
+            UNION ALL
+        """
+        params += [company_id, prev_end]
+
+    moves_lower = "AND sl.date_done >= (%s::date + 1)" if prev_end else ""
+    params.append(company_id)
+    if prev_end:
+        params.append(prev_end)
+    params.append(period_end)
+
+    cursor.execute(f"""
+        INSERT INTO stock_closing_snapshots (company_id, period_end, warehouse_id, product_id, quantity, value)
+        SELECT %s, %s, warehouse_id, product_id, SUM(quantity), SUM(value)
+        FROM (
+            {prev_clause}
+            SELECT sl.warehouse_id, sl.product_id,
+                   sl.quantity_in - sl.quantity_out as quantity,
+                   sl.value_in - sl.value_out as value
+            FROM stock_ledger sl
+            WHERE sl.company_id = %s AND sl.location_type = 'internal' AND sl.warehouse_id IS NOT NULL
+              {moves_lower}
+              AND sl.date_done < (%s::date + 1)
+        ) movements
+        GROUP BY warehouse_id, product_id
+    """, tuple(params))
+    return True
+
+def run_stock_closing(company_id, up_to=None):
+    """
+    Job de cierre mensual: genera los snapshots (compañía, almacén, producto)
+    de todos los meses completos aún no cerrados, hasta 'up_to' (por defecto
+    el mes anterior). Cada mes se calcula a partir del cierre previo y se
+    confirma por separado, así un corte a mitad de proceso no pierde avance.
+    Devuelve la lista de period_end cerrados.
+    """
+    last_complete = date.today().replace(day=1) - timedelta(days=1)
+    if up_to is None or up_to > last_complete:
+        up_to = last_complete
+    up_to = _month_end(up_to) if _month_end(up_to) <= last_complete else last_complete
+
+    conn = None
+    closed = []
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT MAX(period_end) FROM stock_closing_periods WHERE company_id = %s",
+                (company_id,)
+            )
+            prev_end = cursor.fetchone()[0]
+
+            if prev_end:
+                period_end = _month_end(prev_end + timedelta(days=1))
+            else:
+                cursor.execute(
+                    "SELECT MIN(date_done)::date FROM pickings WHERE company_id = %s AND state = 'done'",
+                    (company_id,)
+                )
+                first_done = cursor.fetchone()[0]
+                if not first_done:
+                    return closed
+                period_end = _month_end(first_done)
+            conn.commit()
+
+            while period_end <= up_to:
+                if _close_stock_period(cursor, company_id, prev_end, period_end):
+                    closed.append(period_end)
+                conn.commit()
+                prev_end = period_end
+                period_end = _month_end(period_end + timedelta(days=1))
+
+        if closed:
+            print(f"[CIERRE] Compañía {company_id}: {len(closed)} periodos cerrados hasta {closed[-1]}.")
+        return closed
+
+    except Exception as e:
+        if conn: conn.rollback()
+        print(f"[CIERRE] Error cerrando periodos de la compañía {company_id}: {e}")
+        raise e
+    finally:
+        if conn: return_db_connection(conn)
+
+# --- LIBRO MAYOR DE STOCK (stock_ledger) ---
+# Una fila por (movimiento, ubicación) con cantidades de entrada/salida y valor
+# ya resueltos. Reemplaza el JOIN locations l ON (src = l.id OR dest = l.id)
+# de los reportes: las consultas filtran por índice (compañía, producto|almacén, fecha).
+
+_STOCK_LEDGER_INSERT = """
+    INSERT INTO stock_ledger (
+        move_id, picking_id, company_id, product_id, location_id, warehouse_id,
+        location_type, picking_type_code, date_done,
+        quantity_in, quantity_out, value_in, value_out, price_unit
+    )
+    SELECT
+        sm.id, p.id, p.company_id, sm.product_id, l.id, l.warehouse_id,
+        l.type, pt.code, p.date_done,
+        CASE WHEN sm.location_dest_id = l.id THEN sm.quantity_done ELSE 0 END,
+        CASE WHEN sm.location_src_id = l.id THEN sm.quantity_done ELSE 0 END,
+        CASE WHEN sm.location_dest_id = l.id THEN sm.quantity_done * sm.price_unit ELSE 0 END,
+        CASE WHEN sm.location_src_id = l.id THEN sm.quantity_done * sm.price_unit ELSE 0 END,
+        sm.price_unit
+    FROM stock_moves sm
+    JOIN pickings p ON sm.picking_id = p.id
+    JOIN picking_types pt ON p.picking_type_id = pt.id
+    CROSS JOIN LATERAL (
+        SELECT DISTINCT unnest(ARRAY[sm.location_src_id, sm.location_dest_id]) AS location_id
+    ) sides
+    JOIN locations l ON l.id = sides.location_id
+    WHERE p.state = 'done' AND p.date_done IS NOT NULL AND {where}
+    ON CONFLICT (move_id, location_id) DO NOTHING
+"""
+
+def record_stock_ledger(cursor, picking_id):
+    """
+    Registra en el libro mayor los movimientos de un picking recién validado
+    (dentro de la transacción de validación).
+    """
+    cursor.execute(_STOCK_LEDGER_INSERT.format(where="p.id = %s"), (picking_id,))
+
+def rebuild_stock_ledger(company_id):
+    """
+    Reconstruye el libro mayor de una compañía desde stock_moves
+    (carga inicial o reparación). Devuelve el número de filas generadas.
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM stock_ledger WHERE company_id = %s", (company_id,))
+            cursor.execute(_STOCK_LEDGER_INSERT.format(where="p.company_id = %s"), (company_id,))
+            inserted = cursor.rowcount
+            # Los cierres se calcularon sobre el libro anterior: se regeneran con el próximo run_stock_closing
+            invalidate_stock_closings(cursor, company_id, date.min)
+        conn.commit()
+        print(f"[LEDGER] Compañía {company_id}: {inserted} filas reconstruidas.")
+        return inserted
+    except Exception as e:
+        if conn: conn.rollback()
+        print(f"[LEDGER] Error reconstruyendo el libro mayor de la compañía {company_id}: {e}")
+        raise e
+    finally:
+        if conn: return_db_connection(conn)
 
 # --- DASHBOARD & KPIs ---
 
@@ -253,14 +495,17 @@ def _build_aging_base_query_and_params(company_id, filters={}):
     return cte, params, filters.get("bucket")
 
 
-def get_inventory_aging_details(company_id, filters={}, sort_by='aging_days', ascending=False, limit=None, offset=None):
+def get_inventory_aging_details(company_id, filters={}, sort_by='aging_days', ascending=False, limit=None, offset=None,
+                                with_count=False):
     """
     [OPTIMIZADO] Obtiene el reporte detallado de antigüedad con paginación.
+    [CONTEO] Con with_count devuelve {items, total, next_cursor}: el CTE se evalúa
+    una sola vez para la página y el total.
     """
     cte, params, bucket = _build_aging_base_query_and_params(company_id, filters)
 
     # Consulta principal sobre el CTE
-    query = cte + " SELECT * FROM AgingData"
+    query = cte + f" SELECT *{TOTAL_COUNT_SELECT if with_count else ''} FROM AgingData"
 
     # Filtro por bucket (se aplica sobre aging_days calculado)
     bucket_clause = ""
@@ -291,6 +536,11 @@ def get_inventory_aging_details(company_id, filters={}, sort_by='aging_days', as
     if offset is not None:
         query += f" OFFSET {int(offset)}"
 
+    if with_count:
+        return fetch_counted_page(
+            query, params, offset,
+            count_fallback=lambda: get_inventory_aging_count(company_id, filters)
+        )
     return execute_query(query, tuple(params), fetchall=True)
 
 
@@ -335,15 +585,14 @@ def get_stock_coverage_report(company_id, history_days=90, product_filter=None):
             GROUP BY sq.product_id
         ),
         ConsumptionData AS (
-            SELECT sm.product_id, SUM(sm.quantity_done) as total_consumed
-            FROM stock_moves sm
-            JOIN pickings p ON sm.picking_id = p.id
-            JOIN picking_types pt ON p.picking_type_id = pt.id
-            WHERE p.state = 'done'
-              AND pt.code = 'OUT'
-              AND p.company_id = %s
-              AND p.date_done::date >= (CURRENT_DATE - INTERVAL '{safe_history_days} days')
-            GROUP BY sm.product_id
+            -- [LEDGER] La fila de origen de cada movimiento lleva quantity_out = quantity_done
+            SELECT sl.product_id, SUM(sl.quantity_out) as total_consumed
+            FROM stock_ledger sl
+            WHERE sl.company_id = %s
+              AND sl.picking_type_code = 'OUT'
+              AND sl.quantity_out > 0
+              AND sl.date_done >= (CURRENT_DATE - INTERVAL '{safe_history_days} days')
+            GROUP BY sl.product_id
         )
         SELECT
             p.sku, p.name as product_name,
@@ -374,23 +623,24 @@ def get_product_kardex(company_id, product_id, date_from=None, date_to=None, war
     """
     
     # --- 1. Parámetros y cláusulas para el WHERE ---
-    where_clauses = ["p.state = 'done'", "sm.product_id =  %s", "p.company_id =  %s"]
+    # [LEDGER] Filtros sobre stock_ledger -> índice (company_id, product_id, date_done)
+    where_clauses = ["sl.product_id =  %s", "sl.company_id =  %s"]
     params = [product_id, company_id] # 2 params
 
     if date_from:
-        where_clauses.append("date(p.date_done) >=  %s")
+        where_clauses.append("sl.date_done >= %s::date")
         params.append(date_from) # 3 params
     if date_to:
-        where_clauses.append("date(p.date_done) <=  %s")
+        where_clauses.append("sl.date_done < (%s::date + 1)")
         params.append(date_to) # 4 params
     
-    # --- 2. Filtro de Almacén (se aplica al JOIN 'l') ---
+    # --- 2. Filtro de Almacén (se aplica a la ubicación del ledger) ---
     if warehouse_id and warehouse_id != "all":
-        where_clauses.append("l.warehouse_id =  %s")
+        where_clauses.append("sl.warehouse_id =  %s")
         params.append(warehouse_id) # 5 params
     else:
         # Si queremos "Todos", solo nos importan las ubicaciones internas
-        where_clauses.append("l.type = 'internal'")
+        where_clauses.append("sl.location_type = 'internal'")
         
     query = f"""
         SELECT
@@ -413,20 +663,9 @@ def get_product_kardex(company_id, product_id, date_from=None, date_to=None, war
             
             w.name as affected_warehouse, -- <-- El almacén que estamos "viendo"
             
-            CASE 
-                WHEN sm.location_dest_id = l.id THEN sm.quantity_done
-                ELSE 0 
-            END as quantity_in,
-            
-            CASE 
-                WHEN sm.location_src_id = l.id THEN sm.quantity_done
-                ELSE 0 
-            END as quantity_out,
-            
-            CASE 
-                WHEN sm.location_dest_id = l.id THEN sm.quantity_done * sm.price_unit
-                ELSE 0 
-            END as initial_value_in,
+            sl.quantity_in,
+            sl.quantity_out,
+            sl.value_in as initial_value_in,
             
             sm.price_unit,
             sm.cost_at_adjustment,
@@ -438,15 +677,12 @@ def get_product_kardex(company_id, product_id, date_from=None, date_to=None, war
             l_src.path as location_src_path,
             l_dest.path as location_dest_path
             
-        FROM stock_moves sm
-        JOIN pickings p ON sm.picking_id = p.id
+        FROM stock_ledger sl
+        JOIN stock_moves sm ON sl.move_id = sm.id
+        JOIN pickings p ON sl.picking_id = p.id
         JOIN picking_types pt ON p.picking_type_id = pt.id
-        
-        -- ¡EL JOIN CLAVE RESTAURADO!
-        JOIN locations l ON (sm.location_src_id = l.id OR sm.location_dest_id = l.id)
-        
-        JOIN warehouses w ON l.warehouse_id = w.id
-        JOIN products prod ON sm.product_id = prod.id -- JOIN para product_id
+        JOIN warehouses w ON sl.warehouse_id = w.id
+        JOIN products prod ON sl.product_id = prod.id -- JOIN para product_id
         LEFT JOIN product_categories pc ON prod.category_id = pc.id
         LEFT JOIN partners partner ON p.partner_id = partner.id
         LEFT JOIN locations l_src ON sm.location_src_id = l_src.id
@@ -456,11 +692,7 @@ def get_product_kardex(company_id, product_id, date_from=None, date_to=None, war
         LEFT JOIN work_orders wo ON p.work_order_id = wo.id
         
         WHERE {" AND ".join(where_clauses)}
-        AND (
-            (CASE WHEN sm.location_dest_id = l.id THEN sm.quantity_done ELSE 0 END) > 0
-            OR 
-            (CASE WHEN sm.location_src_id = l.id THEN sm.quantity_done ELSE 0 END) > 0
-        )
+        AND (sl.quantity_in > 0 OR sl.quantity_out > 0)
         -- --------------------------------------------------------------------
         
         ORDER BY p.date_done, p.id
@@ -470,26 +702,19 @@ def get_product_kardex(company_id, product_id, date_from=None, date_to=None, war
 
 def get_kardex_summary(company_id, date_from, date_to, product_filter=None, warehouse_id=None):
     # (La lógica es similar, pero reemplaza date() por ::date)
-    params = []
-    warehouse_clause_cte = ""
-    warehouse_clause_sub = ""
+    # [CIERRES] El saldo inicial parte del último cierre mensual anterior a date_from
+    # (stock_closing_snapshots) y solo escanea los movimientos posteriores a ese cierre.
     wh_id = warehouse_id if warehouse_id and warehouse_id != "all" else "all"
-
-    params.append(company_id)
-    if wh_id != "all":
-        warehouse_clause_cte = " AND w.id = %s"
-        params.append(wh_id)
-
-    params.append(date_from)
-    if wh_id != "all":
-        warehouse_clause_sub = " AND warehouse_id = %s"
-        params.append(wh_id)
-
-    params.append(date_from)
-    params.append(date_to)
-    if wh_id != "all":
-        params.append(wh_id)
-        
+    warehouse_clause_cte = " AND sl.warehouse_id = %s" if wh_id != "all" else ""
+    warehouse_clause_snap = " AND cs.warehouse_id = %s" if wh_id != "all" else ""
+    warehouse_clause_sub = " AND warehouse_id = %s" if wh_id != "all" else ""
+    wh_params = [wh_id] if wh_id != "all" else []
+
+    params = [company_id, date_from]                      # LastClosing
+    params += [company_id] + wh_params                    # InternalStockMoves
+    params += [company_id] + wh_params                    # ClosingBalance
+    params += [date_from] + wh_params                     # InitialBalance
+    params += [date_from, date_to] + wh_params            # PeriodMovements
     params.append(company_id)
     
     product_clause = ""
@@ -498,24 +723,39 @@ def get_kardex_summary(company_id, date_from, date_to, product_filter=None, ware
         params.extend([f"%{product_filter}%", f"%{product_filter}%"])
      
     query = f"""
-        WITH InternalStockMoves AS (
+        WITH LastClosing AS (
+            SELECT MAX(period_end) AS period_end
+            FROM stock_closing_periods
+            WHERE company_id = %s AND period_end < %s::date
+        ),
+        InternalStockMoves AS (
             SELECT
-                sm.product_id, p.date_done, l.warehouse_id,
-                CASE WHEN sm.location_dest_id = l.id THEN sm.quantity_done ELSE 0 END as quantity_in,
-                CASE WHEN sm.location_src_id = l.id THEN sm.quantity_done ELSE 0 END as quantity_out,
-                CASE WHEN sm.location_dest_id = l.id THEN sm.quantity_done * sm.price_unit ELSE 0 END as value_in,
-                CASE WHEN sm.location_src_id = l.id THEN sm.quantity_done * sm.price_unit ELSE 0 END as value_out
-            FROM stock_moves sm
-            JOIN pickings p ON sm.picking_id = p.id
-            JOIN locations l ON (sm.location_src_id = l.id OR sm.location_dest_id = l.id)
-            JOIN warehouses w ON l.warehouse_id = w.id
-            WHERE p.state = 'done' AND l.type = 'internal' AND p.company_id = %s {warehouse_clause_cte}
+                sl.product_id, sl.date_done, sl.warehouse_id,
+                sl.quantity_in, sl.quantity_out, sl.value_in, sl.value_out
+            FROM stock_ledger sl
+            WHERE sl.company_id = %s AND sl.location_type = 'internal' AND sl.warehouse_id IS NOT NULL {warehouse_clause_cte}
+              AND sl.date_done >= COALESCE((SELECT period_end + 1 FROM LastClosing), '-infinity'::date)
+        ),
+        ClosingBalance AS (
+            SELECT cs.product_id,
+                   SUM(cs.quantity) as balance,
+                   SUM(cs.value) as value_balance
+            FROM stock_closing_snapshots cs
+            JOIN LastClosing lc ON cs.period_end = lc.period_end
+            WHERE cs.company_id = %s {warehouse_clause_snap}
+            GROUP BY cs.product_id
         ),
         InitialBalance AS (
-            SELECT product_id,
-                   SUM(quantity_in) - SUM(quantity_out) as balance,
-                   SUM(value_in) - SUM(value_out) as value_balance
-            FROM InternalStockMoves WHERE date_done::date < %s {warehouse_clause_sub} GROUP BY product_id
+            SELECT product_id, SUM(balance) as balance, SUM(value_balance) as value_balance
+            FROM (
+                SELECT product_id, balance, value_balance FROM ClosingBalance
+                UNION ALL
+                SELECT product_id,
+                       SUM(quantity_in) - SUM(quantity_out),
+                       SUM(value_in) - SUM(value_out)
+                FROM InternalStockMoves WHERE date_done::date < %s {warehouse_clause_sub} GROUP BY product_id
+            ) balances
+            GROUP BY product_id
         ),
         PeriodMovements AS (
             SELECT product_id,
@@ -598,7 +838,8 @@ def get_stock_summary_count(company_id, filters={}):
     res = execute_query(base_query, tuple(params), fetchone=True)
     return res['total'] if res else 0
 
-def get_stock_summary_filtered_sorted(company_id, warehouse_id=None, filters={}, sort_by='sku', ascending=True, limit=None, offset=None):
+def get_stock_summary_filtered_sorted(company_id, warehouse_id=None, filters={}, sort_by='sku', ascending=True, limit=None, offset=None,
+                                      cursor=None, with_total=False, with_count=False):
     """ 
     [CORREGIDO DEFINITIVO] Obtiene el stock resumen.
     
@@ -609,8 +850,46 @@ def get_stock_summary_filtered_sorted(company_id, warehouse_id=None, filters={},
     Esto evita el problema donde el cálculo por líneas (stock_move_lines) devolvía 0
     si las líneas aún no tenían 'qty_done' validado, garantizando que el número
     coincida con la realidad operativa.
+
+    [KEYSET] Con cursor ("" = primera página) devuelve {items, next_cursor, total_estimate}.
+    La fila se identifica por (producto, ubicación), así que el desempate es ARRAY[p.id, l.id].
+    [CONTEO] Con with_count devuelve {items, total, next_cursor} en una sola consulta.
+    El total sale de las mismas filas de la página (get_stock_summary_count solo mira
+    stock físico y no cuenta las claves que solo tienen tránsito o reservas).
     """
-    base_query = """
+    sort_map = {
+        'warehouse_name': 'w.name', 'location_name': 'l.name', 'sku': 'p.sku',
+        'product_name': 'p.name', 'category_name': 'pc.name',
+        'physical_quantity': 'physical_quantity', 
+        'reserved_quantity': 'reserved_quantity', 
+        'incoming_quantity': 'incoming_quantity',
+        'available_quantity': 'available_quantity'
+    }
+    order_by_col_key = sort_by if sort_by else 'sku'
+    order_by_col = sort_map.get(order_by_col_key, 'p.sku')
+    direction = "ASC" if ascending else "DESC"
+    
+    if order_by_col in ['pc.name', 'u.name', 'l.name']:
+         order_by_clause = f"COALESCE({order_by_col}, 'zzzz')"
+    else:
+         order_by_clause = order_by_col
+
+    # Para keyset el orden debe ser una expresión real (no un alias del SELECT)
+    keyset_sort_map = {
+        'physical_quantity': 'COALESCE(phys.qty, 0)',
+        'reserved_quantity': 'COALESCE(res.qty, 0)',
+        'incoming_quantity': 'COALESCE(inc.qty, 0)',
+        'available_quantity': '(COALESCE(phys.qty, 0) - COALESCE(res.qty, 0))'
+    }
+    keyset_select = (
+        keyset_columns(keyset_sort_map.get(order_by_col_key, order_by_clause), "ARRAY[p.id, l.id]")
+        if cursor is not None else ""
+    )
+    # Sin agregados en el SELECT externo: la ventana cuenta filas (producto, ubicación).
+    # En modo keyset el total lo agrega fetch_keyset_page.
+    total_select = TOTAL_COUNT_SELECT if with_count and cursor is None else ""
+
+    base_query = f"""
     WITH 
     -- 1. Stock Físico (Quants existentes)
     PhysicalStock AS (
@@ -622,24 +901,19 @@ def get_stock_summary_filtered_sorted(company_id, warehouse_id=None, filters={},
         GROUP BY sq.product_id, sq.location_id
     ),
     -- 2. Stock Reservado (Salidas Planificadas)
+    -- [RESERVAS] Se leen del agregado stock_reservations (demanda total del movimiento)
     ReservedStock AS (
-        SELECT 
-            sm.product_id, sm.location_src_id as location_id, 
-            SUM(sm.product_uom_qty) as qty -- Usamos la demanda total del movimiento
-        FROM stock_moves sm
-        JOIN pickings p ON sm.picking_id = p.id
-        WHERE p.state = 'listo' AND p.company_id = %s
-        GROUP BY sm.product_id, sm.location_src_id
+        SELECT product_id, location_id, SUM(demand_out_qty) as qty
+        FROM stock_reservations
+        WHERE company_id = %s AND demand_out_qty > 0
+        GROUP BY product_id, location_id
     ),
     -- 3. Stock En Tránsito (Entradas Planificadas)
     IncomingStock AS (
-        SELECT 
-            sm.product_id, sm.location_dest_id as location_id, 
-            SUM(sm.product_uom_qty) as qty -- Usamos la demanda total del movimiento
-        FROM stock_moves sm
-        JOIN pickings p ON sm.picking_id = p.id
-        WHERE p.state = 'listo' AND p.company_id = %s
-        GROUP BY sm.product_id, sm.location_dest_id
+        SELECT product_id, location_id, SUM(demand_in_qty) as qty
+        FROM stock_reservations
+        WHERE company_id = %s AND demand_in_qty > 0
+        GROUP BY product_id, location_id
     ),
     -- 4. Unimos todas las claves para no perder productos que solo tengan tránsito
     ActiveKeys AS (
@@ -671,6 +945,8 @@ def get_stock_summary_filtered_sorted(company_id, warehouse_id=None, filters={},
         COALESCE(inc.qty, 0) as incoming_quantity,
         
         (COALESCE(phys.qty, 0) - COALESCE(res.qty, 0)) as available_quantity
+        {keyset_select}
+        {total_select}
 
     FROM ActiveKeys k
     JOIN products p ON k.product_id = p.id
@@ -713,22 +989,14 @@ def get_stock_summary_filtered_sorted(company_id, warehouse_id=None, filters={},
     if where_clauses:
         base_query += " AND " + " AND ".join(where_clauses)
 
-    sort_map = {
-        'warehouse_name': 'w.name', 'location_name': 'l.name', 'sku': 'p.sku',
-        'product_name': 'p.name', 'category_name': 'pc.name',
-        'physical_quantity': 'physical_quantity', 
-        'reserved_quantity': 'reserved_quantity', 
-        'incoming_quantity': 'incoming_quantity',
-        'available_quantity': 'available_quantity'
-    }
-    order_by_col_key = sort_by if sort_by else 'sku'
-    order_by_col = sort_map.get(order_by_col_key, 'p.sku')
-    direction = "ASC" if ascending else "DESC"
-    
-    if order_by_col in ['pc.name', 'u.name', 'l.name']:
-         order_by_clause = f"COALESCE({order_by_col}, 'zzzz')"
-    else:
-         order_by_clause = order_by_col
+    if cursor is not None:
+        return fetch_keyset_page(
+            base_query, params, order_by_col_key, ascending, limit or 50, cursor,
+            with_total=with_total, with_count=with_count
+        )
+
+    # Conjunto filtrado sin orden: respaldo del conteo si la página viene vacía
+    filtered_query, filtered_params = base_query, list(params)
          
     base_query += f" ORDER BY {order_by_clause} {direction}"
     
@@ -736,33 +1004,36 @@ def get_stock_summary_filtered_sorted(company_id, warehouse_id=None, filters={},
         base_query += " LIMIT %s OFFSET %s"
         params.extend([limit, offset])
     
+    if with_count:
+        return fetch_counted_page(
+            base_query, params, offset,
+            count_fallback=lambda: execute_query(
+                f"SELECT COUNT(*) AS total FROM ({filtered_query}) q", tuple(filtered_params), fetchone=True
+            )['total']
+        )
     return execute_query(base_query, tuple(params), fetchall=True)
 
-def get_stock_on_hand_filtered_sorted(company_id, warehouse_id=None, filters={}, sort_by='sku', ascending=True, limit=None, offset=None):
+def get_stock_on_hand_filtered_sorted(company_id, warehouse_id=None, filters={}, sort_by='sku', ascending=True, limit=None, offset=None, stream=False,
+                                      with_count=False):
     """ 
     Obtiene el stock detallado por lote/serie y PROYECTO (Versión V3).
     [CORREGIDO] Arreglado bug de ordenamiento por lote (lot_name_ordered).
+    [STREAMING] Con stream=True devuelve un generador (cursor de servidor) para exportar.
+    [CONTEO] Con with_count devuelve {items, total, next_cursor}; la ventana se evalúa
+    después del GROUP BY, así que cuenta grupos (lo mismo que get_stock_on_hand_count).
     """
-    base_query = """
+    total_select = TOTAL_COUNT_SELECT if with_count and not stream else ""
+    base_query = f"""
     WITH ReservedStock AS (
-        SELECT 
-            sm.product_id, sm.location_src_id, sml.lot_id, sm.project_id,
-            SUM(CASE WHEN sml.id IS NOT NULL THEN sml.qty_done ELSE sm.product_uom_qty END) as reserved_qty
-        FROM stock_moves sm
-        JOIN pickings p ON sm.picking_id = p.id
-        LEFT JOIN stock_move_lines sml ON sm.id = sml.move_id
-        WHERE p.state = 'listo' AND p.company_id = %s
-        GROUP BY sm.product_id, sm.location_src_id, sml.lot_id, sm.project_id
+        -- [RESERVAS] Agregado mantenido por lote/proyecto (ver operation_repo.reserve_picking_stock)
+        SELECT product_id, location_id as location_src_id, lot_id, project_id, reserved_qty
+        FROM stock_reservations
+        WHERE company_id = %s AND reserved_qty > 0
     ),
     IncomingStock AS (
-        SELECT 
-            sm.product_id, sm.location_dest_id, sml.lot_id, sm.project_id,
-            SUM(CASE WHEN sml.id IS NOT NULL THEN sml.qty_done ELSE sm.product_uom_qty END) as incoming_qty
-        FROM stock_moves sm
-        JOIN pickings p ON sm.picking_id = p.id
-        LEFT JOIN stock_move_lines sml ON sm.id = sml.move_id
-        WHERE p.state = 'listo' AND p.company_id = %s
-        GROUP BY sm.product_id, sm.location_dest_id, sml.lot_id, sm.project_id
+        SELECT product_id, location_id as location_dest_id, lot_id, project_id, incoming_qty
+        FROM stock_reservations
+        WHERE company_id = %s AND incoming_qty > 0
     )
     SELECT
         p.id as product_id, w.id as warehouse_id, l.id as location_id, sl.id as lot_id, sq.project_id,
@@ -778,6 +1049,7 @@ def get_stock_on_hand_filtered_sorted(company_id, warehouse_id=None, filters={},
         
         (SUM(sq.quantity) - COALESCE(MAX(rs.reserved_qty), 0)) as available_quantity,
         COALESCE(sl.name, '---') as lot_name_ordered
+        {total_select}
         
     FROM stock_quants sq
     JOIN products p ON sq.product_id = p.id
@@ -850,31 +1122,40 @@ def get_stock_on_hand_filtered_sorted(company_id, warehouse_id=None, filters={},
         base_query += " LIMIT %s OFFSET %s"
         params.extend([limit, offset])
     
+    if stream:
+        return stream_query(base_query, tuple(params))
+    if with_count:
+        return fetch_counted_page(
+            base_query, params, offset,
+            count_fallback=lambda: get_stock_on_hand_count(company_id, warehouse_id, filters)
+        )
     return execute_query(base_query, tuple(params), fetchall=True)
 
-def get_full_product_kardex_data(company_id, date_from, date_to, warehouse_id=None, product_filter=None):
+def get_full_product_kardex_data(company_id, date_from, date_to, warehouse_id=None, product_filter=None, stream=False):
     """
     Obtiene TODOS los movimientos de stock detallados ('done') para el EXPORT CSV.
     [CORREGIDO] Usa ILIKE para búsqueda de productos insensible a mayúsculas.
+    [STREAMING] Con stream=True devuelve un generador (cursor de servidor) en orden sku/fecha.
     """
     
     # --- 1. Parámetros y cláusulas para el WHERE ---
-    where_clauses = ["p.state = 'done'", "p.company_id = %s"]
+    # [LEDGER] Filtros sobre stock_ledger -> índice (company_id, warehouse_id, date_done)
+    where_clauses = ["sl.company_id = %s"]
     params = [company_id]
 
     if date_from:
-        where_clauses.append("date(p.date_done) >= %s")
+        where_clauses.append("sl.date_done >= %s::date")
         params.append(date_from)
     if date_to:
-        where_clauses.append("date(p.date_done) <= %s")
+        where_clauses.append("sl.date_done < (%s::date + 1)")
         params.append(date_to)
     
     # Filtro de Almacén
     if warehouse_id and warehouse_id != "all":
-        where_clauses.append("l.warehouse_id = %s")
+        where_clauses.append("sl.warehouse_id = %s")
         params.append(warehouse_id)
     else:
-        where_clauses.append("l.type = 'internal'")
+        where_clauses.append("sl.location_type = 'internal'")
         
     # Filtro de Producto
     if product_filter:
@@ -921,10 +1202,10 @@ def get_full_product_kardex_data(company_id, date_from, date_to, warehouse_id=No
 
             w.name as affected_warehouse,
 
-            -- Lógica de Entrada/Salida basada en el JOIN 'l'
-            CASE WHEN sm.location_dest_id = l.id THEN sm.quantity_done ELSE 0 END as quantity_in,
-            CASE WHEN sm.location_src_id = l.id THEN sm.quantity_done ELSE 0 END as quantity_out,
-            CASE WHEN sm.location_dest_id = l.id THEN sm.quantity_done * sm.price_unit ELSE 0 END as initial_value_in,
+            -- Entrada/Salida ya resueltas por ubicación en el ledger
+            sl.quantity_in,
+            sl.quantity_out,
+            sl.value_in as initial_value_in,
             
             sm.price_unit,
             sm.cost_at_adjustment,
@@ -936,15 +1217,12 @@ def get_full_product_kardex_data(company_id, date_from, date_to, warehouse_id=No
             l_src.path as location_src_path,
             l_dest.path as location_dest_path
 
-        FROM stock_moves sm
-        JOIN pickings p ON sm.picking_id = p.id
+        FROM stock_ledger sl
+        JOIN stock_moves sm ON sl.move_id = sm.id
+        JOIN pickings p ON sl.picking_id = p.id
         JOIN picking_types pt ON p.picking_type_id = pt.id
-        
-        -- ¡EL JOIN CLAVE RESTAURADO!
-        JOIN locations l ON (sm.location_src_id = l.id OR sm.location_dest_id = l.id)
-        
-        JOIN warehouses w ON l.warehouse_id = w.id
-        JOIN products prod ON sm.product_id = prod.id
+        JOIN warehouses w ON sl.warehouse_id = w.id
+        JOIN products prod ON sl.product_id = prod.id
         LEFT JOIN product_categories pc ON prod.category_id = pc.id
         LEFT JOIN partners par ON p.partner_id = par.id
         LEFT JOIN locations l_src ON sm.location_src_id = l_src.id
@@ -961,6 +1239,8 @@ def get_full_product_kardex_data(company_id, date_from, date_to, warehouse_id=No
     """
 
     print(f"[DB DEBUG] get_full_product_kardex_data Query Params: {tuple(params)}")
+    if stream:
+        return stream_query(query, tuple(params))
     return execute_query(query, tuple(params), fetchall=True)
 
 # --- REPORTE DE PROYECTOS ---
@@ -1052,8 +1332,8 @@ def get_warehouses_kpi_paginated(company_id, user_id, role_name, search=None, li
 
     # 1. Filtro de Permisos
     if role_name != 'Administrador':
-        where_clauses.append("w.id IN (SELECT warehouse_id FROM user_warehouses WHERE user_id = %s)")
-        params.append(user_id)
+        where_clauses.append("w.id = ANY(%s)")
+        params.append(security_repo.get_user_warehouse_ids(user_id))
 
     # 2. Filtro de Búsqueda
     if search:
@@ -1103,8 +1383,8 @@ def get_warehouses_kpi_count(company_id, user_id, role_name, search=None):
     where_clauses = ["w.company_id = %s", "w.status = 'activo'"]
 
     if role_name != 'Administrador':
-        where_clauses.append("w.id IN (SELECT warehouse_id FROM user_warehouses WHERE user_id = %s)")
-        params.append(user_id)
+        where_clauses.append("w.id = ANY(%s)")
+        params.append(security_repo.get_user_warehouse_ids(user_id))
 
     if search:
         where_clauses.append("(w.name ILIKE %s OR wc.name ILIKE %s)")
@@ -1500,33 +1780,30 @@ def get_material_flow_series(company_id, days=30):
     # 2. Query Despachado (Principal -> Contrata)
     # FIX: Si price_unit es 0, usamos standard_price del producto
     query_dispatch = f"""
-        SELECT to_char(p.date_done, 'YYYY-MM-DD') as day, 
-               SUM(sm.quantity_done * COALESCE(NULLIF(sm.price_unit, 0), prod.standard_price)) as val
-        FROM stock_moves sm
-        JOIN products prod ON sm.product_id = prod.id
-        JOIN pickings p ON sm.picking_id = p.id
-        JOIN locations l_src ON sm.location_src_id = l_src.id
-        JOIN warehouses w_src ON l_src.warehouse_id = w_src.id
+        SELECT to_char(sl.date_done, 'YYYY-MM-DD') as day, 
+               SUM(sl.quantity_out * COALESCE(NULLIF(sl.price_unit, 0), prod.standard_price)) as val
+        FROM stock_ledger sl
+        JOIN products prod ON sl.product_id = prod.id
+        JOIN warehouses w_src ON sl.warehouse_id = w_src.id
         JOIN warehouse_categories wc_src ON w_src.category_id = wc_src.id
-        WHERE p.company_id = %s 
-          AND p.state = 'done'
+        WHERE sl.company_id = %s 
+          AND sl.quantity_out > 0 -- Fila de ORIGEN del movimiento
           AND wc_src.name ILIKE '%%PRINCIPAL%%' -- Flexible
-          AND p.date_done >= CURRENT_DATE - INTERVAL '{days} days'
+          AND sl.date_done >= CURRENT_DATE - INTERVAL '{days} days'
         GROUP BY day
     """
     
     # 3. Query Liquidado (Consumo final)
     query_liquidated = f"""
-        SELECT to_char(p.date_done, 'YYYY-MM-DD') as day, 
-               SUM(sm.quantity_done * COALESCE(NULLIF(sm.price_unit, 0), prod.standard_price)) as val
-        FROM stock_moves sm
-        JOIN products prod ON sm.product_id = prod.id
-        JOIN pickings p ON sm.picking_id = p.id
-        JOIN locations l_dest ON sm.location_dest_id = l_dest.id
-        WHERE p.company_id = %s 
-          AND p.state = 'done'
+        SELECT to_char(sl.date_done, 'YYYY-MM-DD') as day, 
+               SUM(sl.quantity_in * COALESCE(NULLIF(sl.price_unit, 0), prod.standard_price)) as val
+        FROM stock_ledger sl
+        JOIN products prod ON sl.product_id = prod.id
+        JOIN locations l_dest ON sl.location_id = l_dest.id
+        WHERE sl.company_id = %s 
+          AND sl.quantity_in > 0 -- Fila de DESTINO del movimiento
           AND l_dest.category IN ('CLIENTE', 'CONTRATA CLIENTE')
-          AND p.date_done >= CURRENT_DATE - INTERVAL '{days} days'
+          AND sl.date_done >= CURRENT_DATE - INTERVAL '{days} days'
         GROUP BY day
     """
     
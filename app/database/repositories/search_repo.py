@@ -0,0 +1,254 @@
+#app/database/repositories/search_repo.py
+"""
+Búsqueda global (pickings, productos, partners y proyectos).
+
+Cada entidad tiene un documento en search_documents con el texto de sus columnas
+y de las tablas unidas (partner, técnico, proyecto, ubicaciones, almacenes...).
+El documento tiene un tsvector generado (búsqueda por palabras con prefijo) y un
+índice trigram sobre el texto (ILIKE '%...%' indexado).
+
+Los documentos los mantienen triggers de la BD (ver search_trigger_statements),
+así que cualquier INSERT/UPDATE —incluidas importaciones masivas y OTs— queda
+indexado sin tocar cada ruta de escritura. Los renombres de tablas unidas
+(p.ej. un partner) re-indexan en cascada los pickings afectados.
+"""
+
+import re
+
+from ..core import execute_query, get_db_connection, return_db_connection
+
+SEARCH_ENTITIES = ('picking', 'product', 'partner', 'project')
+
+# Longitud mínima del término para que los trigramas sirvan de algo
+SEARCH_MIN_LENGTH = 3
+
+_SEARCH_UPSERT = """
+    INSERT INTO search_documents (entity_type, entity_id, company_id, title, subtitle, search_text)
+    {select}
+    ON CONFLICT (entity_type, entity_id) DO UPDATE SET
+        company_id = EXCLUDED.company_id,
+        title = EXCLUDED.title,
+        subtitle = EXCLUDED.subtitle,
+        search_text = EXCLUDED.search_text
+"""
+
+# SELECT por entidad; {where} filtra las filas a (re)indexar.
+# Pickings: mismos alias que operation_repo._PICKINGS_LIST.
+_SEARCH_DOC_SELECT = {
+    'picking': """
+        SELECT 'picking', p.id, p.company_id, p.name,
+               CONCAT_WS(' · ', pt.code, p.custom_operation_type, COALESCE(partner.name, proj.code)),
+               CONCAT_WS(' ', p.name, p.remission_number, p.partner_ref, p.purchase_order,
+                         p.responsible_user, p.custom_operation_type, partner.name,
+                         {employee_cols}
+                         proj.code, proj.name, mp.name,
+                         l_src.path, l_dest.path, w_src.name, w_dest.name)
+        FROM pickings p
+        JOIN picking_types pt ON p.picking_type_id = pt.id
+        LEFT JOIN partners partner ON p.partner_id = partner.id
+        {employee_join}
+        LEFT JOIN projects proj ON p.project_id = proj.id
+        LEFT JOIN macro_projects mp ON proj.macro_project_id = mp.id
+        LEFT JOIN locations l_src ON p.location_src_id = l_src.id
+        LEFT JOIN locations l_dest ON p.location_dest_id = l_dest.id
+        LEFT JOIN warehouses w_src ON l_src.warehouse_id = w_src.id
+        LEFT JOIN warehouses w_dest ON l_dest.warehouse_id = w_dest.id
+        WHERE {where}
+    """,
+    'product': """
+        SELECT 'product', p.id, p.company_id, p.name, p.sku,
+               CONCAT_WS(' ', p.sku, p.name, p.barcode, pc.name)
+        FROM products p
+        LEFT JOIN product_categories pc ON p.category_id = pc.id
+        WHERE {where}
+    """,
+    'partner': """
+        SELECT 'partner', pa.id, pa.company_id, pa.name, pa.ruc,
+               CONCAT_WS(' ', pa.name, pa.ruc, pa.social_reason, pa.address)
+        FROM partners pa
+        WHERE {where}
+    """,
+    'project': """
+        SELECT 'project', proj.id, proj.company_id, CONCAT(proj.code, ' - ', proj.name), mp.name,
+               CONCAT_WS(' ', proj.code, proj.name, mp.name, proj.address,
+                         proj.district, proj.province, proj.department)
+        FROM projects proj
+        LEFT JOIN macro_projects mp ON proj.macro_project_id = mp.id
+        WHERE {where}
+    """,
+}
+
+# (tabla, entidad, columnas que disparan, condición sobre NEW)
+# La primera fila de cada entidad es su propia tabla (INSERT/UPDATE/DELETE);
+# el resto son cascadas por renombres en tablas unidas (solo UPDATE).
+_SEARCH_TRIGGERS = [
+    ('pickings', 'picking',
+     ['name', 'remission_number', 'partner_ref', 'purchase_order', 'responsible_user',
+      'custom_operation_type', 'picking_type_id', 'partner_id', 'project_id',
+      'location_src_id', 'location_dest_id'], "p.id = NEW.id"),
+    ('products', 'product', ['name', 'sku', 'barcode', 'category_id'], "p.id = NEW.id"),
+    ('partners', 'partner', ['name', 'ruc', 'social_reason', 'address'], "pa.id = NEW.id"),
+    ('projects', 'project',
+     ['code', 'name', 'macro_project_id', 'address', 'district', 'province', 'department'], "proj.id = NEW.id"),
+
+    ('partners', 'picking', ['name'], "p.partner_id = NEW.id"),
+    ('projects', 'picking', ['code', 'name', 'macro_project_id'], "p.project_id = NEW.id"),
+    ('macro_projects', 'picking', ['name'], "proj.macro_project_id = NEW.id"),
+    ('macro_projects', 'project', ['name'], "proj.macro_project_id = NEW.id"),
+    ('locations', 'picking', ['path', 'warehouse_id'], "(p.location_src_id = NEW.id OR p.location_dest_id = NEW.id)"),
+    ('warehouses', 'picking', ['name'], "(l_src.warehouse_id = NEW.id OR l_dest.warehouse_id = NEW.id)"),
+    ('product_categories', 'product', ['name'], "p.category_id = NEW.id"),
+]
+_SEARCH_EMPLOYEE_TRIGGER = ('employees', 'picking', ['first_name', 'last_name'], "p.employee_id = NEW.id")
+
+_ENTITY_TABLES = {'picking': 'pickings', 'product': 'products', 'partner': 'partners', 'project': 'projects'}
+
+
+def search_doc_upsert_sql(entity_type, where, with_employees=True):
+    """INSERT ... ON CONFLICT que (re)indexa las filas de la entidad que cumplen `where`."""
+    select = _SEARCH_DOC_SELECT[entity_type].format(
+        where=where,
+        employee_cols="emp.first_name, emp.last_name," if with_employees else "",
+        employee_join="LEFT JOIN employees emp ON p.employee_id = emp.id" if with_employees else ""
+    )
+    return _SEARCH_UPSERT.format(select=select)
+
+
+def search_trigger_statements(with_employees=True):
+    """
+    DDL de las funciones y triggers que mantienen search_documents.
+    with_employees=False si la BD aún no tiene employees/pickings.employee_id.
+    """
+    triggers = list(_SEARCH_TRIGGERS)
+    if with_employees:
+        triggers.append(_SEARCH_EMPLOYEE_TRIGGER)
+        triggers[0] = (triggers[0][0], triggers[0][1], triggers[0][2] + ['employee_id'], triggers[0][3])
+
+    statements = []
+    for table, entity_type, columns, where in triggers:
+        fn = f"search_docs_{table}_{entity_type}"
+        statements.append(f"""
+            CREATE OR REPLACE FUNCTION {fn}() RETURNS trigger AS $$
+            BEGIN
+                {search_doc_upsert_sql(entity_type, where, with_employees)};
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        """)
+        statements.append(f"DROP TRIGGER IF EXISTS trg_{fn} ON {table};")
+        if _ENTITY_TABLES[entity_type] == table:
+            events = f"INSERT OR UPDATE OF {', '.join(columns)}"
+            when = ""
+        else:
+            # Cascada: solo si de verdad cambió alguna columna mostrada
+            events = f"UPDATE OF {', '.join(columns)}"
+            when = "WHEN (" + " OR ".join(f"OLD.{c} IS DISTINCT FROM NEW.{c}" for c in columns) + ")"
+        statements.append(
+            f"CREATE TRIGGER trg_{fn} AFTER {events} ON {table} FOR EACH ROW {when} EXECUTE FUNCTION {fn}();"
+        )
+
+    for entity_type, table in _ENTITY_TABLES.items():
+        fn = f"search_docs_{table}_delete"
+        statements.append(f"""
+            CREATE OR REPLACE FUNCTION {fn}() RETURNS trigger AS $$
+            BEGIN
+                DELETE FROM search_documents WHERE entity_type = '{entity_type}' AND entity_id = OLD.id;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        """)
+        statements.append(f"DROP TRIGGER IF EXISTS trg_{fn} ON {table};")
+        statements.append(f"CREATE TRIGGER trg_{fn} AFTER DELETE ON {table} FOR EACH ROW EXECUTE FUNCTION {fn}();")
+    return statements
+
+
+def search_has_employees(cursor):
+    """True si existen employees y pickings.employee_id (entran al documento del picking)."""
+    cursor.execute("""
+        SELECT to_regclass('employees') IS NOT NULL
+           AND EXISTS (SELECT 1 FROM information_schema.columns
+                       WHERE table_name = 'pickings' AND column_name = 'employee_id')
+    """)
+    return bool(cursor.fetchone()[0])
+
+
+def rebuild_search_documents(company_id=None):
+    """
+    Re-indexa todos los documentos (o los de una compañía). Los triggers mantienen
+    el índice al día; esto es para la carga inicial o tras restaurar datos.
+    Retorna {entidad: filas_indexadas}.
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            with_employees = search_has_employees(cursor)
+            alias = {'picking': 'p', 'product': 'p', 'partner': 'pa', 'project': 'proj'}
+            counts = {}
+            for entity_type in SEARCH_ENTITIES:
+                if company_id is not None:
+                    where = f"{alias[entity_type]}.company_id = %s"
+                    cursor.execute(
+                        "DELETE FROM search_documents WHERE entity_type = %s AND company_id = %s",
+                        (entity_type, company_id)
+                    )
+                    cursor.execute(search_doc_upsert_sql(entity_type, where, with_employees), (company_id,))
+                else:
+                    cursor.execute("DELETE FROM search_documents WHERE entity_type = %s", (entity_type,))
+                    cursor.execute(search_doc_upsert_sql(entity_type, "TRUE", with_employees))
+                counts[entity_type] = cursor.rowcount
+            conn.commit()
+            print(f"[SEARCH] Índice reconstruido (company={company_id}): {counts}")
+            return counts
+    except Exception as e:
+        if conn: conn.rollback()
+        print(f"[DB-ERROR] rebuild_search_documents: {e}")
+        raise e
+    finally:
+        if conn: return_db_connection(conn)
+
+
+def _prefix_tsquery(term):
+    """'cable 4mm' -> 'cable:* & 4mm:*' (solo palabras, sin operadores del usuario)."""
+    tokens = re.findall(r"\w+", term or "")
+    return " & ".join(f"{t}:*" for t in tokens)
+
+
+def search_global(company_id, term, entity_types=None, limit_per_type=10):
+    """
+    Búsqueda rankeada sobre search_documents.
+    Coincide por palabras con prefijo (tsvector) o por subcadena (trigram) y
+    devuelve hasta limit_per_type resultados por tipo, mejor puntuados primero.
+    """
+    term = (term or "").strip()
+    if not term:
+        return []
+    entity_types = [e for e in (entity_types or SEARCH_ENTITIES) if e in SEARCH_ENTITIES]
+    if not entity_types:
+        return []
+
+    tsquery = _prefix_tsquery(term)
+    like = f"%{term}%"
+    query = """
+        WITH q AS (SELECT to_tsquery('simple', %s) AS tsq),
+        matches AS (
+            SELECT sd.entity_type, sd.entity_id, sd.title, sd.subtitle,
+                   (ts_rank(sd.search_vector, q.tsq)
+                    + similarity(sd.title, %s)
+                    + CASE WHEN sd.title ILIKE %s THEN 1 ELSE 0 END) AS score
+            FROM search_documents sd, q
+            WHERE sd.company_id = %s
+              AND sd.entity_type = ANY(%s)
+              AND ((%s <> '' AND sd.search_vector @@ q.tsq) OR sd.search_text ILIKE %s)
+        ),
+        ranked AS (
+            SELECT *, ROW_NUMBER() OVER (PARTITION BY entity_type ORDER BY score DESC, entity_id DESC) AS rn
+            FROM matches
+        )
+        SELECT entity_type, entity_id, title, subtitle, ROUND(score::numeric, 4) AS score
+        FROM ranked
+        WHERE rn <= %s
+        ORDER BY score DESC, entity_type, entity_id DESC
+    """
+    params = (tsquery, term, f"{term}%", company_id, list(entity_types), tsquery, like, limit_per_type)
+    return execute_query(query, params, fetchall=True) or []
@@ -9,6 +9,7 @@ import traceback
 import psycopg2.extras
 from ..core import get_db_connection, return_db_connection, execute_query, execute_commit_query
 from ..utils import _create_warehouse_with_cursor
+from ..ref_cache import reference_data, invalidate_reference
 
 
 # =============================================================================
@@ -18,7 +19,8 @@ from ..utils import _create_warehouse_with_cursor
 def hash_password(password):
     """
     LEGACY: Genera un hash SHA-256 para la contraseña.
-    Preferir AuthService.hash_password_sha256() para nuevo código.
+    Solo para verificar hashes antiguos; las nuevas contraseñas usan bcrypt
+    (ver _hash_new_password). Los SHA-256 se migran a bcrypt al iniciar sesión.
     """
     return hashlib.sha256(password.encode('utf-8')).hexdigest()
 
@@ -31,6 +33,12 @@ def check_password(hashed_password, plain_password):
     return hashed_password == hash_password(plain_password)
 
 
+def _hash_new_password(password):
+    """Hash bcrypt para contraseñas nuevas (CPU intensivo: llamar fuera del event loop)."""
+    from app.services.auth_service import AuthService
+    return AuthService.hash_password_bcrypt(password)
+
+
 # =============================================================================
 # FUNCIONES SQL PURAS PARA AUTENTICACIÓN
 # =============================================================================
@@ -52,9 +60,11 @@ def get_user_for_auth(username: str):
     return execute_query(query, (username,), fetchone=True)
 
 
+@reference_data('role_permissions', company_scoped=False)
 def get_permissions_by_role_id(role_id: int):
     """
     Obtiene los permisos de un rol (SQL puro).
+    [CACHÉ] Se invalida en update_role_permissions.
 
     Returns:
         set: Conjunto de claves de permisos
@@ -70,11 +80,40 @@ def get_permissions_by_role_id(role_id: int):
     return {perm['key'] for perm in permissions}
 
 
+def upgrade_password_hash(user_id: int, old_hash: str, new_hash: str):
+    """
+    Reemplaza el hash de un usuario (migración SHA-256 -> bcrypt al hacer login).
+    Solo si el hash no cambió entretanto (p.ej. un cambio de contraseña concurrente).
+
+    Returns:
+        bool: True si se actualizó
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "UPDATE users SET hashed_password = %s WHERE id = %s AND hashed_password = %s",
+                (new_hash, user_id, old_hash)
+            )
+            updated = cursor.rowcount > 0
+            conn.commit()
+            if updated:
+                print(f"[AUTH] Hash de usuario {user_id} migrado a bcrypt.")
+            return updated
+    except Exception as e:
+        if conn: conn.rollback()
+        raise e
+    finally:
+        if conn: return_db_connection(conn)
+
+
 def validate_user_and_get_permissions(username, plain_password):
     """
     Valida al usuario y devuelve sus detalles.
-    NOTA: Esta función se mantiene por compatibilidad.
-    Para nuevo código, usar get_user_for_auth + AuthService.verify_password.
+    NOTA: Esta función se mantiene por compatibilidad (es bloqueante).
+    Desde endpoints async usar security.authenticate_user, que además
+    migra los hashes SHA-256 a bcrypt.
     """
     from app.services.auth_service import AuthService
 
@@ -114,7 +153,7 @@ def create_user(username, plain_password, full_name, role_id, company_ids=None,
 
     Args:
         username: Nombre de usuario (ya validado)
-        plain_password: Contraseña en texto plano (será hasheada aquí por compatibilidad)
+        plain_password: Contraseña en texto plano (será hasheada aquí con bcrypt)
         full_name: Nombre completo
         role_id: ID del rol
         company_ids: Lista de IDs de compañías
@@ -126,8 +165,7 @@ def create_user(username, plain_password, full_name, role_id, company_ids=None,
         conn.cursor_factory = psycopg2.extras.DictCursor
 
         with conn.cursor() as cursor:
-            # Hashear contraseña usando SHA-256 (compatibilidad)
-            hashed_pass = hash_password(plain_password)
+            hashed_pass = _hash_new_password(plain_password)
 
             # Insertar Usuario
             query_user = """
@@ -158,6 +196,8 @@ def create_user(username, plain_password, full_name, role_id, company_ids=None,
                 print(f" -> Asignados {len(values)} almacenes al usuario {username}.")
 
             conn.commit()
+            # get_user_by_username pudo cachear None para este username
+            invalidate_reference('users', entity_id=new_user_id)
             return new_user_id
 
     except Exception as e:
@@ -191,7 +231,7 @@ def update_user(user_id, full_name, role_id, is_active, new_password=None, compa
         with conn.cursor() as cursor:
             # Actualizar datos básicos
             if new_password:
-                hashed_pass = hash_password(new_password)
+                hashed_pass = _hash_new_password(new_password)
                 query = """
                     UPDATE users
                     SET full_name = %s, role_id = %s, is_active = %s,
@@ -228,6 +268,7 @@ def update_user(user_id, full_name, role_id, is_active, new_password=None, compa
                     cursor.executemany(query_wh, values)
 
             conn.commit()
+            invalidate_reference('users', 'user_companies', 'user_warehouses', entity_id=user_id)
             return True
 
     except Exception as e:
@@ -237,55 +278,37 @@ def update_user(user_id, full_name, role_id, is_active, new_password=None, compa
         if conn: return_db_connection(conn)
 
 
+# Usuario + IDs de compañías y almacenes en una sola consulta (sin N+1)
+_USERS_ADMIN_SELECT = """
+    SELECT u.id, u.username, u.full_name, u.is_active, u.must_change_password, r.name as role_name, u.role_id,
+           ARRAY(SELECT uc.company_id FROM user_companies uc WHERE uc.user_id = u.id ORDER BY uc.company_id) AS company_ids,
+           ARRAY(SELECT uw.warehouse_id FROM user_warehouses uw WHERE uw.user_id = u.id ORDER BY uw.warehouse_id) AS warehouse_ids
+    FROM users u
+    LEFT JOIN roles r ON u.role_id = r.id
+"""
+
 def get_users_for_admin():
     """
     Obtiene todos los usuarios con el nombre de su rol Y 
-    la lista de IDs de compañías a las que tienen acceso.
+    la lista de IDs de compañías y almacenes a los que tienen acceso.
     """
-    conn = None
-    try:
-        conn = get_db_connection() # <-- Correcto: Usa el helper
-        
-        # RECOMENDACIÓN: Usa DictCursor explícitamente aquí para poder hacer dict(row)
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-            # 1. Obtener usuarios básicos
-            query_users = """
-                SELECT u.id, u.username, u.full_name, u.is_active,u.must_change_password, r.name as role_name, u.role_id
-                FROM users u
-                LEFT JOIN roles r ON u.role_id = r.id
-                ORDER BY u.username
-            """
-            cursor.execute(query_users)
-            users_rows = cursor.fetchall()
-            
-            final_users = []
-            for u_row in users_rows:
-                user_dict = dict(u_row)
-                
-                # Traer Compañías
-                cursor.execute("SELECT company_id FROM user_companies WHERE user_id = %s", (user_dict['id'],))
-                user_dict['company_ids'] = [row['company_id'] for row in cursor.fetchall()]
-                
-                # [NUEVO] Traer Almacenes
-                cursor.execute("SELECT warehouse_id FROM user_warehouses WHERE user_id = %s", (user_dict['id'],))
-                user_dict['warehouse_ids'] = [row['warehouse_id'] for row in cursor.fetchall()]
-                
-                final_users.append(user_dict)
-            
-            return final_users
+    rows = execute_query(_USERS_ADMIN_SELECT + " ORDER BY u.username", fetchall=True)
+    return [dict(r) for r in rows]
 
-    except Exception as e:
-        print(f"[ERROR DB] get_users_for_admin: {e}")
-        raise e
-    finally:
-        # --- ¡CORRECCIÓN CRÍTICA AQUÍ! ---
-        if conn:
-            return_db_connection(conn) # <-- Usa el helper, NO db_pool.putconn
+def get_user_for_admin(user_id: int):
+    """
+    Un solo usuario con el mismo formato que get_users_for_admin.
+    Usado tras crear/editar para devolver la fila sin recargar toda la tabla.
+    """
+    row = execute_query(_USERS_ADMIN_SELECT + " WHERE u.id = %s", (user_id,), fetchone=True)
+    return dict(row) if row else None
 
+@reference_data('users', company_scoped=False)
 def get_user_by_username(username: str):
     """
     Obtiene los datos básicos de un usuario por su nombre de usuario.
     Usado para buscar el ID del usuario logueado.
+    [CACHÉ] Se invalida en create_user/update_user.
     """
     query = "SELECT id, username, role_id, full_name FROM users WHERE username = %s"
     # Usamos fetchone=True para obtener un solo diccionario
@@ -373,6 +396,8 @@ def update_role_permissions(role_id, permission_id, has_permission: bool):
             execute_commit_query(query, params)
             
             print(f"[DB-RBAC] Permiso {permission_id} QUITADO de Rol {role_id}")
+
+        invalidate_reference('role_permissions', entity_id=role_id)
         
         # El 'commit' y el manejo de la conexión ya están dentro de 'execute_commit_query'
         return True, "Permiso actualizado"
@@ -383,8 +408,12 @@ def update_role_permissions(role_id, permission_id, has_permission: bool):
         print(f"[ERROR] en update_role_permissions: {e}")
         return False, str(e)
 
+@reference_data('user_companies', company_scoped=False)
 def get_user_companies(user_id):
-    """Devuelve una lista de dicts con las compañías permitidas para el usuario."""
+    """
+    Devuelve una lista de dicts con las compañías permitidas para el usuario.
+    [CACHÉ] Se invalida en update_user y en los cambios de compañías.
+    """
     query = """
         SELECT c.id, c.name, c.country_code
         FROM companies c
@@ -394,6 +423,18 @@ def get_user_companies(user_id):
     """
     return execute_query(query, (user_id,), fetchall=True)
 
+@reference_data('user_warehouses', company_scoped=False)
+def get_user_warehouse_ids(user_id):
+    """
+    IDs de los almacenes asignados al usuario.
+    [CACHÉ] Se invalida en update_user.
+    """
+    rows = execute_query(
+        "SELECT warehouse_id FROM user_warehouses WHERE user_id = %s ORDER BY warehouse_id",
+        (user_id,), fetchall=True
+    )
+    return [r['warehouse_id'] for r in rows]
+
 def create_company(name: str, country_code: str = "PE", creator_user_id: int = None):
     """
     Crea una nueva compañía e inicializa su infraestructura base.
@@ -491,6 +532,7 @@ def create_company(name: str, country_code: str = "PE", creator_user_id: int = N
             cursor.execute("INSERT INTO partners (company_id, name, category_id) VALUES (%s, 'Proveedor Varios', %s) ON CONFLICT (company_id, name) DO NOTHING", (new_company_id, cat_ex_id))
 
             conn.commit()
+            invalidate_reference('companies', 'user_companies', entity_id=new_company_id)
             return new_company
 
     except Exception as e:
@@ -513,6 +555,7 @@ def update_company(company_id: int, name: str, country_code: str):
     try:
         # Y asegúrate de pasar los 3 argumentos en orden
         updated_company = execute_commit_query(query, (name, country_code, company_id), fetchone=True)
+        invalidate_reference('companies', 'user_companies', entity_id=company_id)
         return updated_company
     except Exception as e:
         if "companies_name_key" in str(e):
@@ -569,6 +612,8 @@ def delete_company(company_id: int):
                 raise ValueError("La compañía no existe o ya fue eliminada.")
 
             conn.commit()
+            # Sin namespaces: vacía todo lo de la compañía (y lo no ligado a compañía)
+            invalidate_reference(company_id=company_id, entity_id=company_id)
             print(f" -> Compañía ID {company_id} eliminada correctamente.")
             return True, "Compañía eliminada."
 
@@ -582,6 +627,7 @@ def delete_company(company_id: int):
     finally:
         if conn: return_db_connection(conn)
  
+@reference_data('companies', company_scoped=False)
 def get_companies():
     """Obtiene todas las compañías."""
     # Opción A: Seleccionar todo (Recomendado)
@@ -599,18 +645,24 @@ def change_own_password(user_id: int, new_password: str):
 
     Args:
         user_id: ID del usuario
-        new_password: Nueva contraseña en texto plano (será hasheada aquí)
+        new_password: Nueva contraseña en texto plano (será hasheada aquí con bcrypt)
+    """
+    return set_own_password_hash(user_id, _hash_new_password(new_password))
+
+def set_own_password_hash(user_id: int, hashed_password: str):
+    """
+    Guarda un hash ya calculado (p.ej. en el pool de hashing) y quita el
+    flag must_change_password.
     """
     conn = None
     try:
         conn = get_db_connection()
-        hashed_pass = hash_password(new_password)
         with conn.cursor() as cursor:
             cursor.execute("""
                 UPDATE users
                 SET hashed_password = %s, must_change_password = FALSE
                 WHERE id = %s
-            """, (hashed_pass, user_id))
+            """, (hashed_password, user_id))
             conn.commit()
             return True
     except Exception as e:
@@ -3,11 +3,17 @@ import psycopg2
 import psycopg2.extras
 import traceback
 from ..core import get_db_connection, return_db_connection, execute_query, execute_commit_query
+from ..pagination import fetch_keyset_page, fetch_counted_page, keyset_columns, TOTAL_COUNT_SELECT
+from .. import query_builder as qb
+from ..query_builder import ListQuery
+from ..ref_cache import reference_data, invalidate_reference
+from ..bulk_upsert import bulk_upsert
 # Importamos lógica de creación desde el schema para no duplicar código
 from ..utils import create_warehouse_with_data, _create_warehouse_with_cursor
 
 # --- CATEGORÍAS DE ALMACÉN ---
 
+@reference_data('warehouse_categories')
 def get_warehouse_categories(company_id: int):
     """Obtiene categorías de almacén FILTRADAS POR COMPAÑÍA."""
     return execute_query(
@@ -27,6 +33,7 @@ def create_warehouse_category(name: str, company_id: int):
             (name, company_id),
             fetchone=True
         )
+        invalidate_reference('warehouse_categories', company_id=company_id)
         return new_item
     except Exception as e:
         if "warehouse_categories_company_id_name_key" in str(e):
@@ -43,6 +50,7 @@ def update_warehouse_category(category_id: int, name: str, company_id: int):
         )
         if not updated_item:
             raise ValueError("Categoría no encontrada o no pertenece a esta compañía.")
+        invalidate_reference('warehouse_categories', company_id=company_id, entity_id=category_id)
         return updated_item
     except Exception as e:
         if "warehouse_categories_company_id_name_key" in str(e):
@@ -56,6 +64,7 @@ def delete_warehouse_category(category_id: int, company_id: int):
             "DELETE FROM warehouse_categories WHERE id = %s AND company_id = %s",
             (category_id, company_id)
         )
+        invalidate_reference('warehouse_categories', company_id=company_id, entity_id=category_id)
         return True, "Categoría eliminada."
     except Exception as e:
         if "foreign key constraint" in str(e):
@@ -138,6 +147,8 @@ def create_warehouse(company_id, name, code, category_id, social_reason=None, ru
                 warehouse_id=new_wh_id
             )
             conn.commit()
+            # Nuevo almacén = nuevas ubicaciones y tipos de operación
+            invalidate_reference('warehouses', 'locations', 'picking_types', company_id=company_id)
             return new_wh_id
 
     except Exception as e:
@@ -197,6 +208,7 @@ def update_warehouse(wh_id, name, code, category_id, social_reason, ruc, email,
 
             conn.commit()
             print(" -> Cambios confirmados (commit).")
+            invalidate_reference('warehouses', 'locations', entity_id=wh_id)
             return True
 
     except Exception as err:
@@ -248,6 +260,7 @@ def inactivate_warehouse(warehouse_id):
             rows_affected = cursor.rowcount
             
             conn.commit()
+            invalidate_reference('warehouses', entity_id=warehouse_id)
 
             if rows_affected > 0:
                 print(" -> Almacén archivado con éxito.")
@@ -302,6 +315,7 @@ def get_warehouse_code(warehouse_id):
     result = execute_query("SELECT code FROM warehouses WHERE id = %s", (warehouse_id,), fetchone=True)
     return result['code'] if result else None
 
+@reference_data('warehouses')
 def get_warehouses_simple(company_id):
     """Devuelve una lista simple de almacenes (ID, Nombre, Código) para dropdowns."""
     query = """
@@ -348,149 +362,105 @@ def get_warehouses_by_category(company_id, category_name):
     """
     return execute_query(query, (company_id, category_name), fetchall=True)
 
-def upsert_warehouse_from_import(company_id, code, name, status, social_reason, ruc, email, phone, address, category_id):
+_WAREHOUSE_IMPORT_COLUMNS = ("company_id", "code", "name", "status", "social_reason", "ruc", "email", "phone", "address", "category_id")
+
+def upsert_warehouses_from_import(company_id, rows):
     """
-    Inserta o actualiza un almacén desde la importación.
+    [BATCH] Inserta o actualiza almacenes en UNA transacción (bulk_upsert por lotes).
+    A los almacenes nuevos se les crean sus ubicaciones y tipos de operación.
+    rows: dicts normalizados por WarehouseService.process_csv_row.
+    Retorna (created, updated).
     """
-    # ELIMINADO: global db_pool...
+    values = [(
+        company_id, r['code'], r['name'], r['status'], r['social_reason'], r['ruc'],
+        r['email'], r['phone'], r['address'], r['category_id']
+    ) for r in rows]
 
     conn = None
-    query = """
-        INSERT INTO warehouses (company_id, code, name, status, social_reason, ruc, email, phone, address, category_id)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (company_id, code) DO UPDATE SET
-            name = EXCLUDED.name,
-            status = EXCLUDED.status,
-            social_reason = EXCLUDED.social_reason,
-            ruc = EXCLUDED.ruc,
-            email = EXCLUDED.email,
-            phone = EXCLUDED.phone,
-            address = EXCLUDED.address,
-            category_id = EXCLUDED.category_id
-        RETURNING (xmax = 0) AS inserted;
-    """
-    params = (company_id, code, name, status, social_reason, ruc, email, phone, address, category_id)
-
     try:
-        conn = get_db_connection() # <-- USAR HELPER
-        
+        conn = get_db_connection()
         with conn.cursor() as cursor:
-            cursor.execute(query, params)
-            was_inserted = cursor.fetchone()[0]
-            
-            if was_inserted:
-                print(f" -> Almacén nuevo '{code}'. Creando datos asociados...")
-                cursor.execute("SELECT id FROM warehouses WHERE code = %s AND company_id = %s", (code, company_id))
-                new_wh_id_row = cursor.fetchone()
-                
-                if not new_wh_id_row:
-                    raise Exception(f"No se pudo re-encontrar el almacén '{code}' justo después de crearlo.")
-                
-                new_wh_id = new_wh_id_row[0]
-                create_warehouse_with_data(cursor, name, code, company_id, category_id, for_existing=True, warehouse_id=new_wh_id)
-                print(f" -> Datos asociados creados para el almacén ID {new_wh_id}.")
+            created, updated, returned = bulk_upsert(
+                cursor, "warehouses", _WAREHOUSE_IMPORT_COLUMNS, values,
+                conflict_columns=("company_id", "code"),
+                returning=("id", "code", "name", "category_id")
+            )
+            for inserted, wh_id, code, name, category_id in returned:
+                if inserted:
+                    print(f" -> Almacén nuevo '{code}'. Creando datos asociados...")
+                    create_warehouse_with_data(cursor, name, code, company_id, category_id, for_existing=True, warehouse_id=wh_id)
 
-            conn.commit()
-            return "created" if was_inserted else "updated"
+        conn.commit()
+        invalidate_reference('warehouses', 'locations', 'picking_types', company_id=company_id)
+        print(f"[IMPORT-WAREHOUSES] {created} creados, {updated} actualizados.")
+        return created, updated
 
     except Exception as e:
         if conn: conn.rollback()
-        print(f"Error procesando fila para CÓDIGO {code} (ROLLBACK ejecutado): {e}")
+        print(f"Error en importación masiva de almacenes (ROLLBACK ejecutado): {e}")
         traceback.print_exc()
-        raise e 
+        raise e
     finally:
-        if conn: return_db_connection(conn) # <-- USAR HELPER
+        if conn: return_db_connection(conn)
 
-def get_warehouses_filtered_sorted(company_id, filters={}, sort_by='name', ascending=True, limit=None, offset=None):
-    """Obtiene almacenes filtrados y ordenados."""
-    base_query = """
-    SELECT
+def upsert_warehouse_from_import(company_id, code, name, status, social_reason, ruc, email, phone, address, category_id):
+    """
+    Inserta o actualiza un almacén desde la importación.
+    """
+    created, _ = upsert_warehouses_from_import(company_id, [{
+        'code': code, 'name': name, 'status': status, 'social_reason': social_reason, 'ruc': ruc,
+        'email': email, 'phone': phone, 'address': address, 'category_id': category_id
+    }])
+    return "created" if created else "updated"
+
+# Listado de almacenes (página y conteo desde la misma especificación)
+_WAREHOUSES_LIST = ListQuery(
+    select="""
         w.id, w.company_id, w.name, w.code,
         w.social_reason, w.ruc, w.email, w.phone, w.address,
         w.status,
         w.category_id,
         wc.name as category_name
-    FROM warehouses w
-    LEFT JOIN warehouse_categories wc ON w.category_id = wc.id
-    WHERE w.company_id = %s
-    """
-    params = [company_id]
-    where_clauses = []
-
-    for key, value in filters.items():
-        if not value: continue 
-
-        column_map = {
-            'name': "w.name", 'code': "w.code", 'social_reason': "w.social_reason",
-            'ruc': "w.ruc", 'address': "w.address", 'status': "w.status",
-            'category_name': "wc.name"
-        }
-        sql_column = column_map.get(key)
-        if not sql_column: continue 
-
-        if key == 'category_name' and value == '_NO_CATEGORY_':
-             where_clauses.append("w.category_id IS NULL")
-        elif key in ['name', 'code', 'social_reason', 'ruc', 'address']: 
-             where_clauses.append(f"{sql_column} ILIKE %s")
-             params.append(f"%{value}%")
-        elif key in ['status', 'category_name']: 
-             where_clauses.append(f"{sql_column} = %s")
-             params.append(value)
-
-    if where_clauses:
-        base_query += " AND " + " AND ".join(where_clauses)
-
-    sort_column_map = {
+    """,
+    from_="warehouses w",
+    where="w.company_id = %s",
+    joins={
+        'wc': ("LEFT JOIN warehouse_categories wc ON w.category_id = wc.id", ()),
+    },
+    filters={
+        'name': qb.ilike("w.name"), 'code': qb.ilike("w.code"),
+        'social_reason': qb.ilike("w.social_reason"), 'ruc': qb.ilike("w.ruc"),
+        'address': qb.ilike("w.address"),
+        'status': qb.eq("w.status"),
+        'category_name': qb.eq("wc.name", null_value="_NO_CATEGORY_", null_sql="w.category_id IS NULL"),
+    },
+    sorts={
          'id': "w.id",
          'name': "w.name", 'code': "w.code", 'social_reason': "w.social_reason",
          'ruc': "w.ruc", 'address': "w.address", 'category_name': "wc.name", 'status': "w.status"
-     }
-    order_by_col = sort_column_map.get(sort_by, "w.id") 
-    direction = "ASC" if ascending else "DESC"
-    base_query += f" ORDER BY {order_by_col} {direction}"
-
-    if limit is not None and offset is not None:
-        base_query += " LIMIT %s OFFSET %s"
-        params.append(limit)
-        params.append(offset)
-    
-    return execute_query(base_query, tuple(params), fetchall=True)
+    },
+    default_sort='id'
+)
+
+def get_warehouses_filtered_sorted(company_id, filters={}, sort_by='name', ascending=True, limit=None, offset=None,
+                                   with_count=False):
+    """
+    Obtiene almacenes filtrados y ordenados.
+    [CONTEO] Con with_count devuelve {items, total, next_cursor} en una sola consulta.
+    """
+    if with_count:
+        query, params = _WAREHOUSES_LIST.page_query(
+            filters, (company_id,), sort_by, ascending, limit, offset, extra_select=TOTAL_COUNT_SELECT
+        )
+        return fetch_counted_page(query, params, offset, count_fallback=lambda: get_warehouses_count(company_id, filters))
+
+    query, params = _WAREHOUSES_LIST.page_query(filters, (company_id,), sort_by, ascending, limit, offset)
+    return execute_query(query, tuple(params), fetchall=True)
 
 def get_warehouses_count(company_id, filters={}):
     """Cuenta almacenes."""
-    base_query = """
-    SELECT COUNT(w.id) as total_count
-    FROM warehouses w
-    LEFT JOIN warehouse_categories wc ON w.category_id = wc.id
-    WHERE w.company_id = %s
-    """
-    params = [company_id]
-    where_clauses = []
-    
-    # Misma lógica de filtrado...
-    for key, value in filters.items():
-        if not value: continue
-        column_map = {
-            'name': "w.name", 'code': "w.code", 'social_reason': "w.social_reason",
-            'ruc': "w.ruc", 'address': "w.address", 'status': "w.status",
-            'category_name': "wc.name"
-        }
-        sql_column = column_map.get(key)
-        if not sql_column: continue
-
-        if key == 'category_name' and value == '_NO_CATEGORY_':
-            where_clauses.append("w.category_id IS NULL")
-        elif key in ['name', 'code', 'social_reason', 'ruc', 'address']:
-            where_clauses.append(f"{sql_column} LIKE %s")
-            params.append(f"%{value}%")
-        elif key in ['status', 'category_name']:
-            where_clauses.append(f"{sql_column} = %s")
-            params.append(value)
-            
-    if where_clauses:
-        base_query += " AND " + " AND ".join(where_clauses)
-        
-    result = execute_query(base_query, tuple(params), fetchone=True)
+    query, params = _WAREHOUSES_LIST.count_query(filters, (company_id,))
+    result = execute_query(query, tuple(params), fetchone=True)
     return result['total_count'] if result else 0
 
 # --- UBICACIONES ---
@@ -513,6 +483,7 @@ def get_internal_locations(company_id):
     """
     return execute_query(query, (company_id,), fetchall=True)
 
+@reference_data('locations', company_scoped=False)
 def get_locations_by_warehouse(warehouse_id):
     if not warehouse_id: return []
     try: wh_id_int = int(warehouse_id)
@@ -584,6 +555,7 @@ def create_location(company_id, name, path, type, category, warehouse_id):
             new_id = cursor.fetchone()[0]
 
             conn.commit()
+            invalidate_reference('locations', company_id=company_id, entity_id=new_id)
             return new_id
 
     except Exception as e:
@@ -642,6 +614,7 @@ def update_location(location_id, company_id, name, path, type, category, warehou
                 (name, path, type, category, warehouse_id, location_id, company_id)
             )
             conn.commit()
+            invalidate_reference('locations', company_id=company_id, entity_id=location_id)
             return True
 
     except ValueError as err:
@@ -656,6 +629,68 @@ def update_location(location_id, company_id, name, path, type, category, warehou
     finally:
         if conn: return_db_connection(conn)
 
+_LOCATION_IMPORT_COLUMNS = ("company_id", "path", "name", "type", "category", "warehouse_id")
+
+def upsert_locations_from_import(company_id, rows):
+    """
+    [BATCH] Inserta o actualiza ubicaciones por (company_id, path) en UNA transacción.
+    SQL PURO - rows vienen normalizadas por LocationService.process_csv_row.
+    Mantiene la regla anti-huérfanos de update_location: si la importación deja a
+    un almacén sin ubicaciones internas, no se guarda nada.
+    Retorna (created, updated).
+    """
+    values = []
+    for r in rows:
+        warehouse_id = r['warehouse_id'] if r['type'] == 'internal' else None
+        if r['type'] == 'internal' and warehouse_id is None:
+            raise ValueError(f"Se requiere un Almacén Asociado para la ubicación interna '{r['path']}'.")
+        values.append((company_id, r['path'], r['name'], r['type'], r['category'], warehouse_id))
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cursor:
+            # Almacenes cuyas ubicaciones internas podrían cambiar de tipo/almacén
+            cursor.execute("""
+                SELECT DISTINCT warehouse_id FROM locations
+                WHERE company_id = %s AND type = 'internal' AND warehouse_id IS NOT NULL AND path = ANY(%s)
+            """, (company_id, [v[1] for v in values]))
+            touched_warehouses = [r[0] for r in cursor.fetchall()]
+
+            created, updated, _ = bulk_upsert(
+                cursor, "locations", _LOCATION_IMPORT_COLUMNS, values,
+                conflict_columns=("company_id", "path")
+            )
+
+            # VALIDACIÓN ANTI-HUÉRFANOS (una query para todos los almacenes tocados)
+            if touched_warehouses:
+                cursor.execute("""
+                    SELECT w.id FROM unnest(%s::int[]) AS w(id)
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM locations l WHERE l.warehouse_id = w.id AND l.type = 'internal'
+                    )
+                """, (touched_warehouses,))
+                orphaned = [r[0] for r in cursor.fetchall()]
+                if orphaned:
+                    raise ValueError(f"La importación deja sin ubicaciones internas a los almacenes (ID: {orphaned}).")
+
+        conn.commit()
+        invalidate_reference('locations', company_id=company_id)
+        print(f"[IMPORT-LOCATIONS] {created} creadas, {updated} actualizadas.")
+        return created, updated
+
+    except ValueError as err:
+        if conn: conn.rollback()
+        print(f"[DB-ERROR] Error en importación de ubicaciones: {err}")
+        raise err
+    except Exception as e:
+        if conn: conn.rollback()
+        print(f"Error CRÍTICO en upsert_locations_from_import: {e}")
+        traceback.print_exc()
+        raise e
+    finally:
+        if conn: return_db_connection(conn)
+
 def delete_location(location_id):
     """
     Elimina una ubicación si no está en uso.
@@ -690,6 +725,7 @@ def delete_location(location_id):
             rows_affected = cursor.rowcount
             
             conn.commit()
+            invalidate_reference('locations', entity_id=location_id)
 
             if rows_affected > 0:
                 return True, "Ubicación eliminada correctamente."
@@ -745,66 +781,56 @@ def get_location_details_by_id(location_id: int):
     """
     return execute_query(query, (location_id,), fetchone=True)
 
-def get_locations_filtered_sorted(company_id, filters={}, sort_by='path', ascending=True, limit=None, offset=None):
-    base_query = """
-    SELECT 
+# Listado de ubicaciones (página y conteo desde la misma especificación)
+_LOCATIONS_LIST = ListQuery(
+    select="""
         l.id, l.company_id, l.name, l.path, l.type, l.category,
         l.warehouse_id, w.name as warehouse_name, w.status as warehouse_status
-    FROM locations l
-    LEFT JOIN warehouses w ON l.warehouse_id = w.id
-    WHERE l.company_id = %s
-    """
-    params = [company_id]
-    where_clauses = []
-    column_map = {'path': 'l.path', 'type': 'l.type', 'warehouse_name': 'w.name'}
-
-    for key, value in filters.items():
-        if not value: continue
-        if key == 'warehouse_status':
-            if value == "activos_y_virtuales": where_clauses.append("(w.status = 'activo' OR w.status IS NULL)")
-            elif value == "inactivo": where_clauses.append("w.status = 'inactivo'")
-            continue
-        
-        sql_column = column_map.get(key)
-        if not sql_column: continue
-        if key == 'path' or key == 'warehouse_name':
-            where_clauses.append(f"{sql_column} ILIKE %s"); params.append(f"%{value}%")
-        else:
-            where_clauses.append(f"{sql_column} = %s"); params.append(value)
-
-    if where_clauses: base_query += " AND " + " AND ".join(where_clauses)
-    
-    sort_map = {'path': 'l.path', 'type': 'l.type', 'warehouse_name': 'w.name', 'id': 'l.id'}
-    order_by_col = sort_map.get(sort_by, "l.id")
-    direction = "ASC" if ascending else "DESC"
-    base_query += f" ORDER BY {order_by_col} {direction}"
+    """,
+    from_="locations l",
+    where="l.company_id = %s",
+    joins={
+        'w': ("LEFT JOIN warehouses w ON l.warehouse_id = w.id", ()),
+    },
+    filters={
+        'path': qb.ilike("l.path"), 'warehouse_name': qb.ilike("w.name"),
+        'type': qb.eq("l.type"),
+        'warehouse_status': qb.choice({
+            "activos_y_virtuales": "(w.status = 'activo' OR w.status IS NULL)",
+            "inactivo": "w.status = 'inactivo'",
+        }),
+    },
+    sorts={'path': 'l.path', 'type': 'l.type', 'warehouse_name': 'w.name', 'id': 'l.id'},
+    default_sort='id'
+)
+
+def get_locations_filtered_sorted(company_id, filters={}, sort_by='path', ascending=True, limit=None, offset=None,
+                                  cursor=None, with_total=False, with_count=False):
+    """
+    [KEYSET] Con cursor ("" = primera página) devuelve {items, next_cursor, total_estimate}.
+    [CONTEO] Con with_count devuelve {items, total, next_cursor} en una sola consulta.
+    """
+    if cursor is not None:
+        sort_key = sort_by if sort_by in _LOCATIONS_LIST.sorts else 'id'
+        sort_expr = _LOCATIONS_LIST.sort_expr(sort_key)
+        query, params = _LOCATIONS_LIST.select_query(
+            filters, (company_id,), extra_select=keyset_columns(sort_expr, "l.id")
+        )
+        return fetch_keyset_page(
+            query, params, sort_key, ascending, limit or 100, cursor,
+            same_column=(sort_expr == "l.id"), with_total=with_total, with_count=with_count
+        )
 
-    if limit is not None and offset is not None:
-        base_query += " LIMIT %s OFFSET %s"; params.extend([limit, offset])
+    if with_count:
+        query, params = _LOCATIONS_LIST.page_query(
+            filters, (company_id,), sort_by, ascending, limit, offset, extra_select=TOTAL_COUNT_SELECT
+        )
+        return fetch_counted_page(query, params, offset, count_fallback=lambda: get_locations_count(company_id, filters))
 
-    return execute_query(base_query, tuple(params), fetchall=True)
+    query, params = _LOCATIONS_LIST.page_query(filters, (company_id,), sort_by, ascending, limit, offset)
+    return execute_query(query, tuple(params), fetchall=True)
 
 def get_locations_count(company_id, filters={}):
-    base_query = """
-    SELECT COUNT(l.id) as total_count
-    FROM locations l
-    LEFT JOIN warehouses w ON l.warehouse_id = w.id
-    WHERE l.company_id = %s
-    """
-    params = [company_id]
-    where_clauses = []
-    column_map = {'path': 'l.path', 'type': 'l.type', 'warehouse_name': 'w.name'}
-    for key, value in filters.items():
-        if not value: continue
-        if key == 'warehouse_status':
-            if value == "activos_y_virtuales": where_clauses.append("(w.status = 'activo' OR w.status IS NULL)")
-            elif value == "inactivo": where_clauses.append("w.status = 'inactivo'")
-            continue
-        sql_column = column_map.get(key)
-        if not sql_column: continue
-        if key == 'path' or key == 'warehouse_name': where_clauses.append(f"{sql_column} LIKE %s"); params.append(f"%{value}%")
-        else: where_clauses.append(f"{sql_column} = %s"); params.append(value)
-
-    if where_clauses: base_query += " AND " + " AND ".join(where_clauses)
-    result = execute_query(base_query, tuple(params), fetchone=True)
+    query, params = _LOCATIONS_LIST.count_query(filters, (company_id,))
+    result = execute_query(query, tuple(params), fetchone=True)
     return result['total_count'] if result else 0
\ No newline at end of file
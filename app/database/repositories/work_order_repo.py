@@ -3,8 +3,15 @@ import psycopg2
 import psycopg2.extras
 import traceback
 from ..core import get_db_connection, return_db_connection, execute_query, execute_commit_query
+from ..pagination import fetch_keyset_page, keyset_columns
+from .. import query_builder as qb
+from ..query_builder import ListQuery
+from ..sequences import next_document_names
+from ..bulk_upsert import bulk_upsert
 from collections import defaultdict
 from . import operation_repo
+from . import project_repo
+from . import report_repo
 
 # --- CRUD BÁSICO (Lectura/Creación) ---
 
@@ -58,61 +65,65 @@ def create_work_order(company_id, ot_number, customer, address, service, job_typ
 
 # --- LÓGICA DE NEGOCIO: LIQUIDACIÓN (Migrada de operation_repo) ---
 
-def _create_or_update_draft_picking_internal(cursor, wo_id, code, data, company_id, user):
+def _line_field(line, field):
+    # Las líneas llegan como dict (API) o como objeto (modelos pydantic)
+    return line.get(field) if isinstance(line, dict) else getattr(line, field, None)
+
+def _create_or_update_draft_picking_internal(cursor, wo_id, code, data, company_id, user,
+                                             price_map=None, with_move_lines=True):
     """
     Crea/Actualiza los pickings asociados a la liquidación.
     [FIX APLICADO] Transfiere el project_id de la OT al Picking y sus Moves.
+    [SET-BASED] Configuración + picking existente en una query, moves y líneas en bloque.
+
+    price_map: {product_id: standard_price} ya precargado (si no, se consulta aquí).
+    with_move_lines: False cuando el picking se valida a continuación
+                     (la validación recrea stock_move_lines desde el tracking).
     """
     wh_id = data['warehouse_id']
     
-    # 1. Obtener config tipo de operación
+    # 1. Tipo de operación + proyecto de la OT + borrador existente (una sola query)
     cursor.execute(
-        "SELECT id, default_location_src_id, default_location_dest_id FROM picking_types WHERE warehouse_id = %s AND code = %s", 
-        (wh_id, code)
+        """SELECT pt.id, pt.default_location_src_id, pt.default_location_dest_id,
+                  pt.code AS pt_code, w.code AS wh_code, wo.project_id,
+                  (SELECT p.id FROM pickings p
+                   JOIN picking_types ept ON p.picking_type_id = ept.id
+                   WHERE p.work_order_id = wo.id AND p.state = 'draft' AND ept.code = pt.code
+                   LIMIT 1) AS existing_id
+           FROM picking_types pt
+           JOIN warehouses w ON pt.warehouse_id = w.id
+           LEFT JOIN work_orders wo ON wo.id = %s
+           WHERE pt.warehouse_id = %s AND pt.code = %s""", 
+        (wo_id, wh_id, code)
     )
     pt = cursor.fetchone()
     if not pt: 
         raise ValueError(f"Configuración faltante: No hay tipo de operación '{code}' para el almacén ID {wh_id}.")
 
-    # --- [FIX] OBTENER EL PROJECT_ID DE LA WO ---
-    cursor.execute("SELECT project_id FROM work_orders WHERE id = %s", (wo_id,))
-    wo_row = cursor.fetchone()
-    project_id = wo_row['project_id'] if wo_row else None
-    # --------------------------------------------
-    
-    # 2. Buscar picking existente
-    cursor.execute(
-        """SELECT p.id FROM pickings p 
-           JOIN picking_types pt ON p.picking_type_id = pt.id 
-           WHERE p.work_order_id = %s AND p.state = 'draft' AND pt.code = %s""", 
-        (wo_id, code)
-    )
-    exist = cursor.fetchone()
-    
-    pid = None
-    if exist:
-        pid = exist['id']
+    project_id = pt['project_id']
+    src_id, dest_id = pt['default_location_src_id'], pt['default_location_dest_id']
+
+    # 2. Cabecera: actualizar el borrador existente o crear uno nuevo
+    pid = pt['existing_id']
+    if pid:
         cursor.execute(
             """UPDATE pickings SET 
                warehouse_id=%s, location_src_id=%s, location_dest_id=%s, 
                attention_date=%s, service_act_number=%s, responsible_user=%s,
                project_id=%s -- [FIX] Actualizar proyecto
                WHERE id=%s""", 
-            (wh_id, pt['default_location_src_id'], pt['default_location_dest_id'], 
+            (wh_id, src_id, dest_id, 
              data['date_attended_db'], data['service_act_number'], user, 
              project_id, pid)
         )
+        # Reemplazar líneas (Borrar e Insertar)
+        cursor.execute("DELETE FROM stock_move_lines WHERE move_id IN (SELECT id FROM stock_moves WHERE picking_id = %s)", (pid,))
+        cursor.execute("DELETE FROM stock_moves WHERE picking_id = %s", (pid,))
     else:
-        # Generar nombre
-        cursor.execute(
-            "SELECT wt.code as wh_code, pt.code as pt_code FROM picking_types pt JOIN warehouses wt ON pt.warehouse_id = wt.id WHERE pt.id = %s", 
-            (pt['id'],)
-        )
-        pt_info = cursor.fetchone()
-        prefix = f"{pt_info['wh_code']}/{pt_info['pt_code']}/"
-        cursor.execute("SELECT COUNT(*) FROM pickings WHERE name LIKE %s", (f"{prefix}%",))
-        count = cursor.fetchone()[0]
-        pname = f"{prefix}{str(count + 1).zfill(5)}"
+        # C{empresa}/ como en picking_name_prefix: la secuencia es por compañía
+        # pero pickings.name es único global.
+        prefix = f"C{company_id}/{pt['wh_code']}/{pt['pt_code']}/"
+        pname = next_document_names(company_id, prefix, cursor=cursor)[0]
         
         cursor.execute(
             """INSERT INTO pickings (
@@ -123,54 +134,55 @@ def _create_or_update_draft_picking_internal(cursor, wo_id, code, data, company_
                ) VALUES (%s, %s, %s, %s, %s, %s, 'draft', %s, %s, %s, %s, %s, %s) 
                RETURNING id""",
             (company_id, pname, pt['id'], wh_id, 
-             pt['default_location_src_id'], pt['default_location_dest_id'], 
+             src_id, dest_id, 
              wo_id, "Liquidación por OT", data['service_act_number'], data['date_attended_db'], user,
              project_id) # [FIX] Valor nuevo
         )
         pid = cursor.fetchone()[0]
 
-    # 3. Reemplazar líneas (Borrar e Insertar)
-    cursor.execute("DELETE FROM stock_move_lines WHERE move_id IN (SELECT id FROM stock_moves WHERE picking_id = %s)", (pid,))
-    cursor.execute("DELETE FROM stock_moves WHERE picking_id = %s", (pid,))
-    
-    moves_tracking = {}
-    for line in data['lines_data']:
-        # Validar que line sea dict o objeto
-        p_id = line.get('product_id') if isinstance(line, dict) else line.product_id
-        qty = line.get('quantity') if isinstance(line, dict) else line.quantity
-        
-        # --- [FIX PRECIO] OBTENER EL COSTO ACTUAL DEL PRODUCTO ---
-        # Consultamos el precio estándar actual para valorizar la salida
-        cursor.execute("SELECT standard_price FROM products WHERE id = %s", (p_id,))
-        res_price = cursor.fetchone()
-        cost_price = res_price['standard_price'] if res_price else 0.0
-        # ---------------------------------------------------------
+    lines = [(_line_field(l, 'product_id'), _line_field(l, 'quantity'), _line_field(l, 'tracking_data'))
+             for l in data['lines_data']]
+    if not lines:
+        return pid, {}
+
+    # 3. [FIX PRECIO] Costo actual de los productos para valorizar la salida (una query)
+    if price_map is None:
+        cursor.execute("SELECT id, standard_price FROM products WHERE id = ANY(%s)", (list({l[0] for l in lines}),))
+        price_map = {r['id']: r['standard_price'] for r in cursor.fetchall()}
+
+    # 4. Moves en bloque (RETURNING respeta el orden de VALUES: una sola página)
+    move_rows = [
+        (pid, p_id, qty, qty, src_id, dest_id, project_id, price_map.get(p_id) or 0.0)
+        for p_id, qty, _ in lines
+    ]
+    inserted = psycopg2.extras.execute_values(cursor, """
+        INSERT INTO stock_moves (
+            picking_id, product_id, product_uom_qty, quantity_done,
+            location_src_id, location_dest_id, state,
+            project_id, price_unit
+        ) VALUES %s
+        RETURNING id
+    """, move_rows, template="(%s, %s, %s, %s, %s, %s, 'draft', %s, %s)",
+        page_size=len(move_rows), fetch=True)
 
-        cursor.execute(
-            """INSERT INTO stock_moves (
-                picking_id, product_id, product_uom_qty, quantity_done, 
-                location_src_id, location_dest_id, state,
-                project_id, 
-                price_unit -- [FIX] Guardamos el precio
-               ) VALUES (%s, %s, %s, %s, %s, %s, 'draft', %s, %s) 
-               RETURNING id""",
-            (pid, p_id, qty, qty, pt['default_location_src_id'], pt['default_location_dest_id'],
-             project_id, 
-             cost_price) # [FIX] Pasamos el precio recuperado
-        )
-        mid = cursor.fetchone()[0]
-        
-        tracking = line.get('tracking_data') if isinstance(line, dict) else getattr(line, 'tracking_data', None)
-        
+    moves_tracking = {}
+    pending_lines = []  # (move_id, product_id, lot_name limpio, qty)
+    for (p_id, _, tracking), row in zip(lines, inserted):
         if tracking:
+            mid = row[0]
             moves_tracking[mid] = tracking
-            for lot_name, lqty in tracking.items():
-                # Usar create_lot interno 
-                lot_id = operation_repo.create_lot(cursor, p_id, lot_name) 
-                cursor.execute(
-                    "INSERT INTO stock_move_lines (move_id, lot_id, qty_done) VALUES (%s, %s, %s)", 
-                    (mid, lot_id, lqty)
-                )
+            if with_move_lines:
+                for lot_name, lqty in tracking.items():
+                    pending_lines.append((mid, p_id, operation_repo._clean_lot_name(lot_name), lqty))
+
+    # 5. Series y líneas de movimiento (solo para borradores que no se validan ahora)
+    if pending_lines:
+        lot_id_map = operation_repo._bulk_get_or_create_lots(cursor, [(p, n) for _, p, n, _ in pending_lines])
+        psycopg2.extras.execute_values(
+            cursor,
+            "INSERT INTO stock_move_lines (move_id, lot_id, qty_done) VALUES %s",
+            [(mid, lot_id_map[(p, n)], q) for mid, p, n, q in pending_lines]
+        )
     
     return pid, moves_tracking
 
@@ -220,64 +232,21 @@ def process_full_liquidation(wo_id, consumptions, retiros, service_act_number, d
     """
     [BLINDADO ATÓMICO] Finaliza la liquidación: Guarda, Valida Stocks y Cierra la OT.
     Previene duplicidad por race conditions usando bloqueo de fila.
+    [SET-BASED] Bloqueo + almacén en una query, precios de consumo y retiro en otra,
+    moves en bloque y fase de la obra calculada una sola vez dentro de la transacción.
     """
     print(f"[DB-LIQ-FULL] Finalizando WO {wo_id} (Blindado)...")
     conn = None
     try:
         conn = get_db_connection()
         with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-            
-            # 1. BLOQUEO ATÓMICO (Critical Section)
-            # Bloqueamos la OT para que nadie más pueda tocarla simultáneamente.
-            cursor.execute("SELECT id, phase FROM work_orders WHERE id = %s FOR UPDATE", (wo_id,))
-            wo_status = cursor.fetchone()
-
-            if not wo_status:
-                raise ValueError("La Orden de Trabajo no existe.")
-            
-            # 2. VERIFICACIÓN DE ESTADO POST-BLOQUEO
-            # Si el segundo clic llega aquí, verá que ya está 'Liquidado' y fallará.
-            if wo_status['phase'] == 'Liquidado':
-                # Mensaje amigable para el frontend (no es un error grave, solo concurrencia)
-                return True, "La OT ya había sido liquidada exitosamente por una petición anterior."
-
-            # 3. LÓGICA DE NEGOCIO (Solo si pasamos el bloqueo)
-            
-            # 3.1 Obtener datos del Almacén origen
-            cursor.execute("SELECT warehouse_id FROM locations WHERE id = %s", (current_ui_location_id,))
-            loc_row = cursor.fetchone()
-            if not loc_row: raise ValueError("Ubicación origen inválida")
-            wh_id = loc_row['warehouse_id']
-
-            pid_out, tracking_out = None, {}
-            pid_ret, tracking_ret = None, {}
-
-            # 3.2 Guardar Borradores (Pickings)
-            if consumptions:
-                c_data = {'warehouse_id': wh_id, 'date_attended_db': date_attended_db, 'service_act_number': service_act_number, 'lines_data': consumptions}
-                pid_out, tracking_out = _create_or_update_draft_picking_internal(cursor, wo_id, 'OUT', c_data, company_id, user_name)
-            
-            if retiros:
-                r_data = {'warehouse_id': wh_id, 'date_attended_db': date_attended_db, 'service_act_number': service_act_number, 'lines_data': retiros}
-                pid_ret, tracking_ret = _create_or_update_draft_picking_internal(cursor, wo_id, 'RET', r_data, company_id, user_name)
-
-            # 3.3 Validar Stocks y Confirmar (Usando la función BLINDADA de operation_repo)
-            # Nota: _process_picking_validation_with_cursor TAMBIÉN tiene su propio FOR UPDATE sobre pickings,
-            # lo cual está bien (bloqueo en cascada seguro).
-            
-            if pid_out:
-                ok, msg = operation_repo._process_picking_validation_with_cursor(cursor, pid_out, tracking_out)
-                if not ok: raise ValueError(f"Error validando Consumo: {msg}")
-            
-            if pid_ret:
-                ok, msg = operation_repo._process_picking_validation_with_cursor(cursor, pid_ret, tracking_ret)
-                if not ok: raise ValueError(f"Error validando Retiro: {msg}")
-
-            # 3.4 Cerrar OT (Cambio de estado final)
-            cursor.execute("UPDATE work_orders SET phase = 'Liquidado' WHERE id = %s", (wo_id,))
+            ok, msg = _process_full_liquidation_with_cursor(
+                cursor, wo_id, consumptions, retiros, service_act_number,
+                date_attended_db, current_ui_location_id, user_name, company_id
+            )
 
         conn.commit()
-        return True, "Liquidación exitosa."
+        return ok, msg
 
     except Exception as e:
         if conn: conn.rollback()
@@ -287,6 +256,263 @@ def process_full_liquidation(wo_id, consumptions, retiros, service_act_number, d
     finally:
         if conn: return_db_connection(conn)
 
+def _process_full_liquidation_with_cursor(cursor, wo_id, consumptions, retiros, service_act_number,
+                                          date_attended_db, current_ui_location_id, user_name, company_id,
+                                          mark_dashboard=True):
+    """
+    Núcleo de la liquidación sobre una transacción abierta (no hace commit).
+    Lanza ValueError ante errores de negocio; retorna (True, msg) si se liquidó
+    o si la OT ya estaba liquidada.
+    mark_dashboard: False si el llamador invalida el snapshot del dashboard una
+    sola vez antes de su commit (liquidación masiva).
+    """
+    # 1. BLOQUEO ATÓMICO (Critical Section) + almacén de la ubicación origen
+    # Bloqueamos la OT para que nadie más pueda tocarla simultáneamente.
+    cursor.execute("""
+        SELECT wo.id, wo.phase, wo.project_id,
+               (SELECT l.warehouse_id FROM locations l WHERE l.id = %s) AS warehouse_id
+        FROM work_orders wo
+        WHERE wo.id = %s
+        FOR UPDATE OF wo
+    """, (current_ui_location_id, wo_id))
+    wo_status = cursor.fetchone()
+
+    if not wo_status:
+        raise ValueError("La Orden de Trabajo no existe.")
+    
+    # 2. VERIFICACIÓN DE ESTADO POST-BLOQUEO
+    # Si el segundo clic llega aquí, verá que ya está 'Liquidado' y no hace nada.
+    if wo_status['phase'] == 'Liquidado':
+        # Mensaje amigable para el frontend (no es un error grave, solo concurrencia)
+        return True, "La OT ya había sido liquidada exitosamente por una petición anterior."
+
+    # 3. LÓGICA DE NEGOCIO (Solo si pasamos el bloqueo)
+    wh_id = wo_status['warehouse_id']
+    if not wh_id: raise ValueError("Ubicación origen inválida")
+
+    # 3.1 Precios de TODOS los productos (consumo + retiro) en una query
+    all_lines = list(consumptions or []) + list(retiros or [])
+    product_ids = list({_line_field(l, 'product_id') for l in all_lines})
+    price_map = {}
+    if product_ids:
+        cursor.execute("SELECT id, standard_price FROM products WHERE id = ANY(%s)", (product_ids,))
+        price_map = {r['id']: r['standard_price'] for r in cursor.fetchall()}
+
+    # 3.2 Guardar Borradores (Pickings). Sin stock_move_lines: la validación las recrea.
+    drafts = []
+    for code, label, lines in (('OUT', 'Consumo', consumptions), ('RET', 'Retiro', retiros)):
+        if lines:
+            data = {'warehouse_id': wh_id, 'date_attended_db': date_attended_db,
+                    'service_act_number': service_act_number, 'lines_data': lines}
+            pid, tracking = _create_or_update_draft_picking_internal(
+                cursor, wo_id, code, data, company_id, user_name,
+                price_map=price_map, with_move_lines=False
+            )
+            drafts.append((label, pid, tracking))
+
+    # 3.3 Validar Stocks y Confirmar (validación set-based de operation_repo).
+    # Nota: _process_picking_validation_with_cursor TAMBIÉN tiene su propio FOR UPDATE sobre pickings,
+    # lo cual está bien (bloqueo en cascada seguro).
+    for label, pid, tracking in drafts:
+        ok, msg = operation_repo._process_picking_validation_with_cursor(
+            cursor, pid, tracking, update_project_phase=False, mark_dashboard=False
+        )
+        if not ok: raise ValueError(f"Error validando {label}: {msg}")
+
+    # 3.4 Cerrar OT (Cambio de estado final)
+    cursor.execute("UPDATE work_orders SET phase = 'Liquidado' WHERE id = %s", (wo_id,))
+
+    # 3.5 Fase de la obra una sola vez, viendo el stock de ambos pickings
+    if drafts and wo_status['project_id']:
+        project_repo.check_and_update_project_phase_with_cursor(cursor, wo_status['project_id'])
+
+    # 3.6 Dashboard una sola vez, al final: la fila del snapshot se bloquea después
+    # de los quants de OUT y RET (mismo orden que una validación suelta)
+    if mark_dashboard:
+        report_repo.mark_dashboard_snapshot_stale(cursor, company_id)
+
+    return True, "Liquidación exitosa."
+
+# --- LIQUIDACIÓN MASIVA (Fin de día) ---
+
+LIQUIDATION_BATCH_CHUNK = 50
+
+def _precheck_liquidation_batch(cursor, items, company_id):
+    """
+    Pre-validación de todo el lote contra UNA foto de quants y reservas.
+    Recorre las OTs en orden de proceso descontando lo que consumen las anteriores,
+    así una OT que no alcanzaría stock se descarta antes de abrir su transacción.
+    Retorna {índice: mensaje de error} para las que no pasan.
+    La validación definitiva sigue siendo la de cada picking (bajo bloqueo).
+    """
+    errors = {}
+
+    # 1. OTs de la compañía
+    wo_ids = list({it['wo_id'] for it in items})
+    cursor.execute("SELECT id FROM work_orders WHERE id = ANY(%s) AND company_id = %s", (wo_ids, company_id))
+    valid_wos = {r['id'] for r in cursor.fetchall()}
+
+    # 2. Ubicación de consumo por almacén (la que usará el picking OUT)
+    wh_ids = list({it['warehouse_id'] for it in items if it['warehouse_id']})
+    out_src = {}
+    if wh_ids:
+        cursor.execute("""
+            SELECT pt.warehouse_id, pt.default_location_src_id, l.type
+            FROM picking_types pt
+            JOIN locations l ON pt.default_location_src_id = l.id
+            WHERE pt.warehouse_id = ANY(%s) AND pt.code = 'OUT'
+        """, (wh_ids,))
+        out_src = {r['warehouse_id']: (r['default_location_src_id'], r['type']) for r in cursor.fetchall()}
+
+    # 3. Demanda por OT y foto de stock (físico - reservado) de todo el lote
+    demand_by_item = {}
+    for idx, it in enumerate(items):
+        if it['wo_id'] not in valid_wos:
+            errors[idx] = "La Orden de Trabajo no existe o no pertenece a esta compañía."
+            continue
+        if not it['warehouse_id']:
+            errors[idx] = "Ubicación origen inválida"
+            continue
+        src = out_src.get(it['warehouse_id'])
+        if not src:
+            errors[idx] = f"Configuración faltante: No hay tipo de operación 'OUT' para el almacén ID {it['warehouse_id']}."
+            continue
+        if src[1] != 'internal':
+            continue
+        demand = defaultdict(float)
+        for line in it['consumptions']:
+            demand[(_line_field(line, 'product_id'), src[0])] += float(_line_field(line, 'quantity') or 0)
+        demand_by_item[idx] = demand
+
+    keys = {k for d in demand_by_item.values() for k in d}
+    if not keys:
+        return errors
+    product_ids = list({k[0] for k in keys})
+    location_ids = list({k[1] for k in keys})
+
+    cursor.execute("""
+        SELECT product_id, location_id, COALESCE(SUM(quantity), 0) AS qty
+        FROM stock_quants
+        WHERE product_id = ANY(%s) AND location_id = ANY(%s)
+        GROUP BY product_id, location_id
+    """, (product_ids, location_ids))
+    available = defaultdict(float)
+    for r in cursor.fetchall():
+        available[(r['product_id'], r['location_id'])] += float(r['qty'])
+
+    # Lo reservado por borradores de ESTAS OTs se libera al validarlas: no se descuenta
+    cursor.execute("""
+        SELECT r.product_id, r.location_id, SUM(r.demand_out_qty) AS qty
+        FROM stock_reservation_pickings r
+        WHERE r.product_id = ANY(%s) AND r.location_id = ANY(%s)
+          AND r.picking_id NOT IN (SELECT id FROM pickings WHERE work_order_id = ANY(%s))
+        GROUP BY r.product_id, r.location_id
+    """, (product_ids, location_ids, wo_ids))
+    for r in cursor.fetchall():
+        available[(r['product_id'], r['location_id'])] -= float(r['qty'] or 0)
+
+    cursor.execute("SELECT id, name FROM products WHERE id = ANY(%s)", (product_ids,))
+    names = {r['id']: r['name'] for r in cursor.fetchall()}
+
+    # 4. Consumo acumulado en orden de proceso
+    for idx in sorted(demand_by_item):
+        demand = demand_by_item[idx]
+        missing = [
+            f"- {names.get(pid, pid)}: Requerido {qty} > Disponible {round(available[(pid, loc)], 4)}"
+            for (pid, loc), qty in demand.items() if available[(pid, loc)] < qty - 0.001
+        ]
+        if missing:
+            errors[idx] = "Stock insuficiente:\n" + "\n".join(missing)
+            continue
+        for key, qty in demand.items():
+            available[key] -= qty
+
+    return errors
+
+def process_liquidation_batch(items, company_id, user_name, chunk_size=LIQUIDATION_BATCH_CHUNK):
+    """
+    Liquida muchas OTs (cierre de día).
+
+    items: lista de dicts con wo_id, consumptions, retiros, service_act_number,
+           date_attended_db y location_src_id (mismos datos que process_full_liquidation).
+
+    - Agrupa por almacén y ordena (almacén, OT): orden de bloqueo estable entre lotes.
+    - Pre-valida stock de todo el lote contra una sola foto de quants/reservas.
+    - Confirma en transacciones de chunk_size OTs; cada OT va en su SAVEPOINT,
+      así un error solo descarta esa OT y no el chunk.
+
+    Retorna una lista (en el orden de entrada) de {wo_id, success, message}.
+    """
+    results = [None] * len(items)
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            # 1. Almacén de cada OT (una query para todas las ubicaciones)
+            loc_ids = list({it['location_src_id'] for it in items if it.get('location_src_id')})
+            loc_wh = {}
+            if loc_ids:
+                cursor.execute("SELECT id, warehouse_id FROM locations WHERE id = ANY(%s)", (loc_ids,))
+                loc_wh = {r['id']: r['warehouse_id'] for r in cursor.fetchall()}
+            prepared = [dict(it, warehouse_id=loc_wh.get(it.get('location_src_id'))) for it in items]
+
+            # 2. Pre-validación contra la foto de stock (en orden de proceso)
+            order = sorted(range(len(prepared)), key=lambda i: (prepared[i]['warehouse_id'] or 0, prepared[i]['wo_id']))
+            errors = _precheck_liquidation_batch(cursor, [prepared[i] for i in order], company_id)
+            conn.rollback()  # Solo lectura: no retener la foto mientras se procesa
+
+            pending = []
+            for pos, idx in enumerate(order):
+                if pos in errors:
+                    results[idx] = {"wo_id": prepared[idx]['wo_id'], "success": False, "message": errors[pos]}
+                else:
+                    pending.append(idx)
+
+            # 3. Chunks transaccionales con SAVEPOINT por OT
+            for start in range(0, len(pending), chunk_size):
+                chunk = pending[start:start + chunk_size]
+                chunk_results = {}
+                try:
+                    for idx in chunk:
+                        it = prepared[idx]
+                        cursor.execute("SAVEPOINT liq_item")
+                        try:
+                            ok, msg = _process_full_liquidation_with_cursor(
+                                cursor, it['wo_id'], it['consumptions'], it['retiros'],
+                                it.get('service_act_number'), it.get('date_attended_db'),
+                                it.get('location_src_id'), user_name, company_id,
+                                mark_dashboard=False
+                            )
+                            cursor.execute("RELEASE SAVEPOINT liq_item")
+                        except Exception as e:
+                            cursor.execute("ROLLBACK TO SAVEPOINT liq_item")
+                            ok, msg = False, str(e)
+                        chunk_results[idx] = {"wo_id": it['wo_id'], "success": ok, "message": msg}
+                    # Dashboard una vez por chunk y justo antes del commit: su fila no queda
+                    # bloqueada mientras las siguientes OTs toman quants FOR UPDATE
+                    if any(r['success'] for r in chunk_results.values()):
+                        report_repo.mark_dashboard_snapshot_stale(cursor, company_id)
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    print(f"[ERROR LIQ-BATCH] Chunk descartado: {e}")
+                    for idx in chunk:
+                        chunk_results[idx] = {"wo_id": prepared[idx]['wo_id'], "success": False,
+                                              "message": f"Error al confirmar el lote: {e}"}
+                for idx, res in chunk_results.items():
+                    results[idx] = res
+
+        ok_count = sum(1 for r in results if r and r['success'])
+        print(f"[DB-LIQ-BATCH] {ok_count}/{len(items)} OTs liquidadas.")
+        return results
+
+    except Exception as e:
+        if conn: conn.rollback()
+        traceback.print_exc()
+        raise e
+    finally:
+        if conn: return_db_connection(conn)
+
 def update_work_order_fields(wo_id, fields_to_update: dict):
     """
     Actualiza campos específicos de una Orden de Trabajo.
@@ -380,34 +606,12 @@ def get_work_orders_for_export(company_id, filters={}):
     """Obtiene TODAS las OTs para exportar (sin paginación)."""
     return get_work_orders_filtered_sorted(company_id, filters, limit=None, offset=None)
 
-def get_work_orders_filtered_sorted(company_id, filters={}, sort_by='id', ascending=False, limit=None, offset=None):
-    """
-    Obtiene las OTs con paginación, filtros y ordenamiento.
-    """
-    sort_map = {
-        'id': "wo.id", 'ot_number': "wo.ot_number", 'service_type': "wo.service_type",
-        'job_type': "wo.job_type", 'customer_name': "wo.customer_name", 'address': "wo.address",
-        'phase': "wo.phase", 'warehouse_name': "warehouse_name",
-        'location_src_path': "location_src_path", 'service_act_number': "service_act_number",
-        'attention_date_str': "attention_date_sortable",
-        'date_registered': "wo.date_registered"
-    }
-    order_by_column = sort_map.get(sort_by, "wo.id")
-    direction = "ASC" if ascending else "DESC"
+# Listado de OTs (página y conteo desde la misma especificación).
+# Los joins a pickings pueden repetir la OT, por eso el conteo es COUNT(DISTINCT wo.id).
+_WO_OUT_TYPES = "(SELECT id FROM picking_types WHERE code = 'OUT')"
 
-    base_query = """
-    FROM work_orders wo
-    LEFT JOIN projects proj ON wo.project_id = proj.id
-    LEFT JOIN pickings p_draft ON wo.id = p_draft.work_order_id AND p_draft.state = 'draft' AND p_draft.picking_type_id IN (SELECT id FROM picking_types WHERE code = 'OUT')
-    LEFT JOIN warehouses w_draft ON p_draft.warehouse_id = w_draft.id
-    LEFT JOIN locations l_draft ON p_draft.location_src_id = l_draft.id
-    LEFT JOIN pickings p_done ON wo.id = p_done.work_order_id AND p_done.state = 'done' AND p_done.picking_type_id IN (SELECT id FROM picking_types WHERE code = 'OUT')
-    LEFT JOIN warehouses w_done ON p_done.warehouse_id = w_done.id
-    LEFT JOIN locations l_done ON p_done.location_src_id = l_done.id
-    """
-    
-    select_clause = """
-    SELECT
+_WORK_ORDERS_LIST = ListQuery(
+    select="""
         wo.id, wo.company_id, wo.ot_number, wo.customer_name, wo.address,
         wo.service_type, wo.job_type, wo.phase, wo.date_registered,
         wo.project_id,
@@ -421,76 +625,66 @@ def get_work_orders_filtered_sorted(company_id, filters={}, sort_by='id', ascend
             ''
         ) as attention_date_str,
         COALESCE(p_draft.attention_date, p_done.attention_date, '1970-01-01') as attention_date_sortable
-    """
+    """,
+    from_="work_orders wo",
+    where="wo.company_id = %s",
+    joins={
+        'proj': ("LEFT JOIN projects proj ON wo.project_id = proj.id", ()),
+        'p_draft': (f"LEFT JOIN pickings p_draft ON wo.id = p_draft.work_order_id AND p_draft.state = 'draft' AND p_draft.picking_type_id IN {_WO_OUT_TYPES}", ()),
+        'w_draft': ("LEFT JOIN warehouses w_draft ON p_draft.warehouse_id = w_draft.id", ('p_draft',)),
+        'l_draft': ("LEFT JOIN locations l_draft ON p_draft.location_src_id = l_draft.id", ('p_draft',)),
+        'p_done': (f"LEFT JOIN pickings p_done ON wo.id = p_done.work_order_id AND p_done.state = 'done' AND p_done.picking_type_id IN {_WO_OUT_TYPES}", ()),
+        'w_done': ("LEFT JOIN warehouses w_done ON p_done.warehouse_id = w_done.id", ('p_done',)),
+        'l_done': ("LEFT JOIN locations l_done ON p_done.location_src_id = l_done.id", ('p_done',)),
+    },
+    filters={
+        'id': qb.eq("wo.id"), 'phase': qb.eq("wo.phase"),
+        'ot_number': qb.ilike("wo.ot_number"), 'service_type': qb.ilike("wo.service_type"),
+        'job_type': qb.ilike("wo.job_type"), 'customer_name': qb.ilike("wo.customer_name"),
+        'address': qb.ilike("wo.address"),
+        'project_name': qb.ilike("proj.name"),
+        # Columnas calculadas: se filtra sobre la expresión (un alias del SELECT no es válido en WHERE)
+        'warehouse_name': qb.ilike("COALESCE(w_draft.name, w_done.name, 'N/A')"),
+        'location_src_path': qb.ilike("COALESCE(l_draft.path, l_done.path, '-')"),
+        'service_act_number': qb.ilike("COALESCE(p_draft.service_act_number, p_done.service_act_number, '')"),
+    },
+    sorts={
+        'id': "wo.id", 'ot_number': "wo.ot_number", 'service_type': "wo.service_type",
+        'job_type': "wo.job_type", 'customer_name': "wo.customer_name", 'address': "wo.address",
+        'phase': "wo.phase",
+        'warehouse_name': "COALESCE(w_draft.name, w_done.name, 'N/A')",
+        'location_src_path': "COALESCE(l_draft.path, l_done.path, '-')",
+        'service_act_number': "COALESCE(p_draft.service_act_number, p_done.service_act_number, '')",
+        'attention_date_str': "COALESCE(p_draft.attention_date, p_done.attention_date, '1970-01-01')",
+        'date_registered': "wo.date_registered"
+    },
+    default_sort='id',
+    count_expr="COUNT(DISTINCT wo.id)"
+)
 
-    params = [company_id]
-    where_clauses = ["wo.company_id = %s"]
-    
-    for key, value in filters.items():
-        if not value: continue
-        
-        column_map = {
-            'id': "wo.id",
-            'ot_number': "wo.ot_number", 'service_type': "wo.service_type",
-            'job_type': "wo.job_type", 'customer_name': "wo.customer_name",
-            'address': "wo.address", 'phase': "wo.phase",
-            'warehouse_name': "warehouse_name", 'location_src_path': "location_src_path",
-            'service_act_number': "service_act_number"
-        }
-        db_column = column_map.get(key)
-        
-        if db_column:
-            if key == 'phase' or key == 'id':
-                where_clauses.append(f"{db_column} = %s")
-                params.append(value)
-            else:
-                where_clauses.append(f"{db_column} ILIKE %s")
-                params.append(f"%{value}%")
-
-    where_string = " WHERE " + " AND ".join(where_clauses)
-    final_query = f"{select_clause} {base_query} {where_string} ORDER BY {order_by_column} {direction}"
-    
-    if limit is not None and offset is not None:
-        final_query += " LIMIT %s OFFSET %s"
-        params.append(limit)
-        params.append(offset)
+def get_work_orders_filtered_sorted(company_id, filters={}, sort_by='id', ascending=False, limit=None, offset=None,
+                                    cursor=None, with_total=False):
+    """
+    Obtiene las OTs con paginación, filtros y ordenamiento.
+    [KEYSET] Con cursor ("" = primera página) devuelve {items, next_cursor, total_estimate}.
+    """
+    if cursor is not None:
+        sort_key = sort_by if sort_by in _WORK_ORDERS_LIST.sorts else 'id'
+        sort_expr = _WORK_ORDERS_LIST.sort_expr(sort_key)
+        query, params = _WORK_ORDERS_LIST.select_query(
+            filters, (company_id,), extra_select=keyset_columns(sort_expr, "wo.id")
+        )
+        return fetch_keyset_page(
+            query, params, sort_key, ascending, limit or 50, cursor,
+            same_column=(sort_expr == "wo.id"), with_total=with_total
+        )
 
-    return execute_query(final_query, tuple(params), fetchall=True)
+    query, params = _WORK_ORDERS_LIST.page_query(filters, (company_id,), sort_by, ascending, limit, offset)
+    return execute_query(query, tuple(params), fetchall=True)
 
 def get_work_orders_count(company_id, filters={}):
-    base_query = """
-    FROM work_orders wo
-    LEFT JOIN pickings p_draft ON wo.id = p_draft.work_order_id AND p_draft.state = 'draft' AND p_draft.picking_type_id IN (SELECT id FROM picking_types WHERE code = 'OUT')
-    LEFT JOIN warehouses w_draft ON p_draft.warehouse_id = w_draft.id
-    LEFT JOIN locations l_draft ON p_draft.location_src_id = l_draft.id
-    LEFT JOIN pickings p_done ON wo.id = p_done.work_order_id AND p_done.state = 'done' AND p_done.picking_type_id IN (SELECT id FROM picking_types WHERE code = 'OUT')
-    LEFT JOIN warehouses w_done ON p_done.warehouse_id = w_done.id
-    LEFT JOIN locations l_done ON p_done.location_src_id = l_done.id
-    """
-    params = [company_id]
-    where_clauses = ["wo.company_id = %s"]
-    
-    for key, value in filters.items():
-        if not value: continue
-        column_map = {
-            'ot_number': "wo.ot_number", 'service_type': "wo.service_type",
-            'job_type': "wo.job_type", 'customer_name': "wo.customer_name",
-            'address': "wo.address", 'phase': "wo.phase",
-            'warehouse_name': "warehouse_name", 'location_src_path': "location_src_path",
-            'service_act_number': "service_act_number"
-        }
-        db_column = column_map.get(key)
-        
-        if db_column:
-            if key == 'phase':
-                where_clauses.append(f"{db_column} = %s"); params.append(value)
-            else:
-                where_clauses.append(f"{db_column} ILIKE %s"); params.append(f"%{value}%")
-                
-    where_string = " WHERE " + " AND ".join(where_clauses)
-    count_query = f"SELECT COUNT(DISTINCT wo.id) as total_count {base_query} {where_string}"
-    
-    result = execute_query(count_query, tuple(params), fetchone=True)
+    query, params = _WORK_ORDERS_LIST.count_query(filters, (company_id,))
+    result = execute_query(query, tuple(params), fetchone=True)
     return result['total_count'] if result else 0
 
 def get_liquidation_details_combo(wo_id, company_id):
@@ -611,91 +805,69 @@ def get_liquidation_details_combo(wo_id, company_id):
 
 # --- LÓGICA DE IMPORTACIÓN AVANZADA ---
 
-def _get_project_id_by_name_internal(cursor, company_id, project_name):
+def _get_project_ids_by_names_internal(cursor, company_id, project_names):
     """
-    Busca el ID de un proyecto por nombre (Case Insensitive).
+    Busca los IDs de proyectos por nombre (Case Insensitive), una query para todos.
     Usa el cursor de la transacción en curso.
+    Retorna {nombre_limpio: project_id} (los no encontrados no aparecen: quedan como General).
     """
-    if not project_name or not project_name.strip():
-        return None
-    
-    clean_name = project_name.strip()
-    cursor.execute(
-        "SELECT id FROM projects WHERE company_id = %s AND name ILIKE %s LIMIT 1",
-        (company_id, clean_name)
-    )
-    res = cursor.fetchone()
-    if res:
-        return res[0]
-    else:
-        # Opcional: Podrías levantar error si quieres ser estricto
-        # raise ValueError(f"El proyecto '{clean_name}' no existe en el sistema.")
-        print(f"[IMPORT WARN] Proyecto '{clean_name}' no encontrado. Se asignará como General.")
-        return None
-
-def upsert_work_order_from_import(company_id, data):
+    clean_names = sorted({n.strip() for n in project_names if n and n.strip()})
+    if not clean_names:
+        return {}
+    cursor.execute("""
+        SELECT DISTINCT ON (k.nm) k.nm, p.id
+        FROM unnest(%s::text[]) AS k(nm)
+        JOIN projects p ON p.company_id = %s AND p.name ILIKE k.nm
+        ORDER BY k.nm, p.id
+    """, (clean_names, company_id))
+    found = {r[0]: r[1] for r in cursor.fetchall()}
+    missing = [n for n in clean_names if n not in found]
+    if missing:
+        print(f"[IMPORT WARN] {len(missing)} proyecto(s) no encontrados (se asignan como General): {missing[:10]}")
+    return found
+
+_WORK_ORDER_IMPORT_COLUMNS = ("company_id", "ot_number", "customer_name", "address", "service_type", "job_type", "project_id")
+
+def upsert_work_orders_from_import(company_id, rows):
     """
-    [NUEVO] Importación Inteligente (Upsert).
-    1. Busca el Project ID basándose en el nombre (si viene).
-    2. Si la OT existe, actualiza datos.
-    3. Si no existe, la crea.
+    [BATCH] Importación Inteligente (Upsert) de OTs en UNA transacción.
+    1. Resuelve los Project ID de todos los nombres con una sola query.
+    2. INSERT ... ON CONFLICT (ot_number) por lotes: las OTs nuevas se crean
+       'Sin Liquidar'; las existentes solo actualizan campos no críticos.
+    3. Un ot_number que ya pertenece a OTRA compañía es error (no se guarda nada).
+    rows: dicts de WorkOrderService.process_csv_row. Retorna (created, updated).
     """
     conn = None
     try:
         conn = get_db_connection()
         with conn.cursor() as cursor:
-            # 1. Resolver Project ID
-            project_name = data.get('project_name')
-            project_id = _get_project_id_by_name_internal(cursor, company_id, project_name)
-
-            ot_number = data['ot_number']
-            
-            # 2. Verificar existencia
-            cursor.execute(
-                "SELECT id FROM work_orders WHERE company_id = %s AND ot_number = %s",
-                (company_id, ot_number)
+            project_map = _get_project_ids_by_names_internal(cursor, company_id, [r.get('project_name') for r in rows])
+
+            values = [(
+                company_id, r['ot_number'], r['customer_name'], r.get('address'),
+                r.get('service_type'), r.get('job_type'),
+                project_map.get((r.get('project_name') or '').strip())
+            ) for r in rows]
+
+            created, updated, returned = bulk_upsert(
+                cursor, "work_orders", _WORK_ORDER_IMPORT_COLUMNS, values,
+                conflict_columns=("ot_number",),
+                update_columns=("customer_name", "address", "service_type", "job_type", "project_id"),
+                update_where="work_orders.company_id = EXCLUDED.company_id",
+                returning=("ot_number",)
             )
-            existing = cursor.fetchone()
-
-            if existing:
-                # --- UPDATE (Solo actualizamos campos no críticos) ---
-                wo_id = existing[0]
-                cursor.execute("""
-                    UPDATE work_orders SET 
-                        customer_name = %s,
-                        address = %s,
-                        service_type = %s,
-                        job_type = %s,
-                        project_id = %s -- Actualizamos el proyecto si cambió en el Excel
-                    WHERE id = %s
-                """, (
-                    data['customer_name'], 
-                    data.get('address'), 
-                    data.get('service_type'), 
-                    data.get('job_type'),
-                    project_id,
-                    wo_id
-                ))
-                conn.commit()
-                return "updated"
-            else:
-                # --- INSERT ---
-                cursor.execute("""
-                    INSERT INTO work_orders (
-                        company_id, ot_number, customer_name, address, 
-                        service_type, job_type, project_id, phase, date_registered
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, 'Sin Liquidar', NOW())
-                """, (
-                    company_id, 
-                    ot_number, 
-                    data['customer_name'], 
-                    data.get('address'), 
-                    data.get('service_type'), 
-                    data.get('job_type'),
-                    project_id
-                ))
-                conn.commit()
-                return "created"
+
+            affected = {r[1] for r in returned}
+            foreign = [ot for ot in dict.fromkeys(v[1] for v in values) if ot not in affected]
+            if foreign:
+                raise ValueError(f"Las OTs {foreign[:10]} ya existen en otra compañía.")
+
+            # OTs pendientes de liquidar del dashboard
+            report_repo.mark_dashboard_snapshot_stale(cursor, company_id)
+
+        conn.commit()
+        print(f"[IMPORT-WO] {created} creadas, {updated} actualizadas.")
+        return created, updated
 
     except Exception as e:
         if conn: conn.rollback()
@@ -703,6 +875,14 @@ def upsert_work_order_from_import(company_id, data):
     finally:
         if conn: return_db_connection(conn)
 
+def upsert_work_order_from_import(company_id, data):
+    """
+    [NUEVO] Importación Inteligente (Upsert) de una OT.
+    Delegado en upsert_work_orders_from_import.
+    """
+    created, _ = upsert_work_orders_from_import(company_id, [data])
+    return "created" if created else "updated"
+
 def delete_work_order(wo_id):
     """
     [BLINDADO] Elimina una Orden de Trabajo y sus borradores asociados.
@@ -738,8 +918,19 @@ def delete_work_order(wo_id):
             if cursor.fetchone()['total'] > 0:
                 return False, "🚫 Acción Bloqueada: Esta OT tiene movimientos de inventario ya procesados. Debe anularlos primero (si es posible) o crear una devolución."
 
-            # 4. LIMPIEZA EN CASCADA (Solo Borradores/Cancelados)
-            # Si llegamos aquí, es seguro borrar porque solo hay 'papeles sucios' (borradores) sin impacto real.
+            # 4. LIBERAR RESERVAS de los pickings 'listo' antes de borrarlos
+            # (el CASCADE de stock_reservation_pickings no descuenta el agregado)
+            cursor.execute("""
+                SELECT id, company_id FROM pickings
+                WHERE work_order_id = %s AND state = 'listo'
+                ORDER BY id FOR UPDATE
+            """, (wo_id,))
+            ready_pickings = cursor.fetchall()
+            for p in ready_pickings:
+                operation_repo.release_picking_stock(cursor, p['id'])
+
+            # 5. LIMPIEZA EN CASCADA (Borradores/Listos/Cancelados, ya sin reservas)
+            # Si llegamos aquí, es seguro borrar porque no queda impacto real en stock ni reservas.
             print(f"[DB-DELETE] Limpiando dependencias de OT {wo_id}...")
 
             # A. Borrar Líneas de detalle (Series/Lotes) de los pickings asociados
@@ -763,6 +954,9 @@ def delete_work_order(wo_id):
             # D. Finalmente, borrar la OT
             cursor.execute("DELETE FROM work_orders WHERE id = %s", (wo_id,))
 
+            if ready_pickings:
+                report_repo.mark_dashboard_snapshot_stale(cursor, ready_pickings[0]['company_id'])
+
             conn.commit()
             return True, "Orden de Trabajo eliminada correctamente (se limpiaron los borradores asociados)."
 
@@ -316,6 +316,220 @@ def create_schema(conn):
         );
     """)
 
+    # --- 7b. SNAPSHOTS DE REPORTES ---
+    # Dashboard precalculado por compañía (lectura O(1)).
+    # 'version' se incrementa con cada operación que lo afecta (validar, reservar,
+    # importar, editar precios...), que además encola su recálculo en background_jobs.
+    # El snapshot es vigente mientras snapshot_version == version.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS dashboard_snapshots (
+            company_id INTEGER PRIMARY KEY REFERENCES companies(id) ON DELETE CASCADE,
+            payload JSONB,
+            computed_at TIMESTAMPTZ,
+            version INTEGER NOT NULL DEFAULT 0,
+            snapshot_version INTEGER NOT NULL DEFAULT -1
+        );
+    """)
+
+    # Cierres mensuales de stock: saldo (cantidad y valor) por compañía, almacén y
+    # producto al último día de cada mes cerrado. El Kardex toma el saldo inicial
+    # del último cierre y solo suma los movimientos posteriores.
+    # Al validar un movimiento dentro de un mes cerrado se borra ese cierre y los
+    # siguientes (ON DELETE CASCADE sobre los snapshots).
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stock_closing_periods (
+            company_id INTEGER NOT NULL REFERENCES companies(id) ON DELETE CASCADE,
+            period_end DATE NOT NULL,
+            closed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (company_id, period_end)
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stock_closing_snapshots (
+            company_id INTEGER NOT NULL,
+            period_end DATE NOT NULL,
+            warehouse_id INTEGER NOT NULL REFERENCES warehouses(id) ON DELETE CASCADE,
+            product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+            quantity DOUBLE PRECISION NOT NULL DEFAULT 0,
+            value DOUBLE PRECISION NOT NULL DEFAULT 0,
+            PRIMARY KEY (company_id, period_end, warehouse_id, product_id),
+            FOREIGN KEY (company_id, period_end)
+                REFERENCES stock_closing_periods(company_id, period_end) ON DELETE CASCADE
+        );
+    """)
+
+    # --- 7c. LIBRO MAYOR DE STOCK ---
+    # Una fila por (movimiento validado, ubicación origen/destino) con entrada,
+    # salida y valor ya resueltos. Los reportes de kardex, flujo y cobertura
+    # leen de aquí en lugar de unir locations con (src = l.id OR dest = l.id).
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stock_ledger (
+            id BIGSERIAL PRIMARY KEY,
+            move_id INTEGER NOT NULL REFERENCES stock_moves(id) ON DELETE CASCADE,
+            picking_id INTEGER NOT NULL REFERENCES pickings(id) ON DELETE CASCADE,
+            company_id INTEGER NOT NULL REFERENCES companies(id) ON DELETE CASCADE,
+            product_id INTEGER NOT NULL REFERENCES products(id),
+            location_id INTEGER NOT NULL REFERENCES locations(id),
+            warehouse_id INTEGER REFERENCES warehouses(id),
+            location_type TEXT NOT NULL,
+            picking_type_code TEXT,
+            date_done TIMESTAMPTZ NOT NULL,
+            quantity_in REAL NOT NULL DEFAULT 0,
+            quantity_out REAL NOT NULL DEFAULT 0,
+            value_in REAL,
+            value_out REAL,
+            price_unit REAL,
+            UNIQUE (move_id, location_id)
+        );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ledger_company_product_date ON stock_ledger (company_id, product_id, date_done);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ledger_company_warehouse_date ON stock_ledger (company_id, warehouse_id, date_done);")
+
+    # Carga inicial desde el historial (solo si el ledger está vacío)
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM stock_ledger)")
+    if not cursor.fetchone()[0]:
+        print(" -> Poblando stock_ledger desde movimientos validados...")
+        # Import lazy: la misma plantilla que record_stock_ledger / rebuild_stock_ledger
+        from .repositories.report_repo import _STOCK_LEDGER_INSERT
+        cursor.execute(_STOCK_LEDGER_INSERT.format(where="TRUE"))
+
+    # --- 7d. RESERVAS DE STOCK (Agregado mantenido) ---
+    # Lo comprometido por pickings en 'listo', por (producto, ubicación, lote, proyecto).
+    # Se mantiene al reservar/liberar en operation_repo; los chequeos de disponibilidad
+    # y los reportes de stock leen de aquí en lugar de re-agregar stock_moves.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stock_reservations (
+            id BIGSERIAL PRIMARY KEY,
+            company_id INTEGER NOT NULL REFERENCES companies(id) ON DELETE CASCADE,
+            product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+            location_id INTEGER NOT NULL REFERENCES locations(id) ON DELETE CASCADE,
+            lot_id INTEGER REFERENCES stock_lots(id) ON DELETE CASCADE,
+            project_id INTEGER REFERENCES projects(id) ON DELETE CASCADE,
+            reserved_qty REAL NOT NULL DEFAULT 0,
+            incoming_qty REAL NOT NULL DEFAULT 0,
+            demand_out_qty REAL NOT NULL DEFAULT 0,
+            demand_in_qty REAL NOT NULL DEFAULT 0
+        );
+    """)
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_reservations_unique_key
+        ON stock_reservations (product_id, location_id, COALESCE(lot_id, -1), COALESCE(project_id, -1));
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reservations_company ON stock_reservations (company_id);")
+
+    # Aporte de cada picking al agregado (permite liberar exactamente lo reservado)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stock_reservation_pickings (
+            picking_id INTEGER NOT NULL REFERENCES pickings(id) ON DELETE CASCADE,
+            company_id INTEGER NOT NULL REFERENCES companies(id) ON DELETE CASCADE,
+            product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+            location_id INTEGER NOT NULL REFERENCES locations(id) ON DELETE CASCADE,
+            lot_id INTEGER REFERENCES stock_lots(id) ON DELETE CASCADE,
+            project_id INTEGER REFERENCES projects(id) ON DELETE CASCADE,
+            reserved_qty REAL NOT NULL DEFAULT 0,
+            incoming_qty REAL NOT NULL DEFAULT 0,
+            demand_out_qty REAL NOT NULL DEFAULT 0,
+            demand_in_qty REAL NOT NULL DEFAULT 0
+        );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reservation_pickings_picking ON stock_reservation_pickings (picking_id);")
+
+    # Carga inicial desde los pickings en 'listo' (solo si el agregado está vacío)
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM stock_reservation_pickings)")
+    if not cursor.fetchone()[0]:
+        # Import lazy: la consulta de aportes vive junto a reserve_picking_stock
+        from .repositories.operation_repo import _RESERVATION_CONTRIB_SQL
+        print(" -> Poblando stock_reservations desde pickings en 'listo'...")
+        cursor.execute(f"""
+            INSERT INTO stock_reservation_pickings
+                (picking_id, company_id, product_id, location_id, lot_id, project_id,
+                 reserved_qty, incoming_qty, demand_out_qty, demand_in_qty)
+            {_RESERVATION_CONTRIB_SQL.format(where="p.state = 'listo'")}
+        """)
+        cursor.execute("DELETE FROM stock_reservations")
+        cursor.execute("""
+            INSERT INTO stock_reservations
+                (company_id, product_id, location_id, lot_id, project_id,
+                 reserved_qty, incoming_qty, demand_out_qty, demand_in_qty)
+            SELECT company_id, product_id, location_id, lot_id, project_id,
+                   SUM(reserved_qty), SUM(incoming_qty), SUM(demand_out_qty), SUM(demand_in_qty)
+            FROM stock_reservation_pickings
+            GROUP BY company_id, product_id, location_id, lot_id, project_id
+        """)
+
+    # --- 7e. BÚSQUEDA GLOBAL (Documentos indexados por entidad) ---
+    # Texto de la entidad + tablas unidas; tsvector generado + índice trigram.
+    # Los triggers (search_repo.search_trigger_statements) lo mantienen al día.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS search_documents (
+            entity_type TEXT NOT NULL,
+            entity_id INTEGER NOT NULL,
+            company_id INTEGER NOT NULL REFERENCES companies(id),
+            title TEXT NOT NULL,
+            subtitle TEXT,
+            search_text TEXT NOT NULL DEFAULT '',
+            search_vector tsvector GENERATED ALWAYS AS (to_tsvector('simple', search_text)) STORED,
+            PRIMARY KEY (entity_type, entity_id)
+        );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_search_docs_vector ON search_documents USING gin (search_vector);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_search_docs_text_trgm ON search_documents USING gin (search_text gin_trgm_ops);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_search_docs_company_type ON search_documents (company_id, entity_type);")
+
+    # Import lazy: las consultas de indexado viven en search_repo
+    from .repositories.search_repo import search_trigger_statements, search_has_employees, search_doc_upsert_sql, SEARCH_ENTITIES
+    with_employees = search_has_employees(cursor)
+    for stmt in search_trigger_statements(with_employees):
+        cursor.execute(stmt)
+
+    # Carga inicial (solo si el índice está vacío)
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM search_documents)")
+    if not cursor.fetchone()[0]:
+        print(" -> Poblando search_documents...")
+        for entity_type in SEARCH_ENTITIES:
+            cursor.execute(search_doc_upsert_sql(entity_type, "TRUE", with_employees))
+
+    # --- 7f. SECUENCIAS DE DOCUMENTOS (nombres de picking, guías) ---
+    # Un contador por (compañía, prefijo); ver app/database/sequences.py.
+    # Las filas se siembran perezosamente desde los nombres existentes.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS document_sequences (
+            company_id INTEGER NOT NULL REFERENCES companies(id) ON DELETE CASCADE,
+            prefix TEXT NOT NULL,
+            next_value BIGINT NOT NULL DEFAULT 1,
+            PRIMARY KEY (company_id, prefix)
+        );
+    """)
+
+    # --- 7g. TRABAJOS EN SEGUNDO PLANO (importaciones, exportaciones, recálculos) ---
+    # Cola en la propia BD (sin broker): los workers toman trabajos con
+    # FOR UPDATE SKIP LOCKED; ver app/jobs/runner.py.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS background_jobs (
+            id BIGSERIAL PRIMARY KEY,
+            company_id INTEGER NOT NULL REFERENCES companies(id) ON DELETE CASCADE,
+            kind TEXT NOT NULL,
+            params JSONB NOT NULL DEFAULT '{}'::jsonb,
+            status TEXT NOT NULL DEFAULT 'queued'
+                CHECK (status IN ('queued', 'running', 'done', 'failed', 'cancelled')),
+            progress INTEGER NOT NULL DEFAULT 0,
+            progress_message TEXT,
+            cancel_requested BOOLEAN NOT NULL DEFAULT FALSE,
+            result JSONB,
+            error TEXT,
+            input_file TEXT,
+            result_file TEXT,
+            result_filename TEXT,
+            created_by TEXT NOT NULL,
+            worker TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            started_at TIMESTAMPTZ,
+            heartbeat_at TIMESTAMPTZ,
+            finished_at TIMESTAMPTZ,
+            expires_at TIMESTAMPTZ
+        );
+    """)
+
     # =========================================================================
     # --- 8. ÍNDICES DE RENDIMIENTO (HIGH PERFORMANCE PACK) ---
     # =========================================================================
@@ -368,7 +582,23 @@ def create_schema(conn):
         "CREATE INDEX IF NOT EXISTS idx_prod_price ON products (id, standard_price);",
 
         # 4. Acelera el listado inicial de Almacenes en el Hub
-        "CREATE INDEX IF NOT EXISTS idx_wh_company_status ON warehouses (company_id, status);"
+        "CREATE INDEX IF NOT EXISTS idx_wh_company_status ON warehouses (company_id, status);",
+
+        # F. PAGINACIÓN POR CURSOR (keyset): (compañía, columna de orden, id)
+        # Con estos índices la página N de un listado cuesta lo mismo que la primera.
+        "CREATE INDEX IF NOT EXISTS idx_pickings_company_type_id ON pickings (company_id, picking_type_id, id);",
+        "CREATE INDEX IF NOT EXISTS idx_pickings_company_scheduled ON pickings (company_id, scheduled_date, id);",
+        "CREATE INDEX IF NOT EXISTS idx_products_company_name_id ON products (company_id, name, id);",
+        "CREATE INDEX IF NOT EXISTS idx_products_company_sku_id ON products (company_id, sku, id);",
+        "CREATE INDEX IF NOT EXISTS idx_partners_company_name_id ON partners (company_id, name, id);",
+        "CREATE INDEX IF NOT EXISTS idx_locations_company_path_id ON locations (company_id, path, id);",
+        "CREATE INDEX IF NOT EXISTS idx_wo_company_id ON work_orders (company_id, id);",
+        "CREATE INDEX IF NOT EXISTS idx_projects_company_name_id ON projects (company_id, name, id);",
+
+        # G. COLA DE TRABAJOS: siguiente trabajo pendiente y limpieza de vencidos
+        "CREATE INDEX IF NOT EXISTS idx_jobs_queued ON background_jobs (created_at, id) WHERE status = 'queued';",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_company_user ON background_jobs (company_id, created_by, id);",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_expires ON background_jobs (expires_at) WHERE expires_at IS NOT NULL;"
     ]
 
     for idx_sql in indices:
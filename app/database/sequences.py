@@ -0,0 +1,117 @@
+"""
+Secuencias de documentos por compañía (nombres de picking y guías de remisión).
+
+Cada (company_id, prefix) tiene una fila en document_sequences con el próximo
+número libre. Reservar números es un solo UPDATE ... RETURNING (O(1): no se
+buscan ni ordenan nombres existentes).
+
+- Con cursor=...: corre en la transacción del llamador, sin otra conexión del
+  pool. El lock de la fila serializa a quienes usan el mismo prefijo hasta el
+  commit, y un rollback no deja huecos.
+- Sin cursor: transacción corta propia (lecturas tipo "próximo nombre" para la
+  UI); igual que un SEQUENCE de Postgres, un rollback posterior deja un hueco.
+
+La primera vez que se usa un prefijo la fila se siembra con el mayor número
+ya existente en pickings, para continuar la numeración actual.
+
+Uso:
+    name = next_document_names(company_id, "C1/IN/", cursor=cursor)[0]            # C1/IN/00042
+    names = next_document_names(company_id, "C1/ADJ/", count=500, cursor=cursor)  # bloque para importación
+"""
+
+from .core import get_db_connection, return_db_connection
+
+DOCUMENT_NUMBER_WIDTH = 5
+
+# Prefijo de las guías de remisión (columna pickings.remission_number)
+REMISSION_PREFIX = "GR-"
+
+# Columnas de pickings desde las que se puede sembrar una secuencia
+_SEED_COLUMNS = ('name', 'remission_number')
+
+
+def picking_name_prefix(company_id, pt_code):
+    """Prefijo estándar de nombres de picking: C{company}/{código}/."""
+    return f"C{company_id}/{pt_code}/"
+
+
+def format_document_number(prefix, number):
+    return f"{prefix}{str(number).zfill(DOCUMENT_NUMBER_WIDTH)}"
+
+
+def _like_prefix(prefix):
+    escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"{escaped}%"
+
+
+def _seed_value(cursor, company_id, prefix, column):
+    """Mayor número existente con ese prefijo (solo se usa al crear la fila)."""
+    start = len(prefix) + 1
+    cursor.execute(f"""
+        SELECT COALESCE(MAX(substr({column}, %s)::bigint), 0)
+        FROM pickings
+        WHERE company_id = %s AND {column} LIKE %s AND substr({column}, %s) ~ '^[0-9]+$'
+    """, (start, company_id, _like_prefix(prefix), start))
+    return cursor.fetchone()[0]
+
+
+def _allocate_with_cursor(cursor, company_id, prefix, count, column):
+    cursor.execute("""
+        UPDATE document_sequences SET next_value = next_value + %s
+        WHERE company_id = %s AND prefix = %s
+        RETURNING next_value - %s
+    """, (count, company_id, prefix, count))
+    row = cursor.fetchone()
+
+    if not row:
+        # Primera vez: sembrar desde los documentos existentes.
+        # ON CONFLICT cubre a otro worker sembrando a la vez.
+        seed = _seed_value(cursor, company_id, prefix, column) + 1
+        cursor.execute("""
+            INSERT INTO document_sequences (company_id, prefix, next_value)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (company_id, prefix)
+            DO UPDATE SET next_value = document_sequences.next_value + %s
+            RETURNING next_value - %s
+        """, (company_id, prefix, seed + count, count, count))
+        row = cursor.fetchone()
+    return row[0]
+
+
+def allocate_document_numbers(company_id, prefix, count=1, column='name', cursor=None):
+    """
+    Reserva `count` números consecutivos para (company_id, prefix).
+    Retorna el primero; el bloque es [primero, primero + count).
+    `column` indica de qué columna de pickings sembrar la secuencia la primera vez.
+
+    Con `cursor` la reserva va en la transacción del llamador (sin tomar otra
+    conexión del pool): el lock de la fila se mantiene hasta su commit y un
+    rollback devuelve los números. Sin cursor usa una transacción corta propia.
+    """
+    if count < 1:
+        raise ValueError("La cantidad de números a reservar debe ser mayor a cero.")
+    if column not in _SEED_COLUMNS:
+        raise ValueError(f"Columna de secuencia no soportada: {column}")
+
+    if cursor is not None:
+        return _allocate_with_cursor(cursor, company_id, prefix, count, column)
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as own_cursor:
+            first = _allocate_with_cursor(own_cursor, company_id, prefix, count, column)
+        conn.commit()
+        return first
+    except Exception as e:
+        if conn: conn.rollback()
+        print(f"[DB-ERROR] allocate_document_numbers({company_id}, {prefix}): {e}")
+        raise e
+    finally:
+        if conn: return_db_connection(conn)
+
+
+def next_document_names(company_id, prefix, count=1, column='name', cursor=None):
+    """Lista de `count` nombres consecutivos ya formateados ({prefix}NNNNN)."""
+    first = allocate_document_numbers(company_id, prefix, count, column, cursor=cursor)
+    return [format_document_number(prefix, first + i) for i in range(count)]
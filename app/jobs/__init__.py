@@ -0,0 +1,28 @@
+# app/jobs/__init__.py
+"""
+Trabajos en segundo plano con cola en Postgres (ver runner.py).
+"""
+
+from .runner import (
+    JobCancelled,
+    JobContext,
+    job_handler,
+    submit_job,
+    submit_job_async,
+    request_job,
+    start_job_workers,
+    stop_job_workers,
+    cleanup_jobs,
+)
+
+__all__ = [
+    "JobCancelled",
+    "JobContext",
+    "job_handler",
+    "submit_job",
+    "submit_job_async",
+    "request_job",
+    "start_job_workers",
+    "stop_job_workers",
+    "cleanup_jobs",
+]
@@ -0,0 +1,38 @@
+# app/jobs/__main__.py
+"""
+Proceso dedicado de workers (alternativa a correrlos dentro de la API):
+
+    JOB_WORKERS=2 python -m app.jobs
+
+En la API poner JOB_WORKERS=0 para que solo encole. Ambos procesos deben
+compartir JOBS_DIR (archivos subidos y resultados).
+"""
+
+import signal
+import threading
+
+from app import database as db
+from app.jobs import runner
+# Importar la app registra los handlers de cada módulo de endpoints
+import app.main  # noqa: F401
+
+
+def main():
+    db.init_db_pool()
+    db.start_invalidation_listener()
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    runner.start_job_workers(max(runner.JOB_WORKERS, 1))
+    print("[JOBS] Proceso de workers listo. Ctrl+C / SIGTERM para detener.")
+    stop.wait()
+
+    print("[JOBS] Deteniendo workers...")
+    runner.stop_job_workers()
+    db.stop_invalidation_listener()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+# app/jobs/runner.py
+"""
+Ejecutor de trabajos en segundo plano (importaciones, exportaciones, recálculos).
+
+Las tareas largas no corren dentro del request HTTP (timeouts del proxy en
+Render, un hilo y una conexión ocupados minutos): el endpoint encola un
+trabajo en background_jobs y responde con su id; un pool de workers lo
+ejecuta y el cliente consulta /jobs/{id} hasta que termina.
+
+- Sin broker: la cola es la tabla; los workers toman trabajo con
+  FOR UPDATE SKIP LOCKED, así que pueden convivir varios procesos.
+- Los workers corren dentro de la app (JOB_WORKERS > 0) o como proceso
+  aparte: `python -m app.jobs` (con JOB_WORKERS=0 en la API).
+- Los archivos subidos y los resultados viven en JOBS_DIR (disco local,
+  compartido por la API y los workers) y se borran al vencer el trabajo
+  (JOB_RESULT_TTL_HOURS).
+- Heartbeat: un trabajo 'running' sin latido por JOB_STALE_SECONDS se marca
+  fallido (su worker murió); no se reintenta porque una importación a medias
+  no es idempotente.
+
+Registro de un tipo de trabajo (en el módulo del endpoint):
+    @job_handler("reports.kardex_export")
+    def _kardex_export_job(ctx):
+        ctx.progress(10, "Calculando...")       # lanza JobCancelled si se pidió cancelar
+        path = ctx.result_path("kardex.csv")
+        ...
+        return {"rows": n}                      # queda en background_jobs.result
+"""
+
+import asyncio
+import os
+import socket
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from pathlib import Path
+
+from app import database as db
+
+JOBS_DIR = Path(os.environ.get("JOBS_DIR", os.path.join(tempfile.gettempdir(), "wms_jobs")))
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "1"))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "2"))
+JOB_HEARTBEAT_SECONDS = 30
+JOB_STALE_SECONDS = int(os.environ.get("JOB_STALE_SECONDS", "300"))
+JOB_RESULT_TTL_HOURS = int(os.environ.get("JOB_RESULT_TTL_HOURS", "24"))
+JOB_MAINTENANCE_SECONDS = 600
+# Mínimo entre escrituras de avance a la BD (los handlers pueden llamar progress() en cada fila)
+PROGRESS_MIN_INTERVAL = 1.0
+
+_handlers = {}          # kind -> handler(ctx)
+_running = set()        # ids de trabajos en curso en este proceso
+_running_lock = threading.Lock()
+_wake = threading.Event()
+_stop = threading.Event()
+_threads = []
+_threads_lock = threading.Lock()
+
+
+class JobCancelled(Exception):
+    """El usuario pidió cancelar el trabajo."""
+
+
+def job_handler(kind):
+    """Registra la función que ejecuta los trabajos de tipo `kind`."""
+    def decorator(fn):
+        _handlers[kind] = fn
+        return fn
+    return decorator
+
+
+def _worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _inputs_dir():
+    path = JOBS_DIR / "inputs"
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _results_dir():
+    path = JOBS_DIR / "results"
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _remove_file(path):
+    if not path: return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"[JOBS] No se pudo borrar {path}: {e}")
+
+
+class JobContext:
+    """Lo que recibe un handler: parámetros, archivo de entrada, avance y resultado."""
+
+    def __init__(self, job):
+        self.job_id = job['id']
+        self.company_id = job['company_id']
+        self.kind = job['kind']
+        self.params = job['params'] or {}
+        self.user = job['created_by']
+        self.input_file = job['input_file']
+        self.result_file = None
+        self.result_filename = None
+        self._last_progress_at = 0.0
+
+    def progress(self, percent, message=None, force=False):
+        """
+        Reporta avance (0-100). Se escribe a la BD como máximo una vez por
+        PROGRESS_MIN_INTERVAL salvo force=True. Lanza JobCancelled si el
+        usuario canceló el trabajo.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_progress_at < PROGRESS_MIN_INTERVAL:
+            return
+        self._last_progress_at = now
+        if db.update_job_progress(self.job_id, max(0, min(int(percent), 99)), message):
+            raise JobCancelled()
+
+    def result_path(self, filename):
+        """Ruta donde el handler debe escribir su archivo de resultado (descargable en /jobs/{id}/result)."""
+        self.result_filename = filename
+        self.result_file = str(_results_dir() / f"{self.job_id}_{uuid.uuid4().hex[:8]}_{filename}")
+        return self.result_file
+
+
+def _error_message(error):
+    # HTTPException (detail), WMSBaseException (message) o cualquier otra
+    return str(getattr(error, 'detail', None) or getattr(error, 'message', None) or error) or error.__class__.__name__
+
+
+def _run_job(job):
+    ctx = JobContext(job)
+    handler = _handlers.get(ctx.kind)
+    with _running_lock:
+        _running.add(ctx.job_id)
+    started = time.monotonic()
+    print(f"[JOBS] Iniciando trabajo {ctx.job_id} ({ctx.kind}) de '{ctx.user}'.")
+    try:
+        if handler is None:
+            raise ValueError(f"Tipo de trabajo desconocido: {ctx.kind}")
+        result = handler(ctx)
+        db.finish_job(ctx.job_id, 'done', result=result,
+                      result_file=ctx.result_file, result_filename=ctx.result_filename,
+                      ttl_hours=JOB_RESULT_TTL_HOURS)
+        print(f"[JOBS] Trabajo {ctx.job_id} terminado en {time.monotonic() - started:.1f}s.")
+    except JobCancelled:
+        _remove_file(ctx.result_file)
+        db.finish_job(ctx.job_id, 'cancelled', error="Cancelado por el usuario.", ttl_hours=JOB_RESULT_TTL_HOURS)
+        print(f"[JOBS] Trabajo {ctx.job_id} cancelado.")
+    except Exception as e:
+        _remove_file(ctx.result_file)
+        if not getattr(e, 'detail', None) and not getattr(e, 'message', None):
+            traceback.print_exc()
+        db.finish_job(ctx.job_id, 'failed', error=_error_message(e), ttl_hours=JOB_RESULT_TTL_HOURS)
+        print(f"[JOBS] Trabajo {ctx.job_id} falló: {_error_message(e)}")
+    finally:
+        # El archivo subido ya no hace falta (ni para reintentar: no se reintenta)
+        _remove_file(ctx.input_file)
+        with _running_lock:
+            _running.discard(ctx.job_id)
+
+
+# --- ENCOLADO (desde los endpoints) ---
+
+def submit_job(company_id, kind, params, user, input_bytes=None, input_suffix=".csv"):
+    """Guarda el archivo de entrada (si hay) y encola el trabajo. Retorna su id."""
+    if kind not in _handlers:
+        raise ValueError(f"Tipo de trabajo desconocido: {kind}")
+
+    input_file = None
+    if input_bytes is not None:
+        input_file = str(_inputs_dir() / f"{uuid.uuid4().hex}{input_suffix}")
+        with open(input_file, "wb") as f:
+            f.write(input_bytes)
+    try:
+        job_id = db.create_job(company_id, kind, params, user, input_file)
+    except Exception:
+        _remove_file(input_file)
+        raise
+    _wake.set()  # Despierta a los workers locales sin esperar el polling
+    print(f"[JOBS] Trabajo {job_id} ({kind}) encolado por '{user}'.")
+    return job_id
+
+
+def request_job(company_id, kind, params=None, user=None):
+    """
+    Encola un trabajo interno (sin archivo de entrada) salvo que ya haya uno
+    del mismo tipo en cola para la compañía. Retorna su id o None si ya estaba.
+    """
+    if kind not in _handlers:
+        raise ValueError(f"Tipo de trabajo desconocido: {kind}")
+    job_id = db.enqueue_job_once(company_id, kind, user or db.SYSTEM_JOB_USER, params)
+    if job_id:
+        _wake.set()
+    return job_id
+
+
+async def submit_job_async(company_id, kind, params, user, input_bytes=None, input_suffix=".csv"):
+    """Versión para endpoints async: respuesta estándar del modo asíncrono."""
+    job_id = await asyncio.to_thread(submit_job, company_id, kind, params, user, input_bytes, input_suffix)
+    return {"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}
+
+
+# --- WORKERS ---
+
+class _JobWorker(threading.Thread):
+    def __init__(self, index):
+        super().__init__(name=f"job-worker-{index}", daemon=True)
+        self.worker_name = f"{_worker_name()}/{index}"
+
+    def run(self):
+        while not _stop.is_set():
+            try:
+                job = db.claim_next_job(self.worker_name, list(_handlers))
+            except Exception as e:
+                print(f"[JOBS] No se pudo tomar trabajo: {e}")
+                job = None
+            if job:
+                _run_job(job)
+                continue
+            _wake.wait(JOB_POLL_INTERVAL)
+            _wake.clear()
+
+
+class _JobMaintenance(threading.Thread):
+    """Heartbeat de los trabajos en curso + limpieza de colgados y vencidos."""
+
+    def __init__(self):
+        super().__init__(name="job-maintenance", daemon=True)
+
+    def run(self):
+        last_cleanup = 0.0
+        while not _stop.wait(JOB_HEARTBEAT_SECONDS):
+            try:
+                with _running_lock:
+                    running = list(_running)
+                db.touch_jobs_heartbeat(running)
+
+                if time.monotonic() - last_cleanup >= JOB_MAINTENANCE_SECONDS:
+                    last_cleanup = time.monotonic()
+                    cleanup_jobs()
+            except Exception as e:
+                print(f"[JOBS] Error en mantenimiento: {e}")
+
+
+def cleanup_jobs():
+    """Marca fallidos los trabajos colgados y borra los vencidos (filas + archivos)."""
+    for row in db.fail_stale_jobs(JOB_STALE_SECONDS):
+        print(f"[JOBS] Trabajo {row[0]} sin heartbeat: marcado como fallido.")
+        _remove_file(row[1])
+    expired = db.purge_expired_jobs()
+    for _job_id, input_file, result_file in expired:
+        _remove_file(input_file)
+        _remove_file(result_file)
+    if expired:
+        print(f"[JOBS] {len(expired)} trabajos vencidos eliminados.")
+
+
+def start_job_workers(count=None):
+    """Arranca `count` workers (JOB_WORKERS por defecto) y el hilo de mantenimiento. Idempotente."""
+    count = JOB_WORKERS if count is None else count
+    with _threads_lock:
+        if _threads or count <= 0:
+            return
+        _stop.clear()
+        _threads.append(_JobMaintenance())
+        _threads.extend(_JobWorker(i) for i in range(count))
+        for t in _threads:
+            t.start()
+    print(f"[JOBS] {count} worker(s) de trabajos iniciados ({', '.join(sorted(_handlers))}).")
+
+
+def stop_job_workers(timeout=5):
+    """
+    Detiene los workers. Un trabajo en curso no se interrumpe: si el proceso
+    termina antes, el mantenimiento de otro proceso lo marcará fallido.
+    """
+    with _threads_lock:
+        _stop.set()
+        _wake.set()
+        for t in _threads:
+            t.join(timeout=timeout)
+        _threads.clear()
@@ -8,6 +8,8 @@ from fastapi.responses import JSONResponse, HTMLResponse
 from fastapi.staticfiles import StaticFiles
 import traceback
 from app import database as db
+from app import security
+from app import jobs
 from app.exceptions import (
     WMSBaseException,
     ValidationError,
@@ -31,7 +33,9 @@ from app.api import (
     reports,
     configuration,
     projects,
-    employees
+    employees,
+    search,
+    jobs as jobs_api
 )
 
 @asynccontextmanager
@@ -42,6 +46,15 @@ async def lifespan(app: FastAPI):
         # 1. Inicializar el Pool (Siempre necesario)
         db.init_db_pool()
         print("--- Pool de conexiones a Base de Datos creado. ---")
+
+        # 1b. Pool asíncrono (consultas awaitables sin ocupar hilos)
+        await db.init_async_pool()
+
+        # 1c. Listener de invalidación de cachés entre workers (LISTEN/NOTIFY)
+        db.start_invalidation_listener()
+
+        # 1d. Workers de trabajos en segundo plano (JOB_WORKERS=0 si corren aparte: python -m app.jobs)
+        jobs.start_job_workers()
         
         # 2. Verificar si debemos inicializar la BD (Schema + Seed)
         should_init_db = os.getenv("INIT_DB", "False").lower() in ("true", "1", "yes")
@@ -71,6 +84,10 @@ async def lifespan(app: FastAPI):
             
     yield
     print("--- Servidor apagándose. ---")
+    jobs.stop_job_workers()
+    db.stop_invalidation_listener()
+    security.shutdown_password_pool()
+    await db.close_async_pool()
 
 
 # Crear la aplicación FastAPI con el lifespan
@@ -83,6 +100,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Total-Count"],  # Paginación por cursor
 )
 
 
@@ -128,6 +146,8 @@ app.include_router(configuration.router, prefix="/config", tags=["Configuration"
 app.include_router(reports.router, prefix="/reports", tags=["Reports"])
 app.include_router(projects.router, prefix="/projects", tags=["Projects"])
 app.include_router(employees.router, prefix="/employees", tags=["Employees"])
+app.include_router(search.router, prefix="/search", tags=["Search"])
+app.include_router(jobs_api.router, prefix="/jobs", tags=["Jobs"])
 
 # Montar archivos estáticos (CSS, JS, imágenes si los hubiera)
 STATIC_DIR = Path(__file__).parent.parent / "static"
@@ -1,7 +1,7 @@
 # app/schemas.py
 
 from pydantic import BaseModel
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Generic, TypeVar
 from datetime import datetime, date
 
 # --- Schemas para Productos ---
@@ -310,6 +310,24 @@ class WorkOrderSaveRequest(BaseModel):
     # Datos para el picking 'RET' (Retiro), puede ser None
     retiro_data: Optional[PickingSaveData] = None
 
+class WorkOrderBatchLiquidationItem(WorkOrderSaveRequest):
+    """Una OT dentro de POST /work-orders/liquidate-batch."""
+    wo_id: int
+
+class WorkOrderBatchLiquidationRequest(BaseModel):
+    items: List[WorkOrderBatchLiquidationItem]
+
+class WorkOrderBatchLiquidationResult(BaseModel):
+    wo_id: int
+    success: bool
+    message: str
+
+class WorkOrderBatchLiquidationResponse(BaseModel):
+    total: int
+    success_count: int
+    failed_count: int
+    results: List[WorkOrderBatchLiquidationResult]
+
 # --- Schemas para Ajustes de Inventario ---
 class AdjustmentListResponse(BaseModel):
     """Schema para la fila de la lista de Ajustes."""
@@ -752,4 +770,23 @@ class EmployeeResponse(EmployeeBase):
     created_at: datetime
 
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+# --- Schemas de Búsqueda Global ---
+
+class SearchResult(BaseModel):
+    entity_type: str  # picking | product | partner | project
+    entity_id: int
+    title: str
+    subtitle: Optional[str] = None
+    score: float
+
+# --- Schemas de Paginación ---
+
+T = TypeVar("T")
+
+class Page(BaseModel, Generic[T]):
+    """Respuesta de los listados con with_count=true: página + total en una llamada."""
+    items: List[T]
+    total: int
+    next_cursor: Optional[str] = None
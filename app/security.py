@@ -1,16 +1,37 @@
 # app/security.py
+import asyncio
+import hashlib
+import json
 import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from typing import Optional, List
-from passlib.context import CryptContext
-from jose import JWTError, jwt
+import jwt
 from pydantic import BaseModel
 from app import database as db
+from app.services.auth_service import AuthService
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 
-# --- Configuración de Hashing de Contraseña ---
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# --- Pool dedicado para hashing de contraseñas ---
+# BCrypt es CPU puro (~250ms): corre en su propio pool acotado, separado del pool
+# que usa asyncio.to_thread para la BD, para que una ráfaga de logins (inicio de
+# turno) no bloquee el event loop ni deje sin hilos a las consultas.
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Tareas en espera admitidas antes de responder 503 (el cliente reintenta)
+PASSWORD_HASH_MAX_QUEUE = int(os.environ.get("PASSWORD_HASH_MAX_QUEUE", "200"))
+
+_password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="pwd-hash")
+_password_stats_lock = threading.Lock()
+_password_stats = {
+    "running": 0, "queued": 0, "max_queued": 0,
+    "completed": 0, "rejected": 0,
+    "total_wait_ms": 0.0, "total_run_ms": 0.0,
+}
 
 # --- Configuración de Token JWT ---
 SECRET_KEY = os.environ.get("SECRET_KEY", "tu_super_secreto_por_defecto_cambia_esto")
@@ -19,6 +40,25 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 8 # 8 horas
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token")
 
+# --- Caché de tokens verificados ---
+# Un mismo token llega en cada request de la sesión: tras verificar la firma una
+# vez se guarda el TokenData ya construido hasta su 'exp'. La clave es el hash
+# del token (no se guarda el token en claro).
+TOKEN_CACHE_MAX_ENTRIES = int(os.environ.get("TOKEN_CACHE_MAX_ENTRIES", "4096"))
+_token_cache = OrderedDict()  # sha256(token) -> (exp_timestamp, TokenData)
+_token_cache_lock = threading.Lock()
+
+# --- Log de seguridad muestreado ---
+# Los accesos correctos se registran con probabilidad SECURITY_LOG_SAMPLE_RATE;
+# los bloqueos siempre. Formato: [SECURITY] {json}
+SECURITY_LOG_SAMPLE_RATE = float(os.environ.get("SECURITY_LOG_SAMPLE_RATE", "0.01"))
+
+
+def _security_log(event: str, sampled: bool = True, **fields):
+    if sampled and random.random() >= SECURITY_LOG_SAMPLE_RATE:
+        return
+    print(f"[SECURITY] {json.dumps({'event': event, **fields}, default=str)}")
+
 # --- MODELO DE DATOS DEL TOKEN (CORREGIDO) ---
 class TokenData(BaseModel):
     username: Optional[str] = None
@@ -31,17 +71,108 @@ class TokenData(BaseModel):
 # --- Funciones de Contraseña ---
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """Verifica una contraseña plana contra un hash."""
-    if db.check_password(hashed_password, plain_password):
-        return True
-    try:
-        return pwd_context.verify(plain_password, hashed_password)
-    except Exception:
-        return False
+    """Verifica una contraseña plana contra un hash (SHA-256 legacy o bcrypt)."""
+    return AuthService.verify_password(plain_password, hashed_password)
 
 def get_password_hash(password: str) -> str:
     """Crea un nuevo hash seguro (bcrypt)."""
-    return pwd_context.hash(password)
+    return AuthService.hash_password_bcrypt(password)
+
+
+async def run_password_task(fn, *args):
+    """
+    Ejecuta fn(*args) en el pool de hashing. Si la cola está llena lanza 503
+    en vez de acumular logins que igual expirarían del lado del cliente.
+    """
+    with _password_stats_lock:
+        waiting = _password_stats["queued"]
+        if waiting >= PASSWORD_HASH_MAX_QUEUE:
+            _password_stats["rejected"] += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Servidor ocupado procesando inicios de sesión. Intente nuevamente.",
+                headers={"Retry-After": "2"},
+            )
+        _password_stats["queued"] = waiting + 1
+        _password_stats["max_queued"] = max(_password_stats["max_queued"], waiting + 1)
+
+    submitted_at = time.monotonic()
+
+    def _run():
+        started_at = time.monotonic()
+        with _password_stats_lock:
+            _password_stats["queued"] -= 1
+            _password_stats["running"] += 1
+            _password_stats["total_wait_ms"] += (started_at - submitted_at) * 1000
+        try:
+            return fn(*args)
+        finally:
+            with _password_stats_lock:
+                _password_stats["running"] -= 1
+                _password_stats["completed"] += 1
+                _password_stats["total_run_ms"] += (time.monotonic() - started_at) * 1000
+
+    return await asyncio.get_running_loop().run_in_executor(_password_executor, _run)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await run_password_task(AuthService.verify_password, plain_password, hashed_password)
+
+
+async def hash_password_async(password: str) -> str:
+    return await run_password_task(AuthService.hash_password_bcrypt, password)
+
+
+def password_pool_stats() -> dict:
+    """Métricas del pool de hashing (cola, en curso, tiempos medios)."""
+    with _password_stats_lock:
+        stats = dict(_password_stats)
+    done = stats["completed"] or 1
+    stats["workers"] = PASSWORD_HASH_WORKERS
+    stats["max_queue"] = PASSWORD_HASH_MAX_QUEUE
+    stats["avg_wait_ms"] = round(stats.pop("total_wait_ms") / done, 1)
+    stats["avg_run_ms"] = round(stats.pop("total_run_ms") / done, 1)
+    return stats
+
+
+def shutdown_password_pool():
+    _password_executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def authenticate_user(username: str, plain_password: str):
+    """
+    Login sin bloquear el event loop: BD en asyncio.to_thread, bcrypt en el
+    pool de hashing. Si la contraseña es correcta y el hash es SHA-256 legacy
+    (o bcrypt con menos rondas), se re-hashea a bcrypt de forma transparente.
+
+    Returns:
+        (user_data, permissions_set) o (None, None) si falla.
+    """
+    user = await asyncio.to_thread(db.get_user_for_auth, username)
+    if not user:
+        print(f"[AUTH] Fallo: Usuario '{username}' no encontrado.")
+        return None, None
+
+    if not user['is_active']:
+        print(f"[AUTH] Fallo: Usuario '{username}' está inactivo.")
+        return None, None
+
+    stored_hash = user['hashed_password']
+    if not await verify_password_async(plain_password, stored_hash):
+        print(f"[AUTH] Fallo: Contraseña incorrecta para '{username}'.")
+        return None, None
+
+    if AuthService.needs_rehash(stored_hash):
+        try:
+            new_hash = await hash_password_async(plain_password)
+            await asyncio.to_thread(db.upgrade_password_hash, user['id'], stored_hash, new_hash)
+        except Exception as e:
+            # No bloquea el login: se reintenta en el siguiente
+            print(f"[AUTH] No se pudo migrar el hash de '{username}': {e}")
+
+    print(f"[AUTH] Éxito: Usuario '{username}' (Rol: {user['role_name']}) validado.")
+    permissions_set = await asyncio.to_thread(db.get_permissions_by_role_id, user['role_id'])
+    return dict(user), permissions_set
 
 # --- Funciones de Token JWT ---
 
@@ -56,15 +187,44 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def _cached_token_data(token_key: bytes) -> Optional[TokenData]:
+    now = time.time()
+    with _token_cache_lock:
+        cached = _token_cache.get(token_key)
+        if not cached:
+            return None
+        if cached[0] <= now:
+            del _token_cache[token_key]
+            return None
+        _token_cache.move_to_end(token_key)
+        return cached[1]
+
+
+def _store_token_data(token_key: bytes, exp, token_data: TokenData):
+    if not exp:
+        return  # Sin 'exp' no hay cota: no se cachea
+    with _token_cache_lock:
+        _token_cache[token_key] = (float(exp), token_data)
+        _token_cache.move_to_end(token_key)
+        while len(_token_cache) > TOKEN_CACHE_MAX_ENTRIES:
+            _token_cache.popitem(last=False)
+
+
 async def get_current_user_data(token: str = Depends(oauth2_scheme)) -> TokenData:
     """
     Valida el token y devuelve los datos del usuario (incluyendo rol y compañías).
+    Los tokens ya verificados se sirven desde caché hasta su expiración.
     """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="No se pudieron validar las credenciales",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    token_key = hashlib.sha256(token.encode('utf-8')).digest()
+    cached = _cached_token_data(token_key)
+    if cached is not None:
+        return cached
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         
@@ -86,9 +246,10 @@ async def get_current_user_data(token: str = Depends(oauth2_scheme)) -> TokenDat
             role_name=role_name,      # <--- Asignamos
             company_ids=company_ids   # <--- Asignamos
         )
-    except JWTError:
+    except jwt.PyJWTError:
         raise credentials_exception
-    
+
+    _store_token_data(token_key, payload.get("exp"), token_data)
     return token_data
 
 def verify_company_access(auth: TokenData, company_id: int):
@@ -96,27 +257,22 @@ def verify_company_access(auth: TokenData, company_id: int):
     Verifica estrictamente si el usuario tiene permiso para acceder a la compañía solicitada.
     Lanza HTTP 403 Forbidden si no tiene permiso.
     """
-    # [DEBUG] Log para diagnóstico de problemas multi-compañía
-    print(f"[SECURITY] verify_company_access: User='{auth.username}', Rol='{auth.role_name}', "
-          f"Requested Company={company_id}, Token Companies={auth.company_ids}")
-
     # 1. El Super Admin (Rol 'Administrador') tiene pase maestro.
     if auth.role_name == "Administrador":
-        print(f"[SECURITY] ADMIN PASS: Usuario '{auth.username}' es Administrador - acceso permitido")
+        _security_log("company_access.admin", user=auth.username, company_id=company_id)
         return
 
     # 2. Verificar si el ID de la empresa está en la lista permitida del token.
-    if not auth.company_ids:
-        print(f"[SECURITY WARNING] Usuario '{auth.username}' tiene lista de compañías VACÍA en el token!")
-
     if company_id not in auth.company_ids:
-        print(f"[SECURITY BLOCK] Usuario '{auth.username}' (Rol: {auth.role_name}) "
-              f"intentó acceder a Company ID {company_id}. "
-              f"Compañías permitidas en token: {auth.company_ids}")
+        _security_log(
+            "company_access.blocked", sampled=False,
+            user=auth.username, role=auth.role_name,
+            company_id=company_id, token_companies=auth.company_ids
+        )
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail=f"ACCESO DENEGADO: No tienes autorización para la compañía {company_id}. "
                    f"Compañías permitidas: {auth.company_ids}"
         )
 
-    print(f"[SECURITY OK] Usuario '{auth.username}' tiene acceso a Company ID {company_id}")
+    _security_log("company_access.ok", user=auth.username, company_id=company_id)
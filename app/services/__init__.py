@@ -16,6 +16,7 @@ from .adjustment_service import AdjustmentService
 from .auth_service import AuthService
 from .admin_service import AdminService
 from .config_service import ConfigService
+from .import_service import ImportService
 
 __all__ = [
     "ProductService",
@@ -30,4 +31,5 @@ __all__ = [
     "AuthService",
     "AdminService",
     "ConfigService",
+    "ImportService",
 ]
@@ -6,11 +6,14 @@ Centraliza el hashing de contraseñas, validación de credenciales y generación
 
 from typing import Optional, Dict, List, Any, Tuple, Set
 from datetime import datetime, timedelta, timezone
-from passlib.context import CryptContext
+import bcrypt
 import hashlib
+import hmac
 import jwt
 import os
 import re
+import threading
+import time
 
 from app.exceptions import (
     ValidationError,
@@ -43,17 +46,33 @@ class AuthService:
     # Longitud máxima de username
     MAX_USERNAME_LENGTH = 50
 
-    # Context para BCrypt (moderno y seguro)
-    _pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    # Coste BCrypt: cada +1 duplica el tiempo (~250ms con 12)
+    BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+
+    # BCrypt solo usa los primeros 72 bytes (bcrypt>=5 lanza error si se pasan más)
+    BCRYPT_MAX_BYTES = 72
+
+    # Caché de verificaciones exitosas (evita repetir BCrypt en re-logins seguidos)
+    VERIFY_CACHE_TTL = 300
+    VERIFY_CACHE_MAX_ENTRIES = 1024
+    _verify_cache: Dict[bytes, float] = {}
+    _verify_cache_lock = threading.Lock()
+    # Clave aleatoria por proceso: la caché no guarda nada reutilizable fuera de él
+    _verify_cache_key = os.urandom(32)
 
     # ==========================================================================
     # HASHING DE CONTRASEÑAS
     # ==========================================================================
 
+    @staticmethod
+    def _bcrypt_bytes(password: str) -> bytes:
+        return password.encode('utf-8')[:AuthService.BCRYPT_MAX_BYTES]
+
     @staticmethod
     def hash_password_bcrypt(password: str) -> str:
         """
         Genera un hash seguro de contraseña usando BCrypt.
+        Es CPU intensivo: desde endpoints async usar security.hash_password_async.
 
         Args:
             password: Contraseña en texto plano
@@ -61,7 +80,8 @@ class AuthService:
         Returns:
             str: Hash BCrypt de la contraseña
         """
-        return AuthService._pwd_context.hash(password)
+        salt = bcrypt.gensalt(rounds=AuthService.BCRYPT_ROUNDS)
+        return bcrypt.hashpw(AuthService._bcrypt_bytes(password), salt).decode('ascii')
 
     @staticmethod
     def hash_password_sha256(password: str) -> str:
@@ -80,11 +100,26 @@ class AuthService:
         """
         return hashlib.sha256(password.encode('utf-8')).hexdigest()
 
+    @staticmethod
+    def is_legacy_hash(hashed_password: str) -> bool:
+        """True si el hash es SHA-256 legacy (64 caracteres hex)."""
+        return (
+            bool(hashed_password)
+            and len(hashed_password) == 64
+            and all(c in '0123456789abcdef' for c in hashed_password)
+        )
+
+    @staticmethod
+    def _verify_cache_key_for(plain_password: str, hashed_password: str) -> bytes:
+        message = hashed_password.encode('utf-8') + b"\x00" + plain_password.encode('utf-8')
+        return hmac.new(AuthService._verify_cache_key, message, hashlib.sha256).digest()
+
     @staticmethod
     def verify_password(plain_password: str, hashed_password: str) -> bool:
         """
         Verifica una contraseña contra su hash.
-        Soporta tanto BCrypt (nuevo) como SHA-256 (legacy).
+        Soporta tanto BCrypt (nuevo) como SHA-256 (legacy), según el formato del hash.
+        Es CPU intensivo: desde endpoints async usar security.verify_password_async.
 
         Args:
             plain_password: Contraseña en texto plano
@@ -93,20 +128,42 @@ class AuthService:
         Returns:
             bool: True si la contraseña es correcta
         """
-        # Primero intentar SHA-256 (legacy)
-        if AuthService.hash_password_sha256(plain_password) == hashed_password:
-            return True
+        if not plain_password or not hashed_password:
+            return False
+
+        # SHA-256 (legacy): comparación en tiempo constante
+        if AuthService.is_legacy_hash(hashed_password):
+            return hmac.compare_digest(AuthService.hash_password_sha256(plain_password), hashed_password)
+
+        # BCrypt: primero la caché de verificaciones recientes
+        cache_key = AuthService._verify_cache_key_for(plain_password, hashed_password)
+        now = time.monotonic()
+        with AuthService._verify_cache_lock:
+            expires_at = AuthService._verify_cache.get(cache_key)
+            if expires_at and expires_at > now:
+                return True
 
-        # Luego intentar BCrypt (moderno)
         try:
-            return AuthService._pwd_context.verify(plain_password, hashed_password)
-        except Exception:
+            ok = bcrypt.checkpw(AuthService._bcrypt_bytes(plain_password), hashed_password.encode('ascii'))
+        except (ValueError, TypeError):
             return False
 
+        if ok:
+            with AuthService._verify_cache_lock:
+                if len(AuthService._verify_cache) >= AuthService.VERIFY_CACHE_MAX_ENTRIES:
+                    # Purga simple: expirados primero, si no alcanza se vacía
+                    for key in [k for k, exp in AuthService._verify_cache.items() if exp <= now]:
+                        del AuthService._verify_cache[key]
+                    if len(AuthService._verify_cache) >= AuthService.VERIFY_CACHE_MAX_ENTRIES:
+                        AuthService._verify_cache.clear()
+                AuthService._verify_cache[cache_key] = now + AuthService.VERIFY_CACHE_TTL
+        return ok
+
     @staticmethod
     def needs_rehash(hashed_password: str) -> bool:
         """
-        Verifica si una contraseña necesita ser re-hasheada (migración a BCrypt).
+        Verifica si una contraseña necesita ser re-hasheada:
+        hash SHA-256 legacy o BCrypt con menos rondas que BCRYPT_ROUNDS.
 
         Args:
             hashed_password: Hash almacenado
@@ -114,9 +171,12 @@ class AuthService:
         Returns:
             bool: True si debe migrarse a BCrypt
         """
-        # Los hashes SHA-256 tienen exactamente 64 caracteres hex
-        if len(hashed_password) == 64 and all(c in '0123456789abcdef' for c in hashed_password):
+        if AuthService.is_legacy_hash(hashed_password):
             return True
+        # Formato BCrypt: $2b$12$<salt+hash>
+        parts = (hashed_password or "").split('$')
+        if len(parts) >= 4 and parts[2].isdigit():
+            return int(parts[2]) < AuthService.BCRYPT_ROUNDS
         return False
 
     # ==========================================================================
@@ -308,7 +368,7 @@ class AuthService:
             return payload
         except jwt.ExpiredSignatureError:
             return None
-        except jwt.JWTError:
+        except jwt.PyJWTError:
             return None
 
     @staticmethod
@@ -0,0 +1,57 @@
+# app/services/import_service.py
+"""
+Service Layer compartido para importaciones CSV de datos maestros.
+Valida TODAS las filas antes de tocar la BD; el repositorio luego aplica las
+filas válidas en una sola transacción (bulk_upsert).
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.exceptions import ValidationError
+
+
+class ImportService:
+    """
+    Validación por lotes de filas CSV.
+    Cada servicio aporta su process_csv_row(row, row_num, *args).
+    """
+
+    # Las filas de datos empiezan en la línea 2 (la 1 es la cabecera)
+    FIRST_DATA_ROW = 2
+
+    @staticmethod
+    def process_csv_rows(
+        rows: List[Dict[str, str]],
+        process_row: Callable[..., Dict[str, Any]],
+        *args: Any,
+        row_label: Optional[Callable[[Dict[str, str]], str]] = None,
+        skip_row: Optional[Callable[[Dict[str, str]], bool]] = None
+    ) -> Tuple[List[Dict[str, Any]], List[str]]:
+        """
+        Aplica process_row a todas las filas acumulando los errores.
+
+        Args:
+            rows: Filas del CSV
+            process_row: Función del servicio (p.ej. ProductService.process_csv_row)
+            *args: Argumentos extra para process_row (mapas de referencia)
+            row_label: Texto de contexto para errores inesperados (p.ej. "SKU: X")
+            skip_row: Filas a ignorar (p.ej. vacías)
+
+        Returns:
+            (filas_normalizadas, errores). Si hay errores no debe importarse nada.
+        """
+        prepared, errors = [], []
+
+        for i, row in enumerate(rows):
+            row_num = i + ImportService.FIRST_DATA_ROW
+            if skip_row and skip_row(row):
+                continue
+            try:
+                prepared.append(process_row(row, row_num, *args))
+            except ValidationError as ve:
+                errors.append(ve.message)
+            except Exception as e:
+                label = f" ({row_label(row)})" if row_label else ""
+                errors.append(f"Fila {row_num}{label}: {e}")
+
+        return prepared, errors
@@ -4,7 +4,7 @@ Servicio de Reportes y Dashboard.
 Centraliza la lógica de negocio para cálculos de KPIs, antigüedad, cobertura y Kardex.
 """
 
-from typing import Dict, List, Any, Optional, Tuple
+from typing import Dict, List, Any, Optional, Tuple, Iterable, Iterator
 from decimal import Decimal, ROUND_HALF_UP, getcontext
 from datetime import datetime, date
 
@@ -14,6 +14,30 @@ from app.exceptions import ValidationError, NotFoundError, ErrorCodes
 getcontext().prec = 28
 
 
+class _ClosingChunks:
+    """
+    Bloques CSV de open_csv_stream. close() cierra también las filas de origen,
+    aunque la descarga no haya empezado (un generador sin iniciar no ejecuta
+    su finally al cerrarse).
+    """
+
+    def __init__(self, chunks: Iterator[str], rows: Iterator):
+        self._chunks = chunks
+        self._rows = rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        return next(self._chunks)
+
+    def close(self) -> None:
+        try:
+            self._chunks.close()
+        finally:
+            ReportService._close_rows(self._rows)
+
+
 class ReportService:
     """
     Servicio para lógica de negocio de reportes.
@@ -43,6 +67,9 @@ class ReportService:
     TWO_PLACES = Decimal('0.01')
     FOUR_PLACES = Decimal('0.0001')
 
+    # --- CONSTANTES DE EXPORTACIÓN (STREAMING) ---
+    CSV_ROWS_PER_CHUNK = 500  # Filas por bloque enviado al cliente
+
     # =========================================================================
     # VALIDACIONES
     # =========================================================================
@@ -173,20 +200,89 @@ class ReportService:
     # KARDEX - PROCESAMIENTO DE EXPORTACIÓN
     # =========================================================================
 
+    # --- Aritmética de punto fijo (enteros escalados) ---
+    # Cantidades y valores se llevan como enteros en millonésimas (FIXED_SCALE);
+    # los precios unitarios ya redondeados, en diezmilésimas (PRICE_SCALE).
+    # Para entradas con hasta 6 decimales (columnas REAL) el resultado es
+    # idéntico al cálculo con Decimal + ROUND_HALF_UP.
+    FIXED_DIGITS = 6
+    FIXED_SCALE = 10 ** FIXED_DIGITS
+    PRICE_SCALE = 10 ** 4
+    KARDEX_ZERO_THRESHOLD = 5 * 10 ** (FIXED_DIGITS - 3)  # 0.005
+
     @staticmethod
-    def process_kardex_export_data(
+    def _to_fixed(value: Any) -> int:
+        """Convierte float/int/Decimal/None a entero escalado (FIXED_SCALE)."""
+        if not value:
+            return 0
+        if isinstance(value, Decimal):
+            return int((value * ReportService.FIXED_SCALE).to_integral_value(rounding=ROUND_HALF_UP))
+        return int(round(value * ReportService.FIXED_SCALE))
+
+    @staticmethod
+    def _round_div(numerator: int, denominator: int) -> int:
+        """División entera con redondeo ROUND_HALF_UP (empates se alejan del cero)."""
+        q, r = divmod(abs(numerator), denominator)
+        if 2 * r >= denominator:
+            q += 1
+        return -q if numerator < 0 else q
+
+    @staticmethod
+    def _format_fixed(value: int, from_digits: int, places: int, negative: Optional[bool] = None) -> str:
+        """
+        Redondea (HALF_UP) un entero escalado a `places` decimales y lo
+        formatea igual que str(Decimal.quantize(...)), incluido el '-0.00'.
+        `negative` fuerza el signo cuando el valor ya redondeado es 0 pero
+        provenía de un negativo (p.ej. costo promedio de un saldo negativo).
+        """
+        q = ReportService._round_div(value, 10 ** (from_digits - places)) if from_digits > places else value
+        if negative is None:
+            negative = value < 0
+        sign = '-' if negative else ''
+        a = abs(q)
+        unit = 10 ** places
+        return f"{sign}{a // unit}.{a % unit:0{places}d}"
+
+    @staticmethod
+    def _format_date(value: Any, fmt: str) -> str:
+        if not value:
+            return ''
+        try:
+            return value.strftime(fmt)
+        except AttributeError:
+            return str(value)
+
+    @staticmethod
+    def _kardex_opening_row(group_id: int, state: Dict[str, Any], date_from_display: str) -> Dict[str, Any]:
+        fmt = ReportService._format_fixed
+        return {
+            'GroupID': group_id,
+            'SKU': state['sku'],
+            'Producto': state['name'],
+            'Categoría': state.get('category_name') or '',
+            'Fecha': date_from_display,
+            'Referencia': 'SALDO INICIAL',
+            'Saldo Cant': fmt(state['qty'], ReportService.FIXED_DIGITS, 2),
+            'Saldo Valorizado': fmt(state['val'], ReportService.FIXED_DIGITS, 2)
+        }
+
+    @staticmethod
+    def iter_kardex_export_rows(
         company_id: int,
         date_from_db: str,
         date_to_db: str,
         warehouse_id: Optional[str],
         product_filter: Optional[str],
         date_from_display: str
-    ) -> List[Dict[str, Any]]:
+    ) -> Iterator[Dict[str, Any]]:
         """
-        Procesa los datos del Kardex para exportación CSV.
+        Motor de Kardex en streaming para exportación CSV.
         Calcula saldos progresivos usando costo promedio ponderado.
 
-        Esta es la función "pesada" que antes estaba en el API.
+        Consume los movimientos producto por producto desde un cursor de
+        servidor (ordenados por SKU y fecha) y emite cada fila de salida
+        apenas se calcula: en memoria solo viven los saldos iniciales y el
+        estado del producto en curso.
 
         Args:
             company_id: ID de la empresa
@@ -196,173 +292,178 @@ class ReportService:
             product_filter: Filtro de producto (SKU o nombre)
             date_from_display: Fecha desde en formato DD/MM/YYYY para mostrar
 
-        Returns:
-            Lista de diccionarios con los datos procesados para CSV
-
-        Raises:
-            NotFoundError: Si no hay datos para exportar
+        Yields:
+            Diccionarios con las columnas de get_kardex_csv_headers()
         """
-        D = Decimal
-        TWO_PLACES = ReportService.TWO_PLACES
-        FOUR_PLACES = ReportService.FOUR_PLACES
+        to_fixed = ReportService._to_fixed
 
-        # 1. Obtener saldo inicial de TODOS los productos
+        # 1. Saldo inicial de TODOS los productos (solo qty/val por producto)
+        # final_balance de [date_from, date_from] = todo lo movido hasta date_from,
+        # partiendo del último cierre mensual en lugar de todo el historial.
         summary_initial = report_repo.get_kardex_summary(
-            company_id, '1900-01-01', date_from_db, product_filter, warehouse_id
+            company_id, date_from_db, date_from_db, product_filter, warehouse_id
         )
 
         product_states = {}
-        for item_row in summary_initial:
-            item = dict(item_row)
+        for item in summary_initial:
             product_states[item['product_id']] = {
-                'qty': D(str(item.get('final_balance', 0.0) or 0.0)),
-                'val': D(str(item.get('final_value', 0.0) or 0.0)),
+                'qty': to_fixed(item['final_balance']),
+                'val': to_fixed(item['final_value']),
                 'sku': item['sku'],
                 'name': item['product_name'],
-                'category_name': item.get('category_name')
+                'category_name': item['category_name']
             }
 
-        # 2. Obtener TODOS los movimientos en el rango
-        raw_moves = report_repo.get_full_product_kardex_data(
-            company_id, date_from_db, date_to_db, warehouse_id, product_filter
-        )
+        # 2. Movimientos del rango desde cursor de servidor
+        # (se cierra en el finally aunque el consumidor abandone este generador)
+        moves = iter(report_repo.get_full_product_kardex_data(
+            company_id, date_from_db, date_to_db, warehouse_id, product_filter, stream=True
+        ))
+        try:
+            yield from ReportService._iter_kardex_move_rows(moves, product_states, date_from_display)
+        finally:
+            ReportService._close_rows(moves)
 
-        final_data = []
-        group_id_counter = 0
-        current_product_id = None
-        state = {}
+    @staticmethod
+    def _iter_kardex_move_rows(
+        moves: Iterator[Dict[str, Any]],
+        product_states: Dict[int, Dict[str, Any]],
+        date_from_display: str
+    ) -> Iterator[Dict[str, Any]]:
+        """Saldos progresivos de iter_kardex_export_rows a partir de los movimientos."""
+        import itertools
+
+        to_fixed = ReportService._to_fixed
+        round_div = ReportService._round_div
+        fmt = ReportService._format_fixed
+        fmt_date = ReportService._format_date
+        DIGITS = ReportService.FIXED_DIGITS
+        S = ReportService.FIXED_SCALE
+        P = ReportService.PRICE_SCALE
+        S_TO_PRICE = S // P           # millonésimas -> diezmilésimas
+        VALUE_DIV = S * 100           # (cant * precio) -> centésimas
+        CENTS_TO_S = S // 100         # centésimas -> millonésimas
+        ZERO_THRESHOLD = ReportService.KARDEX_ZERO_THRESHOLD
+
+        first_move = next(moves, None)
 
         # Si no hay movimientos, exportar solo los saldos iniciales
-        if not raw_moves:
-            for group_id, (pid, state_data) in enumerate(product_states.items(), 1):
-                if state_data['qty'] != D('0') or state_data['val'] != D('0'):
-                    final_data.append({
-                        'GroupID': group_id,
-                        'SKU': state_data['sku'],
-                        'Producto': state_data['name'],
-                        'Categoría': state_data.get('category_name') or '',
-                        'Fecha': date_from_display,
-                        'Referencia': 'SALDO INICIAL',
-                        'Saldo Cant': state_data['qty'].quantize(TWO_PLACES, rounding=ROUND_HALF_UP),
-                        'Saldo Valorizado': state_data['val'].quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
-                    })
-            return final_data
-
-        # 3. Procesar movimientos y calcular saldos
-        for move_row in raw_moves:
-            move = dict(move_row)
-            p_id = move['product_id']
-
-            if p_id != current_product_id:
-                current_product_id = p_id
-                group_id_counter += 1
-                state = product_states.get(p_id, {
-                    'qty': D('0'),
-                    'val': D('0'),
-                    'sku': move['product_sku'],
-                    'name': move['product_name'],
-                    'category_name': move.get('category_name')
-                })
-
-                if state['qty'] != D('0') or state['val'] != D('0'):
-                    final_data.append({
-                        'GroupID': group_id_counter,
-                        'SKU': state['sku'],
-                        'Producto': state['name'],
-                        'Categoría': state.get('category_name') or '',
-                        'Fecha': date_from_display,
-                        'Referencia': 'SALDO INICIAL',
-                        'Saldo Cant': state['qty'].quantize(TWO_PLACES, rounding=ROUND_HALF_UP),
-                        'Saldo Valorizado': state['val'].quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
-                    })
-
-            current_qty = state['qty']
-            current_val = state['val']
-
-            quantity_in = D(str(move.get('quantity_in', 0.0) or 0.0))
-            quantity_out = D(str(move.get('quantity_out', 0.0) or 0.0))
-            cost_at_adjustment_raw = move.get('cost_at_adjustment')
-            cost_at_adjustment = D(str(cost_at_adjustment_raw)) if cost_at_adjustment_raw is not None else None
-
-            valor_entrada_calc = D('0')
-            valor_salida_calc = D('0')
-            precio_unit_salida = D('0')
-            precio_unit_entrada = D('0')
-            current_avg_cost = (current_val / current_qty) if current_qty > D('0') else D('0')
-
-            if quantity_out > D('0'):
-                if cost_at_adjustment is not None and cost_at_adjustment > D('0'):
-                    precio_unit_salida = cost_at_adjustment.quantize(FOUR_PLACES, rounding=ROUND_HALF_UP)
-                    valor_salida_calc = (quantity_out * precio_unit_salida).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
-                else:
-                    precio_unit_salida = current_avg_cost.quantize(FOUR_PLACES, rounding=ROUND_HALF_UP)
-                    valor_salida_calc = (quantity_out * precio_unit_salida).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
-                current_qty -= quantity_out
-                current_val -= valor_salida_calc
-
-            elif quantity_in > D('0'):
-                price_unit_in_raw = move.get('price_unit')
-                if price_unit_in_raw is not None and D(str(price_unit_in_raw)) > D('0'):
-                    precio_unit_entrada = D(str(price_unit_in_raw)).quantize(FOUR_PLACES, rounding=ROUND_HALF_UP)
-                    valor_entrada_calc = (quantity_in * precio_unit_entrada).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
-                else:
-                    precio_unit_entrada = current_avg_cost.quantize(FOUR_PLACES, rounding=ROUND_HALF_UP)
-                    valor_entrada_calc = (quantity_in * precio_unit_entrada).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
-                current_qty += quantity_in
-                current_val += valor_entrada_calc
-
-            # Limpiar cantidades pequeñas
-            if current_qty.compare(D('0.005')) < 0:
-                current_qty = D('0')
-                current_val = D('0')
-
-            state['qty'] = current_qty
-            state['val'] = current_val
-
-            # Formatear fecha
-            fecha_str = ''
-            if move.get('date'):
-                try:
-                    fecha_str = move['date'].strftime("%d/%m/%Y %H:%M")
-                except AttributeError:
-                    fecha_str = str(move['date'])
-
-            fecha_traslado_str = ''
-            if move.get('date_transfer'):
-                try:
-                    fecha_traslado_str = move['date_transfer'].strftime("%d/%m/%Y")
-                except AttributeError:
-                    fecha_traslado_str = str(move['date_transfer'])
-
-            final_data.append({
-                'GroupID': group_id_counter,
-                'SKU': move['product_sku'],
-                'Producto': move['product_name'],
-                'Categoría': move.get('category_name') or '',
-                'Fecha': fecha_str,
-                'Fecha Traslado': fecha_traslado_str,
-                'Referencia': move['operation_ref'],
-                'Tipo Operacion': move['custom_operation_type'],
-                'Almacen Origen': move.get('almacen_origen') or (move.get('partner_name') if move.get('type_code') == 'IN' else "-"),
-                'Ubicacion Origen': move.get('ubicacion_origen') or "-",
-                'Almacen Destino': move.get('almacen_destino') or (move.get('partner_name') if move.get('type_code') == 'OUT' else "-"),
-                'Ubicacion Destino': move.get('ubicacion_destino') or "-",
-                'Razón Ajuste': move.get('adjustment_reason') or '',
-                'Almacen Afectado': move.get('affected_warehouse') or '',
-                'Guia Remision / Acta': move.get('partner_ref') or '',
-                'Proveedor / Cliente / OT': move.get('partner_name') or '',
-                'Orden de Compra': move.get('purchase_order') or '',
-                'Entrada Cant': quantity_in.quantize(TWO_PLACES, rounding=ROUND_HALF_UP) if quantity_in > D('0') else '',
-                'Precio Unit. Entrada': precio_unit_entrada.quantize(FOUR_PLACES, rounding=ROUND_HALF_UP) if quantity_in > D('0') else '',
-                'Valor Entrada': valor_entrada_calc.quantize(TWO_PLACES, rounding=ROUND_HALF_UP) if valor_entrada_calc > D('0') else '',
-                'Salida Cant': quantity_out.quantize(TWO_PLACES, rounding=ROUND_HALF_UP) if quantity_out > D('0') else '',
-                'Precio Unit. Salida': precio_unit_salida.quantize(FOUR_PLACES, rounding=ROUND_HALF_UP) if quantity_out > D('0') else '',
-                'Valor Salida': valor_salida_calc.quantize(TWO_PLACES, rounding=ROUND_HALF_UP) if valor_salida_calc > D('0') else '',
-                'Saldo Cant': current_qty.quantize(TWO_PLACES, rounding=ROUND_HALF_UP),
-                'Saldo Valorizado': current_val.quantize(TWO_PLACES, rounding=ROUND_HALF_UP),
-            })
-
-        return final_data
+        if first_move is None:
+            for group_id, state in enumerate(product_states.values(), 1):
+                if state['qty'] != 0 or state['val'] != 0:
+                    yield ReportService._kardex_opening_row(group_id, state, date_from_display)
+            return
+
+        # 3. Procesar movimientos producto por producto
+        all_moves = itertools.chain([first_move], moves)
+        for group_id, (p_id, product_moves) in enumerate(
+            itertools.groupby(all_moves, key=lambda m: m['product_id']), 1
+        ):
+            state = None
+
+            for move in product_moves:
+                if state is None:
+                    opening = product_states.get(p_id)
+                    state = opening or {
+                        'qty': 0, 'val': 0,
+                        'sku': move['product_sku'],
+                        'name': move['product_name'],
+                        'category_name': move['category_name']
+                    }
+                    if state['qty'] != 0 or state['val'] != 0:
+                        yield ReportService._kardex_opening_row(group_id, state, date_from_display)
+
+                current_qty = state['qty']
+                current_val = state['val']
+
+                raw_in = move['quantity_in'] or 0
+                raw_out = move['quantity_out'] or 0
+                quantity_in = to_fixed(raw_in)
+                quantity_out = to_fixed(raw_out)
+
+                valor_entrada = 0   # centésimas
+                valor_salida = 0    # centésimas
+                precio_entrada = 0  # diezmilésimas
+                precio_salida = 0   # diezmilésimas
+                avg_cost = round_div(current_val * P, current_qty) if current_qty > 0 else 0
+                avg_negative = current_qty > 0 and current_val < 0
+                precio_negativo = False
+
+                if raw_out > 0:
+                    cost_at_adjustment = move['cost_at_adjustment']
+                    if cost_at_adjustment is not None and cost_at_adjustment > 0:
+                        precio_salida = round_div(to_fixed(cost_at_adjustment), S_TO_PRICE)
+                    else:
+                        precio_salida = avg_cost
+                        precio_negativo = avg_negative
+                    valor_salida = round_div(quantity_out * precio_salida, VALUE_DIV)
+                    current_qty -= quantity_out
+                    current_val -= valor_salida * CENTS_TO_S
+
+                elif raw_in > 0:
+                    price_unit_in = move['price_unit']
+                    if price_unit_in is not None and price_unit_in > 0:
+                        precio_entrada = round_div(to_fixed(price_unit_in), S_TO_PRICE)
+                    else:
+                        precio_entrada = avg_cost
+                        precio_negativo = avg_negative
+                    valor_entrada = round_div(quantity_in * precio_entrada, VALUE_DIV)
+                    current_qty += quantity_in
+                    current_val += valor_entrada * CENTS_TO_S
+
+                # Limpiar cantidades pequeñas
+                if current_qty < ZERO_THRESHOLD:
+                    current_qty = 0
+                    current_val = 0
+
+                state['qty'] = current_qty
+                state['val'] = current_val
+
+                type_code = move['type_code']
+                yield {
+                    'GroupID': group_id,
+                    'SKU': move['product_sku'],
+                    'Producto': move['product_name'],
+                    'Categoría': move['category_name'] or '',
+                    'Fecha': fmt_date(move['date'], "%d/%m/%Y %H:%M"),
+                    'Fecha Traslado': fmt_date(move['date_transfer'], "%d/%m/%Y"),
+                    'Referencia': move['operation_ref'],
+                    'Tipo Operacion': move['custom_operation_type'],
+                    'Almacen Origen': move['almacen_origen'] or (move['partner_name'] if type_code == 'IN' else "-"),
+                    'Ubicacion Origen': move['ubicacion_origen'] or "-",
+                    'Almacen Destino': move['almacen_destino'] or (move['partner_name'] if type_code == 'OUT' else "-"),
+                    'Ubicacion Destino': move['ubicacion_destino'] or "-",
+                    'Razón Ajuste': move['adjustment_reason'] or '',
+                    'Almacen Afectado': move['affected_warehouse'] or '',
+                    'Guia Remision / Acta': move['partner_ref'] or '',
+                    'Proveedor / Cliente / OT': move['partner_name'] or '',
+                    'Orden de Compra': move['purchase_order'] or '',
+                    'Entrada Cant': fmt(quantity_in, DIGITS, 2) if raw_in > 0 else '',
+                    'Precio Unit. Entrada': fmt(precio_entrada, 4, 4, precio_negativo) if raw_in > 0 else '',
+                    'Valor Entrada': fmt(valor_entrada, 2, 2) if valor_entrada > 0 else '',
+                    'Salida Cant': fmt(quantity_out, DIGITS, 2) if raw_out > 0 else '',
+                    'Precio Unit. Salida': fmt(precio_salida, 4, 4, precio_negativo) if raw_out > 0 else '',
+                    'Valor Salida': fmt(valor_salida, 2, 2) if valor_salida > 0 else '',
+                    'Saldo Cant': fmt(current_qty, DIGITS, 2),
+                    'Saldo Valorizado': fmt(current_val, DIGITS, 2),
+                }
+
+    @staticmethod
+    def process_kardex_export_data(
+        company_id: int,
+        date_from_db: str,
+        date_to_db: str,
+        warehouse_id: Optional[str],
+        product_filter: Optional[str],
+        date_from_display: str
+    ) -> List[Dict[str, Any]]:
+        """
+        Versión materializada de iter_kardex_export_rows (lista completa).
+        Para exportar usar el generador: no acumula filas en memoria.
+        """
+        return list(ReportService.iter_kardex_export_rows(
+            company_id, date_from_db, date_to_db, warehouse_id, product_filter, date_from_display
+        ))
 
     # =========================================================================
     # GENERACIÓN DE CSV
@@ -450,6 +551,95 @@ class ReportService:
 
         return output.getvalue()
 
+    @staticmethod
+    def iter_csv_chunks(
+        rows: Iterable,
+        fieldnames: List[str],
+        header_labels: Optional[List[str]] = None,
+        rows_per_chunk: Optional[int] = None
+    ) -> Iterator[str]:
+        """
+        Genera el CSV por bloques (streaming) a partir de un iterable de filas.
+        Nunca materializa el archivo completo: se reutiliza un único buffer
+        que se vacía cada `rows_per_chunk` filas.
+
+        Args:
+            rows: Iterable de dicts/DictRow (p.ej. un cursor de servidor)
+            fieldnames: Claves a extraer de cada fila (en orden)
+            header_labels: Etiquetas de cabecera (por defecto, las mismas claves)
+            rows_per_chunk: Filas por bloque (por defecto CSV_ROWS_PER_CHUNK)
+
+        Yields:
+            str: Fragmentos consecutivos del CSV (delimitador ';')
+        """
+        import csv
+        import io
+
+        rows_per_chunk = rows_per_chunk or ReportService.CSV_ROWS_PER_CHUNK
+        buffer = io.StringIO(newline='')
+        writer = csv.writer(buffer, delimiter=';')
+        writer.writerow(header_labels or fieldnames)
+
+        pending = 0
+        for row in rows:
+            writer.writerow([row.get(key, '') for key in fieldnames])
+            pending += 1
+            if pending >= rows_per_chunk:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+                pending = 0
+
+        tail = buffer.getvalue()
+        if tail:
+            yield tail
+
+    @staticmethod
+    def open_csv_stream(
+        rows: Iterable,
+        fieldnames: List[str],
+        header_labels: Optional[List[str]] = None,
+        empty_message: str = "No hay datos para exportar"
+    ) -> Iterator[str]:
+        """
+        Prepara una exportación en streaming.
+        Lee la primera fila ANTES de empezar a responder, para poder
+        devolver 404 si no hay datos (una vez enviados los headers HTTP
+        ya no se puede cambiar el status).
+
+        Llamar desde un hilo (asyncio.to_thread): la primera lectura
+        ejecuta la consulta.
+
+        Cerrar el generador devuelto (o agotarlo) cierra también `rows`,
+        y con él la conexión/cursor de servidor que haya detrás.
+
+        Raises:
+            NotFoundError: Si el iterable está vacío
+        """
+        import itertools
+
+        rows = iter(rows)
+        try:
+            first = next(rows, None)
+        except BaseException:
+            ReportService._close_rows(rows)
+            raise
+        if first is None:
+            ReportService._close_rows(rows)
+            raise NotFoundError(message=empty_message, code=ErrorCodes.EXPORT_NO_DATA)
+
+        return _ClosingChunks(
+            ReportService.iter_csv_chunks(itertools.chain([first], rows), fieldnames, header_labels),
+            rows
+        )
+
+    @staticmethod
+    def _close_rows(rows: Iterable) -> None:
+        """Cierra un generador de filas (libera su conexión) si lo es."""
+        close = getattr(rows, 'close', None)
+        if close:
+            close()
+
     # =========================================================================
     # DASHBOARD KPIs
     # =========================================================================
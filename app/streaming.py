@@ -0,0 +1,72 @@
+# app/streaming.py
+"""
+Respuestas CSV en streaming que liberan su origen de datos explícitamente.
+
+Las exportaciones generan el CSV con generadores síncronos que, al fondo,
+retienen una conexión del pool y un cursor de servidor (core.stream_query).
+StreamingResponse no cierra el iterador si el cliente se desconecta o el envío
+falla: quedaría a medio consumir hasta que lo recoja el GC. CsvStreamingResponse
+lo cierra siempre al terminar la respuesta (completa, con error o cancelada).
+"""
+
+import asyncio
+import threading
+
+from fastapi.responses import StreamingResponse
+
+
+class _ThreadedIterator:
+    """
+    Avanza un iterador síncrono en hilos (no bloquea el event loop).
+    close() espera al next() en curso: un generador no puede cerrarse
+    mientras otro hilo lo está ejecutando.
+    """
+
+    def __init__(self, iterator):
+        self._iterator = iterator
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _next(self):
+        with self._lock:
+            if self._closed:
+                return None
+            return next(self._iterator, None)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            close = getattr(self._iterator, "close", None)
+            if close:
+                try:
+                    close()
+                except Exception as e:
+                    print(f"[STREAM] Error al cerrar la exportación: {e}")
+
+    async def chunks(self):
+        while True:
+            chunk = await asyncio.to_thread(self._next)
+            if chunk is None:
+                return
+            yield chunk
+
+
+class CsvStreamingResponse(StreamingResponse):
+    """StreamingResponse de CSV (p.ej. ReportService.open_csv_stream) que cierra su origen al terminar."""
+
+    def __init__(self, chunks, filename):
+        self._source = _ThreadedIterator(chunks)
+        super().__init__(
+            self._source.chunks(),
+            media_type="text/csv",
+            headers={"Content-Disposition": f"attachment; filename={filename}"}
+        )
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # Sin await: si la tarea fue cancelada (desconexión) el cierre igual corre en su hilo
+            asyncio.get_running_loop().run_in_executor(None, self._source.close)
@@ -0,0 +1,303 @@
+# tests/test_kardex_fixed_point.py
+"""
+El motor de Kardex en punto fijo (ReportService.iter_kardex_export_rows) debe
+producir exactamente las mismas filas que la implementación anterior con
+Decimal + ROUND_HALF_UP. Se alimenta con movimientos fijos (sin BD) reemplazando
+las funciones del repositorio que consulta el generador.
+"""
+
+from datetime import datetime, date
+from decimal import Decimal, ROUND_HALF_UP
+
+import pytest
+
+from app.services import report_service
+from app.services.report_service import ReportService
+
+DATE_FROM_DISPLAY = "01/03/2025"
+
+
+def _legacy_kardex_rows(summary_initial, raw_moves, date_from_display):
+    """
+    Implementación de referencia: process_kardex_export_data antes del paso a
+    punto fijo (Decimal desde str(float), quantize ROUND_HALF_UP). Solo se
+    cambiaron las consultas al repositorio por los parámetros.
+    """
+    D = Decimal
+    TWO_PLACES = Decimal('0.01')
+    FOUR_PLACES = Decimal('0.0001')
+
+    product_states = {}
+    for item_row in summary_initial:
+        item = dict(item_row)
+        product_states[item['product_id']] = {
+            'qty': D(str(item.get('final_balance', 0.0) or 0.0)),
+            'val': D(str(item.get('final_value', 0.0) or 0.0)),
+            'sku': item['sku'],
+            'name': item['product_name'],
+            'category_name': item.get('category_name')
+        }
+
+    final_data = []
+    group_id_counter = 0
+    current_product_id = None
+    state = {}
+
+    if not raw_moves:
+        for group_id, (pid, state_data) in enumerate(product_states.items(), 1):
+            if state_data['qty'] != D('0') or state_data['val'] != D('0'):
+                final_data.append({
+                    'GroupID': group_id,
+                    'SKU': state_data['sku'],
+                    'Producto': state_data['name'],
+                    'Categoría': state_data.get('category_name') or '',
+                    'Fecha': date_from_display,
+                    'Referencia': 'SALDO INICIAL',
+                    'Saldo Cant': state_data['qty'].quantize(TWO_PLACES, rounding=ROUND_HALF_UP),
+                    'Saldo Valorizado': state_data['val'].quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
+                })
+        return final_data
+
+    for move_row in raw_moves:
+        move = dict(move_row)
+        p_id = move['product_id']
+
+        if p_id != current_product_id:
+            current_product_id = p_id
+            group_id_counter += 1
+            state = product_states.get(p_id, {
+                'qty': D('0'),
+                'val': D('0'),
+                'sku': move['product_sku'],
+                'name': move['product_name'],
+                'category_name': move.get('category_name')
+            })
+
+            if state['qty'] != D('0') or state['val'] != D('0'):
+                final_data.append({
+                    'GroupID': group_id_counter,
+                    'SKU': state['sku'],
+                    'Producto': state['name'],
+                    'Categoría': state.get('category_name') or '',
+                    'Fecha': date_from_display,
+                    'Referencia': 'SALDO INICIAL',
+                    'Saldo Cant': state['qty'].quantize(TWO_PLACES, rounding=ROUND_HALF_UP),
+                    'Saldo Valorizado': state['val'].quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
+                })
+
+        current_qty = state['qty']
+        current_val = state['val']
+
+        quantity_in = D(str(move.get('quantity_in', 0.0) or 0.0))
+        quantity_out = D(str(move.get('quantity_out', 0.0) or 0.0))
+        cost_at_adjustment_raw = move.get('cost_at_adjustment')
+        cost_at_adjustment = D(str(cost_at_adjustment_raw)) if cost_at_adjustment_raw is not None else None
+
+        valor_entrada_calc = D('0')
+        valor_salida_calc = D('0')
+        precio_unit_salida = D('0')
+        precio_unit_entrada = D('0')
+        current_avg_cost = (current_val / current_qty) if current_qty > D('0') else D('0')
+
+        if quantity_out > D('0'):
+            if cost_at_adjustment is not None and cost_at_adjustment > D('0'):
+                precio_unit_salida = cost_at_adjustment.quantize(FOUR_PLACES, rounding=ROUND_HALF_UP)
+                valor_salida_calc = (quantity_out * precio_unit_salida).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
+            else:
+                precio_unit_salida = current_avg_cost.quantize(FOUR_PLACES, rounding=ROUND_HALF_UP)
+                valor_salida_calc = (quantity_out * precio_unit_salida).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
+            current_qty -= quantity_out
+            current_val -= valor_salida_calc
+
+        elif quantity_in > D('0'):
+            price_unit_in_raw = move.get('price_unit')
+            if price_unit_in_raw is not None and D(str(price_unit_in_raw)) > D('0'):
+                precio_unit_entrada = D(str(price_unit_in_raw)).quantize(FOUR_PLACES, rounding=ROUND_HALF_UP)
+                valor_entrada_calc = (quantity_in * precio_unit_entrada).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
+            else:
+                precio_unit_entrada = current_avg_cost.quantize(FOUR_PLACES, rounding=ROUND_HALF_UP)
+                valor_entrada_calc = (quantity_in * precio_unit_entrada).quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
+            current_qty += quantity_in
+            current_val += valor_entrada_calc
+
+        if current_qty.compare(D('0.005')) < 0:
+            current_qty = D('0')
+            current_val = D('0')
+
+        state['qty'] = current_qty
+        state['val'] = current_val
+
+        fecha_str = ''
+        if move.get('date'):
+            try:
+                fecha_str = move['date'].strftime("%d/%m/%Y %H:%M")
+            except AttributeError:
+                fecha_str = str(move['date'])
+
+        fecha_traslado_str = ''
+        if move.get('date_transfer'):
+            try:
+                fecha_traslado_str = move['date_transfer'].strftime("%d/%m/%Y")
+            except AttributeError:
+                fecha_traslado_str = str(move['date_transfer'])
+
+        final_data.append({
+            'GroupID': group_id_counter,
+            'SKU': move['product_sku'],
+            'Producto': move['product_name'],
+            'Categoría': move.get('category_name') or '',
+            'Fecha': fecha_str,
+            'Fecha Traslado': fecha_traslado_str,
+            'Referencia': move['operation_ref'],
+            'Tipo Operacion': move['custom_operation_type'],
+            'Almacen Origen': move.get('almacen_origen') or (move.get('partner_name') if move.get('type_code') == 'IN' else "-"),
+            'Ubicacion Origen': move.get('ubicacion_origen') or "-",
+            'Almacen Destino': move.get('almacen_destino') or (move.get('partner_name') if move.get('type_code') == 'OUT' else "-"),
+            'Ubicacion Destino': move.get('ubicacion_destino') or "-",
+            'Razón Ajuste': move.get('adjustment_reason') or '',
+            'Almacen Afectado': move.get('affected_warehouse') or '',
+            'Guia Remision / Acta': move.get('partner_ref') or '',
+            'Proveedor / Cliente / OT': move.get('partner_name') or '',
+            'Orden de Compra': move.get('purchase_order') or '',
+            'Entrada Cant': quantity_in.quantize(TWO_PLACES, rounding=ROUND_HALF_UP) if quantity_in > D('0') else '',
+            'Precio Unit. Entrada': precio_unit_entrada.quantize(FOUR_PLACES, rounding=ROUND_HALF_UP) if quantity_in > D('0') else '',
+            'Valor Entrada': valor_entrada_calc.quantize(TWO_PLACES, rounding=ROUND_HALF_UP) if valor_entrada_calc > D('0') else '',
+            'Salida Cant': quantity_out.quantize(TWO_PLACES, rounding=ROUND_HALF_UP) if quantity_out > D('0') else '',
+            'Precio Unit. Salida': precio_unit_salida.quantize(FOUR_PLACES, rounding=ROUND_HALF_UP) if quantity_out > D('0') else '',
+            'Valor Salida': valor_salida_calc.quantize(TWO_PLACES, rounding=ROUND_HALF_UP) if valor_salida_calc > D('0') else '',
+            'Saldo Cant': current_qty.quantize(TWO_PLACES, rounding=ROUND_HALF_UP),
+            'Saldo Valorizado': current_val.quantize(TWO_PLACES, rounding=ROUND_HALF_UP),
+        })
+
+    return final_data
+
+
+# --- DATOS FIJOS ---
+
+def _summary(product_id, sku, balance, value):
+    return {
+        'product_id': product_id, 'sku': sku, 'product_name': f"Producto {sku}",
+        'category_name': 'Materiales', 'final_balance': balance, 'final_value': value,
+    }
+
+
+def _move(product_id, sku, ref, quantity_in=0.0, quantity_out=0.0, price_unit=None,
+          cost_at_adjustment=None, type_code='IN', day=1):
+    return {
+        'product_id': product_id, 'product_sku': sku, 'product_name': f"Producto {sku}",
+        'category_name': 'Materiales' if product_id % 2 else None,
+        'date': datetime(2025, 3, day, 10, 30), 'date_transfer': date(2025, 3, day),
+        'operation_ref': ref, 'custom_operation_type': 'Operación de prueba', 'type_code': type_code,
+        'almacen_origen': None, 'ubicacion_origen': 'ALM/Stock' if type_code == 'OUT' else None,
+        'almacen_destino': None, 'ubicacion_destino': 'ALM/Stock' if type_code == 'IN' else None,
+        'adjustment_reason': None, 'affected_warehouse': 'ALM', 'partner_ref': None,
+        'partner_name': 'Proveedor SAC', 'purchase_order': None,
+        'quantity_in': quantity_in, 'quantity_out': quantity_out,
+        'price_unit': price_unit, 'cost_at_adjustment': cost_at_adjustment,
+    }
+
+
+SUMMARY = [
+    _summary(1, 'A-001', 10.5, 31.575),     # saldo inicial con valor que redondea en .5
+    _summary(3, 'C-003', 1000.0, -0.01),    # costo promedio negativo diminuto -> '-0.0000'
+    _summary(4, 'D-004', 0.0, 0.0),         # sin saldo: no genera fila de saldo inicial
+    _summary(6, 'F-006', 2.0, 5.0),         # solo saldo inicial, sin movimientos
+]
+
+MOVES = [
+    # A: fraccionarios, precios que redondean en .5, quiebre a cero y saldo negativo
+    _move(1, 'A-001', 'C1/IN/00001', quantity_in=2.125, price_unit=1.00005, day=2),
+    _move(1, 'A-001', 'C1/OUT/00001', quantity_out=3.333, type_code='OUT', day=3),
+    _move(1, 'A-001', 'C1/OUT/00002', quantity_out=9.292, type_code='OUT', day=4),
+    _move(1, 'A-001', 'C1/IN/00002', quantity_in=0.5, price_unit=0.0, day=5),
+    _move(1, 'A-001', 'C1/OUT/00003', quantity_out=1.0, type_code='OUT', day=6),
+    _move(1, 'A-001', 'C1/IN/00003', quantity_in=2.0, price_unit=2.345, day=7),
+    _move(1, 'A-001', 'C1/ADJ/00001', quantity_out=0.75, cost_at_adjustment=1.23455, type_code='ADJ', day=8),
+    _move(1, 'A-001', 'C1/IN/00004', quantity_in=0.333333, price_unit=3.33335, day=9),
+    # B: sin saldo inicial, valores de medio centavo y salidas bajo cero
+    _move(2, 'B-002', 'C1/IN/00005', quantity_in=0.5, price_unit=0.01, day=2),
+    _move(2, 'B-002', 'C1/IN/00006', quantity_in=1.5, price_unit=0.00005, day=3),
+    _move(2, 'B-002', 'C1/OUT/00004', quantity_out=4.25, type_code='OUT', day=4),
+    _move(2, 'B-002', 'C1/OUT/00005', quantity_out=0.125, cost_at_adjustment=0.0, type_code='OUT', day=5),
+    _move(2, 'B-002', 'C1/IN/00007', quantity_in=10.0, price_unit=None, day=6),
+    _move(2, 'B-002', 'C1/IN/00008', quantity_in=0.004, price_unit=12.5, day=7),
+    # C: promedio negativo en entradas y salidas sin precio
+    _move(3, 'C-003', 'C1/IN/00009', quantity_in=1.0, price_unit=None, day=2),
+    _move(3, 'C-003', 'C1/OUT/00006', quantity_out=1000.995, type_code='OUT', day=3),
+    _move(3, 'C-003', 'C1/OUT/00007', quantity_out=0.003, type_code='OUT', day=4),
+    # D: saldo en cero, entrada y salida exacta (vuelve a cero)
+    _move(4, 'D-004', 'C1/IN/00010', quantity_in=7.77, price_unit=0.125, day=2),
+    _move(4, 'D-004', 'C1/OUT/00008', quantity_out=7.77, type_code='OUT', day=3),
+    _move(4, 'D-004', 'C1/OUT/00009', quantity_out=0.001, type_code='OUT', day=4),
+    # E: un solo movimiento de un producto sin resumen
+    _move(5, 'E-005', 'C1/ADJ/00002', quantity_in=1.235, price_unit=0.995, type_code='ADJ', day=2),
+]
+
+
+def _normalize(rows):
+    """Los Decimal se escribían al CSV con str(): se comparan como texto."""
+    return [{k: str(v) if isinstance(v, Decimal) else v for k, v in row.items()} for row in rows]
+
+
+def _patch_repo(monkeypatch, summary, moves):
+    monkeypatch.setattr(report_service.report_repo, "get_kardex_summary", lambda *args, **kwargs: summary)
+    monkeypatch.setattr(report_service.report_repo, "get_full_product_kardex_data", lambda *args, **kwargs: iter(moves))
+
+
+def _fixed_point_rows():
+    return list(ReportService.iter_kardex_export_rows(
+        1, '2025-03-01', '2025-03-31', 'all', None, DATE_FROM_DISPLAY
+    ))
+
+
+def test_kardex_matches_decimal_implementation(monkeypatch):
+    _patch_repo(monkeypatch, SUMMARY, MOVES)
+
+    expected = _normalize(_legacy_kardex_rows(SUMMARY, MOVES, DATE_FROM_DISPLAY))
+    actual = _fixed_point_rows()
+
+    assert len(actual) == len(expected)
+    for i, (got, want) in enumerate(zip(actual, expected)):
+        assert got == want, f"Fila {i} ({want.get('Referencia')}) difiere"
+
+
+def test_kardex_only_opening_balances(monkeypatch):
+    _patch_repo(monkeypatch, SUMMARY, [])
+
+    expected = _normalize(_legacy_kardex_rows(SUMMARY, [], DATE_FROM_DISPLAY))
+    assert _fixed_point_rows() == expected
+
+
+@pytest.mark.parametrize("quantity, price", [
+    (0.5, 0.01), (0.1, 0.05), (2.5, 1.00005), (0.333333, 0.00015),
+    (123456.789, 0.12345), (1e-06, 99999.99995), (3.0, 1.99995),
+])
+def test_kardex_rounding_half_up(monkeypatch, quantity, price):
+    moves = [
+        _move(7, 'G-007', 'C1/IN/00011', quantity_in=quantity, price_unit=price, day=2),
+        _move(7, 'G-007', 'C1/OUT/00010', quantity_out=round(quantity / 3, 6), type_code='OUT', day=3),
+    ]
+    _patch_repo(monkeypatch, [], moves)
+
+    assert _fixed_point_rows() == _normalize(_legacy_kardex_rows([], moves, DATE_FROM_DISPLAY))
+
+
+def test_kardex_closes_cursor_when_abandoned(monkeypatch):
+    """Cerrar la exportación a medias debe cerrar el generador del cursor de servidor."""
+    closed = []
+
+    def stream_moves(*args, **kwargs):
+        try:
+            yield from MOVES
+        finally:
+            closed.append(True)
+
+    monkeypatch.setattr(report_service.report_repo, "get_kardex_summary", lambda *args, **kwargs: SUMMARY)
+    monkeypatch.setattr(report_service.report_repo, "get_full_product_kardex_data", stream_moves)
+
+    # Se conserva la referencia al generador: el cierre no debe depender del GC
+    kardex_rows = ReportService.iter_kardex_export_rows(1, '2025-03-01', '2025-03-31', 'all', None, DATE_FROM_DISPLAY)
+    chunks = ReportService.open_csv_stream(kardex_rows, ReportService.get_kardex_csv_headers())
+    assert closed == []
+    chunks.close()
+    assert closed == [True]
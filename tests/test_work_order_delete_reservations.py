@@ -0,0 +1,126 @@
+# tests/test_work_order_delete_reservations.py
+"""
+Borrar una OT con un picking 'listo' debe devolver stock_reservations a su
+valor previo. stock_reservation_pickings es ON DELETE CASCADE: si el picking se
+borra sin liberar antes su aporte, el agregado queda con reservas fantasma.
+Se simula la BD en memoria (sin PostgreSQL) reemplazando la conexión y las
+funciones de reserva del repositorio de operaciones.
+"""
+
+from collections import defaultdict
+
+from app.database.repositories import work_order_repo
+
+WO_ID = 7
+COMPANY_ID = 1
+KEY = (10, 3)  # (product_id, location_id)
+
+
+class _FakeDb:
+    """Tablas mínimas: pickings de la OT, aportes por picking y el agregado."""
+
+    def __init__(self, pickings):
+        self.pickings = dict(pickings)  # id -> state
+        self.contrib = {}  # picking_id -> {key: qty}
+        self.reservations = defaultdict(float)  # key -> reserved_qty
+        self.committed = False
+
+    def reserve(self, picking_id, qty):
+        self.contrib[picking_id] = {KEY: qty}
+        self.reservations[KEY] += qty
+
+    def release(self, picking_id):
+        for key, qty in self.contrib.pop(picking_id, {}).items():
+            self.reservations[key] -= qty
+            if abs(self.reservations[key]) < 0.000001:
+                del self.reservations[key]
+
+
+class _FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self._result = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        sql = " ".join(sql.split())
+        self._result = []
+        if sql.startswith("SELECT id, phase, ot_number FROM work_orders"):
+            self._result = [{"id": WO_ID, "phase": "Por Liquidar", "ot_number": "OT-7"}]
+        elif sql.startswith("SELECT count(*) as total FROM pickings"):
+            done = sum(1 for s in self.db.pickings.values() if s == 'done')
+            self._result = [{"total": done}]
+        elif sql.startswith("SELECT id, company_id FROM pickings") and "'listo'" in sql:
+            self._result = [
+                {"id": pid, "company_id": COMPANY_ID}
+                for pid, s in sorted(self.db.pickings.items()) if s == 'listo'
+            ]
+        elif sql.startswith("DELETE FROM pickings"):
+            # ON DELETE CASCADE: desaparecen los aportes, el agregado no se toca
+            for pid in list(self.db.pickings):
+                self.db.contrib.pop(pid, None)
+            self.db.pickings.clear()
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+    def fetchall(self):
+        return list(self._result)
+
+
+class _FakeConn:
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self, cursor_factory=None):
+        return _FakeCursor(self.db)
+
+    def commit(self):
+        self.db.committed = True
+
+    def rollback(self):
+        pass
+
+
+def _patch_db(monkeypatch, db):
+    stale = []
+    monkeypatch.setattr(work_order_repo, "get_db_connection", lambda: _FakeConn(db))
+    monkeypatch.setattr(work_order_repo, "return_db_connection", lambda conn: None)
+    monkeypatch.setattr(work_order_repo.operation_repo, "release_picking_stock",
+                        lambda cursor, picking_id: db.release(picking_id))
+    monkeypatch.setattr(work_order_repo.report_repo, "mark_dashboard_snapshot_stale",
+                        lambda cursor, company_id: stale.append(company_id))
+    return stale
+
+
+def test_delete_work_order_releases_ready_picking_reservations(monkeypatch):
+    db = _FakeDb({100: 'listo', 101: 'draft'})
+    db.reservations[KEY] = 4.0  # reservas previas de otros documentos
+    before = dict(db.reservations)
+    db.reserve(100, 6.0)
+    stale = _patch_db(monkeypatch, db)
+
+    ok, msg = work_order_repo.delete_work_order(WO_ID)
+
+    assert ok, msg
+    assert db.committed
+    assert dict(db.reservations) == before
+    assert stale == [COMPANY_ID]
+
+
+def test_delete_work_order_with_only_drafts_leaves_reservations(monkeypatch):
+    db = _FakeDb({101: 'draft'})
+    db.reservations[KEY] = 4.0
+    before = dict(db.reservations)
+    stale = _patch_db(monkeypatch, db)
+
+    ok, msg = work_order_repo.delete_work_order(WO_ID)
+
+    assert ok, msg
+    assert dict(db.reservations) == before
+    assert stale == []